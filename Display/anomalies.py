@@ -0,0 +1,269 @@
+###########################################################################################
+# File: anomalies.py                                                                      #
+# Purpose: Flags component_statistic samples that are far from normal for their device,   #
+#          like a thermal runaway or a usage spike. Each device's temperature and usage   #
+#          have an exponentially weighted moving average (EWMA) mean and variance, and a  #
+#          sample more than the threshold number of standard deviations away is written   #
+#          to the anomaly table. The state is a few numbers per device, and the rows are  #
+#          read on from where the last run stopped, so history is never read twice.       #
+#                                                                                         #
+# Usage: python Display/anomalies.py [--database metrics.db] [--z temperature=3,usage=4]  #
+#                                                                                         #
+# v1.1.0 Initial version.                                                                 #
+###########################################################################################
+
+import argparse
+import os
+import sys
+import time
+import shards
+
+# The component_statistic columns that are watched.
+DETECTED_COLUMNS = ("temperature", "usage")
+
+# How many standard deviations from the mean a sample has to be to be flagged, per column.
+# MTG_ANOMALY_Z overrides them, either one number for every column or 'temperature=3,usage=4'.
+DEFAULT_THRESHOLDS = {"temperature": 3.0, "usage": 4.0}
+THRESHOLD_ENV = "MTG_ANOMALY_Z"
+
+# How much weight each new sample gets. 0.05 is roughly the last 40 samples, 20 minutes at 30 seconds.
+DEFAULT_ALPHA = 0.05
+
+# Nothing is flagged until a device has this many samples, so the mean and variance have settled.
+WARMUP_SAMPLES = 30
+
+# The smallest standard deviation a z-score is worked out with. A sensor that sits on exactly
+# the same value would otherwise flag the first change of a tenth of a degree.
+MIN_STD = 1.0
+
+# How many rows of a device are read and processed per transaction.
+BATCH_ROWS = 50000
+
+# Don't look for new rows more often than this. The collector only writes every 30 seconds anyway.
+DETECT_INTERVAL = 30
+
+# When each database was last checked, keyed on the database path.
+_LAST_DETECT = {}
+
+# The statements for the schema migration that adds the tables (see db_interface.MIGRATIONS).
+# The timestamps are the same type as component_statistic's, text in v1 and milliseconds in v2.
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS anomaly (
+           serial_number TEXT,
+           metric TEXT,
+           timestamp DATETIME,
+           value FLOAT NOT NULL,
+           mean FLOAT NOT NULL,
+           std FLOAT NOT NULL,
+           z FLOAT NOT NULL,
+           PRIMARY KEY (serial_number, metric, timestamp)
+       )""",
+    # Each device's EWMA for each column, and the timestamp of the last sample it has seen.
+    """CREATE TABLE IF NOT EXISTS anomaly_state (
+           serial_number TEXT,
+           metric TEXT,
+           mean FLOAT,
+           variance FLOAT NOT NULL,
+           samples INTEGER NOT NULL,
+           last_timestamp DATETIME NOT NULL,
+           PRIMARY KEY (serial_number, metric)
+       )""",
+]
+
+
+class Ewma:
+    """The exponentially weighted mean and variance of one column of one device."""
+
+    __slots__ = ("mean", "variance", "samples")
+
+    def __init__(self, mean=None, variance=0.0, samples=0):
+        self.mean = mean
+        self.variance = variance
+        self.samples = samples
+
+    def update(self, value, alpha, threshold):
+        """Adds a sample. Returns (mean, std, z) from before it was added if it's an anomaly, otherwise None."""
+        if self.mean is None:
+            self.mean = value
+            self.samples = 1
+            return None
+
+        # The sample is judged against what came before it, then folded in.
+        diff = value - self.mean
+        flagged = None
+        if self.samples >= WARMUP_SAMPLES:
+            std = max(self.variance ** 0.5, MIN_STD)
+            z = diff / std
+            if abs(z) > threshold:
+                flagged = (self.mean, std, z)
+
+        increment = alpha * diff
+        self.mean += increment
+        self.variance = (1 - alpha) * (self.variance + diff * increment)
+        self.samples += 1
+        return flagged
+
+
+def parse_thresholds(text):
+    """Turns '3' or 'temperature=3,usage=4' into thresholds for each column. Raises ValueError."""
+    thresholds = dict(DEFAULT_THRESHOLDS)
+    if not text or not text.strip():
+        return thresholds
+    if "=" not in text:
+        return {column: float(text) for column in DETECTED_COLUMNS}
+
+    for part in text.split(","):
+        column, _, value = part.partition("=")
+        column = column.strip()
+        if column not in DETECTED_COLUMNS:
+            raise ValueError(f"Unknown anomaly column: {column}")
+        thresholds[column] = float(value)
+    return thresholds
+
+
+def configured_thresholds():
+    """The thresholds asked for with THRESHOLD_ENV, or the defaults if it isn't set (or can't be read)."""
+    try:
+        return parse_thresholds(os.environ.get(THRESHOLD_ENV, ""))
+    except ValueError:
+        return dict(DEFAULT_THRESHOLDS)
+
+
+def has_anomalies(conn):
+    """Checks the database has been migrated to a version with the anomaly tables."""
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                        ("anomaly_state",)).fetchone() is not None
+
+
+def load_state(conn, serial_number):
+    """A device's EWMA for each column and the timestamp of the last sample it saw (None for a new device)."""
+    states = {column: Ewma() for column in DETECTED_COLUMNS}
+    last = None
+    for metric, mean, variance, samples, last_timestamp in conn.execute(
+            """SELECT metric, mean, variance, samples, last_timestamp
+               FROM anomaly_state
+               WHERE serial_number = ?""", (serial_number,)):
+        if metric in states:
+            states[metric] = Ewma(mean, variance, samples)
+            last = last_timestamp
+    return states, last
+
+
+def oldest_checkpoint(conn):
+    """The earliest timestamp a device was last checked up to. None if a device has never been checked."""
+    unchecked = conn.execute("""SELECT 1 FROM component c
+                                WHERE NOT EXISTS (SELECT 1 FROM anomaly_state s
+                                                  WHERE s.serial_number = c.serial_number)""").fetchone()
+    if unchecked:
+        return None
+    return conn.execute("SELECT MIN(last_timestamp) FROM anomaly_state").fetchone()[0]
+
+
+def read_batch(conn, shard_list, serial_number, after, batch_rows):
+    """The next batch_rows (timestamp, columns...) rows of a device after a timestamp, oldest first."""
+    query = f"""SELECT timestamp, {", ".join(DETECTED_COLUMNS)}
+                FROM {{db}}.component_statistic
+                WHERE serial_number = ?"""
+    params = [serial_number]
+    if after is not None:
+        query += " AND timestamp > ?"
+        params.append(after)
+    query += " ORDER BY timestamp LIMIT ?"
+    return shards.fetch(conn, shard_list, query, params + [batch_rows],
+                        merge="SELECT * FROM ({arms}) ORDER BY 1 LIMIT ?", merge_params=[batch_rows])
+
+
+def detect(conn, shard_list=(), thresholds=None, alpha=DEFAULT_ALPHA, batch_rows=BATCH_ROWS):
+    """Runs every device's rows since the last run through its EWMA and writes the anomalies.
+
+    shard_list is the shards holding rows newer than oldest_checkpoint(). Returns how many rows
+    were read and how many anomalies were found.
+    """
+    thresholds = thresholds or configured_thresholds()
+    rows_read = found = 0
+
+    serial_numbers = [row[0] for row in conn.execute("SELECT serial_number FROM component ORDER BY rowid")]
+    for serial_number in serial_numbers:
+        states, last = load_state(conn, serial_number)
+        while True:
+            rows = read_batch(conn, shard_list, serial_number, last, batch_rows)
+            if not rows:
+                break
+
+            flags = []
+            for row in rows:
+                for index, column in enumerate(DETECTED_COLUMNS, start=1):
+                    value = row[index]
+                    # Emojis, text and the like aren't numbers, so they can't be anomalies either.
+                    if type(value) is not float and type(value) is not int:
+                        continue
+                    flagged = states[column].update(value, alpha, thresholds[column])
+                    if flagged:
+                        flags.append((serial_number, column, row[0], value) + flagged)
+            last = rows[-1][0]
+
+            # The anomalies and the state they came from are written together. Running the same rows
+            # twice (two servers at once) writes the same thing twice, which changes nothing.
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.executemany("INSERT OR REPLACE INTO anomaly VALUES (?, ?, ?, ?, ?, ?, ?)", flags)
+                conn.executemany("INSERT OR REPLACE INTO anomaly_state VALUES (?, ?, ?, ?, ?, ?)",
+                                 [(serial_number, column, state.mean, state.variance, state.samples, last)
+                                  for column, state in states.items() if state.mean is not None])
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+            rows_read += len(rows)
+            found += len(flags)
+            if len(rows) < batch_rows:
+                break
+
+    return rows_read, found
+
+
+def drop_before(conn, oldest):
+    """Old rows get pruned, so the anomalies from before the oldest sample are dropped, like the rollups."""
+    if oldest is None:
+        return 0
+    with conn:
+        return conn.execute("DELETE FROM anomaly WHERE timestamp < ?", (oldest,)).rowcount
+
+
+def due(db):
+    """True if the database hasn't been checked in the last DETECT_INTERVAL seconds. Marks it as checked."""
+    now = time.monotonic()
+    if now - _LAST_DETECT.get(db, -DETECT_INTERVAL) < DETECT_INTERVAL:
+        return False
+    _LAST_DETECT[db] = now
+    return True
+
+
+def main():
+    """Checks every row added since the last run (all of them the first time), and prints the rate."""
+    # Imported here, db_interface imports this module.
+    import db_interface
+
+    parser = argparse.ArgumentParser(description="Flag unusual temperature and usage samples")
+    parser.add_argument("--database", help="Path to the metrics database")
+    parser.add_argument("--z", help="Thresholds: one number, or 'temperature=3,usage=4'")
+    parser.add_argument("--alpha", type=float, default=DEFAULT_ALPHA, help="Weight of each new sample")
+    args = parser.parse_args()
+    db_interface.set_path_config(database=args.database)
+
+    try:
+        thresholds = parse_thresholds(args.z or os.environ.get(THRESHOLD_ENV, ""))
+    except ValueError as error:
+        parser.error(str(error))
+
+    started = time.perf_counter()
+    rows, found = db_interface.detect_anomalies(thresholds=thresholds, alpha=args.alpha)
+    seconds = time.perf_counter() - started
+    print(f"{rows:,} rows checked in {seconds:.2f}s ({rows / seconds if seconds else 0:,.0f} rows/s), "
+          f"{found:,} anomalies")
+    db_interface.close_pools()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
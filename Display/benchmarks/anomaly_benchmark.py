@@ -0,0 +1,80 @@
+###########################################################################################
+# File: anomaly_benchmark.py                                                              #
+# Purpose: Throughput of the EWMA anomaly detector (anomalies.py) on a synthetic          #
+#          database: the first run over the whole history, then the rows arriving a       #
+#          flush at a time, against the target rate.                                      #
+#                                                                                         #
+# Usage: python Display/benchmarks/anomaly_benchmark.py [rows] [flush_rows]               #
+#                                                                                         #
+# v1.1.0 Initial version.                                                                 #
+###########################################################################################
+
+import datetime
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+# db_interface lives one directory up.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import db_interface
+import synthetic_data
+
+# The detector has to keep up with this many new component_statistic rows a second.
+TARGET_ROWS_PER_SECOND = 5000
+
+# How many flushes are appended and checked one at a time.
+FLUSHES = 20
+
+
+def main(rows, flush_rows):
+    """Builds the synthetic database, holds back the newest rows, and times the detector on both parts."""
+    tmp_dir = tempfile.mkdtemp()
+    db = os.path.join(tmp_dir, "metrics.db")
+    print(f"Creating {rows + flush_rows * FLUSHES:,} row database...")
+    synthetic_data.generate_database(db, rows + flush_rows * FLUSHES, processes=0,
+                                     start=datetime.datetime(2025, 1, 1))
+
+    # The newest rows are taken out and put back a flush at a time, like the collector writing them.
+    conn = sqlite3.connect(db)
+    held = conn.execute("SELECT * FROM component_statistic ORDER BY timestamp DESC LIMIT ?",
+                        (flush_rows * FLUSHES,)).fetchall()[::-1]
+    conn.execute("DELETE FROM component_statistic WHERE rowid IN "
+                 "(SELECT rowid FROM component_statistic ORDER BY timestamp DESC LIMIT ?)", (flush_rows * FLUSHES,))
+    conn.commit()
+    db_interface.set_path_config(database=db)
+
+    started = time.perf_counter()
+    checked, found = db_interface.detect_anomalies()
+    history = time.perf_counter() - started
+
+    times = []
+    for i in range(FLUSHES):
+        conn.executemany("INSERT INTO component_statistic VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         held[i * flush_rows:(i + 1) * flush_rows])
+        conn.commit()
+        started = time.perf_counter()
+        new_rows, new_found = db_interface.detect_anomalies()
+        times.append(time.perf_counter() - started)
+        checked += new_rows
+        found += new_found
+    conn.close()
+
+    flush_rate = flush_rows * FLUSHES / sum(times)
+    print(f"{'run':<24}{'rows':>12}{'seconds':>10}{'rows/s':>14}")
+    print(f"{'whole history':<24}{rows:>12,}{history:>10.2f}{rows / history:>14,.0f}")
+    print(f"{f'{FLUSHES} flushes':<24}{flush_rows * FLUSHES:>12,}{sum(times):>10.2f}{flush_rate:>14,.0f}")
+    print(f"Slowest flush: {max(times) * 1000:.1f} ms for {flush_rows:,} rows. {found:,} anomalies in "
+          f"{checked:,} rows.")
+    print(f"Target {TARGET_ROWS_PER_SECOND:,} rows/s: "
+          f"{'OK' if min(rows / history, flush_rate) >= TARGET_ROWS_PER_SECOND else 'TOO SLOW'}")
+
+    db_interface.close_pools()
+    shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000, int(sys.argv[2]) if len(sys.argv) > 2 else 1000)
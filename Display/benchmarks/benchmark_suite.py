@@ -0,0 +1,266 @@
+###########################################################################################
+# File: benchmark_suite.py                                                                #
+# Purpose: Times the database reads, the backup, pruning and each web route on synthetic  #
+#          databases of several sizes, and writes the results as json. Two result files   #
+#          (say from two commits) can then be compared to spot anything that got slower.  #
+#                                                                                         #
+# Usage: python Display/benchmarks/benchmark_suite.py [--scales 100000,1000000]           #
+#                                                     [--output results.json]             #
+#                                                     [--baseline old_results.json]       #
+#        python Display/benchmarks/benchmark_suite.py --compare old.json new.json         #
+#                                                                                         #
+# v1.1.0 Initial version.                                                                 #
+###########################################################################################
+
+import argparse
+import datetime
+import glob
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# db_interface lives one directory up.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import db_interface
+import response_cache
+import rollups
+import synthetic_data
+from metrics_web_server import app
+
+# Every run generates the same data, so databases kept with --data-dir can be reused between commits.
+START = datetime.datetime(2025, 1, 1)
+SEED = 0
+
+# The default sizes, in component_statistic rows.
+DEFAULT_SCALES = [100000, 1000000]
+
+# A benchmark is reported as a regression when its median is this many times the baseline's.
+DEFAULT_THRESHOLD = 1.2
+
+# The result file format. Bumped if the layout changes, so old files aren't compared wrongly.
+RESULTS_VERSION = 1
+
+
+def git_commit():
+    """The commit being benchmarked and whether the tree has uncommitted changes. (None, None) without git."""
+    root = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=root, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=root,
+                               capture_output=True, text=True, check=True).stdout.strip() != ""
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def get_database(data_dir, rows, processes):
+    """Generates the database for a scale, or reuses the one already in data_dir."""
+    db = os.path.join(data_dir, f"synthetic-{rows}-{processes}-{SEED}.db")
+    if not os.path.exists(db):
+        print(f"Generating {rows:,} rows...", file=sys.stderr)
+        synthetic_data.generate_database(db, rows, processes, start=START, seed=SEED)
+    return db
+
+
+def time_it(function, repeats, setup=None):
+    """Runs function repeats times and returns the times in seconds. setup() runs first each time, untimed."""
+    times = []
+    for _ in range(repeats):
+        if setup:
+            setup()
+        started = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - started)
+    return times
+
+
+def route(method, path, **kwargs):
+    """A benchmark of one request to the app. The response cache is emptied first, so the view really runs."""
+    client = app.test_client()
+
+    def request():
+        response = client.open(path, method=method, **kwargs)
+        if response.status_code != 200:
+            raise RuntimeError(f"{method} {path} returned {response.status_code}")
+        response.get_data()
+
+    return request, response_cache.cache.clear
+
+
+def remove_backups(db):
+    """Deletes the backups create_backup() made, so the next one isn't skipped as too recent."""
+    for backup in glob.glob(db + ".*"):
+        os.remove(backup)
+
+
+def run_scale(db, rows, repeats, only=None):
+    """Runs every benchmark against one database. Returns a list of result dictionaries."""
+    db_interface.set_path_config(database=db)
+    conn = sqlite3.connect(db)
+    first, last = conn.execute("SELECT MIN(timestamp), MAX(timestamp) FROM component_statistic").fetchone()
+    cpu = conn.execute("SELECT serial_number FROM component WHERE device_type = 'CPU'").fetchone()[0]
+    conn.close()
+    last_day = (db_interface.parse_timestamp(last) - datetime.timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S")
+
+    # The first read after generating rolls up every row. That's timed once, on its own.
+    started = time.perf_counter()
+    with db_interface.connect(0) as pooled:
+        rollups.refresh_rollups(pooled)
+    results = [{"benchmark": "refresh_rollups (initial)", "times": [time.perf_counter() - started]}]
+    rollups._LAST_REFRESH[db] = time.monotonic()
+
+    def prune_setup():
+        """Pruning deletes rows, so each run prunes a fresh copy."""
+        db_interface.close_pools()
+        shutil.copyfile(db, prune_copy)
+        db_interface.set_path_config(database=prune_copy)
+
+    def prune():
+        # Everything older than the last tenth of the data.
+        span = db_interface.parse_timestamp(last) - db_interface.parse_timestamp(first)
+        db_interface.prune_database(span * 0.9, now=db_interface.parse_timestamp(last))
+
+    def backup():
+        thread = db_interface.create_backup(0)
+        if thread is not None:
+            thread.join()
+
+    prune_copy = db + "-prune"
+    benchmarks = [
+        ("read_metrics", db_interface.read_metrics, None),
+        ("read_metrics (last day)", lambda: db_interface.read_metrics(0, last_day, last), None),
+        ("read_processes", db_interface.read_processes, None),
+        ("count_processes", db_interface.count_processes, db_interface._PROCESS_COUNTS.clear),
+        ("read_process_page (cpu desc)", lambda: db_interface.read_process_page(0, 0, 100, 2, "desc"), None),
+        ("create_backup", backup, lambda: remove_backups(db)),
+        ("prune_database (10%)", prune, prune_setup),
+        ("GET /", *route("GET", "/")),
+        ("POST /gather", *route("POST", "/gather")),
+        ("POST /user_report", *route("POST", "/user_report")),
+        ("GET /api/metrics", *route("GET", "/api/metrics", query_string={"serial_number": cpu})),
+        ("GET /api/metrics (last day)", *route("GET", "/api/metrics", query_string={
+            "serial_number": cpu, "start": last_day, "end": last})),
+        ("POST /proc_table", *route("POST", "/proc_table")),
+        ("GET /api/processes", *route("GET", "/api/processes", query_string={"length": 100})),
+        ("GET /api/processes (cpu desc)", *route("GET", "/api/processes", query_string={
+            "length": 100, "order[0][column]": 2, "order[0][dir]": "desc"})),
+        ("GET /api/processes (search)", *route("GET", "/api/processes", query_string={
+            "length": 100, "search[value]": last[:13]})),
+    ]
+
+    for name, function, setup in benchmarks:
+        if only and not any(part in name for part in only):
+            continue
+        print(f"  {name}", file=sys.stderr)
+        try:
+            results.append({"benchmark": name, "times": time_it(function, repeats, setup)})
+        finally:
+            # Put the real database back after the prune benchmark.
+            if setup is prune_setup:
+                db_interface.close_pools()
+                db_interface.set_path_config(database=db)
+
+    remove_backups(db)
+    if os.path.exists(prune_copy):
+        os.remove(prune_copy)
+    db_interface.close_pools()
+    db_interface.set_path_config()
+
+    for result in results:
+        times = result.pop("times")
+        result.update(scale=rows, repeats=len(times), min=min(times), median=statistics.median(times),
+                      max=max(times))
+    return results
+
+
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD, out=sys.stdout):
+    """Prints each benchmark's median against the baseline's. Returns the regressions."""
+    old = {(result["scale"], result["benchmark"]): result for result in baseline["results"]}
+    regressions = []
+
+    print(f"baseline: {baseline.get('commit')}  current: {current.get('commit')}", file=out)
+    print(f"{'scale':>12}  {'benchmark':<32}{'old ms':>10}{'new ms':>10}{'ratio':>8}", file=out)
+    for result in current["results"]:
+        before = old.get((result["scale"], result["benchmark"]))
+        if before is None:
+            continue
+        ratio = result["median"] / before["median"] if before["median"] else float("inf")
+        flag = ""
+        if ratio > threshold:
+            flag = "  slower"
+            regressions.append(result)
+        elif ratio < 1 / threshold:
+            flag = "  faster"
+        print(f"{result['scale']:>12,}  {result['benchmark']:<32}{before['median'] * 1000:>10.1f}"
+              f"{result['median'] * 1000:>10.1f}{ratio:>8.2f}{flag}", file=out)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the database and the web routes")
+    parser.add_argument("--scales", default=",".join(map(str, DEFAULT_SCALES)),
+                        help="comma separated component_statistic row counts")
+    parser.add_argument("--processes", type=int, default=20, help="process rows per sample")
+    parser.add_argument("--repeats", type=int, default=3, help="times to run each benchmark")
+    parser.add_argument("--only", action="append", help="only run benchmarks whose name contains this")
+    parser.add_argument("--data-dir", help="keep the generated databases here, to reuse next time")
+    parser.add_argument("--output", help="write the results here as json (default: stdout)")
+    parser.add_argument("--baseline", help="a results file to compare this run against")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="median ratio past which a benchmark counts as a regression")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two results files and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as old, open(args.compare[1]) as new:
+            sys.exit(1 if compare(json.load(old), json.load(new), args.threshold) else 0)
+
+    data_dir = args.data_dir or tempfile.mkdtemp()
+    os.makedirs(data_dir, exist_ok=True)
+    commit, dirty = git_commit()
+    output = {
+        "version": RESULTS_VERSION,
+        "commit":  commit,
+        "dirty":   dirty,
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python":  platform.python_version(),
+        "sqlite":  sqlite3.sqlite_version,
+        "machine": platform.platform(),
+        "results": [],
+    }
+
+    try:
+        for rows in [int(scale) for scale in args.scales.split(",")]:
+            db = get_database(data_dir, rows, args.processes)
+            print(f"Benchmarking {rows:,} rows", file=sys.stderr)
+            output["results"] += run_scale(db, rows, args.repeats, args.only)
+    finally:
+        response_cache.close_watchers()
+        if not args.data_dir:
+            shutil.rmtree(data_dir)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(output, file, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        print()
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            # The comparison goes to stderr when the results are on stdout, so they can still be piped.
+            out = sys.stdout if args.output else sys.stderr
+            sys.exit(1 if compare(json.load(file), output, args.threshold, out) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+###########################################################################################
+# File: collector_benchmark.py                                                            #
+# Purpose: The cpu overhead of the python collector at a 1 second interval with hundreds  #
+#          of processes running, for each process reader, against the 1% target.          #
+#                                                                                         #
+# Usage: python Display/benchmarks/collector_benchmark.py [processes] [seconds] [interval] #
+#                                                                                         #
+# v1.1.0 Initial version.                                                                 #
+###########################################################################################
+
+import datetime
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import psutil
+
+# db_interface lives one directory up.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import db_interface
+import psutil_collector
+
+# The most of one cpu the collector is allowed to use.
+TARGET_PERCENT = 1.0
+
+
+def start_idle_processes(count):
+    """Starts processes that just sleep, so there are count processes to sample in total."""
+    needed = max(count - len(psutil.pids()), 0)
+    if os.name == "nt":
+        command = [sys.executable, "-c", "import time; time.sleep(3600)"]
+    else:
+        # Much lighter than a python per process.
+        command = ["sleep", "3600"]
+    return [subprocess.Popen(command) for _ in range(needed)]
+
+
+def run(reader, seconds, interval):
+    """Runs a collector with the reader for the given number of seconds. Returns its stats."""
+    collector = psutil_collector.Collector(datetime.timedelta(days=365), interval, reader=reader)
+    thread = threading.Thread(target=collector.run)
+    thread.start()
+    time.sleep(seconds)
+    collector.stop()
+    thread.join()
+    return collector.stats()
+
+
+def main(processes, seconds, interval):
+    """Compares the process readers and checks the overhead is under the target."""
+    tmp_dir = tempfile.mkdtemp()
+    db_interface.set_path_config(database=os.path.join(tmp_dir, "metrics.db"))
+    idle = start_idle_processes(processes)
+
+    readers = [("psutil", psutil_collector.PsutilProcessReader())]
+    if psutil_collector.ProcStatReader.available():
+        readers.append(("/proc/<pid>/stat", psutil_collector.ProcStatReader()))
+
+    try:
+        print(f"{len(psutil.pids())} processes, {interval}s interval, {seconds}s per reader")
+        print(f"{'reader':<18}{'samples':>8}{'rows':>9}{'sample ms':>11}{'flush ms':>10}{'cpu %':>8}")
+        for name, reader in readers:
+            stats = run(reader, seconds, interval)
+            verdict = "ok" if stats["cpu_percent"] < TARGET_PERCENT else f"over {TARGET_PERCENT}%"
+            print(f"{name:<18}{stats['samples']:>8}{stats['rows']:>9,}{stats['sample_ms']:>11.2f}"
+                  f"{stats['flush_ms']:>10.2f}{stats['cpu_percent']:>8.2f}  {verdict}")
+    finally:
+        for proc in idle:
+            proc.kill()
+            proc.wait()
+        db_interface.close_pools()
+        db_interface.set_path_config()
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 400,
+         float(sys.argv[2]) if len(sys.argv) > 2 else 30,
+         float(sys.argv[3]) if len(sys.argv) > 3 else 1)
@@ -0,0 +1,85 @@
+###########################################################################################
+# File: columnar_benchmark.py                                                             #
+# Purpose: Memory and throughput of read_metrics() against read_metrics_columnar() on a   #
+#          synthetic database.                                                            #
+#                                                                                         #
+# Usage: python Display/benchmarks/columnar_benchmark.py [rows]                           #
+#                                                                                         #
+# v1.1.0 Initial version.                                                                 #
+# v1.2.0 Builds its database with synthetic_data.                                         #
+###########################################################################################
+
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# db_interface lives one directory up.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import db_interface
+import columnar
+import synthetic_data
+
+# The CPU in synthetic_data's default device mix.
+CPU_KEY = "BFEBFBFF000806F8 (CPU)"
+
+
+def measure(label, function):
+    """Runs the function twice: once for the time taken, once for the peak and retained memory."""
+    # tracemalloc slows python down a lot, so the timing run is done without it.
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    result = function()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return label, result, elapsed, peak, retained
+
+
+def main(rows):
+    """Builds the synthetic database and compares the two read paths."""
+    columnar.require_numpy()
+
+    tmp_dir = tempfile.mkdtemp()
+    db = os.path.join(tmp_dir, "metrics.db")
+    print(f"Creating {rows:,} row database...")
+    synthetic_data.generate_database(db, rows, processes=0, start=datetime.datetime(2025, 1, 1))
+    db_interface.set_path_config(database=db)
+
+    # Warm the pool and the page cache, so both read paths start from the same place.
+    db_interface.read_devices(0)
+
+    results = [
+        measure("read_metrics", lambda: db_interface.read_metrics(0)),
+        measure("read_metrics_columnar", lambda: db_interface.read_metrics_columnar(0)),
+    ]
+
+    # The vectorized work the columnar format is for: a one day window and its aggregates.
+    series = results[1][1][CPU_KEY]
+    day_start, day_end = columnar.to_epoch_ms("2025-01-10"), columnar.to_epoch_ms("2025-01-11")
+    # The first call pays for numpy loading its percentile code, so warm it up first.
+    columnar.aggregate(series, "temperature")
+    start = time.perf_counter()
+    day = columnar.window(series, day_start, day_end)
+    summary = columnar.aggregate(day, "temperature")
+    aggregate_ms = (time.perf_counter() - start) * 1000
+
+    print(f"{'read path':<24}{'seconds':>10}{'rows/s':>14}{'peak MB':>10}{'kept MB':>10}{'bytes/row':>11}")
+    for label, _, elapsed, peak, retained in results:
+        print(f"{label:<24}{elapsed:>10.2f}{rows / elapsed:>14,.0f}{peak / 2**20:>10.1f}"
+              f"{retained / 2**20:>10.1f}{retained / rows:>11.1f}")
+    print(f"Array bytes: {columnar.nbytes(results[1][1]) / 2**20:.1f} MB")
+    print(f"One day window + aggregate of one device: {aggregate_ms:.2f} ms ({summary['count']} samples)")
+
+    db_interface.close_pools()
+    shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
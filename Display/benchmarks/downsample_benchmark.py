@@ -0,0 +1,116 @@
+###########################################################################################
+# File: downsample_benchmark.py                                                           #
+# Purpose: Measure the accuracy and latency of the chart downsampling on the sample DBs.  #
+#                                                                                         #
+# Usage: python Display/benchmarks/downsample_benchmark.py [max_points ...]               #
+#                                                                                         #
+# v1.1.0 Initial version.                                                                 #
+###########################################################################################
+
+import glob
+import os
+import sqlite3
+import sys
+import time
+
+# The downsampling module lives one directory up.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import downsample
+
+# The repository root, where the samples/ directory lives.
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+# The series lengths used for the latency runs. Short sample series are tiled up to these.
+SCALES = [10000, 100000, 500000]
+
+
+def load_series(db):
+    """Loads each component's series from a database in the same shape as read_metrics()."""
+    conn = sqlite3.connect(db)
+    rows = conn.execute("""
+        SELECT serial_number, timestamp, temperature, usage, power_consumption,
+               core_speed, memory_speed, total_ram
+        FROM component_statistic
+        ORDER BY serial_number, timestamp
+    """).fetchall()
+    conn.close()
+
+    series = {}
+    for row in rows:
+        series.setdefault(row[0], []).append(list(row[1:]))
+    return series
+
+
+def interpolation_error(rows, sampled, column):
+    """Mean absolute error (as % of the column range) of the line drawn through the sampled points."""
+    # Map each kept row back to its position in the full series.
+    positions = {id(row): i for i, row in enumerate(rows)}
+    kept = [(positions[id(row)], downsample.to_number(row[column])) for row in sampled]
+    kept = [(x, y) for x, y in kept if y is not None]
+
+    values = [downsample.to_number(row[column]) for row in rows]
+    numbers = [value for value in values if value is not None]
+    if len(kept) < 2 or not numbers or max(numbers) == min(numbers):
+        return 0.0
+
+    # Walk along the full series linearly interpolating between the kept points.
+    error = 0.0
+    segment = 0
+    for x, y in enumerate(values):
+        if y is None:
+            continue
+        while segment < len(kept) - 2 and x > kept[segment + 1][0]:
+            segment += 1
+        (x0, y0), (x1, y1) = kept[segment], kept[segment + 1]
+        estimate = y0 if x1 == x0 else y0 + (y1 - y0) * (x - x0) / (x1 - x0)
+        error += abs(estimate - y)
+
+    return 100.0 * error / len(numbers) / (max(numbers) - min(numbers))
+
+
+def tile(rows, length):
+    """Repeats a short series until it is the requested length."""
+    return [list(rows[i % len(rows)]) for i in range(length)]
+
+
+def main(targets):
+    """Runs the accuracy and latency benchmarks and prints a table of the results."""
+    databases = sorted(glob.glob(os.path.join(ROOT, "samples", "*.db")))
+    databases += sorted(glob.glob(os.path.join(ROOT, "Display", "tests", "sample_dbs", "metrics.db")))
+
+    # Accuracy: how far the downsampled line strays from the real data on each sample database.
+    print("Accuracy (mean abs error as % of range, averaged over all series and columns)")
+    print(f"{'database':<32}{'rows':>8}" + "".join(f"{t:>10}" for t in targets))
+    for db in databases:
+        series = load_series(db)
+        errors = []
+        for target in targets:
+            column_errors = []
+            for rows in series.values():
+                # Tile the tiny sample series up, so there is something to downsample.
+                rows = tile(rows, 20 * len(rows))
+                sampled = downsample.lttb(rows, target)
+                column_errors += [interpolation_error(rows, sampled, c) for c in downsample.VALUE_COLUMNS]
+            errors.append(sum(column_errors) / max(len(column_errors), 1))
+
+        total = sum(len(rows) for rows in series.values())
+        print(f"{os.path.basename(db):<32}{total:>8}" + "".join(f"{e:>9.2f}%" for e in errors))
+
+    # Latency: how long it takes to downsample a single long series.
+    base = max((rows for db in databases for rows in load_series(db).values()), key=len)
+    print()
+    print("Latency (seconds to downsample one series)")
+    print(f"{'points':>10}" + "".join(f"{t:>10}" for t in targets))
+    for scale in SCALES:
+        rows = tile(base, scale)
+        timings = []
+        for target in targets:
+            start = time.perf_counter()
+            downsample.lttb(rows, target)
+            timings.append(time.perf_counter() - start)
+        print(f"{scale:>10}" + "".join(f"{t:>10.3f}" for t in timings))
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [250, 1000, 5000])
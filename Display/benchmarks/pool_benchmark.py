@@ -0,0 +1,137 @@
+###########################################################################################
+# File: pool_benchmark.py                                                                 #
+# Purpose: Concurrent reads while a writer inserts rows, pooled WAL connections against   #
+#          the old connect-per-call behaviour.                                            #
+#                                                                                         #
+# Usage: python Display/benchmarks/pool_benchmark.py [readers] [seconds]                  #
+#                                                                                         #
+# v1.1.0 Initial version.                                                                 #
+###########################################################################################
+
+import datetime
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+# db_interface lives one directory up.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import db_interface
+
+# The components the writer inserts statistics for.
+SERIALS = ["bench_cpu", "bench_gpu", "bench_ram", "bench_hdd"]
+
+# The query every reader runs. The last 500 samples of one component, like a chart would.
+READ_QUERY = """SELECT timestamp, usage FROM component_statistic
+                WHERE serial_number = ? ORDER BY timestamp DESC LIMIT 500"""
+
+
+def seed_database(db, rows_per_serial=20000):
+    """Creates the benchmark database with some history so the reads have work to do."""
+    conn = sqlite3.connect(db)
+    db_interface.create_mtg_database(conn)
+    db_interface.migrate_database(conn)
+
+    start = datetime.datetime(2025, 1, 1)
+    for serial in SERIALS:
+        conn.execute("INSERT INTO component VALUES (?, 'CPU', 0, 0, 0)", (serial,))
+        conn.executemany(
+            "INSERT INTO component_statistic VALUES (?, ?, 'Active', 40, 50, 10, 0, 0, 0, '2026-01-01')",
+            [(serial, (start + datetime.timedelta(seconds=30 * i)).strftime("%Y-%m-%d %H:%M:%S.%f"))
+             for i in range(rows_per_serial)])
+    conn.commit()
+    conn.close()
+
+
+def writer(db, stop, stats):
+    """Inserts one row per component per transaction, like the collector does."""
+    # The writer always uses WAL once the pool has switched the database over.
+    conn = sqlite3.connect(db, timeout=5)
+    timestamp = datetime.datetime(2026, 1, 1)
+    while not stop.is_set():
+        timestamp += datetime.timedelta(seconds=1)
+        try:
+            with conn:
+                for serial in SERIALS:
+                    conn.execute("INSERT INTO component_statistic VALUES "
+                                 "(?, ?, 'Active', 40, 50, 10, 0, 0, 0, '2027-01-01')",
+                                 (serial, timestamp.strftime("%Y-%m-%d %H:%M:%S.%f")))
+            stats["rows"] += len(SERIALS)
+        except sqlite3.OperationalError:
+            stats["busy"] += 1
+    conn.close()
+
+
+def read_fresh(db, serial):
+    """The old read path: a new connection, CREATE TABLE IF NOT EXISTS, query, never closed."""
+    conn = sqlite3.connect(db)
+    db_interface.create_mtg_database(conn)
+    return conn.execute(READ_QUERY, (serial,)).fetchall()
+
+
+def read_pooled(pool, serial):
+    """The new read path: borrow a pooled WAL connection."""
+    with pool.connection() as conn:
+        return conn.execute(READ_QUERY, (serial,)).fetchall()
+
+
+def run(mode, readers, seconds):
+    """Runs the readers and the writer for the given number of seconds."""
+    tmp_dir = tempfile.mkdtemp()
+    db = os.path.join(tmp_dir, "bench.db")
+    seed_database(db)
+
+    # Only the pooled mode switches the database to WAL, so the fresh mode is the real old behaviour.
+    pool = db_interface.ConnectionPool(db, wal=(mode == "pooled"))
+    if mode == "pooled":
+        pool.release(pool.acquire())
+
+    stop = threading.Event()
+    write_stats = {"rows": 0, "busy": 0}
+    latencies = [[] for _ in range(readers)]
+    errors = [0] * readers
+
+    def reader(index):
+        while not stop.is_set():
+            serial = SERIALS[len(latencies[index]) % len(SERIALS)]
+            start = time.perf_counter()
+            try:
+                if mode == "pooled":
+                    read_pooled(pool, serial)
+                else:
+                    read_fresh(db, serial)
+            except sqlite3.OperationalError:
+                errors[index] += 1
+            latencies[index].append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=writer, args=(db, stop, write_stats))]
+    threads += [threading.Thread(target=reader, args=(i,)) for i in range(readers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    pool.close()
+
+    all_latencies = sorted(latency for thread_latencies in latencies for latency in thread_latencies)
+    p50 = all_latencies[len(all_latencies) // 2] if all_latencies else 0
+    p95 = all_latencies[int(len(all_latencies) * 0.95)] if all_latencies else 0
+    print(f"{mode:<8}{len(all_latencies) / seconds:>12.0f}{p50 * 1000:>10.2f}{p95 * 1000:>10.2f}"
+          f"{sum(errors):>8}{write_stats['rows'] / seconds:>12.0f}{write_stats['busy']:>8}")
+
+
+def main(readers, seconds):
+    """Runs both read modes and prints a table of the results."""
+    print(f"{readers} readers, 1 writer, {seconds}s per mode")
+    print(f"{'mode':<8}{'reads/s':>12}{'p50 ms':>10}{'p95 ms':>10}{'errors':>8}{'writes/s':>12}{'busy':>8}")
+    for mode in ["fresh", "pooled"]:
+        run(mode, readers, seconds)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 4,
+         float(sys.argv[2]) if len(sys.argv) > 2 else 5)
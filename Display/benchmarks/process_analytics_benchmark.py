@@ -0,0 +1,122 @@
+###########################################################################################
+# File: process_analytics_benchmark.py                                                    #
+# Purpose: Times read_top_processes(), the top N pids over a window with sparklines, on a #
+#          process table with tens of millions of rows. Also times the first build of the #
+#          hourly/daily process summaries, keeping them up to date after that, and the    #
+#          same windows grouped straight from the raw rows for comparison.                #
+#                                                                                         #
+# Usage: python Display/benchmarks/process_analytics_benchmark.py [samples]               #
+#                                                                 [--processes N]         #
+#        The process table gets samples * processes rows (default 1,000,000 * 20).        #
+#                                                                                         #
+# v1.1.0 Initial version.                                                                 #
+###########################################################################################
+
+import argparse
+import datetime
+import os
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+# db_interface lives one directory up.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import db_interface
+import process_analytics
+import synthetic_data
+
+REPEATS = 5
+
+# The windows, as (name, how far back from the newest sample it starts). None is the whole table.
+WINDOWS = [
+    ("last hour", datetime.timedelta(hours=1)),
+    ("last day", datetime.timedelta(days=1)),
+    ("last week", datetime.timedelta(days=7)),
+    ("last 30 days", datetime.timedelta(days=30)),
+    ("last 90 days", datetime.timedelta(days=90)),
+    ("everything", None),
+]
+
+# Only these are grouped from the raw rows as well, the longer ones take a while.
+RAW_WINDOWS = ["last hour", "last day", "last week"]
+
+
+def median_ms(function, repeats=REPEATS):
+    times = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - started)
+    return statistics.median(times) * 1000
+
+
+def raw_top(db, start, metric="cpu", limit=process_analytics.DEFAULT_LIMIT):
+    """The top pids grouped straight from the raw rows in the window, without the summaries."""
+    conn = sqlite3.connect(db)
+    try:
+        summary, params = process_analytics.window_query(start)
+        return conn.execute(process_analytics.top_query(summary, metric), params + [limit]).fetchall()
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the top process analytics")
+    parser.add_argument("samples", type=int, nargs="?", default=1000000, help="samples in the process table")
+    parser.add_argument("--processes", type=int, default=20, help="process rows per sample")
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    db = os.path.join(tmp_dir, "metrics.db")
+    devices = len(synthetic_data.DEVICE_MIXES["nvidia"])
+    try:
+        print(f"Generating {args.samples * args.processes:,} process rows...", file=sys.stderr)
+        started = time.perf_counter()
+        _, process_rows = synthetic_data.generate_database(db, args.samples * devices, args.processes)
+        print(f"{process_rows:,} process rows ({args.processes} per sample, {synthetic_data.PID_POOL} pids), "
+              f"{os.path.getsize(db) / 1e6:,.0f} MB, generated in {time.perf_counter() - started:.0f}s")
+        db_interface.set_path_config(database=db)
+
+        # The first refresh summarizes the whole table, a chunk at a time.
+        with db_interface.connect() as conn:
+            started = time.perf_counter()
+            process_analytics.refresh(conn)
+            elapsed = time.perf_counter() - started
+            print(f"first build of the summaries: {elapsed:.1f}s ({process_rows / elapsed:,.0f} rows/s)")
+            for table in [process_analytics.HOURLY, process_analytics.DAILY]:
+                count = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                print(f"  {table}: {count:,} rows")
+            process_analytics._LAST_REFRESH[db] = time.monotonic()
+
+            # What the collector adds every 30 seconds, then the refresh that catches up with it.
+            last = conn.execute("SELECT MAX(timestamp) FROM process").fetchone()[0]
+            moment = db_interface.parse_timestamp(last) + synthetic_data.SAMPLE_INTERVAL
+            timestamp = synthetic_data.format_timestamp(moment)
+            conn.executemany("INSERT INTO process VALUES (?, ?, 1.0, 10.0, ?)",
+                             [(pid, timestamp, timestamp) for pid in range(4, 4 + 4 * args.processes, 4)])
+            conn.commit()
+            print(f"refresh after one more sample: {median_ms(lambda: process_analytics.refresh(conn), 1):.1f} ms")
+            newest = moment
+
+        print(f"\n{'window':<16}{'resolution':>12}{'sparkline':>11}{'cpu avg':>10}{'cpu max':>10}"
+              f"{'mem avg':>10}{'mem max':>10}{'raw':>11}  (ms)")
+        for name, span in WINDOWS:
+            start = (newest - span).strftime("%Y-%m-%d %H:%M:%S") if span else None
+            top = db_interface.read_top_processes(0, start)
+            times = [median_ms(lambda: db_interface.read_top_processes(0, start, None, metric, stat))
+                     for metric in process_analytics.METRICS for stat in process_analytics.STATS]
+            raw = f"{median_ms(lambda: raw_top(db, start), 1):>11.0f}" if name in RAW_WINDOWS else f"{'-':>11}"
+            print(f"{name:<16}{top['resolution']:>12}{top['sparkline']['resolution']:>11}"
+                  + "".join(f"{ms:>10.1f}" for ms in times) + raw)
+    finally:
+        db_interface.close_pools()
+        db_interface.set_path_config()
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+###########################################################################################
+# File: startup_benchmark.py                                                              #
+# Purpose: Time to first response of the web server: from launching it to the first page  #
+#          it sends back, which is what the user waits for before the browser tab shows   #
+#          anything. Runs the script, or the one-file and one-dir builds, several times.  #
+#                                                                                         #
+# Usage: python Display/benchmarks/startup_benchmark.py [server ...]                      #
+#        A server is a .py script or a built exe. With none, metrics_web_server.py is run.#
+#                                                                                         #
+# v1.1.0 Initial version.                                                                 #
+###########################################################################################
+
+import http.client
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+SERVER_SCRIPT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "metrics_web_server.py"))
+
+RUNS = 10
+
+# Give up on a server that hasn't answered in this long.
+TIMEOUT = 60
+
+
+def free_port():
+    """A port nothing is listening on."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def command_for(server):
+    """A .py file is run with this python, anything else is run as it is (a built exe)."""
+    if server.endswith(".py"):
+        return [sys.executable, server]
+    return [os.path.abspath(server)]
+
+
+def first_response(command, database):
+    """Starts the server and asks for / until it answers. Returns the seconds it took."""
+    port = free_port()
+    started = time.perf_counter()
+    process = subprocess.Popen(command + ["--no-browser", "--port", str(port), "--database", database],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - started < TIMEOUT:
+            if process.poll() is not None:
+                raise RuntimeError(f"{command[-1]} exited with {process.returncode}")
+            try:
+                connection = http.client.HTTPConnection("127.0.0.1", port, timeout=TIMEOUT)
+                connection.request("GET", "/")
+                status = connection.getresponse().status
+                connection.close()
+                if status == 200:
+                    return time.perf_counter() - started
+            except OSError:
+                # Not listening yet.
+                time.sleep(0.005)
+        raise RuntimeError(f"{command[-1]} didn't answer in {TIMEOUT}s")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main(servers):
+    tmp_dir = tempfile.mkdtemp()
+    database = os.path.join(tmp_dir, "metrics.db")
+    try:
+        print(f"{'server':<60}{'first':>9}{'min':>9}{'median':>9}{'max':>9}  (ms)")
+        for server in servers:
+            command = command_for(server)
+            # The first launch also creates the database, and is the coldest (nothing in the disk cache).
+            times = [first_response(command, database) * 1000 for _ in range(RUNS + 1)]
+            warm = times[1:]
+            print(f"{os.path.relpath(server):<60}{times[0]:>9.0f}{min(warm):>9.0f}"
+                  f"{statistics.median(warm):>9.0f}{max(warm):>9.0f}")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:] or [SERVER_SCRIPT])
@@ -0,0 +1,172 @@
+###########################################################################################
+# File: synthetic_data.py                                                                 #
+# Purpose: Generates metrics.db files of any size (1M to 100M+ rows) for the benchmarks.  #
+#          The devices, values and timestamps look like the ones in samples/: one row per #
+#          component every 30 seconds, plus the processes seen at each sample.            #
+#                                                                                         #
+# Usage: python Display/benchmarks/synthetic_data.py output.db [--rows N] [--processes N] #
+#                                                                                         #
+# v1.1.0 Initial version.                                                                 #
+###########################################################################################
+
+import argparse
+import datetime
+import math
+import os
+import random
+import sqlite3
+import sys
+import time
+
+# db_interface lives one directory up.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import db_interface
+
+# Device mixes like the machines in samples/. (serial_number, device_type, v_ram, stock core, stock memory)
+DEVICE_MIXES = {
+    "nvidia": [
+        ("Default string", "Mainboard", 0, 0.0, 0.0),
+        ("BFEBFBFF000806F8", "CPU", 0, 3.09599995613098, 0.0),
+        ("55B95784", "RAM", 0, 0.0, 4800.0),
+        ("PCI\\VEN_10DE&DEV_2531&SUBSYS_151D17AA&REV_A1\\4&19B241F0&0&0008", "GpuNvidia", 0, 1200.0, 7000.0),
+    ],
+    "ati": [
+        ("240943272200371", "Mainboard", 0, 0.0, 0.0),
+        ("178BFBFF00B40F40", "CPU", 0, 4.69999980926514, 0.0),
+        ("B65632F4", "RAM", 0, 0.0, 4800.0),
+        ("PCI\\VEN_1002&DEV_13C0&SUBSYS_88771043&REV_CB\\4&1EBE6A9C&0&0041", "GpuAti", 0, 1200.0, 7000.0),
+    ],
+    "lab": [
+        ("E5B6EACEE48E7AF3", "Mainboard", 0, 0.0, 0.0),
+        ("BFEBFBFF00090675", "CPU", 0, 3.0, 0.0),
+        ("36A29DBC", "RAM", 0, 0.0, 3200.0),
+        ("0025_38E2_31CC_76C5.", "HDD", 0, 0.0, 0.0),
+    ],
+}
+
+# The collector samples every 30 seconds.
+SAMPLE_INTERVAL = datetime.timedelta(seconds=30)
+
+# How many rows are handed to executemany() at a time. Keeps memory flat at any size.
+BATCH_ROWS = 100000
+
+# How many different pids a machine runs over the whole history (the lab sample had about 300).
+PID_POOL = 400
+
+
+def format_timestamp(moment):
+    """Formats a datetime the way the collector does: 7 fractional digits."""
+    return moment.strftime("%Y-%m-%d %H:%M:%S.%f") + "0"
+
+
+def statistic_rows(devices, samples, start, lifetime, rng):
+    """Yields component_statistic rows, one per device per sample, with values that wander like real ones."""
+    # Each device's usage does a random walk between 0 and 100, temperature follows usage.
+    usage = {serial: rng.uniform(5, 40) for serial, *_ in devices}
+    total_ram = rng.choice([7.6962890625, 31.4673919677734, 61.6400451660156])
+    for i in range(samples):
+        moment = start + SAMPLE_INTERVAL * i
+        timestamp = format_timestamp(moment)
+        end_of_life = format_timestamp(moment + lifetime)
+        # A slow daily cycle so the charts and the rollups have something to show.
+        daily = 10 * math.sin(2 * math.pi * i / 2880)
+        for serial, device_type, _, stock_core, stock_memory in devices:
+            usage[serial] = min(100.0, max(0.0, usage[serial] + rng.gauss(0, 3)))
+            busy = min(100.0, max(0.0, usage[serial] + daily))
+            if device_type in ("CPU", "GpuNvidia", "GpuAti"):
+                temperature = 35 + busy * 0.5 + rng.gauss(0, 1)
+                power = 5 + busy * 1.2
+                core_speed = stock_core * 1000 * (0.8 + busy / 250) if device_type == "CPU" else stock_core
+            else:
+                temperature, power, core_speed = 0.0, 0.0, 0.0
+            yield (serial, timestamp, "Active", temperature, busy, power, core_speed, stock_memory, total_ram,
+                   end_of_life)
+
+
+def process_rows(processes, samples, start, lifetime, rng):
+    """Yields process rows, the given number of pids per sample, picked from a fixed pool."""
+    pids = rng.sample(range(4, 40000, 4), PID_POOL)
+    for i in range(samples):
+        moment = start + SAMPLE_INTERVAL * i
+        timestamp = format_timestamp(moment)
+        end_of_life = format_timestamp(moment + lifetime)
+        for pid in rng.sample(pids, processes):
+            yield (pid, timestamp, min(100.0, rng.expovariate(0.5)), rng.lognormvariate(3, 1.2), end_of_life)
+
+
+def insert_batches(conn, sql, rows):
+    """executemany() in batches, so the rows never all have to be in memory."""
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH_ROWS:
+            conn.executemany(sql, batch)
+            batch.clear()
+    if batch:
+        conn.executemany(sql, batch)
+
+
+def generate_database(db, rows, processes=20, mix="nvidia", start=None, lifetime_days=365, seed=0,
+                      migrate=True):
+    """Creates db with about `rows` component_statistic rows and `processes` process rows per sample.
+
+    Everything is written in a single transaction with journaling off, which is only safe because the
+    file is thrown away if the generator fails. Returns the number of (statistic, process) rows written.
+    """
+    if os.path.exists(db):
+        os.remove(db)
+
+    rng = random.Random(seed)
+    devices = DEVICE_MIXES[mix]
+    samples = max(rows // len(devices), 1)
+    processes = min(processes, PID_POOL)
+    lifetime = datetime.timedelta(days=lifetime_days)
+    # By default the data ends now, so nothing is past its lifetime yet.
+    start = start or datetime.datetime.now().replace(microsecond=0) - SAMPLE_INTERVAL * samples
+
+    conn = sqlite3.connect(db, isolation_level=None)
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("PRAGMA cache_size = -262144")
+    db_interface.create_mtg_database(conn)
+
+    conn.execute("BEGIN")
+    conn.executemany("INSERT INTO component VALUES (?, ?, ?, ?, ?)", devices)
+    insert_batches(conn, "INSERT INTO component_statistic VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                   statistic_rows(devices, samples, start, lifetime, rng))
+    if processes:
+        insert_batches(conn, "INSERT INTO process VALUES (?, ?, ?, ?, ?)",
+                       process_rows(processes, samples, start, lifetime, rng))
+    conn.execute("COMMIT")
+
+    # The indexes are quicker to build once at the end than to keep up to date row by row.
+    if migrate:
+        db_interface.migrate_database(conn)
+    conn.execute("PRAGMA journal_mode = DELETE")
+    conn.close()
+
+    return samples * len(devices), samples * processes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic metrics database")
+    parser.add_argument("database", help="The file to create (overwritten if it exists)")
+    parser.add_argument("--rows", type=int, default=1000000, help="component_statistic rows to create")
+    parser.add_argument("--processes", type=int, default=20, help="process rows per sample")
+    parser.add_argument("--mix", choices=sorted(DEVICE_MIXES), default="nvidia", help="which machine to copy")
+    parser.add_argument("--seed", type=int, default=0, help="random seed, the same seed gives the same data")
+    parser.add_argument("--no-migrate", action="store_true", help="leave the schema at version 0 (no indexes)")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    statistics, processes = generate_database(args.database, args.rows, args.processes, args.mix,
+                                              seed=args.seed, migrate=not args.no_migrate)
+    elapsed = time.perf_counter() - started
+    size = os.path.getsize(args.database) / 2**20
+    print(f"{statistics:,} statistic rows and {processes:,} process rows in {elapsed:.1f}s "
+          f"({(statistics + processes) / elapsed:,.0f} rows/s), {size:,.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+###########################################################################################
+# File: transport_benchmark.py                                                            #
+# Purpose: Payload size and parse time of a chart series sent as json against the binary  #
+#          typed-array format (binary_series.py), plain and with gzip/deflate. The parse  #
+#          times are the page's own code (static/js/series.js) run in node, if it's there.#
+#                                                                                         #
+# Usage: python Display/benchmarks/transport_benchmark.py [points,points,...]             #
+#                                                                                         #
+# v1.1.0 Initial version.                                                                 #
+# v1.1.1 Times the copy from the typed arrays into the chart's arrays on its own as well. #
+###########################################################################################
+
+import datetime
+import gzip
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+# db_interface lives one directory up.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import db_interface
+import response_cache
+import rollups
+import synthetic_data
+from metrics_web_server import app
+
+DEFAULT_SCALES = [10000, 100000, 500000]
+REPEATS = 5
+
+# The devices in synthetic_data's default mix. Each sample has a row for every one of them.
+DEVICES = len(synthetic_data.DEVICE_MIXES["nvidia"])
+
+SERIES_JS = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "static", "js", "series.js"))
+
+# Times the page's two ways of turning a response into chart labels and values. The json way is
+# what createChart() did before the binary format: filter out the non-numbers, then map. The binary
+# way is split into reading the typed arrays and copying them into the chart's arrays.
+NODE_SCRIPT = """
+const fs = require("fs");
+const { decodeSeries, seriesPoints } = require(process.argv[1]);
+const json = fs.readFileSync(process.argv[2], "utf8");
+const binary = fs.readFileSync(process.argv[3]);
+const repeats = parseInt(process.argv[4]);
+
+function time(work) {
+    const times = [];
+    for (let i = 0; i < repeats; i++) {
+        const started = process.hrtime.bigint();
+        work();
+        times.push(Number(process.hrtime.bigint() - started) / 1e6);
+    }
+    return times.sort((a, b) => a - b)[times.length >> 1];
+}
+
+const buffer = binary.buffer.slice(binary.byteOffset, binary.byteOffset + binary.length);
+// seriesPoints() copies the typed arrays into the plain arrays Chart.js is given. Timed on its own.
+const decoded = decodeSeries(buffer);
+console.log(JSON.stringify({
+    json: time(() => {
+        const points = JSON.parse(json).points.filter(item => typeof item[1] === "number" && isFinite(item[1]));
+        return [points.map(item => item[0]), points.map(item => item[1])];
+    }),
+    json_parse_only: time(() => JSON.parse(json)),
+    binary: time(() => seriesPoints(decodeSeries(buffer))),
+    binary_decode_only: time(() => decodeSeries(buffer)),
+    binary_copy_only: time(() => seriesPoints(decoded)),
+}));
+"""
+
+
+def fetch(client, query, encoding=None):
+    """One request to /api/metrics with an empty cache. Returns (body as sent, seconds)."""
+    response_cache.cache.clear()
+    headers = {"Accept-Encoding": encoding} if encoding else {}
+    started = time.perf_counter()
+    response = client.get("/api/metrics", query_string=query, headers=headers)
+    body = response.get_data()
+    elapsed = time.perf_counter() - started
+    if response.status_code != 200:
+        raise RuntimeError(f"/api/metrics returned {response.status_code}")
+    return body, elapsed
+
+
+def node_times(tmp_dir, json_body, binary_body):
+    """The median parse times in milliseconds from node, or None if node isn't installed."""
+    node = shutil.which("node") or shutil.which("nodejs")
+    if node is None:
+        return None
+    json_path = os.path.join(tmp_dir, "series.json")
+    binary_path = os.path.join(tmp_dir, "series.bin")
+    with open(json_path, "wb") as file:
+        file.write(json_body)
+    with open(binary_path, "wb") as file:
+        file.write(binary_body)
+    output = subprocess.run([node, "-e", NODE_SCRIPT, SERIES_JS, json_path, binary_path, str(REPEATS)],
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output)
+
+
+def run_scale(tmp_dir, points):
+    """Generates a database with `points` samples per device and compares the formats for one device."""
+    db = os.path.join(tmp_dir, f"metrics-{points}.db")
+    # The samples are packed closer together than the collector's 30 seconds, so the whole series fits
+    # in a window short enough to be read raw rather than from the rollups.
+    synthetic_data.SAMPLE_INTERVAL = rollups.RAW_MAX_SPAN / points
+    synthetic_data.generate_database(db, points * DEVICES, processes=0, start=datetime.datetime(2025, 1, 1))
+    db_interface.set_path_config(database=db)
+    cpu = db_interface.read_devices()[1]["serial_number"]
+    client = app.test_client()
+
+    series = db_interface.read_metric_range(cpu, "temperature", max_points=0)
+    assert series["resolution"] == rollups.RAW and len(series["points"]) == points
+
+    result = {"points": points, "sizes": {}, "server_ms": {}}
+    bodies = {}
+    for response_format in ["json", "binary"]:
+        query = {"serial_number": cpu, "column": "temperature", "max_points": 0, "format": response_format}
+        times = []
+        for _ in range(REPEATS):
+            body, elapsed = fetch(client, query)
+            times.append(elapsed)
+        bodies[response_format] = body
+        result["server_ms"][response_format] = statistics.median(times) * 1000
+        result["sizes"][response_format] = len(body)
+
+        # The compressed sizes, and how long the server takes to compress.
+        for encoding in response_cache.ENCODINGS:
+            body, elapsed = fetch(client, query, encoding)
+            result["sizes"][f"{response_format}+{encoding}"] = len(body)
+        result["server_ms"][f"{response_format}+gzip"] = statistics.median(
+            [fetch(client, query, "gzip")[1] for _ in range(REPEATS)]) * 1000
+
+    # Sanity check: the compressed bodies really are the same bytes.
+    assert gzip.decompress(fetch(client, query, "gzip")[0]) == bodies["binary"]
+    assert zlib.decompress(fetch(client, query, "deflate")[0]) == bodies["binary"]
+
+    result["client_ms"] = node_times(tmp_dir, bodies["json"], bodies["binary"])
+    db_interface.close_pools()
+    os.remove(db)
+    return result
+
+
+def print_result(result):
+    points = result["points"]
+    print(f"\n{points:,} points")
+    print(f"  {'payload':<18}{'bytes':>14}{'bytes/point':>13}{'vs json':>9}")
+    for name, size in result["sizes"].items():
+        print(f"  {name:<18}{size:>14,}{size / points:>13.2f}{size / result['sizes']['json']:>9.2f}")
+    print(f"  {'server':<18}{'ms':>14}")
+    for name, ms in result["server_ms"].items():
+        print(f"  {name:<18}{ms:>14.1f}")
+    if result["client_ms"] is None:
+        print("  (node isn't installed, so there are no client parse times)")
+        return
+    print(f"  {'client parse':<18}{'ms':>14}")
+    for name, ms in result["client_ms"].items():
+        print(f"  {name:<18}{ms:>14.1f}")
+
+
+def main(scales):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for points in scales:
+            print(f"Generating {points:,} points per device...", file=sys.stderr)
+            print_result(run_scale(tmp_dir, points))
+    finally:
+        db_interface.set_path_config()
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main([int(points) for points in sys.argv[1].split(",")] if len(sys.argv) > 1 else DEFAULT_SCALES)
@@ -0,0 +1,120 @@
+###########################################################################################
+# File: binary_series.py                                                                  #
+# Purpose: A binary format for chart series, smaller than json and read by the browser    #
+#          straight into typed arrays (static/js/series.js). The layout is:               #
+#              bytes 0-3   b"MTGS"                                                        #
+#              bytes 4-7   the header's length in bytes, uint32 little-endian             #
+#              bytes 8-    the header, utf-8 json padded with spaces to 8 bytes:          #
+#                          {"length": rows, "columns": [{"name", "type", "offset"}, ...]} #
+#                          plus anything else about the series (resolution, etc)          #
+#          then each column, little-endian, starting on a multiple of 8 bytes so the      #
+#          browser can use it as a BigInt64Array/Float32Array without copying:            #
+#              timestamp   int64    milliseconds since the epoch (naive times as UTC)     #
+#              values      float32  NaN where the database had no usable number           #
+#                                                                                         #
+# v1.1.0 Initial version.                                                                 #
+###########################################################################################
+
+import array
+import datetime
+import json
+import struct
+import sys
+
+MAGIC = b"MTGS"
+MIMETYPE = "application/octet-stream"
+
+# The array module's typecodes for each column type. 'q' is 8 bytes and 'f' is 4 on every platform.
+TYPECODES = {"int64": "q", "float32": "f"}
+
+EPOCH = datetime.datetime(1970, 1, 1)
+MILLISECOND = datetime.timedelta(milliseconds=1)
+
+
+def to_epoch_ms(timestamp):
+    """Epoch milliseconds for a database or bucket timestamp. None if it can't be read."""
+    try:
+        # fromisoformat is much faster than strptime, but older pythons only take 3 or 6 fractional digits.
+        return (datetime.datetime.fromisoformat(timestamp) - EPOCH) // MILLISECOND
+    except (TypeError, ValueError):
+        pass
+    # Only loaded when it's needed. It imports numpy, which is slow to import.
+    import columnar
+    try:
+        return columnar.to_epoch_ms(timestamp)
+    except (AttributeError, ValueError):
+        return None
+
+
+def pad(data, fill=b"\0"):
+    """Pads bytes out to a multiple of 8."""
+    return data + fill * (-len(data) % 8)
+
+
+def encode(columns, **header):
+    """Packs (name, type, values) columns of the same length into the binary format.
+
+    The keyword arguments go in the header as they are. Values that aren't numbers are NaN in a
+    float32 column and must not be there in an int64 one.
+    """
+    length = len(columns[0][2]) if columns else 0
+    buffers = []
+    descriptions = []
+    for name, kind, values in columns:
+        if len(values) != length:
+            raise ValueError(f"Column {name} has {len(values)} values, not {length}")
+        if kind == "float32":
+            values = [value if type(value) is float or type(value) is int else float("nan") for value in values]
+        packed = array.array(TYPECODES[kind], values)
+        if sys.byteorder == "big":
+            packed.byteswap()
+        buffers.append(pad(packed.tobytes()))
+        descriptions.append({"name": name, "type": kind})
+
+    # The offsets depend on the header's length, which depends on the offsets. Work the header out
+    # with offsets that are certainly long enough, then pad the real one out to the same length.
+    def header_bytes(offsets):
+        for description, offset in zip(descriptions, offsets):
+            description["offset"] = offset
+        return json.dumps(dict(header, length=length, columns=descriptions), separators=(",", ":")).encode()
+
+    size = len(pad(header_bytes([10 ** 15] * len(buffers)), b" "))
+    offsets = []
+    offset = 8 + size
+    for buffer in buffers:
+        offsets.append(offset)
+        offset += len(buffer)
+    text = header_bytes(offsets)
+    text += b" " * (size - len(text))
+
+    return b"".join([MAGIC, struct.pack("<I", size), text] + buffers)
+
+
+def decode(body):
+    """Unpacks the binary format into (header, {name: list of values}). The tests use it."""
+    if body[:4] != MAGIC:
+        raise ValueError("Not a binary series")
+    size, = struct.unpack_from("<I", body, 4)
+    header = json.loads(body[8:8 + size])
+
+    columns = {}
+    for column in header["columns"]:
+        values = array.array(TYPECODES[column["type"]])
+        values.frombytes(body[column["offset"]:column["offset"] + header["length"] * values.itemsize])
+        if sys.byteorder == "big":
+            values.byteswap()
+        columns[column["name"]] = values.tolist()
+    return header, columns
+
+
+def encode_points(points, names=("value",), **header):
+    """Encodes [timestamp, value, ...] points (read_metric_range()'s) with the timestamps as int64.
+
+    Points whose timestamp can't be read are left out, they can't be placed on the chart anyway.
+    """
+    timestamps = [to_epoch_ms(point[0]) for point in points]
+    kept = [(ms, point) for ms, point in zip(timestamps, points) if ms is not None]
+    columns = [("timestamp", "int64", [ms for ms, _ in kept])]
+    for index, name in enumerate(names, start=1):
+        columns.append((name, "float32", [point[index] for _, point in kept]))
+    return encode(columns, **header)
@@ -0,0 +1,203 @@
+###########################################################################################
+# File: columnar.py                                                                       #
+# Purpose: Column based (numpy) storage for the metrics of a single component.            #
+#          A series is a dictionary of equal length arrays, one per column:               #
+#              timestamp          int64   milliseconds since the epoch                    #
+#              temperature, ...   float32 NaN where the database had no usable number     #
+#          numpy is optional. Everything else in the web server works without it.         #
+#                                                                                         #
+# v1.1.0 Initial version.                                                                 #
+###########################################################################################
+
+import datetime
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# The metric columns in the same order as a read_metrics() row (after the timestamp).
+# The names match db_interface.METRIC_COLUMNS.
+COLUMNS = ("temperature", "usage", "power", "core_speed", "memory_speed", "total_ram")
+
+# How many rows are pulled out of the database at a time. Keeps the python objects short lived.
+CHUNK_ROWS = 65536
+
+# The unix epoch as a julian day, used to turn the stored timestamps into milliseconds in SQL.
+JULIAN_EPOCH = 2440587.5
+
+
+def require_numpy():
+    """Raises a helpful error if numpy isn't installed."""
+    if numpy is None:
+        raise ImportError("The columnar metrics need numpy. Install it with 'pip install numpy'.")
+
+
+def to_float_array(values):
+    """Turns a column of database values into a float32 array. Anything that isn't a number is NaN."""
+    try:
+        # The fast path. None is turned into NaN by numpy.
+        return numpy.array(values, dtype=numpy.float32)
+    except (TypeError, ValueError):
+        # Something odd (an emoji, some text) is in the column, so check each value.
+        return numpy.array([value if isinstance(value, (int, float)) else None for value in values],
+                           dtype=numpy.float32)
+
+
+def from_rows(rows):
+    """Builds a series from rows of (epoch_ms, temperature, usage, power, core_speed, memory_speed, total_ram).
+
+    Rows without a usable timestamp (None) are dropped, since they can't be placed in time.
+    """
+    require_numpy()
+
+    # Transpose the rows into columns. An empty list still needs the right number of columns.
+    columns = list(zip(*rows)) or [()] * (len(COLUMNS) + 1)
+
+    # Timestamps the database couldn't understand come through as None.
+    timestamps = numpy.array(columns[0], dtype=numpy.float64)
+    keep = ~numpy.isnan(timestamps)
+
+    series = {"timestamp": timestamps[keep].astype(numpy.int64)}
+    for name, values in zip(COLUMNS, columns[1:]):
+        series[name] = to_float_array(values)[keep]
+    return series
+
+
+def from_cursor(cursor, keys, chunk_rows=CHUNK_ROWS):
+    """Builds a series for every component from a cursor of (serial_number, epoch_ms, temperature, ...) rows.
+
+    The rows can come in any order (a plain table scan is the fastest way to read them).
+    keys maps each serial number to the dictionary key to use. Serial numbers not in keys are skipped.
+    """
+    require_numpy()
+
+    codes = {}
+    parts = []
+    while True:
+        rows = cursor.fetchmany(chunk_rows)
+        if not rows:
+            break
+
+        # Each serial number gets a small integer code, so the grouping can be done in numpy.
+        serials = numpy.array([codes.setdefault(row[0], len(codes)) for row in rows], dtype=numpy.int32)
+        timestamps = numpy.array([row[1] for row in rows], dtype=numpy.float64)
+        keep = ~numpy.isnan(timestamps)
+
+        part = {"serial": serials[keep], "timestamp": timestamps[keep].astype(numpy.int64)}
+        for i, name in enumerate(COLUMNS, start=2):
+            part[name] = to_float_array([row[i] for row in rows])[keep]
+        parts.append(part)
+
+    if not parts:
+        return {}
+
+    # Stitch the chunks together, then sort by component and time so each component is one slice.
+    merged = {name: numpy.concatenate([part[name] for part in parts]) for name in parts[0]}
+    order = numpy.lexsort((merged["timestamp"], merged["serial"]))
+    merged = {name: values[order] for name, values in merged.items()}
+
+    # Find where each component's rows start and end.
+    serial_codes = merged.pop("serial")
+    boundaries = numpy.flatnonzero(numpy.diff(serial_codes)) + 1
+    starts = numpy.concatenate(([0], boundaries))
+    ends = numpy.concatenate((boundaries, [len(serial_codes)]))
+
+    serial_numbers = {code: serial for serial, code in codes.items()}
+    datasets = {}
+    for start, end in zip(starts, ends):
+        serial = serial_numbers[int(serial_codes[start])]
+        if serial in keys:
+            # Copy the slice, so the big merged arrays can be freed.
+            datasets[keys[serial]] = {name: values[start:end].copy() for name, values in merged.items()}
+    return datasets
+
+
+def to_epoch_ms(timestamp):
+    """Turns a database style timestamp '2025-04-17 18:17:30.925' into epoch milliseconds."""
+    # The database can store up to 7 fractional digits but python only understands 6.
+    timestamp = timestamp.strip().replace("T", " ")
+    if "." in timestamp:
+        whole, fraction = timestamp.split(".", 1)
+        timestamp = f"{whole}.{fraction[:6]}"
+    else:
+        timestamp += ".0"
+
+    # Fill in anything missing from a short timestamp like '2025-04-17 18:17'.
+    for pattern in ["%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M.%f", "%Y-%m-%d.%f"]:
+        try:
+            parsed = datetime.datetime.strptime(timestamp, pattern)
+            break
+        except ValueError:
+            continue
+    else:
+        raise ValueError(f"Can't understand the timestamp: {timestamp}")
+
+    epoch = datetime.datetime(1970, 1, 1)
+    return (parsed - epoch) // datetime.timedelta(milliseconds=1)
+
+
+def window(series, start_ms=None, end_ms=None):
+    """Returns the part of the series between start_ms and end_ms (inclusive). No data is copied."""
+    require_numpy()
+
+    timestamps = series["timestamp"]
+    # The series is sorted by time, so a binary search finds the edges of the window.
+    first = 0 if start_ms is None else int(numpy.searchsorted(timestamps, start_ms, side="left"))
+    last = len(timestamps) if end_ms is None else int(numpy.searchsorted(timestamps, end_ms, side="right"))
+    return {name: values[first:last] for name, values in series.items()}
+
+
+def aggregate(series, column):
+    """Returns the count, min, max, mean and 95th percentile of a column, ignoring NaNs."""
+    require_numpy()
+
+    values = series[column]
+    values = values[~numpy.isnan(values)]
+
+    # Nothing to summarize.
+    if not len(values):
+        return {"count": 0, "min": None, "max": None, "mean": None, "p95": None}
+
+    return {
+        "count": int(len(values)),
+        "min":   float(values.min()),
+        "max":   float(values.max()),
+        # float64 for the sum, float32 loses precision over millions of samples.
+        "mean":  float(values.mean(dtype=numpy.float64)),
+        "p95":   float(numpy.percentile(values, 95)),
+    }
+
+
+def to_rows(series):
+    """The thin adapter back to the read_metrics() format: [timestamp, temperature, ...] lists."""
+    require_numpy()
+
+    # Turn the epoch milliseconds back into the '2025-04-17 18:17:30.925' strings the charts use.
+    timestamps = numpy.datetime_as_string(series["timestamp"].astype("datetime64[ms]"), unit="ms")
+    timestamps = numpy.char.replace(timestamps, "T", " ")
+
+    # NaN isn't valid json, so it goes back to being None.
+    columns = [timestamps.tolist()]
+    for name in COLUMNS:
+        values = series[name].astype(object)
+        values[numpy.isnan(series[name])] = None
+        columns.append(values.tolist())
+
+    return [list(row) for row in zip(*columns)]
+
+
+def to_datasets(columnar_datasets):
+    """Converts a whole read_metrics_columnar() dictionary into the read_metrics() format."""
+    datasets = {key: to_rows(series) for key, series in columnar_datasets.items()}
+
+    # Same as read_metrics(), an empty database still returns SOMETHING.
+    if not datasets:
+        datasets["No Components Found"] = [0]
+
+    return datasets
+
+
+def nbytes(columnar_datasets):
+    """The number of bytes the arrays take up."""
+    return sum(values.nbytes for series in columnar_datasets.values() for values in series.values())
@@ -4,15 +4,344 @@
 #                                                                                         #
 # v0.0.1 Initial version. mthuffer 2025-03-11                                             #
 # v1.0.0 Initial Production version. mthuffer 2025-04-30                                  #
+# v1.1.0 Added read_devices() and read_metric_range() for the lazy loading charts.        #
+# v1.2.0 Versioned schema migrations (PRAGMA user_version) and the first set of indexes.  #
+# v1.3.0 Reads go through a pool of reusable WAL mode connections instead of a new        #
+#        connection per call.                                                             #
+# v1.4.0 The project root is only worked out once. MTG_ROOT/MTG_DATABASE override it.     #
+# v1.5.0 Added read_metrics_columnar(), the numpy version of read_metrics().              #
+# v1.6.0 Hourly/daily rollups. Windowed reads pick raw, hourly or daily data by the span. #
+# v1.7.0 Added read_process_page() for the server side paged process table.               #
+# v1.8.0 Backups use SQLite's online backup on a background thread, not shutil.copy.      #
+# v1.9.0 Added prune_database(), which deletes old rows in small batches.                 #
+# v1.10.0 The reads record their time and row counts for /debug/stats.                    #
+# v1.11.0 Every read works on the compact v2 layout (schema_v2.py) as well as v1.         #
+# v1.12.0 Sharded databases (shards.py). Reads ATTACH the shards that overlap the window, #
+#         prune deletes whole shards and backups skip the shards that haven't changed.    #
+# v1.13.0 read_devices() and read_process_page() can be limited to one host of a central  #
+#         database (ingest.py).                                                           #
+# v1.14.0 Added read_summary(), each component's min/max/mean/p95 over a window, in SQL.  #
+# v1.15.0 Added detect_anomalies() and read_anomalies() for the EWMA detector.            #
+# v1.16.0 subprocess is only imported when git is asked for the project root.             #
+# v1.17.0 Added read_top_processes(), the busiest pids over a window, with sparklines.    #
+# v1.18.0 prune_database() recomputes the rollup and process summary buckets of the       #
+#         rows it deletes, in the same transaction as the delete.                         #
+# v1.18.1 read_process_page() ignores the host outside a central database.                #
 ###########################################################################################
 
-import subprocess
+import sys
 import os
 import sqlite3
 import datetime
 import glob
-import shutil
+import math
 import pathlib
+import time
+import threading
+import queue
+import contextlib
+import atexit
+import anomalies
+import downsample
+import instrumentation
+import process_analytics
+import rollups
+import schema_v2
+import shards
+
+# The metric columns a chart can ask for. Maps the API name to the column in component_statistic.
+# Never put user input straight into SQL, only ever the values from this dictionary.
+METRIC_COLUMNS = {
+    "temperature":  "temperature",
+    "usage":        "usage",
+    "power":        "power_consumption",
+    "core_speed":   "core_speed",
+    "memory_speed": "memory_speed",
+    "total_ram":    "total_ram",
+}
+
+# The columns read_summary() summarizes when it isn't asked for any, and the percentile it reports.
+SUMMARY_COLUMNS = ("temperature", "usage")
+SUMMARY_PERCENTILE = 95
+
+# The schema migrations. Each entry is (version, description, statements).
+# The database remembers the last version it was upgraded to in PRAGMA user_version.
+# Only ever append new migrations to the end. Never change one that has already shipped.
+MIGRATIONS = [
+    (1, "Indexes for time window queries and pruning", [
+        # Time window queries across every component and the prune of old data.
+        """CREATE INDEX IF NOT EXISTS idx_component_statistic_timestamp
+           ON component_statistic (timestamp)""",
+        # The prune also checks end_of_life, which is OR'd with timestamp.
+        """CREATE INDEX IF NOT EXISTS idx_component_statistic_end_of_life
+           ON component_statistic (end_of_life)""",
+        # (timestamp, cpu_usage) also covers plain timestamp lookups, so no separate timestamp index.
+        """CREATE INDEX IF NOT EXISTS idx_process_timestamp_cpu_usage
+           ON process (timestamp, cpu_usage)""",
+        """CREATE INDEX IF NOT EXISTS idx_process_end_of_life
+           ON process (end_of_life)""",
+    ]),
+    (2, "Hourly and daily rollups of component_statistic", rollups.SCHEMA),
+    (3, "Anomaly flags and the detector's state", anomalies.SCHEMA),
+    (4, "Hourly and daily summaries of each process", process_analytics.SCHEMA),
+]
+
+
+# A central database (ingest.py) holds many machines. Their serial numbers are 'host/serial'.
+HOST_SEPARATOR = "/"
+
+# The process table columns, in the order the process table shows them.
+# DataTables asks to sort by the column's position, which is looked up here rather than put into SQL.
+PROCESS_COLUMNS = ["pid", "timestamp", "cpu_usage", "memory_usage", "end_of_life"]
+
+# The same columns in the v2 layout, where end_of_life comes from the row's retention batch.
+PROCESS_COLUMNS_V2 = ["pid", "timestamp", "cpu_usage", "memory_usage", "timestamp + lifetime_ms"]
+
+# The most rows the process table can ask for at once, even if it asks for 'All'.
+MAX_PAGE_LENGTH = 1000
+
+# How long the process table's total row count is trusted for, in seconds.
+COUNT_TTL = 30
+
+# The cached process counts, keyed on the database path. Each is (rowid range, time counted, count).
+_PROCESS_COUNTS = {}
+
+
+# The pruner deletes this many rows per transaction, then sleeps for PRUNE_YIELD seconds so the
+# collector and the web pages get a turn at the database. Smaller batches hold the lock for less time.
+PRUNE_BATCH_SIZE = 5000
+PRUNE_YIELD = 0.05
+
+# The tables the pruner deletes old rows from, and the columns it checks (each one is indexed).
+PRUNE_TABLES = ["component_statistic", "process"]
+
+# The summaries of each pruned table (v1 layout). A batch recomputes the buckets of the rows it deletes.
+PRUNE_SUMMARIES = {
+    "component_statistic": rollups.COMPONENT_ROLLUPS,
+    "process":             process_analytics.PROCESS_SUMMARIES,
+}
+
+# Backups are copied this many pages at a time, with a sleep in between so the collector can write.
+BACKUP_PAGES = 1024
+BACKUP_SLEEP = 0.01
+
+# The background backup thread, and how the backups have gone. BACKUP_STATS is served by /api/backup.
+_BACKUP_THREAD = None
+_BACKUP_LOCK = threading.Lock()
+BACKUP_STATS = {
+    "running":       False,
+    "backup":        None,   # The file the last backup was written to.
+    "last_started":  None,
+    "last_finished": None,
+    "duration":      None,   # Seconds the last successful backup took.
+    "pages":         0,      # Pages in the last backup, shards included.
+    "steps":         0,      # How many steps (of BACKUP_PAGES pages) it took.
+    "shards":        0,      # Shards copied by the last backup. Unchanged shards aren't copied again.
+    "count":         0,      # Successful backups since the server started.
+    "failures":      0,
+    "error":         None,   # Why the last backup failed, if it did.
+}
+
+
+# Environment variables that override where the project root and the production database are.
+# Mostly for the frozen (pyinstaller) builds, which can't use git to find the root.
+ROOT_ENV = "MTG_ROOT"
+DATABASE_ENV = "MTG_DATABASE"
+
+# get_proj_root() results, keyed on the working directory they were worked out from.
+# Cleared by set_path_config() whenever the configuration changes.
+_ROOT_CACHE = {}
+
+# The PRAGMAs applied to every pooled connection. Change them with configure_pool().
+DB_PROFILE = {
+    "cache_size":   -16000,     # Negative means KiB, so a 16MB page cache per connection.
+    "mmap_size":    268435456,  # Memory map up to 256MB of the database file for reads.
+    "busy_timeout": 5000,       # Wait up to 5s for the collector to finish writing instead of failing.
+}
+
+# The max number of idle connections kept open for each database.
+POOL_SIZE = 8
+
+# One pool per database file, created the first time the database is used.
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+
+class ConnectionPool:
+    """A thread safe pool of SQLite connections to a single database file.
+
+    A connection is only ever used by one thread at a time, but can move between waitress's
+    worker threads, so the connections are opened with check_same_thread=False.
+    """
+
+    def __init__(self, db, wal=True, size=POOL_SIZE, profile=None):
+        self.db = db
+        self.wal = wal
+        self.size = size
+        self.profile = dict(profile or DB_PROFILE)
+        self.idle = queue.LifoQueue(maxsize=size)
+        self.closed = False
+        # schema_v2.LAYOUT_V1 or LAYOUT_V2. Worked out once, when the pool is opened.
+        self.layout = schema_v2.LAYOUT_V1
+        # True if the rows are kept in shard files (shards.py) and this is the main database.
+        self.sharded = False
+
+    def open(self):
+        """Opens a new connection with the profile applied."""
+        conn = sqlite3.connect(self.db, check_same_thread=False,
+                               timeout=self.profile["busy_timeout"] / 1000)
+        try:
+            for pragma, value in self.profile.items():
+                conn.execute(f"PRAGMA {pragma} = {int(value)}")
+
+            # WAL lets our readers run while the collector is writing, and the other way around.
+            if self.wal:
+                conn.execute("PRAGMA journal_mode = WAL")
+        except sqlite3.Error:
+            # Don't leak the connection if the database is broken.
+            conn.close()
+            raise
+
+        return conn
+
+    def acquire(self):
+        """Gets an idle connection, or opens a new one if they are all in use."""
+        if self.closed:
+            raise sqlite3.ProgrammingError(f"Connection pool for {self.db} is closed")
+
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            return self.open()
+
+    def release(self, conn):
+        """Hands a connection back. Extra connections over the pool size are closed."""
+        # Never hand back a connection that is part way through a transaction.
+        if conn.in_transaction:
+            conn.rollback()
+
+        if self.closed:
+            conn.close()
+            return
+
+        try:
+            self.idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Borrows a connection for the length of a with block."""
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """Closes every idle connection. Connections still in use are closed when released."""
+        self.closed = True
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def get_pool(debug=0):
+    """Returns the connection pool for the database, creating it (and the tables) on first use."""
+    db = get_database(debug)
+    # The test databases are never sharded, they're checked in as single files.
+    return open_pool(db, production=(debug == 0), sharded=(debug == 0 and shards.is_sharded(db)))
+
+
+def open_pool(db, production=True, sharded=False):
+    """Returns the connection pool for a database file, creating it (and the tables) on first use.
+
+    production is False for the checked in test databases, which are left exactly as they are.
+    A sharded database keeps its component_statistic and process rows in shards (see shards.py).
+    """
+    with _POOLS_LOCK:
+        pool = _POOLS.get(db)
+        if pool is not None:
+            return pool
+
+        # The test databases are checked in, so leave their journal mode alone.
+        pool = ConnectionPool(db, wal=production)
+        pool.sharded = sharded
+
+        # The tables only need to be created (and migrated) once, not on every read.
+        try:
+            with pool.connection() as conn:
+                # A new database is v1 unless schema_v2.LAYOUT_ENV asks for v2. The shards are v1,
+                # so a sharded database is too.
+                if not sharded and schema_v2.wants_v2(conn):
+                    schema_v2.create_database(conn)
+                else:
+                    create_mtg_database(conn)
+                pool.layout = schema_v2.get_layout(conn)
+                if production:
+                    migrate_database(conn)
+        except sqlite3.Error:
+            pool.close()
+            raise
+
+        # The directory is what keeps the database sharded once MTG_SHARDS is unset.
+        if sharded:
+            os.makedirs(shards.shard_dir(db), exist_ok=True)
+
+        _POOLS[db] = pool
+        return pool
+
+
+def connect(debug=0):
+    """Borrows a pooled connection to the database: 'with db_interface.connect(debug) as conn:'"""
+    return get_pool(debug).connection()
+
+
+def get_layout(debug=0):
+    """Which layout the database uses, schema_v2.LAYOUT_V1 or LAYOUT_V2."""
+    return get_pool(debug).layout
+
+
+def get_shards(debug=0, start=None, end=None):
+    """The shards a read between start and end (text timestamps) has to look at along with the
+    database itself. Oldest first, and empty if the database isn't sharded.
+    """
+    if not get_pool(debug).sharded:
+        return []
+    return shards.overlapping(get_database(debug), parse_timestamp(start) if start else None,
+                              parse_timestamp(end) if end else None)
+
+
+def configure_pool(size=None, **profile):
+    """Changes the pool size and/or PRAGMA profile. Existing pools are closed so the change applies."""
+    global POOL_SIZE
+
+    if size is not None:
+        POOL_SIZE = size
+    DB_PROFILE.update(profile)
+    close_pools()
+
+
+def close_pools():
+    """Closes every pooled connection. Called when the server shuts down."""
+    with _POOLS_LOCK:
+        for pool in _POOLS.values():
+            pool.close()
+        _POOLS.clear()
+
+
+def close_pool(db):
+    """Closes the pool for one database file, before it's deleted."""
+    with _POOLS_LOCK:
+        pool = _POOLS.pop(db, None)
+    if pool is not None:
+        pool.close()
+
+
+# Make sure the connections (and the WAL) are closed cleanly when python exits.
+atexit.register(close_pools)
 
 
 def create_mtg_database(conn):
@@ -58,6 +387,34 @@ def create_mtg_database(conn):
     """)
 
 
+def get_schema_version(conn):
+    """Returns the schema version the database has been migrated to."""
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate_database(conn):
+    """Runs every migration the database hasn't had yet. Safe to call on an up to date database."""
+    version = get_schema_version(conn)
+
+    for migration_version, description, statements in MIGRATIONS:
+        # Skip the migrations that have already been run.
+        if migration_version <= version:
+            continue
+
+        # Each migration is all or nothing, including the bump of the version number.
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {int(migration_version)}")
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+
+    return get_schema_version(conn)
+
+
 def need_new_backup(backup_db):
     """Checks to see if we need a new backup. Should only create new backups every 6 hours."""
     # If no backup exists then we need one.
@@ -77,34 +434,261 @@ def need_new_backup(backup_db):
 
 
 def create_backup(debug=0):
-    """If a new backup is needed it will create one and delete the old backup."""
+    """If a new backup is needed it starts one on a background thread and returns the thread.
+
+    Returns None if no backup was needed. The old backups are deleted once the new one is written.
+    """
     # Get the path to the current database and do the checking to make sure it exists.
     db = get_database(debug)
     check_db(debug)
 
-    # Find all current backups and check to see if we need to create a new one.
-    current_backups = glob.glob(db + ".*")
-    if not need_new_backup(current_backups):
-        # If we don't then we can just return.
-        return
+    global _BACKUP_THREAD
+    with _BACKUP_LOCK:
+        # Only one backup at a time. Hand back the one that's already running.
+        if _BACKUP_THREAD is not None and _BACKUP_THREAD.is_alive():
+            return _BACKUP_THREAD
+
+        # Find all current backups and check to see if we need to create a new one.
+        current_backups = glob.glob(db + ".*")
+        if not need_new_backup(current_backups):
+            # If we don't then we can just return.
+            return None
+
+        # Set up the new backup.
+        new_backup = db + "." + datetime.datetime.now().strftime("%Y_%m_%d_%H")
+
+        # Only the shards written to since they were last backed up, usually just this month's.
+        shard_list = [shard for shard in get_shards(debug) if shards.changed_since_backup(shard)]
+
+        # The copy can take a while on a big database, so don't make the request wait for it.
+        _BACKUP_THREAD = threading.Thread(target=run_backup,
+                                          args=(db, new_backup, current_backups, shard_list),
+                                          name="mtg-backup", daemon=True)
+        _BACKUP_THREAD.start()
+        return _BACKUP_THREAD
+
+
+def run_backup(db, new_backup, old_backups=(), shard_list=()):
+    """Copies the database to new_backup with SQLite's online backup, then removes the old backups.
+
+    The copy is done BACKUP_PAGES pages at a time, sleeping BACKUP_SLEEP seconds in between so the
+    collector can keep writing. It's written to a temporary file first and renamed when complete,
+    so a backup file is never half written.
+
+    Each of shard_list is then backed up next to itself with the same suffix, replacing its older
+    backups. Shards that haven't changed since their last backup are left out by create_backup().
+    """
+    started = time.monotonic()
+    steps = 0
+    pages = 0
+
+    def progress(status, remaining, total):
+        """Called by SQLite after each step. The sleep is what lets the collector in."""
+        nonlocal steps, pages
+        steps += 1
+        pages += total if remaining == 0 else 0
+        time.sleep(BACKUP_SLEEP)
+
+    with _BACKUP_LOCK:
+        BACKUP_STATS.update(running=True, backup=new_backup, error=None,
+                            last_started=datetime.datetime.now().isoformat(timespec="seconds"))
+
+    suffix = new_backup[len(db):]
+    try:
+        copies = [(db, new_backup, old_backups)]
+        copies += [(shard.path, shard.path + suffix, glob.glob(shard.path + ".*")) for shard in shard_list]
+        for source, backup, old in copies:
+            copy_database(source, backup, progress)
+
+            # Remove all the old backups.
+            for old_backup in old:
+                if old_backup != backup and os.path.exists(old_backup):
+                    os.remove(old_backup)
+
+    except (sqlite3.Error, OSError) as error:
+        with _BACKUP_LOCK:
+            BACKUP_STATS.update(running=False, error=str(error), failures=BACKUP_STATS["failures"] + 1)
+        return False
+
+    with _BACKUP_LOCK:
+        BACKUP_STATS.update(running=False, pages=pages, steps=steps, shards=len(shard_list),
+                            count=BACKUP_STATS["count"] + 1, duration=round(time.monotonic() - started, 3),
+                            last_finished=datetime.datetime.now().isoformat(timespec="seconds"))
+    return True
+
+
+def copy_database(db, backup, progress):
+    """One online backup of db to backup, by way of a temporary file. progress is called after each step."""
+    # Doesn't match the db + ".*" pattern, so a leftover temp file is never mistaken for a backup.
+    temp_backup = db + "-backup.tmp"
+    try:
+        # Check if it already exists for some reason and delete it if needs be.
+        if os.path.exists(temp_backup):
+            os.remove(temp_backup)
+
+        source = sqlite3.connect(db, timeout=DB_PROFILE["busy_timeout"] / 1000)
+        target = sqlite3.connect(temp_backup)
+        try:
+            # sleep here is how long to wait when the database is locked, before trying again.
+            source.backup(target, pages=BACKUP_PAGES, progress=progress, sleep=BACKUP_SLEEP)
+        finally:
+            target.close()
+            source.close()
+
+        # A rename within a directory is atomic, the backup appears all at once.
+        os.replace(temp_backup, backup)
+    except (sqlite3.Error, OSError):
+        if os.path.exists(temp_backup):
+            os.remove(temp_backup)
+        raise
+
+
+def backup_stats():
+    """A copy of BACKUP_STATS, for monitoring."""
+    with _BACKUP_LOCK:
+        return dict(BACKUP_STATS)
+
+
+def delete_batch(conn, table, where, params, summaries=None):
+    """Runs one DELETE in its own write transaction. Returns the number of rows deleted.
+
+    If the table has summaries (rollups.Summaries) in this database, the buckets the rows were in
+    are recomputed in the same transaction, so the charts never show rows that have gone.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if summaries is not None and summaries.exists(conn):
+            deleted = summaries.delete_rows(conn, where, params)
+        else:
+            deleted = conn.execute(f"DELETE FROM {table} WHERE {where}", params).rowcount
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    return deleted
+
+
+def prune_v2_deletes(conn, cutoff, now, batch_size):
+    """The batched deletes that prune a v2 database, as (table, WHERE clause, params).
+
+    A row goes at whichever comes first of the max_age cutoff and the end of its retention batch's
+    lifetime, so each batch has a single bound. component_statistic is done a component at a time,
+    which makes every delete a range of the primary key. The process deletes use the timestamp index.
+    """
+    cutoff_ms = schema_v2.to_ms(cutoff)
+    now_ms = schema_v2.to_ms(now)
+
+    serials = schema_v2.serial_numbers(conn)
+    deletes = []
+    for batch, lifetime_ms in conn.execute("SELECT batch, lifetime_ms FROM retention").fetchall():
+        bound = max(cutoff_ms, now_ms - lifetime_ms)
+        for serial in serials:
+            deletes.append(("component_statistic",
+                            """serial_number = ?
+                               AND timestamp IN (SELECT timestamp FROM component_statistic
+                                                 WHERE serial_number = ? AND timestamp < ? AND batch = ?
+                                                 ORDER BY timestamp
+                                                 LIMIT ?)""", (serial, serial, bound, batch, batch_size)))
+        deletes.append(("process",
+                        """(pid, timestamp) IN (SELECT pid, timestamp FROM process
+                                                WHERE timestamp < ? AND batch = ?
+                                                LIMIT ?)""", (bound, batch, batch_size)))
+    return deletes
+
 
-    # Set up the new backup.
-    new_backup = db + "." + datetime.datetime.now().strftime("%Y_%m_%d_%H")
+@instrumentation.timed_query(rows=lambda result: result["rows"])
+def prune_database(max_age, debug=0, batch_size=None, yield_interval=None, now=None):
+    """Deletes rows older than max_age (a timedelta) or past their end of life, a batch at a time.
 
-    # Check if it already exists for some reason and delete it if needs be.
-    if os.path.exists(new_backup):
-        os.remove(new_backup)
+    Does the same as 'OpenHardwareMonitor.exe prune-now', without the long write lock.
+    Returns the number of rows deleted from each table and how fast it went. The rows in the
+    shards that were deleted whole aren't counted, the shards are listed in shards_dropped.
+    """
+    batch_size = batch_size or PRUNE_BATCH_SIZE
+    yield_interval = PRUNE_YIELD if yield_interval is None else yield_interval
 
-    # Copy the current database to its backup.
-    shutil.copy(db, new_backup)
+    # Stored the same way the collector stores them, so they compare as strings.
+    now = now or datetime.datetime.now()
+    cutoff = (now - max_age).strftime("%Y-%m-%d %H:%M:%S.%f")
+    current = now.strftime("%Y-%m-%d %H:%M:%S.%f")
 
-    # Remove all the old backups.
-    for backup in current_backups:
-        os.remove(backup)
+    started = time.monotonic()
+    deleted = {table: 0 for table in PRUNE_TABLES}
+    batches = 0
+
+    # Shards that end before the cutoff only hold rows that would be deleted, so the whole file goes.
+    # That's instant, however many rows are in it.
+    dropped = []
+    if get_pool(debug).sharded:
+        dropped = shards.drop_expired(get_database(debug), now - max_age)
+
+    summaries = {}
+    if get_layout(debug) == schema_v2.LAYOUT_V2:
+        # There are no rollups or process summaries in v2, the reads group the raw rows.
+        with connect(debug) as conn:
+            deletes = prune_v2_deletes(conn, now - max_age, now, batch_size)
+    else:
+        # One pass per column instead of 'timestamp < ? OR end_of_life < ?', so each pass uses its index.
+        # The rowids are found with the column's index, then deleted by rowid, so the write lock is only
+        # held for batch_size rows no matter how many rows are old.
+        deletes = [(table, f"""rowid IN (SELECT rowid FROM {table}
+                                         WHERE {column} < ?
+                                         LIMIT ?)""", (bound, batch_size))
+                   for table in PRUNE_TABLES
+                   for column, bound in [("timestamp", cutoff), ("end_of_life", current)]]
+        summaries = PRUNE_SUMMARIES
+
+    # The shards left can still have rows past their end of life, and the oldest straddles the cutoff.
+    pools = [get_pool(debug)] + [shards.get_pool(shard.path) for shard in get_shards(debug)]
+    for pool in pools:
+        for table, where, params in deletes:
+            while True:
+                # Give the connection back between batches, it isn't needed while we sleep.
+                with pool.connection() as conn:
+                    rows = delete_batch(conn, table, where, params, summaries.get(table))
+                deleted[table] += rows
+                batches += 1
+
+                # A short batch means there's nothing left.
+                if rows < batch_size:
+                    break
+                time.sleep(yield_interval)
+
+    # Components with no statistics left, same as the executable. The component table is tiny.
+    with connect(debug) as conn:
+        if get_pool(debug).sharded:
+            # The statistics are spread over the shards, which can't be joined into a DELETE.
+            # (A database can't be attached in the middle of a transaction.)
+            arm = "SELECT DISTINCT serial_number FROM {db}.component_statistic"
+            used = {serial_number for serial_number, in shards.fetch(conn, get_shards(debug), arm)}
+            unused = [(serial_number,) for serial_number, in conn.execute("SELECT serial_number FROM component")
+                      if serial_number not in used]
+            with conn:
+                deleted["component"] = conn.executemany("DELETE FROM component WHERE serial_number = ?",
+                                                        unused).rowcount
+        else:
+            with conn:
+                deleted["component"] = conn.execute("""DELETE FROM component
+                                                       WHERE serial_number NOT IN
+                                                       (SELECT DISTINCT serial_number FROM component_statistic)
+                                                    """).rowcount
+
+    seconds = time.monotonic() - started
+    total = sum(deleted.values())
+    return {
+        "deleted":         deleted,
+        "rows":            total,
+        "batches":         batches,
+        "seconds":         round(seconds, 3),
+        "rows_per_second": round(total / seconds) if seconds else total,
+        "shards_dropped":  [os.path.basename(shard.path) for shard in dropped],
+    }
 
 
 def get_git_root():
     """Finds the git root if we are in a git checkout. NOTE: This official releases are not in a checkout"""
+    # Imported here, it's only needed the first time the root is worked out (and never when frozen).
+    import subprocess
     try:
         # Try to call the git root.
         root = subprocess.check_output(
@@ -112,8 +696,8 @@ def get_git_root():
             stderr=subprocess.DEVNULL).decode('utf-8').strip()
         # Return it if found
         return root
-    except subprocess.CalledProcessError:
-        # Otherwise return None
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        # Otherwise return None. FileNotFoundError means git isn't installed at all.
         return None
 
     return None
@@ -144,17 +728,45 @@ def rebuild_path(split_path):
     return os.getcwd()
 
 
-def get_proj_root():
-    """Finds the project root."""
-    # If we have a git root just use that.
-    if get_git_root():
-        return get_git_root()
+def find_proj_root():
+    """Works out the project root. Slow, since it may need to call git, so use get_proj_root()."""
+    # Frozen releases are never in a git checkout, so don't bother asking git.
+    if not getattr(sys, 'frozen', False):
+        # If we have a git root just use that.
+        git_root = get_git_root()
+        if git_root:
+            return git_root
 
     # Otherwise split the path into it's components and try to rebuild it.
     split_path = list(pathlib.Path(os.getcwd()).parts)
     return rebuild_path(split_path)
 
 
+def get_proj_root():
+    """Finds the project root. Only worked out once, after that the cached value is used."""
+    # An explicit root always wins.
+    override = os.environ.get(ROOT_ENV)
+    if override:
+        return os.path.abspath(override)
+
+    # The root depends on where we were started from, so that's what the cache is keyed on.
+    cwd = os.getcwd()
+    if cwd not in _ROOT_CACHE:
+        _ROOT_CACHE[cwd] = find_proj_root()
+    return _ROOT_CACHE[cwd]
+
+
+def set_path_config(root=None, database=None):
+    """Sets the project root and/or production database overrides and clears the cached root."""
+    if root:
+        os.environ[ROOT_ENV] = os.path.abspath(root)
+    if database:
+        os.environ[DATABASE_ENV] = os.path.abspath(database)
+
+    # The configuration changed, so anything we worked out before may be wrong now.
+    _ROOT_CACHE.clear()
+
+
 def get_database(debug):
     """Returns the path of a database depending on the debug level."""
     # If there is a git root then we set the root to the sample dbs.
@@ -165,7 +777,8 @@ def get_database(debug):
     sample_path = "Display/tests/sample_dbs"
 
     if debug == 0:
-        return os.path.join(root, "metrics.db")
+        # An explicit production database always wins.
+        return os.environ.get(DATABASE_ENV) or os.path.join(root, "metrics.db")
     elif debug == 1:
         return os.path.join(root, sample_path, "metrics.db")
     elif debug == 2:
@@ -188,33 +801,37 @@ def check_db(debug=0):
     if debug > 0:
         return
 
-    # Get the path to the database
-    db = get_database(debug)
-    conn = sqlite3.connect(db)
+    # Opening the pool creates the database and tables if they don't exist,
+    # then upgrades it to the latest schema.
+    get_pool(debug)
 
-    # Create the database and tables if they don't exist.
-    create_mtg_database(conn)
-    conn.close()
 
+@instrumentation.timed_query()
+def read_metrics(debug=0, start=None, end=None):
+    """Pulls out the metrics data from the database.
 
-def read_metrics(debug=0):
-    """Pulls out the metrics data from the database."""
-    # Get the path to the database.
-    db = get_database(debug)
-    conn = sqlite3.connect(db)
+    With a start and/or end only that window is read, from the raw rows or the hourly/daily
+    rollups depending on how long the window is.
+    """
+    # A window goes through the same path as the charts.
+    if start or end:
+        return read_metrics_window(debug, start, end)
 
-    # Create the database and tables if they don't exist.
-    create_mtg_database(conn)
-    cursor = conn.cursor()
+    # v2 stores epoch milliseconds, which are turned back into text timestamps for the page.
+    timestamp = "t1.timestamp"
+    if get_layout(debug) == schema_v2.LAYOUT_V2:
+        timestamp = schema_v2.to_text_sql(timestamp)
 
-    # Get the metrics and device type for each component.
-    output = cursor.execute("""
-        SELECT t1.serial_number, t1.timestamp, t1.temperature, t1.usage, t1.power_consumption, 
-               t1.core_speed, t1.memory_speed, t1.total_ram, t2.device_type
-        FROM 'component_statistic' t1 
-        JOIN 'component' t2 
-        ON t1.serial_number = t2.serial_number
-    """).fetchall()
+    # Borrow a connection from the pool. The tables were created when the pool was opened.
+    with connect(debug) as conn:
+        # Get the metrics and device type for each component, from every shard if it's sharded.
+        output = shards.fetch(conn, get_shards(debug), f"""
+            SELECT t1.serial_number, {timestamp}, t1.temperature, t1.usage, t1.power_consumption,
+                   t1.core_speed, t1.memory_speed, t1.total_ram, t2.device_type
+            FROM {{db}}.component_statistic t1
+            JOIN main.component t2
+            ON t1.serial_number = t2.serial_number
+        """)
 
     component_dict = {}
 
@@ -251,18 +868,782 @@ def read_metrics(debug=0):
     return component_dict
 
 
+@instrumentation.timed_query()
+def read_metrics_window(debug=0, start=None, end=None):
+    """read_metrics() for a window. Each row is [timestamp, temperature, usage, ...] like read_metrics()."""
+    columns = list(METRIC_COLUMNS)
+    component_dict = {}
+    layout = get_layout(debug)
+
+    # Borrow a connection from the pool. The tables were created when the pool was opened.
+    with connect(debug) as conn:
+        components = conn.execute("""SELECT serial_number, device_type
+                                     FROM component
+                                     ORDER BY rowid""").fetchall()
+
+        shard_list = get_shards(debug, start, end)
+        for serial_number, device_type in components:
+            _, rows = read_series(conn, get_database(debug), serial_number, columns, start, end, layout, shard_list)
+            if rows:
+                component_dict[f"{serial_number} ({device_type})"] = rows
+
+    # If no entries were found (empty database) then we want to return SOMETHING.
+    if not component_dict:
+        component_dict["No Components Found"] = [0]
+
+    return component_dict
+
+
+@instrumentation.timed_query(rows=lambda datasets: sum(len(series["timestamp"]) for series in datasets.values()))
+def read_metrics_columnar(debug=0):
+    """The same data as read_metrics(), but each component gets a columnar (numpy) series.
+
+    The key is the same 'serial (device)' string and the value is a dictionary of arrays,
+    see columnar.py. columnar.to_datasets() turns the result back into the read_metrics() format.
+    """
+    # Only loaded when it's needed. numpy is slow to import and optional.
+    import columnar
+    columnar.require_numpy()
+
+    # The timestamps are turned into epoch milliseconds in SQL, so python never has to parse them.
+    # v2 already stores them that way.
+    timestamp = f"CAST(ROUND((julianday(timestamp) - {columnar.JULIAN_EPOCH}) * 86400000) AS INTEGER)"
+    if get_layout(debug) == schema_v2.LAYOUT_V2:
+        timestamp = "timestamp"
+    values = ", ".join(METRIC_COLUMNS[name] for name in columnar.COLUMNS)
+    query = f"""SELECT serial_number, {timestamp}, {values}
+                FROM {{db}}.component_statistic"""
+
+    # Borrow a connection from the pool. The tables were created when the pool was opened.
+    with connect(debug) as conn:
+        # Same as the join in read_metrics(), only components in the component table are returned.
+        keys = {serial_number: f"{serial_number} ({device_type})"
+                for serial_number, device_type in conn.execute("""SELECT serial_number, device_type
+                                                                  FROM component""")}
+
+        # A straight scan of the table (and the shards), the grouping and sorting is done in numpy.
+        with shards.federated(conn, get_shards(debug), query) as cursor:
+            datasets = columnar.from_cursor(cursor, keys)
+
+    return datasets
+
+
+def process_query(layout):
+    """The SELECT list and FROM clause for process table rows, and the columns to sort by (PROCESS_COLUMNS).
+
+    v2 rows are turned back into the v1 shape: text timestamps and an end_of_life. The FROM clause
+    has {db} where the schema goes, see shards.federated().
+    """
+    if layout == schema_v2.LAYOUT_V2:
+        select = (f"pid, {schema_v2.to_text_sql('timestamp')}, cpu_usage, memory_usage, "
+                  f"{schema_v2.to_text_sql('timestamp + lifetime_ms')}")
+        return select, "{db}.process LEFT JOIN {db}.retention USING (batch)", PROCESS_COLUMNS_V2
+    return "pid, timestamp, cpu_usage, memory_usage, end_of_life", "{db}.process", PROCESS_COLUMNS
+
+
+@instrumentation.timed_query()
 def read_processes(debug=0):
     """Pulls the processes out of the database."""
-    # Get the path to the database.
+    select, source, _ = process_query(get_layout(debug))
+
+    # Borrow a connection from the pool. The tables were created when the pool was opened.
+    with connect(debug) as conn:
+        # Simply pull the columns we care about and return them.
+        output = shards.fetch(conn, get_shards(debug), f"""SELECT {select}
+                                                          FROM {source}
+                                                          ORDER BY pid""",
+                              merge="SELECT * FROM ({arms}) ORDER BY 1, 2")
+    return output
+
+
+@instrumentation.timed_query(rows=lambda total: 1)
+def count_processes(debug=0):
+    """Returns the number of rows in the process table.
+
+    COUNT(*) has to walk the whole table, so the result is cached. It's counted again when rows
+    are added or removed at either end of the table (the rowid range changes) or after COUNT_TTL.
+    """
     db = get_database(debug)
-    conn = sqlite3.connect(db)
+    shard_list = get_shards(debug)
+    # v2 tables have no rowid. The timestamp index gives the same thing, the oldest and newest rows.
+    key = "timestamp" if get_layout(debug) == schema_v2.LAYOUT_V2 else "rowid"
+    with connect(debug) as conn:
+        # MIN/MAX are a single lookup each, much cheaper than the count. They have to be separate
+        # subqueries, asking for both in one SELECT makes SQLite scan the table.
+        # A sharded database has a range for each shard, so a shard coming or going changes it too.
+        rowids = shards.fetch(conn, shard_list, f"""SELECT (SELECT MIN({key}) FROM {{db}}.process),
+                                                           (SELECT MAX({key}) FROM {{db}}.process)""")
 
-    # Create the database and tables if they don't exist.
-    create_mtg_database(conn)
-    cursor = conn.cursor()
+        cached = _PROCESS_COUNTS.get(db)
+        now = datetime.datetime.now()
+        if cached and cached[0] == rowids and (now - cached[1]).total_seconds() < COUNT_TTL:
+            return cached[2]
 
-    # Simply pull the columns we care about and return them.
-    output = cursor.execute("""SELECT pid, timestamp, cpu_usage, memory_usage, end_of_life
-                               FROM process 
-                               ORDER BY pid""").fetchall()
-    return output
+        count = shards.fetch(conn, shard_list, "SELECT COUNT(*) AS n FROM {db}.process",
+                             merge="SELECT SUM(n) AS n FROM ({arms})")[0][0]
+
+    _PROCESS_COUNTS[db] = (rowids, now, count)
+    return count
+
+
+def process_search(search, layout=schema_v2.LAYOUT_V1):
+    """Builds the WHERE clause for the process table's search box.
+
+    Only searches that can use an index are supported: an exact pid, or the start of a timestamp
+    such as '2025-04-17'.
+    """
+    search = (search or "").strip()
+    if not search:
+        return "", []
+
+    # A number is a pid. It can't also be tried as a timestamp, since the timestamp column would
+    # compare it as a number (which sorts before every text timestamp) and match every row.
+    if search.isdigit():
+        return "WHERE pid = ?", [int(search)]
+    # Any other number (1.5, 1e3) can't be a pid or a timestamp, so nothing matches.
+    try:
+        float(search)
+        return "WHERE 0", []
+    except ValueError:
+        pass
+
+    # v2 timestamps are milliseconds, so the search is turned into the range of milliseconds it covers.
+    if layout == schema_v2.LAYOUT_V2:
+        try:
+            return "WHERE timestamp >= ? AND timestamp <= ?", [schema_v2.bound_ms(search),
+                                                                schema_v2.bound_ms(search, upper=True)]
+        except ValueError:
+            return "WHERE 0", []
+
+    # '2025-04-17 18' matches every timestamp in that hour, the same as normalize_timestamp() does.
+    return "WHERE timestamp >= ? AND timestamp <= ?", [search.replace("T", " "),
+                                                        normalize_timestamp(search, upper=True)]
+
+
+@instrumentation.timed_query(rows=lambda page: len(page[2]))
+def read_process_page(debug=0, start=0, length=10, order_column=0, order_dir="asc", search="", host=None):
+    """Pulls one page of the process table out of the database.
+
+    The sorting, searching and paging are all done by SQLite, so only the rows on the page are read.
+    host limits it to one machine of a central database (ingest.py). Any other database only has
+    the one machine's processes, and no host column, so the host is ignored.
+    Returns (total rows, rows matching the search and host, the page of rows).
+    """
+    # Never put user input straight into SQL. The column comes from PROCESS_COLUMNS by position.
+    if not 0 <= order_column < len(PROCESS_COLUMNS):
+        order_column = 0
+    direction = "DESC" if str(order_dir).lower() == "desc" else "ASC"
+
+    # DataTables asks for -1 rows when the user picks 'All'.
+    if length is None or length < 0 or length > MAX_PAGE_LENGTH:
+        length = MAX_PAGE_LENGTH
+    start = max(start or 0, 0)
+
+    total = count_processes(debug)
+    layout = get_layout(debug)
+    select, source, columns = process_query(layout)
+    where, params = process_search(search, layout)
+    shard_list = get_shards(debug)
+
+    with connect(debug) as conn:
+        if host and process_analytics.host_column(conn) == "host":
+            where = f"{where} AND host = ?" if where else "WHERE host = ?"
+            params = params + [host]
+
+        # Without a search (or host) every row matches, so the cached count can be used.
+        filtered = total
+        if where:
+            filtered = shards.fetch(conn, shard_list, f"SELECT COUNT(*) AS n FROM {{db}}.process {where}",
+                                    params, merge="SELECT SUM(n) AS n FROM ({arms})")[0][0]
+
+        # pid, timestamp is the primary key, so adding it makes the order (and the pages) stable.
+        arm = f"""SELECT {select}
+                  FROM {source}
+                  {where}
+                  ORDER BY {columns[order_column]} {direction}, pid, timestamp
+                  LIMIT ? OFFSET ?"""
+        # With shards, the page is somewhere in the first start + length rows of each of them. Those
+        # are put in order and the page is taken from that. The select list is in PROCESS_COLUMNS order.
+        page = [start + length, 0] if shard_list else [length, start]
+        merge = f"""SELECT * FROM ({{arms}})
+                    ORDER BY {order_column + 1} {direction}, 1, 2
+                    LIMIT ? OFFSET ?"""
+        rows = shards.fetch(conn, shard_list, arm, params + page, merge, [length, start],
+                            partial_params=[start + length, 0])
+
+    return total, filtered, rows
+
+
+def normalize_timestamp(timestamp, upper=False):
+    """Turns a user supplied timestamp into something we can compare with the database.
+
+    The browser sends '2025-04-17T18:17' but the database stores '2025-04-17 18:17:30.9250629'.
+    Since they compare as strings, an upper bound is padded so the whole minute/second is included.
+    """
+    # No timestamp means no bound.
+    if not timestamp:
+        return None
+
+    timestamp = timestamp.strip().replace("T", " ")
+
+    # '~' sorts after every digit, space, colon and dot so '18:17~' is after every '18:17:xx.xxx'.
+    if upper:
+        timestamp += "~"
+
+    return timestamp
+
+
+@instrumentation.timed_query()
+def read_devices(debug=0, host=None):
+    """Lists each component with its first and last timestamp. Cheap enough to embed in a page.
+
+    host limits it to the components of one machine in a central database (ingest.py).
+    """
+    devices = []
+
+    first_sql, last_sql = [f"""(SELECT {aggregate}(timestamp) FROM {{db}}.component_statistic s
+                                 WHERE s.serial_number = c.serial_number)""" for aggregate in ("MIN", "MAX")]
+    # v2 timestamps are turned back into text, like the rest of the page.
+    if get_layout(debug) == schema_v2.LAYOUT_V2:
+        first_sql, last_sql = schema_v2.to_text_sql(first_sql), schema_v2.to_text_sql(last_sql)
+
+    # Borrow a connection from the pool. The tables were created when the pool was opened.
+    with connect(debug) as conn:
+        # Only the component table is scanned, which is a handful of rows.
+        components = conn.execute("""SELECT serial_number, device_type
+                                     FROM component
+                                     ORDER BY rowid""").fetchall()
+
+        # MIN/MAX on a prefix of the primary key are single index lookups, not scans. A sharded
+        # database has them for each shard, so the earliest first and the latest last are taken.
+        ranges = {serial_number: (first, last)
+                  for serial_number, first, last in shards.fetch(conn, get_shards(debug), f"""
+                      SELECT c.serial_number, {first_sql} AS first, {last_sql} AS last
+                      FROM main.component c""", merge="""
+                      SELECT serial_number, MIN(first) AS first, MAX(last) AS last
+                      FROM ({arms})
+                      GROUP BY serial_number""")}
+
+    for serial_number, device_type in components:
+        if host and not serial_number.startswith(host + HOST_SEPARATOR):
+            continue
+        first, last = ranges.get(serial_number, (None, None))
+
+        # Components without any statistics have nothing to draw, so leave them out.
+        if first is None:
+            continue
+
+        devices.append({
+            # The key is the same 'serial (device)' string used for the drop-downs in read_metrics().
+            "key":           f"{serial_number} ({device_type})",
+            "serial_number": serial_number,
+            "device_type":   device_type,
+            "first":         first,
+            "last":          last,
+        })
+
+    return devices
+
+
+def parse_timestamp(timestamp):
+    """Turns a database or browser timestamp into a datetime, ignoring anything after the seconds."""
+    timestamp = timestamp.rstrip("~").replace("T", " ")[:19]
+    for pattern in ["%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"]:
+        try:
+            return datetime.datetime.strptime(timestamp, pattern)
+        except ValueError:
+            continue
+
+    # Something we can't understand, like an emoji.
+    return None
+
+
+def refresh_rollups(conn, db, shard_list=()):
+    """Catches the rollups up with any rows the collector added since the last refresh."""
+    rollups.maybe_refresh_rollups(conn, db)
+    # Each shard has its own rollups. A bucket never spans two shards, they all start on a day.
+    for shard in shard_list:
+        with shards.get_pool(shard.path).connection() as shard_conn:
+            rollups.maybe_refresh_rollups(shard_conn, shard.path)
+
+
+def read_series(conn, db, serial_number, columns, start=None, end=None, layout=schema_v2.LAYOUT_V1,
+                shard_list=()):
+    """Reads [timestamp, column values...] rows for one component between start and end.
+
+    Long windows are read from the hourly or daily rollups instead of the raw rows.
+    shard_list is the shards to read along with the database (get_shards()).
+    Returns the resolution that was used ('raw', 'hourly' or 'daily') and the rows.
+    """
+    if layout == schema_v2.LAYOUT_V2:
+        return read_series_v2(conn, serial_number, columns, start, end)
+
+    start = normalize_timestamp(start)
+    end = normalize_timestamp(end, upper=True)
+
+    # An open ended window runs to the first/last sample. These are primary key lookups, in each shard.
+    first = start or shards.fetch(conn, shard_list, """SELECT MIN(timestamp) AS value FROM {db}.component_statistic
+                                                       WHERE serial_number = ?""", (serial_number,),
+                                  merge="SELECT MIN(value) AS value FROM ({arms})")[0][0]
+    last = end or shards.fetch(conn, shard_list, """SELECT MAX(timestamp) AS value FROM {db}.component_statistic
+                                                    WHERE serial_number = ?""", (serial_number,),
+                               merge="SELECT MAX(value) AS value FROM ({arms})")[0][0]
+
+    # Work out which table to read from. The test databases don't have the rollups.
+    resolution = rollups.RAW
+    if first and last:
+        first_time = parse_timestamp(str(first))
+        last_time = parse_timestamp(str(last))
+        if first_time and last_time and rollups.has_rollups(conn):
+            resolution = rollups.choose_resolution(first_time, last_time)
+
+    if resolution != rollups.RAW:
+        refresh_rollups(conn, db, shard_list)
+        values = [METRIC_COLUMNS[column] for column in columns]
+        query, params = rollups.rollup_query(resolution, serial_number, values, start, end, schema="{db}")
+        return resolution, [list(row) for row in shards.fetch(conn, shard_list, query, params,
+                                                              merge="SELECT * FROM ({arms}) ORDER BY 1")]
+
+    # The (serial_number, timestamp) primary key means this only reads the rows in the window.
+    query = f"""SELECT timestamp, {", ".join(METRIC_COLUMNS[column] for column in columns)}
+                FROM {{db}}.component_statistic
+                WHERE serial_number = ?"""
+    params = [serial_number]
+    if start:
+        query += " AND timestamp >= ?"
+        params.append(start)
+    if end:
+        query += " AND timestamp <= ?"
+        params.append(end)
+    query += " ORDER BY timestamp"
+
+    return resolution, [list(row) for row in shards.fetch(conn, shard_list, query, params,
+                                                          merge="SELECT * FROM ({arms}) ORDER BY 1")]
+
+
+def read_series_v2(conn, serial_number, columns, start=None, end=None):
+    """read_series() for the v2 layout.
+
+    There are no rollup tables in v2. Long windows are averaged into hourly or daily buckets in SQL
+    instead, which only reads the component's slice of the clustered primary key.
+    """
+    try:
+        start_ms = schema_v2.bound_ms(start)
+        end_ms = schema_v2.bound_ms(end, upper=True)
+    except ValueError:
+        # Something that isn't a timestamp can't be compared with milliseconds, so nothing matches.
+        return rollups.RAW, []
+
+    # An open ended window runs to the first/last sample. These are primary key lookups.
+    # (Asking for MIN and MAX in one query would read every row in between.)
+    first, last = start_ms, end_ms
+    if first is None:
+        first = conn.execute("""SELECT MIN(timestamp) FROM component_statistic
+                                WHERE serial_number = ?""", (serial_number,)).fetchone()[0]
+    if last is None:
+        last = conn.execute("""SELECT MAX(timestamp) FROM component_statistic
+                               WHERE serial_number = ?""", (serial_number,)).fetchone()[0]
+
+    resolution = rollups.RAW
+    if first is not None and last is not None:
+        resolution = rollups.choose_resolution(schema_v2.from_ms(first), schema_v2.from_ms(last))
+
+    values = [METRIC_COLUMNS[column] for column in columns]
+    if resolution == rollups.RAW:
+        select = ", ".join([schema_v2.to_text_sql("timestamp")] + values)
+        group = ""
+        order = "timestamp"
+    else:
+        # Labelled with the start of the bucket, the same as the rollup tables.
+        bucket = schema_v2.BUCKET_MS[resolution]
+        label = f"strftime('%Y-%m-%d %H:%M:%S', timestamp / {bucket} * {bucket} / 1000, 'unixepoch')"
+        select = ", ".join([label] + [f"AVG({rollups.numeric(value)})" for value in values])
+        group = f"GROUP BY timestamp / {bucket}"
+        order = "1"
+        # Include the bucket the start falls in, so a window never starts with a gap.
+        if start_ms is not None:
+            start_ms = start_ms // bucket * bucket
+
+    query = f"""SELECT {select}
+                FROM component_statistic
+                WHERE serial_number = ?"""
+    params = [serial_number]
+    if start_ms is not None:
+        query += " AND timestamp >= ?"
+        params.append(start_ms)
+    if end_ms is not None:
+        query += " AND timestamp <= ?"
+        params.append(end_ms)
+    query += f" {group} ORDER BY {order}"
+
+    return resolution, [list(row) for row in conn.execute(query, params)]
+
+
+@instrumentation.timed_query(rows=lambda series: len(series["points"]))
+def read_metric_range(serial_number, column, start=None, end=None,
+                      max_points=downsample.DEFAULT_MAX_POINTS, debug=0):
+    """Pulls a single metric for a single component between start and end (inclusive).
+
+    Returns the resolution that was read ('raw', 'hourly' or 'daily') and a list of
+    [timestamp, value] pairs downsampled to max_points.
+    """
+    # Only ever allow the known columns into the SQL.
+    if column not in METRIC_COLUMNS:
+        raise ValueError(f"Unknown metric column: {column}")
+
+    # Borrow a connection from the pool. The tables were created when the pool was opened.
+    with connect(debug) as conn:
+        resolution, rows = read_series(conn, get_database(debug), serial_number, [column], start, end,
+                                       get_layout(debug), get_shards(debug, start, end))
+
+    # Thin the series out before it is handed to the browser.
+    return {
+        "resolution": resolution,
+        "points": downsample.lttb(rows, max_points, columns=(1,)),
+    }
+
+
+def summary_buckets(conn, db, shard_list, start, end):
+    """Works out which rollup read_summary() can use for a v1 window, and the buckets wholly inside it.
+
+    start and end are normalized timestamps. Returns the resolution and the (first, stop) buckets
+    for rollups.summary_query(), or ('raw', None) when the raw rows have to be read.
+    """
+    # An open ended window runs to the first/last sample. The timestamp index makes these lookups.
+    first = start or shards.fetch(conn, shard_list, "SELECT MIN(timestamp) AS value FROM {db}.component_statistic",
+                                  merge="SELECT MIN(value) AS value FROM ({arms})")[0][0]
+    last = end or shards.fetch(conn, shard_list, "SELECT MAX(timestamp) AS value FROM {db}.component_statistic",
+                               merge="SELECT MAX(value) AS value FROM ({arms})")[0][0]
+
+    # The test databases don't have the rollups.
+    first_time = parse_timestamp(str(first)) if first else None
+    last_time = parse_timestamp(str(last)) if last else None
+    if not first_time or not last_time or not rollups.has_rollups(conn):
+        return rollups.RAW, None
+    resolution = rollups.choose_resolution(first_time, last_time)
+    if resolution == rollups.RAW:
+        return resolution, None
+
+    table = rollups.RESOLUTIONS[resolution]
+    bucket_format = rollups.BUCKET_FORMATS[table]
+
+    # The first bucket that starts at or after the start. Compared as strings, like the timestamps.
+    first_bucket = None
+    if start:
+        first_bucket = first_time.strftime(bucket_format)
+        if first_bucket < start:
+            first_bucket = (datetime.datetime.strptime(first_bucket, "%Y-%m-%d %H:%M:%S") +
+                            rollups.BUCKET_SIZES[table]).strftime(bucket_format)
+    # The bucket the end (or the last sample) falls in. It's read raw, so the newest rows are always counted.
+    stop = last_time.strftime(bucket_format)
+    if first_bucket and first_bucket >= stop:
+        return rollups.RAW, None
+
+    refresh_rollups(conn, db, shard_list)
+    return resolution, (first_bucket, stop)
+
+
+def read_percentile(conn, shard_list, serial_number, column, count, start=None, end=None,
+                    percentile=SUMMARY_PERCENTILE):
+    """The percentile of one component's column between start and end, interpolated like numpy's.
+
+    count is how many numbers there are in the window (from the summary). Only the two values either
+    side of the percentile are sent back, and SQLite only keeps the largest (100 - percentile)% of
+    the rows while sorting.
+    """
+    # The positions (smallest first) either side of the percentile, like numpy.percentile().
+    position = percentile / 100 * (count - 1)
+    lower = math.floor(position)
+    upper = min(lower + 1, count - 1)
+
+    value = rollups.numeric(column)
+    query = f"""SELECT {value} AS value
+                FROM {{db}}.component_statistic
+                WHERE serial_number = ? AND value IS NOT NULL"""
+    params = [serial_number]
+    if start is not None:
+        query += " AND timestamp >= ?"
+        params.append(start)
+    if end is not None:
+        query += " AND timestamp <= ?"
+        params.append(end)
+    query += " ORDER BY value DESC LIMIT ? OFFSET ?"
+
+    # Largest first, so the offset is counted from the top. With shards, each one sends its largest
+    # count - lower rows, and the two values are picked out of those.
+    keep = count - lower
+    limit, offset = upper - lower + 1, count - 1 - upper
+    rows = shards.fetch(conn, shard_list, query, params + ([keep, 0] if shard_list else [limit, offset]),
+                        merge="SELECT * FROM ({arms}) ORDER BY value DESC LIMIT ? OFFSET ?",
+                        merge_params=[limit, offset], partial_params=[keep, 0])
+    if not rows:
+        return None
+
+    high, low = rows[0][0], rows[-1][0]
+    return low + (high - low) * (position - lower)
+
+
+@instrumentation.timed_query(rows=lambda summary: len(summary["components"]))
+def read_summary(debug=0, start=None, end=None, columns=SUMMARY_COLUMNS, host=None):
+    """Summarizes each component's columns between start and end (inclusive).
+
+    Each column gets its count, min, max, mean and 95th percentile, worked out by SQLite in one
+    grouped pass rather than sending the rows to python. Long windows read the whole buckets from
+    the hourly/daily rollups and only the raw rows at either end. The percentile needs the values
+    themselves, so it's read from the raw rows, see read_percentile().
+    host limits it to the components of one machine in a central database (ingest.py).
+    """
+    # Only ever allow the known columns into the SQL.
+    for column in columns:
+        if column not in METRIC_COLUMNS:
+            raise ValueError(f"Unknown metric column: {column}")
+    values = [METRIC_COLUMNS[column] for column in columns]
+
+    layout = get_layout(debug)
+    shard_list = get_shards(debug, start, end)
+    summary = {"start": start, "end": end, "resolution": rollups.RAW, "components": []}
+
+    # Borrow a connection from the pool. The tables were created when the pool was opened.
+    with connect(debug) as conn:
+        if layout == schema_v2.LAYOUT_V2:
+            # There are no rollups in v2, the clustered primary key keeps the raw read cheap.
+            try:
+                lower, upper = schema_v2.bound_ms(start), schema_v2.bound_ms(end, upper=True)
+            except ValueError:
+                # Something that isn't a timestamp can't be compared with milliseconds, so nothing matches.
+                return summary
+            resolution, whole = rollups.RAW, None
+        else:
+            lower, upper = normalize_timestamp(start), normalize_timestamp(end, upper=True)
+            resolution, whole = summary_buckets(conn, get_database(debug), shard_list, lower, upper)
+        summary["resolution"] = resolution
+
+        query, params = rollups.summary_query(values, lower, upper, resolution, whole, schema="{db}")
+        totals = {row[0]: row[1:] for row in shards.fetch(conn, shard_list, query, params, merge=f"""
+                      SELECT {rollups.summary_select(values)}
+                      FROM ({{arms}})
+                      GROUP BY serial_number""")}
+
+        components = conn.execute("""SELECT serial_number, device_type
+                                     FROM component
+                                     ORDER BY rowid""").fetchall()
+        for serial_number, device_type in components:
+            if host and not serial_number.startswith(host + HOST_SEPARATOR):
+                continue
+            # Components without any statistics in the window have nothing to summarize.
+            if serial_number not in totals:
+                continue
+
+            stats = {}
+            for index, (column, value) in enumerate(zip(columns, values)):
+                count, low, high, total = totals[serial_number][index * 4:index * 4 + 4]
+                if not count:
+                    stats[column] = {"count": 0, "min": None, "max": None, "mean": None, "p95": None}
+                    continue
+                stats[column] = {
+                    "count": count,
+                    "min":   low,
+                    "max":   high,
+                    "mean":  total / count,
+                    "p95":   read_percentile(conn, shard_list, serial_number, value, count, lower, upper),
+                }
+
+            summary["components"].append({
+                # The key is the same 'serial (device)' string used for the drop-downs in read_metrics().
+                "key":           f"{serial_number} ({device_type})",
+                "serial_number": serial_number,
+                "device_type":   device_type,
+                "columns":       stats,
+            })
+
+    return summary
+
+
+def detect_anomalies(debug=0, thresholds=None, alpha=anomalies.DEFAULT_ALPHA, batch_rows=anomalies.BATCH_ROWS):
+    """Runs the anomaly detector over the rows added since it last ran. Returns (rows read, anomalies found).
+
+    The test databases don't have the anomaly tables, so nothing is read or written for those.
+    """
+    with connect(debug) as conn:
+        if not anomalies.has_anomalies(conn):
+            return 0, 0
+
+        # Only the shards with rows after the device that's furthest behind.
+        shard_list = get_shards(debug, anomalies.oldest_checkpoint(conn))
+        result = anomalies.detect(conn, shard_list, thresholds, alpha, batch_rows)
+
+        # The oldest row is in metrics.db or the oldest shard.
+        oldest = shards.fetch(conn, get_shards(debug)[:1], """SELECT MIN(timestamp) AS value
+                                                              FROM {db}.component_statistic""",
+                              merge="SELECT MIN(value) AS value FROM ({arms})")[0][0]
+        anomalies.drop_before(conn, oldest)
+
+    return result
+
+
+@instrumentation.timed_query()
+def read_anomalies(serial_number, column, start=None, end=None, debug=0):
+    """Lists the [timestamp, value, z] of a component's anomalies in one column between start and end.
+
+    Catches the detector up first, at most every anomalies.DETECT_INTERVAL seconds.
+    """
+    if column not in METRIC_COLUMNS:
+        raise ValueError(f"Unknown metric column: {column}")
+    column = METRIC_COLUMNS[column]
+    # Only temperature and usage are watched.
+    if column not in anomalies.DETECTED_COLUMNS:
+        return []
+
+    if anomalies.due(get_database(debug)):
+        detect_anomalies(debug)
+
+    layout = get_layout(debug)
+    timestamp = "timestamp"
+    if layout == schema_v2.LAYOUT_V2:
+        try:
+            start, end = schema_v2.bound_ms(start), schema_v2.bound_ms(end, upper=True)
+        except ValueError:
+            return []
+        timestamp = schema_v2.to_text_sql("timestamp")
+    else:
+        start, end = normalize_timestamp(start), normalize_timestamp(end, upper=True)
+
+    with connect(debug) as conn:
+        if not anomalies.has_anomalies(conn):
+            return []
+
+        # (serial_number, metric, timestamp) is the primary key, so this only reads the window.
+        query = f"""SELECT {timestamp}, value, z
+                    FROM anomaly
+                    WHERE serial_number = ? AND metric = ?"""
+        params = [serial_number, column]
+        if start is not None:
+            query += " AND timestamp >= ?"
+            params.append(start)
+        if end is not None:
+            query += " AND timestamp <= ?"
+            params.append(end)
+        query += " ORDER BY timestamp"
+        return [list(row) for row in conn.execute(query, params)]
+
+
+def refresh_process_rollups(conn, db, shard_list=()):
+    """Catches the hourly/daily process summaries up with any rows added since the last refresh."""
+    process_analytics.maybe_refresh(conn, db)
+    # Each shard has its own summaries, like the component_statistic rollups.
+    for shard in shard_list:
+        with shards.get_pool(shard.path).connection() as shard_conn:
+            process_analytics.maybe_refresh(shard_conn, shard.path)
+
+
+@instrumentation.timed_query(rows=lambda top: len(top["processes"]))
+def read_top_processes(debug=0, start=None, end=None, metric="cpu", stat="avg",
+                       limit=process_analytics.DEFAULT_LIMIT, host=None,
+                       points=process_analytics.SPARKLINE_POINTS):
+    """The top pids by their average or peak cpu or memory usage between start and end (inclusive).
+
+    Each pid gets the average and peak of both metrics, how many samples it had, and a sparkline of
+    the metric (points averages, or peaks, across the window). SQLite groups, sorts and limits the
+    pids, so only the top ones are sent to python. Long windows read whole days and hours from the
+    process summaries and only the raw rows at either end, and the sparklines read whichever of
+    raw, hourly or daily rows gives a few per point. host limits it to one machine of a central
+    database (ingest.py).
+    """
+    # Only ever allow the known metrics into the SQL.
+    if metric not in process_analytics.METRICS:
+        raise ValueError(f"Unknown process metric: {metric}")
+    if stat not in process_analytics.STATS:
+        raise ValueError(f"Unknown statistic: {stat}")
+    limit = min(max(limit, 1), process_analytics.MAX_LIMIT)
+
+    layout = get_layout(debug)
+    shard_list = get_shards(debug, start, end)
+    top = {"start": start, "end": end, "metric": metric, "by": stat, "resolution": rollups.RAW,
+           "sparkline": None, "processes": []}
+
+    # Borrow a connection from the pool. The tables were created when the pool was opened.
+    with connect(debug) as conn:
+        if layout == schema_v2.LAYOUT_V2:
+            # There are no process summaries in v2, or hosts. Every row in the window is read.
+            try:
+                lower, upper = schema_v2.bound_ms(start), schema_v2.bound_ms(end, upper=True)
+            except ValueError:
+                # Something that isn't a timestamp can't be compared with milliseconds, so nothing matches.
+                return top
+            host_expression = "''"
+        else:
+            lower, upper = normalize_timestamp(start), normalize_timestamp(end, upper=True)
+            host_expression = process_analytics.host_column(conn)
+
+        # An open ended window runs to the first/last sample. The timestamp index makes these lookups.
+        first = lower if lower is not None else shards.fetch(
+            conn, shard_list, "SELECT MIN(timestamp) AS value FROM {db}.process",
+            merge="SELECT MIN(value) AS value FROM ({arms})")[0][0]
+        last = upper if upper is not None else shards.fetch(
+            conn, shard_list, "SELECT MAX(timestamp) AS value FROM {db}.process",
+            merge="SELECT MAX(value) AS value FROM ({arms})")[0][0]
+        if first is None or last is None:
+            return top
+
+        if layout == schema_v2.LAYOUT_V2:
+            first_time, last_time = schema_v2.from_ms(first), schema_v2.from_ms(last)
+            summaries = False
+        else:
+            # The test databases don't have the summaries, and a timestamp we can't read can't be bucketed.
+            first_time, last_time = parse_timestamp(str(first)), parse_timestamp(str(last))
+            summaries = first_time is not None and last_time is not None and process_analytics.has_rollups(conn)
+
+        pieces = []
+        if summaries:
+            refresh_process_rollups(conn, get_database(debug), shard_list)
+            pieces = process_analytics.plan(first_time, last_time)
+            if pieces:
+                top["resolution"] = "daily" if any(piece[0] == "daily" for piece in pieces) else "hourly"
+
+        # With shards a pid can be in several of them, so each one sends all of its pids and the
+        # totals are ranked once they've been added up.
+        summary, params = process_analytics.window_query(lower, upper, pieces, host, host_expression, schema="{db}")
+        merged = f"SELECT {process_analytics.summary_select()} FROM ({{arms}}) GROUP BY host, pid"
+        rows = shards.fetch(conn, shard_list, process_analytics.top_query(summary, metric, stat),
+                            params + [-1 if shard_list else limit],
+                            process_analytics.top_query(merged, metric, stat), [limit], partial_params=[-1])
+        if not rows:
+            return top
+
+        for row in rows:
+            process = {"pid": row[1], "host": row[0], "samples": row[2], "sparkline": None}
+            for index, name in enumerate(process_analytics.METRICS):
+                count, total, peak = row[3 + index * 3:6 + index * 3]
+                process[name] = {"avg": total / count if count else None, "max": peak}
+            top["processes"].append(process)
+
+        if first_time is None or last_time is None:
+            return top
+
+        # The sparklines. Each point is an equal slice of the window.
+        slot = max((last_time - first_time) / points, datetime.timedelta(milliseconds=1))
+        resolution = process_analytics.sparkline_resolution(slot) if summaries else rollups.RAW
+        if layout == schema_v2.LAYOUT_V2:
+            origin, width, ms = first, slot / datetime.timedelta(milliseconds=1), True
+        else:
+            origin, width, ms = first_time.strftime("%Y-%m-%d %H:%M:%S"), slot / datetime.timedelta(days=1), False
+        query, params = process_analytics.sparkline_query(
+            resolution, metric, stat, sorted({process["pid"] for process in top["processes"]}), origin, last,
+            width, points, host, host_expression, schema="{db}", ms=ms)
+        lines = {}
+        for row_host, pid, index, total, count, peak in shards.fetch(conn, shard_list, query, params, merge="""
+                SELECT host, pid, slot, SUM(total) AS total, SUM(n) AS n, MAX(peak) AS peak
+                FROM ({arms})
+                GROUP BY host, pid, slot"""):
+            lines.setdefault((row_host, pid), [None] * points)[index] = \
+                peak if stat == "max" else (total / count if count else None)
+
+    for process in top["processes"]:
+        process["sparkline"] = lines.get((process["host"], process["pid"]), [None] * points)
+    top["sparkline"] = {
+        "resolution": resolution,
+        "first":      first_time.strftime("%Y-%m-%d %H:%M:%S"),
+        "seconds":    slot.total_seconds(),
+        "points":     points,
+    }
+    return top
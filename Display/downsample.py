@@ -0,0 +1,139 @@
+###########################################################################################
+# File: downsample.py                                                                     #
+# Purpose: Reduce the chart series to a target number of points before rendering.        #
+#                                                                                         #
+# v1.1.0 Initial version. Largest-Triangle-Three-Buckets (LTTB) downsampling.             #
+###########################################################################################
+
+# Default number of points sent to the browser for each series.
+DEFAULT_MAX_POINTS = 1000
+
+# The metric columns of a read_metrics() row. Column 0 is the timestamp.
+VALUE_COLUMNS = (1, 2, 3, 4, 5, 6)
+
+
+def to_number(value):
+    """Returns the value as a float, or None if it is not a usable number."""
+    # Booleans are ints in python, but they are never real metrics.
+    if isinstance(value, bool):
+        return None
+
+    # Only real numbers can be plotted. Emojis, strings and NULLs are skipped.
+    if isinstance(value, (int, float)) and value == value:
+        return float(value)
+
+    return None
+
+
+def normalized_columns(rows, columns):
+    """Pulls each column out of the rows as numbers scaled by the column range.
+
+    Scaling means every column is weighted equally, so 'Total Ram' doesn't drown out '% Usage'.
+    """
+    series = []
+    for column in columns:
+        values = [to_number(row[column]) for row in rows]
+        numbers = [value for value in values if value is not None]
+
+        # A flat or empty column contributes nothing, but we can't divide by 0.
+        if len(numbers) < 2 or max(numbers) == min(numbers):
+            scale = 1.0
+        else:
+            scale = max(numbers) - min(numbers)
+
+        series.append([value / scale if value is not None else None for value in values])
+
+    return series
+
+
+def bucket_average(series, start, end):
+    """Averages each column over the rows in [start, end), returns the average x as well."""
+    averages = []
+    for values in series:
+        numbers = [value for value in values[start:end] if value is not None]
+        averages.append(sum(numbers) / len(numbers) if numbers else None)
+
+    # The x value is simply the row position (samples are taken on a fixed interval).
+    x_average = (start + end - 1) / 2
+    return averages, x_average
+
+
+def triangle_area(series, a, b, averages, x_c):
+    """Sums the area of the triangle (a, b, bucket average) across every column."""
+    area = 0.0
+    for values, y_c in zip(series, averages):
+        y_a = values[a]
+        y_b = values[b]
+
+        # If any of the points are missing for this column it can't have an area.
+        if y_a is None or y_b is None or y_c is None:
+            continue
+
+        area += abs((a - x_c) * (y_b - y_a) - (a - b) * (y_c - y_a))
+
+    return area
+
+
+def lttb(rows, threshold, columns=VALUE_COLUMNS):
+    """Downsamples a list of rows to the threshold using Largest-Triangle-Three-Buckets.
+
+    Each row is kept whole (timestamp and all metrics) so the result is still a valid
+    read_metrics() series. The triangle areas are summed across all the given columns.
+    """
+    # Nothing to do if we already have few enough points or downsampling is turned off.
+    if threshold <= 0 or len(rows) <= threshold:
+        return rows
+
+    # With fewer than 3 points we can only keep the first and last.
+    if threshold < 3:
+        return [rows[0], rows[-1]][:threshold]
+
+    # Only use the columns that actually exist in the rows.
+    columns = [column for column in columns if all(len(row) > column for row in rows)]
+    series = normalized_columns(rows, columns)
+
+    # The first and last points are always kept, the rest are split into buckets.
+    sampled = [rows[0]]
+    bucket_size = (len(rows) - 2) / (threshold - 2)
+    selected = 0
+
+    for i in range(threshold - 2):
+        # The current bucket to pick a point from.
+        bucket_start = int(i * bucket_size) + 1
+        bucket_end = int((i + 1) * bucket_size) + 1
+
+        # The next bucket, which we average to get the third point of the triangle.
+        next_end = min(int((i + 2) * bucket_size) + 1, len(rows))
+        averages, x_next = bucket_average(series, bucket_end, next_end)
+
+        # Pick the point in this bucket that makes the largest triangle.
+        best_area = -1.0
+        best_index = bucket_start
+        for j in range(bucket_start, bucket_end):
+            area = triangle_area(series, selected, j, averages, x_next)
+            if area > best_area:
+                best_area = area
+                best_index = j
+
+        sampled.append(rows[best_index])
+        selected = best_index
+
+    sampled.append(rows[-1])
+    return sampled
+
+
+def downsample_datasets(datasets, max_points=DEFAULT_MAX_POINTS):
+    """Downsamples every series in a read_metrics() dictionary to max_points."""
+    # 0 or less means the user asked for every point.
+    if not max_points or max_points <= 0:
+        return datasets
+
+    downsampled = {}
+    for key, rows in datasets.items():
+        # The 'No Components Found' placeholder isn't a list of rows, so leave it alone.
+        if rows and isinstance(rows[0], (list, tuple)):
+            downsampled[key] = lttb(rows, max_points)
+        else:
+            downsampled[key] = rows
+
+    return downsampled
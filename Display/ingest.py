@@ -0,0 +1,317 @@
+###########################################################################################
+# File: ingest.py                                                                         #
+# Purpose: Merges the metrics.db files from many machines into one central database the   #
+#          web server can show. Each machine is a host. Its serial numbers are tagged     #
+#          'host/serial' and its process rows get a host column, so nothing clashes.      #
+#                                                                                         #
+#          The sources are read in parallel by a pool of processes, a chunk of rowids at  #
+#          a time, and upserted into the central database in large batches. The last      #
+#          rowid read from each source is remembered, so running it again only reads the  #
+#          rows added since.                                                              #
+#                                                                                         #
+# Usage: python Display/ingest.py central.db samples/*.db lab03=lab_metrics3-27.db        #
+#        python Display/metrics_web_server.py --database central.db                       #
+#                                                                                         #
+# v1.1.0 Initial version.                                                                 #
+# v1.2.0 The process pool modules are only imported by ingest(), not by the web server.   #
+###########################################################################################
+
+import argparse
+import datetime
+import os
+import re
+import sqlite3
+import time
+import db_interface
+import schema_v2
+
+# Rows read from a source, and written to the central database, per chunk.
+BATCH_ROWS = 50000
+
+# Chunks read ahead of the writer for each worker. Bounds how many rows can be waiting in memory.
+CHUNKS_PER_WORKER = 2
+
+# What a host can be called. Never has db_interface.HOST_SEPARATOR in it.
+HOST_PATTERN = re.compile(r"^[A-Za-z0-9_.-]+$")
+
+# Created before db_interface's tables, which are then left alone (CREATE TABLE IF NOT EXISTS).
+# The process table is the v1 one with a host column in the primary key, since pids are only
+# unique on one machine. ingest_source has each source's high-water marks: the last rowid read
+# from each table, and that row's timestamp. If the row has changed (the file was replaced or
+# vacuumed) the source is read again from the start.
+CENTRAL_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS process (
+           pid INT,
+           timestamp DATETIME,
+           cpu_usage FLOAT NOT NULL,
+           memory_usage FLOAT NOT NULL,
+           end_of_life DATETIME NOT NULL,
+           host TEXT NOT NULL,
+           PRIMARY KEY (pid, timestamp, host)
+       )""",
+    """CREATE INDEX IF NOT EXISTS idx_process_host_timestamp
+       ON process (host, timestamp)""",
+    """CREATE TABLE IF NOT EXISTS ingest_source (
+           path TEXT PRIMARY KEY,
+           host TEXT NOT NULL,
+           statistic_rowid INTEGER NOT NULL DEFAULT 0,
+           statistic_timestamp TEXT,
+           process_rowid INTEGER NOT NULL DEFAULT 0,
+           process_timestamp TEXT,
+           rows INTEGER NOT NULL DEFAULT 0,
+           ingested_at TEXT
+       )""",
+]
+
+# (the source table, its ingest_source mark columns, the upsert into the central database)
+TABLES = [
+    ("component_statistic", "statistic", """
+        INSERT INTO component_statistic VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (serial_number, timestamp) DO UPDATE SET
+            machine_state = excluded.machine_state, temperature = excluded.temperature,
+            usage = excluded.usage, power_consumption = excluded.power_consumption,
+            core_speed = excluded.core_speed, memory_speed = excluded.memory_speed,
+            total_ram = excluded.total_ram, end_of_life = excluded.end_of_life"""),
+    ("process", "process", """
+        INSERT INTO process VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (pid, timestamp, host) DO UPDATE SET
+            cpu_usage = excluded.cpu_usage, memory_usage = excluded.memory_usage,
+            end_of_life = excluded.end_of_life"""),
+]
+
+COMPONENT_UPSERT = """
+    INSERT INTO component VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (serial_number) DO UPDATE SET
+        device_type = excluded.device_type, v_ram = excluded.v_ram,
+        stock_core_speed = excluded.stock_core_speed, stock_memory_speed = excluded.stock_memory_speed"""
+
+
+def default_host(path):
+    """The host for a source given without one: its file name without the extension."""
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", os.path.splitext(os.path.basename(path))[0])
+
+
+def parse_source(argument):
+    """'host=path' or just 'path' on the command line. Returns (host, absolute path)."""
+    host, separator, path = argument.partition("=")
+    if not separator:
+        host, path = default_host(argument), argument
+    if not HOST_PATTERN.match(host):
+        raise ValueError(f"Host names can only have letters, numbers, '_', '.' and '-': {host!r}")
+    return host, os.path.abspath(path)
+
+
+def tag(host, serial_number):
+    """The serial number a component of the host has in the central database."""
+    return f"{host}{db_interface.HOST_SEPARATOR}{serial_number}"
+
+
+def is_central(conn):
+    """True if the database is a central database, made by this module."""
+    return conn.execute("""SELECT 1 FROM sqlite_master
+                           WHERE type = 'table' AND name = 'ingest_source'""").fetchone() is not None
+
+
+def open_central(path):
+    """The connection pool for the central database, creating its tables the first time."""
+    conn = sqlite3.connect(path)
+    try:
+        tables = {name for name, in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        if "process" in tables and not is_central(conn):
+            raise ValueError(f"{path} is a metrics database, not a central one. Ingest into a new file.")
+        with conn:
+            for statement in CENTRAL_SCHEMA:
+                conn.execute(statement)
+    finally:
+        conn.close()
+    # The rest of the tables, the indexes and the rollups, the same as any metrics database.
+    return db_interface.open_pool(path)
+
+
+def read_chunk(path, host, table, after, upto):
+    """Reads one chunk of a source, tagged with its host: the rows with after < rowid <= upto.
+
+    Runs in a worker process, so it opens its own read-only connection.
+    """
+    conn = schema_v2.open_read_only(path)
+    try:
+        rows = conn.execute(f"""SELECT * FROM {table}
+                                WHERE rowid > ? AND rowid <= ?""", (after, upto)).fetchall()
+    finally:
+        conn.close()
+
+    if table == "process":
+        return [row + (host,) for row in rows]
+    return [(tag(host, row[0]),) + row[1:] for row in rows]
+
+
+def plan_source(central, host, path, batch_rows):
+    """Works out what has to be read from a source.
+
+    Returns its components, the chunks to read as (table, after, upto), and the marks each table
+    gets once they've all been written, {table: (rowid, timestamp)}.
+    """
+    marks = central.execute("""SELECT host, statistic_rowid, statistic_timestamp, process_rowid, process_timestamp
+                               FROM ingest_source WHERE path = ?""", (path,)).fetchone()
+    if marks and marks[0] != host:
+        raise ValueError(f"{path} was ingested as host {marks[0]!r}, not {host!r}")
+
+    source = schema_v2.open_read_only(path)
+    try:
+        if schema_v2.get_layout(source) != schema_v2.LAYOUT_V1:
+            raise ValueError(f"{path} uses the v2 layout. Only v1 databases can be ingested.")
+        components = [(tag(host, row[0]),) + row[1:] for row in source.execute("SELECT * FROM component")]
+
+        chunks = []
+        new_marks = {}
+        for i, (table, _, _) in enumerate(TABLES):
+            after, timestamp = (marks[1 + 2 * i], marks[2 + 2 * i]) if marks else (0, None)
+            # The row the mark points at has to be the one that was read, or the rowids don't mean
+            # the same thing any more. Reading it all again is safe, every write is an upsert.
+            if after and source.execute(f"SELECT timestamp FROM {table} WHERE rowid = ?",
+                                        (after,)).fetchone() != (timestamp,):
+                after = 0
+
+            last = source.execute(f"SELECT MAX(rowid) FROM {table}").fetchone()[0] or 0
+            if last <= after:
+                continue
+            chunks += [(table, start, min(start + batch_rows, last)) for start in range(after, last, batch_rows)]
+            new_marks[table] = (last, source.execute(f"SELECT timestamp FROM {table} WHERE rowid = ?",
+                                                     (last,)).fetchone()[0])
+    finally:
+        source.close()
+
+    return components, chunks, new_marks
+
+
+def ingest(central_path, sources, workers=None, batch_rows=BATCH_ROWS):
+    """Reads the new rows of each (host, path) source into the central database.
+
+    The sources are read by a pool of worker processes while this process does the writing,
+    one transaction per chunk. The chunks can finish in any order, so a table's mark is only
+    moved on in the transaction that writes the last of its chunks. If it's stopped part way,
+    the next run reads the unfinished table again.
+    Returns the rows read from each source and how fast it went.
+    """
+    # Imported here, the web server imports this module for list_hosts() and doesn't need them.
+    import concurrent.futures
+
+    started = time.perf_counter()
+    pool = open_central(central_path)
+    workers = workers or os.cpu_count() or 1
+
+    plans = {}
+    tasks = []
+    with pool.connection() as conn:
+        for host, path in sources:
+            components, chunks, marks = plan_source(conn, host, path, batch_rows)
+            left = {table: sum(chunk[0] == table for chunk in chunks) for table in marks}
+            plans[path] = {"host": host, "marks": marks, "left": left, "rows": 0}
+            tasks += [(path, chunk) for chunk in chunks]
+            with conn:
+                conn.executemany(COMPONENT_UPSERT, components)
+                conn.execute("""INSERT INTO ingest_source (path, host) VALUES (?, ?)
+                                ON CONFLICT (path) DO NOTHING""", (path, host))
+
+    upserts = {table: upsert for table, _, upsert in TABLES}
+    mark_columns = {table: mark for table, mark, _ in TABLES}
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+        while tasks or pending:
+            # Keep every worker busy, without reading the whole of every source into memory at once.
+            while tasks and len(pending) < workers * CHUNKS_PER_WORKER:
+                path, (table, after, upto) = tasks.pop(0)
+                future = executor.submit(read_chunk, path, plans[path]["host"], table, after, upto)
+                pending[future] = (path, table)
+
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                path, table = pending.pop(future)
+                rows = future.result()
+                plan = plans[path]
+                plan["left"][table] -= 1
+                with pool.connection() as conn:
+                    with conn:
+                        conn.executemany(upserts[table], rows)
+                        if plan["left"][table] == 0:
+                            mark = mark_columns[table]
+                            conn.execute(f"""UPDATE ingest_source
+                                             SET {mark}_rowid = ?, {mark}_timestamp = ?
+                                             WHERE path = ?""", plan["marks"][table] + (path,))
+                        conn.execute("""UPDATE ingest_source SET rows = rows + ?, ingested_at = ?
+                                        WHERE path = ?""",
+                                     (len(rows), datetime.datetime.now().isoformat(timespec="seconds"), path))
+                plan["rows"] += len(rows)
+
+    seconds = time.perf_counter() - started
+    total = sum(plan["rows"] for plan in plans.values())
+    return {
+        "sources":         {path: {"host": plan["host"], "rows": plan["rows"]} for path, plan in plans.items()},
+        "rows":            total,
+        "seconds":         round(seconds, 3),
+        "rows_per_second": round(total / seconds) if seconds else total,
+    }
+
+
+def list_hosts(debug=0):
+    """The names of the hosts in a central database, for the host filters. Empty for an ordinary one."""
+    with db_interface.connect(debug) as conn:
+        if not is_central(conn):
+            return []
+        return [host for host, in conn.execute("SELECT DISTINCT host FROM ingest_source ORDER BY host")]
+
+
+def read_hosts(debug=0):
+    """The hosts in a central database, with their sources and how much of each there is.
+
+    Empty for an ordinary metrics database.
+    """
+    with db_interface.connect(debug) as conn:
+        if not is_central(conn):
+            return []
+        sources = conn.execute("""SELECT host, COUNT(*), SUM(rows), MAX(ingested_at)
+                                  FROM ingest_source
+                                  GROUP BY host
+                                  ORDER BY host""").fetchall()
+        components = conn.execute("SELECT serial_number FROM component").fetchall()
+
+    devices = db_interface.read_devices(debug)
+    hosts = []
+    for host, source_count, rows, ingested_at in sources:
+        prefix = tag(host, "")
+        ranges = [(device["first"], device["last"]) for device in devices
+                  if device["serial_number"].startswith(prefix)]
+        hosts.append({
+            "host":        host,
+            "sources":     source_count,
+            "rows":        rows,
+            "ingested_at": ingested_at,
+            "components":  sum(serial_number.startswith(prefix) for serial_number, in components),
+            "first":       min((first for first, _ in ranges), default=None),
+            "last":        max((last for _, last in ranges), default=None),
+        })
+    return hosts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge the metrics databases of many machines into one")
+    parser.add_argument("central", help="the central database, created if it doesn't exist")
+    parser.add_argument("sources", nargs="+", metavar="[HOST=]SOURCE",
+                        help="a machine's metrics.db. The host defaults to the file name")
+    parser.add_argument("--workers", type=int, help="processes reading the sources (default: one per cpu)")
+    parser.add_argument("--batch-rows", type=int, default=BATCH_ROWS, help="rows per chunk")
+    args = parser.parse_args()
+
+    result = ingest(os.path.abspath(args.central), [parse_source(source) for source in args.sources],
+                    args.workers, args.batch_rows)
+    for path, source in result["sources"].items():
+        print(f"{source['host']:<24}{source['rows']:>12,} rows  {path}")
+    print(f"{result['rows']:,} rows in {result['seconds']:.2f}s ({result['rows_per_second']:,} rows/s)")
+
+
+if __name__ == "__main__":
+    # The pyinstaller build needs this to start the worker processes.
+    import multiprocessing
+    multiprocessing.freeze_support()
+    main()
@@ -0,0 +1,365 @@
+###########################################################################################
+# File: instrumentation.py                                                                #
+# Purpose: Where the time goes in the web server. Records the wall time of each route,    #
+#          the time and rows of each db_interface query, template render time and the     #
+#          response size, in rolling histograms (p50/p95/p99) served by /debug/stats.     #
+#          Optionally adds Server-Timing headers, and profiles a sample of requests with  #
+#          cProfile, keeping the profiles of the slowest ones.                            #
+#                                                                                         #
+# v1.1.0 Initial version.                                                                 #
+###########################################################################################
+
+import collections
+import contextvars
+import cProfile
+import datetime
+import functools
+import heapq
+import math
+import os
+import random
+import re
+import threading
+import time
+from flask import request, before_render_template, template_rendered
+
+# How many of the most recent samples each histogram keeps. The percentiles are over these.
+WINDOW = 1024
+
+# Set to 1 to send a Server-Timing header with every response (the browser's dev tools show it).
+SERVER_TIMING_ENV = "MTG_SERVER_TIMING"
+
+# The fraction of requests to profile (0.1 = one in ten). Unset or 0 turns profiling off.
+PROFILE_ENV = "MTG_PROFILE"
+# Where the profiles are written. Defaults to profiles/ in the project root.
+PROFILE_DIR_ENV = "MTG_PROFILE_DIR"
+# How many of the slowest profiles are kept. Faster ones are deleted as slower ones come in.
+PROFILE_KEEP = 10
+
+# The current settings. Read from the environment by init_app(), changed with configure().
+SETTINGS = {
+    "server_timing": False,
+    "profile_rate":  0.0,
+    "profile_dir":   None,
+    "profile_keep":  PROFILE_KEEP,
+}
+
+# The timings of the request being handled on this thread, or None outside a request.
+_CURRENT = contextvars.ContextVar("mtg_request_timings", default=None)
+
+# cProfile can only have one profiler running at a time, so only one request is profiled at once.
+_PROFILE_LOCK = threading.Lock()
+
+
+def percentile(ordered, fraction):
+    """The nearest rank percentile of an already sorted list."""
+    index = max(math.ceil(fraction * len(ordered)) - 1, 0)
+    return ordered[min(index, len(ordered) - 1)]
+
+
+class Histogram:
+    """The last WINDOW values of something, for working out percentiles. Thread safe."""
+
+    def __init__(self, window=WINDOW):
+        self.values = collections.deque(maxlen=window)
+        # All time totals, not just the window.
+        self.count = 0
+        self.total = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, value):
+        """Records one value."""
+        with self.lock:
+            self.values.append(value)
+            self.count += 1
+            self.total += value
+
+    def summary(self):
+        """count and mean over all time, p50/p95/p99/max over the window."""
+        with self.lock:
+            ordered = sorted(self.values)
+            count, total = self.count, self.total
+        if not ordered:
+            return {"count": 0}
+        return {
+            "count": count,
+            "mean":  round(total / count, 3),
+            "p50":   round(percentile(ordered, 0.50), 3),
+            "p95":   round(percentile(ordered, 0.95), 3),
+            "p99":   round(percentile(ordered, 0.99), 3),
+            "max":   round(ordered[-1], 3),
+        }
+
+
+class Registry:
+    """Histograms grouped by name then measure, e.g. histograms["GET /api/metrics"]["wall_ms"]."""
+
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self.histograms = collections.defaultdict(dict)
+        self.lock = threading.Lock()
+
+    def add(self, name, measure, value):
+        """Records a value, creating the histogram the first time."""
+        with self.lock:
+            histogram = self.histograms[name].get(measure)
+            if histogram is None:
+                histogram = self.histograms[name][measure] = Histogram(self.window)
+        histogram.add(value)
+
+    def summary(self):
+        """Every histogram's summary, in the same nesting."""
+        with self.lock:
+            names = {name: dict(measures) for name, measures in self.histograms.items()}
+        return {name: {measure: histogram.summary() for measure, histogram in sorted(measures.items())}
+                for name, measures in sorted(names.items())}
+
+    def clear(self):
+        """Forgets everything recorded."""
+        with self.lock:
+            self.histograms.clear()
+
+
+# Per route timings and per query timings.
+routes = Registry()
+queries = Registry()
+
+# When the stats were last cleared.
+_SINCE = datetime.datetime.now()
+
+
+class RequestTimings:
+    """What one request has spent its time on so far."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.sql_ms = 0.0
+        self.sql_rows = 0
+        self.queries = 0
+        self.template_ms = 0.0
+        self.template_started = None
+        # Set while a query is running, so a query called by another query isn't counted twice.
+        self.in_query = False
+        self.profile = None
+
+
+def count_rows(result):
+    """The rows in a query's result: the length of a list, or of each list in a dictionary of them."""
+    if isinstance(result, dict):
+        return sum(len(value) for value in result.values() if isinstance(value, list))
+    if isinstance(result, (list, tuple)):
+        return len(result)
+    return 0
+
+
+def timed_query(rows=count_rows):
+    """Decorator for the db_interface reads. Records the time and the rows (rows(result)) of each call."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            timings = _CURRENT.get()
+            outer = timings is not None and not timings.in_query
+            if outer:
+                timings.in_query = True
+
+            started = time.perf_counter()
+            try:
+                result = function(*args, **kwargs)
+            finally:
+                elapsed = (time.perf_counter() - started) * 1000
+                if outer:
+                    timings.in_query = False
+
+            count = rows(result)
+            queries.add(function.__name__, "ms", elapsed)
+            queries.add(function.__name__, "rows", count)
+            if outer:
+                timings.sql_ms += elapsed
+                timings.sql_rows += count
+                timings.queries += 1
+            return result
+        return wrapper
+    return decorator
+
+
+def configure(server_timing=None, profile_rate=None, profile_dir=None, profile_keep=None):
+    """Changes the settings. Anything left as None is kept as it is."""
+    changes = {"server_timing": server_timing, "profile_rate": profile_rate,
+               "profile_dir": profile_dir, "profile_keep": profile_keep}
+    SETTINGS.update({key: value for key, value in changes.items() if value is not None})
+
+
+def route_name():
+    """The method and route of the current request, e.g. 'GET /jobs/<job_id>'."""
+    rule = request.url_rule.rule if request.url_rule is not None else "<unmatched>"
+    return f"{request.method} {rule}"
+
+
+def get_profile_dir():
+    """The directory the profiles are written to."""
+    if SETTINGS["profile_dir"]:
+        return SETTINGS["profile_dir"]
+    # Imported here, db_interface imports this module for timed_query().
+    import db_interface
+    return os.path.join(db_interface.get_proj_root() or ".", "profiles")
+
+
+class ProfileKeeper:
+    """Keeps the profiles of the slowest requests on disk."""
+
+    def __init__(self):
+        # A min heap of (milliseconds, path), so the fastest kept profile is the first to go.
+        self.kept = []
+        self.lock = threading.Lock()
+
+    def offer(self, profile, elapsed, name):
+        """Writes the profile if it's one of the slowest profile_keep. Returns its path, or None."""
+        with self.lock:
+            if len(self.kept) >= SETTINGS["profile_keep"] and elapsed <= self.kept[0][0]:
+                return None
+
+            directory = get_profile_dir()
+            os.makedirs(directory, exist_ok=True)
+            # e.g. 1523ms-GET-api-metrics-20250601-120000-123456.prof, sorts by the time taken.
+            slug = re.sub(r"[^A-Za-z0-9]+", "-", name).strip("-")
+            stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+            path = os.path.join(directory, f"{int(elapsed):06d}ms-{slug}-{stamp}.prof")
+            profile.dump_stats(path)
+
+            heapq.heappush(self.kept, (elapsed, path, name))
+            while len(self.kept) > SETTINGS["profile_keep"]:
+                _, old_path, _ = heapq.heappop(self.kept)
+                if os.path.exists(old_path):
+                    os.remove(old_path)
+            return path
+
+    def list(self):
+        """The kept profiles, slowest first."""
+        with self.lock:
+            return [{"ms": round(elapsed, 3), "route": name, "file": path}
+                    for elapsed, path, name in sorted(self.kept, reverse=True)]
+
+    def clear(self):
+        """Forgets the kept profiles. The files are left where they are."""
+        with self.lock:
+            self.kept.clear()
+
+
+profiles = ProfileKeeper()
+
+
+def start_profile(timings):
+    """Profiles this request if it's picked by the sampling rate and nothing else is being profiled."""
+    rate = SETTINGS["profile_rate"]
+    if rate <= 0 or random.random() >= rate or not _PROFILE_LOCK.acquire(blocking=False):
+        return
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        # Something else (a debugger, another profiler) already has the profiling hook.
+        _PROFILE_LOCK.release()
+        return
+    timings.profile = profile
+
+
+def stop_profile(timings):
+    """Stops the request's profiler, if it has one, and lets the next request be profiled."""
+    profile, timings.profile = timings.profile, None
+    if profile is None:
+        return None
+    profile.disable()
+    _PROFILE_LOCK.release()
+    return profile
+
+
+def before_request():
+    """Starts timing the request."""
+    timings = RequestTimings()
+    _CURRENT.set(timings)
+    start_profile(timings)
+
+
+def after_request(response):
+    """Records the request's timings and size, and adds the Server-Timing header if it's turned on."""
+    timings = _CURRENT.get()
+    if timings is None:
+        return response
+
+    profile = stop_profile(timings)
+    elapsed = (time.perf_counter() - timings.started) * 1000
+    name = route_name()
+
+    routes.add(name, "wall_ms", elapsed)
+    routes.add(name, "sql_ms", timings.sql_ms)
+    routes.add(name, "sql_rows", timings.sql_rows)
+    routes.add(name, "template_ms", timings.template_ms)
+    # Streamed responses (/api/live) don't have a size until they've finished. Asking for one would
+    # read the whole stream in here, so they're left out.
+    if not response.is_streamed and response.content_length is not None:
+        routes.add(name, "bytes", response.content_length)
+
+    if profile is not None:
+        profiles.offer(profile, elapsed, name)
+
+    if SETTINGS["server_timing"]:
+        response.headers["Server-Timing"] = (
+            f'sql;dur={timings.sql_ms:.3f};desc="{timings.queries} queries, {timings.sql_rows} rows", '
+            f"tpl;dur={timings.template_ms:.3f}, app;dur={elapsed:.3f}")
+    return response
+
+
+def teardown_request(error=None):
+    """Makes sure the profiler is stopped and the timings are dropped, even if the view raised."""
+    timings = _CURRENT.get()
+    if timings is not None:
+        stop_profile(timings)
+        _CURRENT.set(None)
+
+
+def template_started(sender, template, context, **extra):
+    """Flask signal: a template is about to be rendered."""
+    timings = _CURRENT.get()
+    if timings is not None:
+        timings.template_started = time.perf_counter()
+
+
+def template_finished(sender, template, context, **extra):
+    """Flask signal: a template has been rendered."""
+    timings = _CURRENT.get()
+    if timings is not None and timings.template_started is not None:
+        timings.template_ms += (time.perf_counter() - timings.template_started) * 1000
+        timings.template_started = None
+
+
+def init_app(app):
+    """Hooks the instrumentation into a Flask app, with the settings from the environment."""
+    configure(server_timing=os.environ.get(SERVER_TIMING_ENV, "") not in ("", "0"),
+              profile_rate=float(os.environ.get(PROFILE_ENV) or 0),
+              profile_dir=os.environ.get(PROFILE_DIR_ENV))
+    app.before_request(before_request)
+    app.after_request(after_request)
+    app.teardown_request(teardown_request)
+    before_render_template.connect(template_started, app)
+    template_rendered.connect(template_finished, app)
+
+
+def stats():
+    """Everything recorded so far, for /debug/stats."""
+    return {
+        "since":    _SINCE.isoformat(timespec="seconds"),
+        "window":   WINDOW,
+        "settings": {key: SETTINGS[key] for key in ("server_timing", "profile_rate", "profile_keep")},
+        "routes":   routes.summary(),
+        "queries":  queries.summary(),
+        "profiles": profiles.list(),
+    }
+
+
+def reset():
+    """Clears every histogram and the list of kept profiles."""
+    global _SINCE
+    routes.clear()
+    queries.clear()
+    profiles.clear()
+    _SINCE = datetime.datetime.now()
@@ -0,0 +1,154 @@
+###########################################################################################
+# File: job_manager.py                                                                    #
+# Purpose: Runs the collector and prune calls on background threads, so a web request     #
+#          gets a job id back straight away instead of waiting for the executable.        #
+#          The web page then polls the job's status with /jobs/<job_id>.                  #
+#                                                                                         #
+# v1.1.0 Initial version.                                                                 #
+###########################################################################################
+
+import collections
+import datetime
+import subprocess
+import threading
+import time
+import uuid
+
+# The states a job goes through. queued -> running -> succeeded/failed.
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+# The most jobs of each kind that can be queued or running at the same time.
+# Two prunes at once would just fight over the database, so only one is allowed.
+DEFAULT_LIMITS = {"prune": 1, "collect": 1}
+
+# How many finished jobs are remembered for the status endpoint.
+MAX_FINISHED_JOBS = 100
+
+
+class JobLimitError(Exception):
+    """Raised when a job can't be started because too many of its kind are already running."""
+
+    def __init__(self, kind, active):
+        super().__init__(f"A {kind} job is already running")
+        self.kind = kind
+        # The jobs that are in the way, so the caller can point the user at them.
+        self.active = active
+
+
+class Job:
+    """One call to the metrics executable, and what came of it."""
+
+    def __init__(self, kind, function, args):
+        self.job_id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.function = function
+        self.args = args
+        self.state = QUEUED
+        self.submitted = datetime.datetime.now()
+        self.started = None
+        self.finished = None
+        # Timing is done with the monotonic clock, so a clock change can't make it negative.
+        self.started_clock = None
+        self.finished_clock = None
+        self.output = None
+        self.error = None
+
+    def run(self):
+        """Runs the job, catching anything that goes wrong so it can be reported."""
+        self.state = RUNNING
+        self.started = datetime.datetime.now()
+        self.started_clock = time.monotonic()
+        try:
+            self.output = self.function(*self.args)
+            self.state = SUCCEEDED
+        except subprocess.CalledProcessError as error:
+            # The executable failed. Whatever it printed is the most useful thing to show.
+            self.output = error.stdout
+            self.error = error.stderr or str(error)
+            self.state = FAILED
+        except Exception as error:
+            self.error = str(error)
+            self.state = FAILED
+        finally:
+            self.finished = datetime.datetime.now()
+            self.finished_clock = time.monotonic()
+
+    @property
+    def active(self):
+        """True until the job has finished."""
+        return self.state in (QUEUED, RUNNING)
+
+    def elapsed(self):
+        """Seconds the job has been running for (or ran for, once it's finished)."""
+        if self.started_clock is None:
+            return 0.0
+        end = self.finished_clock if self.finished_clock is not None else time.monotonic()
+        return round(end - self.started_clock, 3)
+
+    def to_dict(self):
+        """The job's status as something that can be turned into json."""
+        return {
+            "job_id":    self.job_id,
+            "kind":      self.kind,
+            "state":     self.state,
+            "submitted": self.submitted.isoformat(timespec="seconds"),
+            "started":   self.started.isoformat(timespec="seconds") if self.started else None,
+            "finished":  self.finished.isoformat(timespec="seconds") if self.finished else None,
+            "elapsed":   self.elapsed(),
+            "output":    self.output,
+            "error":     self.error,
+        }
+
+
+class JobManager:
+    """Starts jobs on background threads and keeps track of them."""
+
+    def __init__(self, limits=None, max_finished=MAX_FINISHED_JOBS):
+        self.limits = dict(DEFAULT_LIMITS if limits is None else limits)
+        self.max_finished = max_finished
+        # Oldest first, so the oldest finished jobs are the first to be forgotten.
+        self.jobs = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def submit(self, kind, function, *args):
+        """Starts function(*args) on a background thread and returns the Job straight away.
+
+        Raises JobLimitError if the limit for this kind of job has been reached.
+        """
+        with self.lock:
+            active = [job for job in self.jobs.values() if job.kind == kind and job.active]
+            limit = self.limits.get(kind)
+            if limit is not None and len(active) >= limit:
+                raise JobLimitError(kind, active)
+
+            job = Job(kind, function, args)
+            self.jobs[job.job_id] = job
+            self.forget_finished()
+
+        # Daemon threads, so a stuck executable can't stop the server from shutting down.
+        thread = threading.Thread(target=job.run, name=f"mtg-{kind}-{job.job_id}", daemon=True)
+        thread.start()
+        return job
+
+    def get(self, job_id):
+        """Returns the job with this id, or None if there isn't one."""
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        """Returns every job that is remembered, oldest first."""
+        with self.lock:
+            return list(self.jobs.values())
+
+    def forget_finished(self):
+        """Drops the oldest finished jobs once there are more than max_finished. Called with the lock held."""
+        finished = [job_id for job_id, job in self.jobs.items() if not job.active]
+        for job_id in finished[:max(len(finished) - self.max_finished, 0)]:
+            del self.jobs[job_id]
+
+
+# The job manager the web server uses.
+jobs = JobManager()
@@ -0,0 +1,287 @@
+###########################################################################################
+# File: live_feed.py                                                                      #
+# Purpose: Streams new component_statistic rows to the browser as Server-Sent Events.     #
+#          One poller per database reads the rows added since the last poll (by rowid)    #
+#          and hands them to every subscriber, so 1 or 100 open pages is 1 query a poll.  #
+#                                                                                         #
+# v1.1.0 Initial version.                                                                 #
+# v1.2.0 v2 databases have no rowid, the high-water mark is the timestamp instead.        #
+# v1.3.0 Sharded databases. The id is the shard and the rowid in it (shards.event_id()).  #
+# v1.4.0 A poll after the newest rows were pruned carries on from the newest row left.    #
+#        A failed poll is sent to the pages as an error event.                            #
+###########################################################################################
+
+import json
+import queue
+import threading
+import time
+import db_interface
+import schema_v2
+import shards
+
+# How often the poller looks for new rows, in seconds. The collector writes every 30 seconds.
+POLL_INTERVAL = 2.0
+
+# The most rows read in one poll. Anything past this is picked up by the next poll.
+MAX_ROWS_PER_POLL = 5000
+
+# How many polls' worth of rows a subscriber can fall behind by before the oldest are dropped.
+MAX_QUEUED_BATCHES = 100
+
+# A comment is sent this often when there's nothing new, so proxies don't close the connection.
+KEEPALIVE_INTERVAL = 15.0
+
+# A stream ends after this many seconds and the browser reconnects (EventSource does it by itself,
+# sending the Last-Event-ID). Stops a waitress thread being held by a tab that was left open forever.
+MAX_STREAM_SECONDS = 300
+
+# The columns sent for each row, with the same names as /api/metrics uses.
+ROW_KEYS = ["rowid", "serial_number", "timestamp"] + list(db_interface.METRIC_COLUMNS)
+ROW_QUERY = f"""SELECT rowid, serial_number, timestamp, {", ".join(db_interface.METRIC_COLUMNS.values())}
+                FROM component_statistic
+                WHERE rowid > ? AND rowid <= ?
+                ORDER BY rowid
+                LIMIT ?"""
+
+# v2 tables have no rowid. Each component's new rows are read off the end of its slice of the
+# primary key instead, and the epoch millisecond timestamp stands in for the rowid.
+ROW_QUERY_V2 = f"""SELECT timestamp, serial_number, {schema_v2.to_text_sql("timestamp")},
+                          {", ".join(db_interface.METRIC_COLUMNS.values())}
+                   FROM component_statistic
+                   WHERE serial_number = ? AND timestamp > ? AND timestamp <= ?
+                   ORDER BY timestamp
+                   LIMIT ?"""
+
+# One feed per database, keyed on the database path.
+_FEEDS = {}
+_FEEDS_LOCK = threading.Lock()
+
+
+class Subscriber:
+    """One open stream. Gets the rows for the components it asked for, in the order they were added."""
+
+    def __init__(self, serial_numbers=None):
+        # None means every component.
+        self.serial_numbers = set(serial_numbers) if serial_numbers else None
+        self.batches = queue.Queue(maxsize=MAX_QUEUED_BATCHES)
+        self.dropped = 0
+
+    def put(self, rows):
+        """Queues the rows this subscriber cares about. Never blocks the poller."""
+        if self.serial_numbers is not None:
+            rows = [row for row in rows if row["serial_number"] in self.serial_numbers]
+        if rows:
+            self.enqueue(rows)
+
+    def put_error(self, message):
+        """Queues an error event, e.g. a poll that failed. It's a dict, where the rows are a list."""
+        self.enqueue({"error": message})
+
+    def enqueue(self, batch):
+        """Queues a batch. Never blocks the poller."""
+        # A client that isn't keeping up loses its oldest rows rather than slowing everyone else down.
+        while True:
+            try:
+                self.batches.put_nowait(batch)
+                return
+            except queue.Full:
+                try:
+                    self.batches.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def events(self, duration=MAX_STREAM_SECONDS, keepalive=KEEPALIVE_INTERVAL):
+        """Yields the Server-Sent Events for this subscriber until duration seconds have passed."""
+        # Tell the browser how long to wait before reconnecting, in milliseconds.
+        yield f"retry: {int(POLL_INTERVAL * 1000)}\n\n"
+
+        deadline = time.monotonic() + duration
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                rows = self.batches.get(timeout=min(keepalive, remaining))
+            except queue.Empty:
+                yield ": keepalive\n\n"
+                continue
+
+            if isinstance(rows, dict):
+                yield f"event: error\ndata: {json.dumps(rows)}\n\n"
+                continue
+
+            # The id is the last rowid sent, so a reconnect carries on from there.
+            yield f"id: {rows[-1]['rowid']}\nevent: rows\ndata: {json.dumps(rows)}\n\n"
+
+
+class LiveFeed:
+    """Polls one database for new component_statistic rows and passes them on to the subscribers."""
+
+    def __init__(self, debug=0, interval=POLL_INTERVAL):
+        self.debug = debug
+        self.interval = interval
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.thread = None
+        # The high-water mark. Every row up to here has been sent.
+        self.last_rowid = None
+        # How many times the database has been queried, for the stats and the tests.
+        self.queries = 0
+
+    def latest_id(self, conn):
+        """The id of the newest row: its rowid, or its timestamp in a v2 database."""
+        if db_interface.get_pool(self.debug).sharded:
+            return self.latest_shard_id()
+        if db_interface.get_layout(self.debug) != schema_v2.LAYOUT_V2:
+            return conn.execute("SELECT MAX(rowid) FROM component_statistic").fetchone()[0] or 0
+
+        # One primary key lookup per component.
+        latest = 0
+        for serial_number in schema_v2.serial_numbers(conn):
+            newest = conn.execute("""SELECT MAX(timestamp) FROM component_statistic
+                                     WHERE serial_number = ?""", (serial_number,)).fetchone()[0]
+            latest = max(latest, newest or 0)
+        return latest
+
+    def read_rows(self, after, upto=None):
+        """Reads the rows with after < id <= upto, as dictionaries."""
+        with db_interface.connect(self.debug) as conn:
+            if upto is None:
+                upto = self.latest_id(conn)
+            if db_interface.get_pool(self.debug).sharded:
+                rows = self.read_rows_sharded(after, upto)
+            elif db_interface.get_layout(self.debug) == schema_v2.LAYOUT_V2:
+                rows = self.read_rows_v2(conn, after, upto)
+            else:
+                cursor = conn.execute(ROW_QUERY, (after, upto, MAX_ROWS_PER_POLL))
+                rows = [dict(zip(ROW_KEYS, row)) for row in cursor]
+        self.queries += 1
+        return rows
+
+    def read_rows_v2(self, conn, after, upto):
+        """read_rows() for a v2 database, where the id is the timestamp."""
+        rows = []
+        cut = upto
+        for serial_number in schema_v2.serial_numbers(conn):
+            found = conn.execute(ROW_QUERY_V2, (serial_number, after, upto, MAX_ROWS_PER_POLL)).fetchall()
+            # A component with more than a poll's worth of rows holds everyone back to where it got to,
+            # so the high-water mark never skips rows.
+            if len(found) == MAX_ROWS_PER_POLL:
+                cut = min(cut, found[-1][0])
+            rows += [dict(zip(ROW_KEYS, row)) for row in found]
+
+        rows = [row for row in rows if row["rowid"] <= cut]
+        rows.sort(key=lambda row: (row["rowid"], row["serial_number"]))
+        return rows
+
+    def latest_shard_id(self):
+        """latest_id() for a sharded database: the newest row in the newest shard.
+
+        The collector writes to the shards and not metrics.db, so only the shards are followed.
+        """
+        shard_list = db_interface.get_shards(self.debug)
+        if not shard_list:
+            return 0
+        with shards.get_pool(shard_list[-1].path).connection() as conn:
+            rowid = conn.execute("SELECT MAX(rowid) FROM component_statistic").fetchone()[0] or 0
+        return shards.event_id(shard_list[-1], rowid)
+
+    def read_rows_sharded(self, after, upto):
+        """read_rows() for a sharded database. Carries on through the shards after the one after is in."""
+        after_ordinal, after_rowid = shards.parse_event_id(after)
+        upto_ordinal, upto_rowid = shards.parse_event_id(upto)
+
+        rows = []
+        for shard in db_interface.get_shards(self.debug):
+            if not after_ordinal <= shard.ordinal <= upto_ordinal:
+                continue
+            low = after_rowid if shard.ordinal == after_ordinal else 0
+            high = upto_rowid if shard.ordinal == upto_ordinal else shards.MAX_ROWID
+            with shards.get_pool(shard.path).connection() as conn:
+                found = conn.execute(ROW_QUERY, (low, high, MAX_ROWS_PER_POLL - len(rows))).fetchall()
+            rows += [dict(zip(ROW_KEYS, (shards.event_id(shard, row[0]),) + row[1:])) for row in found]
+
+            # The rest is picked up by the next poll.
+            if len(rows) >= MAX_ROWS_PER_POLL:
+                break
+        return rows
+
+    def subscribe(self, serial_numbers=None, last_id=None):
+        """Adds a subscriber and starts the poller if it isn't running.
+
+        A reconnecting browser sends the last id it saw. The rows it missed are sent first.
+        """
+        subscriber = Subscriber(serial_numbers)
+        with self.lock:
+            if self.last_rowid is None:
+                # Start from now. The page already has the history from /api/metrics.
+                with db_interface.connect(self.debug) as conn:
+                    self.last_rowid = self.latest_id(conn)
+
+            # Catching up is done under the lock, so it can't overlap with a poll and send a row twice.
+            if last_id is not None and last_id < self.last_rowid:
+                subscriber.put(self.read_rows(last_id, self.last_rowid))
+
+            self.subscribers.add(subscriber)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="mtg-live-feed", daemon=True)
+                self.thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        """Removes a subscriber. The poller stops by itself once there are none left."""
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def poll(self):
+        """Reads the new rows once and hands them to every subscriber. Returns how many rows there were."""
+        with self.lock:
+            with db_interface.connect(self.debug) as conn:
+                latest = self.latest_id(conn)
+            if latest < self.last_rowid:
+                # The newest rows were pruned, and the ids they had will be given to new rows.
+                # Carry on from the newest row that's left, or they'd never be sent.
+                self.last_rowid = latest
+            rows = self.read_rows(self.last_rowid, latest)
+            if rows:
+                self.last_rowid = rows[-1]["rowid"]
+                for subscriber in self.subscribers:
+                    subscriber.put(rows)
+        return len(rows)
+
+    def run(self):
+        """The poller thread. Polls every interval seconds while anyone is subscribed."""
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.subscribers:
+                    self.thread = None
+                    # Start from the latest row again next time, nobody is waiting for the rows in between.
+                    self.last_rowid = None
+                    return
+            try:
+                self.poll()
+            except Exception as error:
+                # The database might be busy or mid-migration. Tell the pages, and try again next time round.
+                with self.lock:
+                    for subscriber in self.subscribers:
+                        subscriber.put_error(f"Live feed poll failed: {error}")
+
+
+def get_feed(debug=0):
+    """Returns the live feed for the database, creating it the first time."""
+    db = db_interface.get_database(debug)
+    with _FEEDS_LOCK:
+        feed = _FEEDS.get(db)
+        if feed is None:
+            feed = _FEEDS[db] = LiveFeed(debug)
+        return feed
+
+
+def stream(feed, subscriber, duration=MAX_STREAM_SECONDS):
+    """The response body for one stream. Unsubscribes when the browser goes away or the stream ends."""
+    try:
+        yield from subscriber.events(duration)
+    finally:
+        feed.unsubscribe(subscriber)
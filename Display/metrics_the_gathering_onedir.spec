@@ -0,0 +1,53 @@
+# -*- mode: python ; coding: utf-8 -*-
+
+# The one-dir build: a folder with metrics_the_gathering.exe and everything it needs next to it.
+# The one-file build (metrics_the_gathering.spec) unpacks itself to a temp folder on every launch,
+# which is most of its start up time. This one starts straight away, so it's the one to hand out
+# as a zip. Build it with: pyinstaller metrics_the_gathering_onedir.spec
+
+a = Analysis(
+    ['metrics_web_server.py'],
+    pathex=[],
+    binaries=[],
+    datas=[
+        ('templates', 'templates'),
+        ('static', 'static'),
+    ],
+    hiddenimports=[],
+    hookspath=[],
+    hooksconfig={},
+    runtime_hooks=[],
+    # numpy is only for the columnar reads (columnar.py), which the web server doesn't use.
+    excludes=['numpy'],
+    noarchive=False,
+    optimize=0,
+)
+pyz = PYZ(a.pure)
+
+exe = EXE(
+    pyz,
+    a.scripts,
+    [],
+    exclude_binaries=True,
+    name='metrics_the_gathering',
+    debug=False,
+    bootloader_ignore_signals=False,
+    strip=False,
+    # UPX compressed DLLs have to be decompressed every time they're loaded.
+    upx=False,
+    console=True,
+    disable_windowed_traceback=False,
+    argv_emulation=False,
+    target_arch=None,
+    codesign_identity=None,
+    entitlements_file=None,
+)
+coll = COLLECT(
+    exe,
+    a.binaries,
+    a.datas,
+    strip=False,
+    upx=False,
+    upx_exclude=[],
+    name='metrics_the_gathering',
+)
@@ -7,27 +7,71 @@
 # v0.1.1 Removing unnecessary imports as well as socketio since we don't need to talk to  #
 #        other instances.                                                                 #
 # v1.0.0 Initial Production version. mthuffer 2025-04-30                                  #
+# v1.1.0 The user_report series are downsampled to max_points before rendering.           #
+# v1.2.0 user_report only embeds the device list. The charts fetch their own data from    #
+#        the new /api/metrics route.                                                      #
+# v1.3.0 The database is created/upgraded to the latest schema when the server starts.    #
+#        The pooled database connections are closed when the server stops.                #
+# v1.4.0 Added --root and --database to override where the project and database are.      #
+# v1.5.0 /api/metrics reports the resolution (raw, hourly or daily) the points came from. #
+# v1.6.0 The process table is paged, sorted and searched on the server (/api/processes).  #
+# v1.7.0 Added /api/backup to monitor the background database backups.                    #
+# v1.8.0 /metrics runs the executable as a background job. /jobs/<job_id> reports on it.  #
+# v1.9.0 Added /metrics/status, which checks the collector without stopping it.           #
+# v1.10.0 Added /api/live, a Server-Sent Events stream of new rows for live charts.       #
+# v1.11.0 The pages and the json apis are cached until the database changes, with ETags.  #
+# v1.12.0 Routes, queries and templates are timed. /debug/stats has the percentiles.      #
+# v1.13.0 /gather can start the python (psutil) collector instead of the executable.      #
+# v1.14.0 The reports and process pages can be filtered by host on a central database     #
+#         (ingest.py). Added /api/hosts.                                                  #
+# v1.15.0 Added /api/summary, each component's min/max/mean/p95 for the reports panel.    #
+# v1.16.0 Added /api/anomalies, the EWMA detector's flags for the chart markers.          #
+# v1.17.0 /api/metrics can send typed arrays (format=binary, see binary_series.py).       #
+# v1.18.0 Faster start up. The collector modules (psutil) are imported when a collector   #
+#         page needs them. The port is open before the database check, so the browser     #
+#         can start at the same time. Added --profile-startup, --port and --no-browser.   #
+# v1.19.0 Added /api/processes/top, the busiest pids over a range with their sparklines.  #
 ###########################################################################################
 
+import startup_profile
+# --profile-startup times every import from here on. It has to start before they happen.
+startup_profile.begin(__name__ == "__main__")
+
+import binary_series
 import db_interface
-import ohm_interface
+import downsample
+import ingest
+import instrumentation
+import job_manager
+import live_feed
+import process_analytics
+import response_cache
 import sys
 import os
-from flask import Flask, render_template, request
-from waitress import serve
-import webbrowser
+import argparse
+from flask import Flask, Response, render_template, request, jsonify, stream_with_context
+
+# waitress worker threads. The live chart streams (/api/live) each hold one while they're open.
+WAITRESS_THREADS = 16
+DEFAULT_PORT = 8080
 
 # If running as an executable (to set up for pyinstaller)
 if getattr(sys, 'frozen', False):
     base_path = sys._MEIPASS
 else:
-    base_path = os.path.join(db_interface.get_proj_root(), "Display")
+    # The templates sit next to this file, no need to go looking for the project root.
+    base_path = os.path.dirname(os.path.abspath(__file__))
 
 # Set up the Flask instance based on what type of run we are.
 app = Flask(__name__,
             template_folder=os.path.join(base_path, 'templates'),
             static_folder=os.path.join(base_path, 'static'))
 
+# Time every request. MTG_SERVER_TIMING and MTG_PROFILE turn on the extras, see instrumentation.py.
+instrumentation.init_app(app)
+# Print the start up profile once the first response is sent, if it was asked for.
+startup_profile.watch(app)
+
 
 @app.route("/")
 def index():
@@ -38,42 +82,224 @@ def index():
 @app.route("/gather", methods=["POST"])
 def gather_report():
     """Calls the Gathering. User interface for metrics collection"""
-    return render_template("gather.html")
+    # Imported here, psutil is slow to load and only the collector pages need it.
+    import psutil_collector
+    # The executable only runs on windows, everywhere else the python collector is the one to use.
+    return render_template("gather.html", default_collector="exe" if sys.platform == "win32" else "python",
+                           default_interval=psutil_collector.DEFAULT_INTERVAL)
 
 
 @app.route("/user_report", methods=["POST"])
+@response_cache.cached
 def user_report():
     """Calls reports.html. Show graphs of metrics."""
     # Debug value for testing purposes. Default 0 since we should only get a debug flag in testing.
     debug = request.form.get("debug", type=int, default=0)
+    # The number of points to draw for each series. 0 means draw every point.
+    max_points = request.form.get("max_points", type=int, default=downsample.DEFAULT_MAX_POINTS)
+    # On a central database the devices can be limited to one machine. Empty means every machine.
+    host = request.form.get("host", default="")
 
-    # Get the data from db_interface.
-    # Should be a dictionary where the key is the serial_number + component and the value is a list of metrics.
-    datasets = db_interface.read_metrics(debug)
-
-    # Find the max datapoints, so we can set the 'end' value when loading the page.
-    max_datapoints = max((len(lst) for lst in datasets.values()), default=0)
+    # Only the list of devices is put in the page. Each chart asks /api/metrics for its own data,
+    # so the page stays the same size no matter how big the database gets.
+    devices = db_interface.read_devices(debug, host)
     return render_template(
-        "reports.html", datasets=datasets, max_datapoints=max_datapoints
+        "reports.html", devices=devices, max_points=max_points, debug=debug,
+        hosts=ingest.list_hosts(debug), host=host
     )
 
 
+@app.route("/api/metrics", methods=["GET"])
+@response_cache.cached
+def api_metrics():
+    """Returns one metric for one component over a time range as json."""
+    # Debug value for testing purposes. Default 0 since we should only get a debug flag in testing.
+    debug = request.args.get("debug", type=int, default=0)
+    serial_number = request.args.get("serial_number", default="")
+    column = request.args.get("column", default="temperature")
+    start = request.args.get("start")
+    end = request.args.get("end")
+    max_points = request.args.get("max_points", type=int, default=downsample.DEFAULT_MAX_POINTS)
+    # json, or binary for little-endian int64 timestamps and float32 values the page reads as typed arrays.
+    response_format = request.args.get("format", default="json")
+
+    # Tell the user if they asked for a column we don't have.
+    if column not in db_interface.METRIC_COLUMNS:
+        return jsonify({"error": f"Unknown column '{column}'"}), 400
+    if response_format not in ("json", "binary"):
+        return jsonify({"error": f"Unknown format '{response_format}'"}), 400
+
+    # Long windows come from the hourly/daily rollups. The resolution used is sent back with the points.
+    series = db_interface.read_metric_range(serial_number, column, start, end, max_points, debug)
+    if response_format == "binary":
+        body = binary_series.encode_points(series["points"], serial_number=serial_number, column=column,
+                                           resolution=series["resolution"])
+        return Response(body, mimetype=binary_series.MIMETYPE)
+    return jsonify({
+        "serial_number": serial_number,
+        "column": column,
+        "resolution": series["resolution"],
+        "points": series["points"],
+    })
+
+
+@app.route("/api/anomalies", methods=["GET"])
+@response_cache.cached
+def api_anomalies():
+    """Returns the anomalies flagged in one metric of one component over a time range as json."""
+    # Debug value for testing purposes. Default 0 since we should only get a debug flag in testing.
+    debug = request.args.get("debug", type=int, default=0)
+    serial_number = request.args.get("serial_number", default="")
+    column = request.args.get("column", default="temperature")
+
+    # Tell the user if they asked for a column we don't have.
+    if column not in db_interface.METRIC_COLUMNS:
+        return jsonify({"error": f"Unknown column '{column}'"}), 400
+
+    # Each is [timestamp, value, z-score]. Only temperature and usage are watched, the rest have none.
+    return jsonify({
+        "serial_number": serial_number,
+        "column": column,
+        "anomalies": db_interface.read_anomalies(serial_number, column, request.args.get("start"),
+                                                 request.args.get("end"), debug),
+    })
+
+
+@app.route("/api/summary", methods=["GET"])
+@response_cache.cached
+def api_summary():
+    """Returns the count, min, max, mean and 95th percentile of each component's metrics over a range as json."""
+    # Debug value for testing purposes. Default 0 since we should only get a debug flag in testing.
+    debug = request.args.get("debug", type=int, default=0)
+    columns = request.args.getlist("column") or list(db_interface.SUMMARY_COLUMNS)
+
+    # Tell the user if they asked for a column we don't have.
+    for column in columns:
+        if column not in db_interface.METRIC_COLUMNS:
+            return jsonify({"error": f"Unknown column '{column}'"}), 400
+
+    # Worked out by SQLite, and cached until the database changes, so reloading the page is free.
+    return jsonify(db_interface.read_summary(debug, request.args.get("start"), request.args.get("end"),
+                                             columns, request.args.get("host", default="")))
+
+
+@app.route("/api/live", methods=["GET"])
+def api_live():
+    """Streams new component_statistic rows as Server-Sent Events, for the live charts."""
+    # Debug value for testing purposes. Default 0 since we should only get a debug flag in testing.
+    debug = request.args.get("debug", type=int, default=0)
+    # Only the components on the page. None means every component.
+    serial_numbers = request.args.getlist("serial_number") or None
+    duration = min(request.args.get("duration", type=float, default=live_feed.MAX_STREAM_SECONDS),
+                   live_feed.MAX_STREAM_SECONDS)
+    # Sent by the browser when it reconnects, so it gets the rows it missed.
+    last_id = request.headers.get("Last-Event-ID", type=int)
+
+    # Every stream shares one poller per database. Subscribing reads the database, so a broken
+    # database fails here rather than part way through the stream.
+    feed = live_feed.get_feed(debug)
+    subscriber = feed.subscribe(serial_numbers, last_id)
+    return Response(stream_with_context(live_feed.stream(feed, subscriber, duration)),
+                    mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 @app.route("/proc_table", methods=["POST"])
+@response_cache.cached
 def proc_table():
     """Calls processes.html. Shows a table of the processes"""
     # Debug value for testing purposes. Default 0 since we should only get a debug flag in testing.
     debug = request.form.get("debug", type=int, default=0)
 
-    # Get the data from db_interface. Simply a tuple from the SQL command
-    data = db_interface.read_processes(debug)
+    # The rows are fetched a page at a time from /api/processes, the page only needs the row count.
+    total = db_interface.count_processes(debug)
     return render_template(
-        "processes.html", data=data
+        "processes.html", total=total, debug=debug, hosts=ingest.list_hosts(debug)
+    )
+
+
+@app.route("/api/processes", methods=["GET"])
+@response_cache.cached
+def api_processes():
+    """Returns one page of the process table, in the DataTables server side processing format."""
+    # Debug value for testing purposes. Default 0 since we should only get a debug flag in testing.
+    debug = request.args.get("debug", type=int, default=0)
+
+    # See https://datatables.net/manual/server-side for what DataTables sends.
+    total, filtered, rows = db_interface.read_process_page(
+        debug,
+        start=request.args.get("start", type=int, default=0),
+        length=request.args.get("length", type=int, default=10),
+        order_column=request.args.get("order[0][column]", type=int, default=0),
+        order_dir=request.args.get("order[0][dir]", default="asc"),
+        search=request.args.get("search[value]", default=""),
+        host=request.args.get("host", default=""),
     )
+    return jsonify({
+        # draw is sent back as is, so DataTables can ignore responses that arrive out of order.
+        "draw": request.args.get("draw", type=int, default=0),
+        "recordsTotal": total,
+        "recordsFiltered": filtered,
+        "data": [list(row) for row in rows],
+    })
+
+
+@app.route("/api/processes/top", methods=["GET"])
+@response_cache.cached
+def api_top_processes():
+    """Returns the top pids by average or peak cpu or memory usage over a range, with sparklines, as json."""
+    # Debug value for testing purposes. Default 0 since we should only get a debug flag in testing.
+    debug = request.args.get("debug", type=int, default=0)
+    metric = request.args.get("metric", default="cpu")
+    stat = request.args.get("by", default="avg")
+    limit = request.args.get("limit", default=str(process_analytics.DEFAULT_LIMIT))
+
+    # Tell the user if they asked for something we can't rank by.
+    if metric not in process_analytics.METRICS:
+        return jsonify({"error": f"Unknown metric '{metric}'"}), 400
+    if stat not in process_analytics.STATS:
+        return jsonify({"error": f"Unknown statistic '{stat}'"}), 400
+    if not limit.isdigit() or not 1 <= int(limit) <= process_analytics.MAX_LIMIT:
+        return jsonify({"error": f"limit must be 1 to {process_analytics.MAX_LIMIT}"}), 400
+
+    return jsonify(db_interface.read_top_processes(debug, request.args.get("start"), request.args.get("end"),
+                                                   metric, stat, int(limit), request.args.get("host", default="")))
+
+
+@app.route("/api/hosts", methods=["GET"])
+@response_cache.cached
+def api_hosts():
+    """Returns each machine in a central database, with how much data it has, as json."""
+    # Debug value for testing purposes. Default 0 since we should only get a debug flag in testing.
+    debug = request.args.get("debug", type=int, default=0)
+    return jsonify(ingest.read_hosts(debug))
+
+
+@app.route("/api/backup", methods=["GET"])
+def api_backup():
+    """Returns how the database backups have gone (duration, pages copied, errors) as json."""
+    return jsonify(db_interface.backup_stats())
+
+
+@app.route("/api/cache", methods=["GET"])
+def api_cache():
+    """Returns the response cache's hit/miss counters and size as json."""
+    return jsonify(response_cache.cache.stats())
+
+
+@app.route("/debug/stats", methods=["GET"])
+def debug_stats():
+    """Returns the p50/p95/p99 timings of each route and query, and the kept profiles, as json."""
+    return jsonify(instrumentation.stats())
 
 
 @app.route("/metrics", methods=['POST'])
 def run_metrics():
     """Sets up the metrics executable when called."""
+    # Imported here, psutil is slow to load and only the collector pages need it.
+    import ohm_interface
+    import psutil_collector
+
     # Get user data.
     data = request.get_json()
     years = data.get('years')
@@ -81,22 +307,99 @@ def run_metrics():
     weeks = data.get('weeks')
     days = data.get('days')
     job = data.get('job')  # Should either be 'collect' or 'prune'
+    collector = data.get('collector', 'exe')  # Should either be 'exe' or 'python'
 
-    # If we are pruning then we call the prune method
+    # If we are pruning then we start a prune job. Only one can run at a time.
     if job == 'prune':
-        return ohm_interface.prune_data(years, months, weeks, days)
+        return submit_job("prune", ohm_interface.prune_data, years, months, weeks, days)
 
-    # If we aren't pruning we should be collecting. First check if the metrics is already running.
-    # This will stop the collector if it is currently running.
+    # If we aren't pruning we should be collecting. The button toggles, so stop it if it's running.
     if ohm_interface.is_metrics_running():
-        return "Metrics Stopped"
+        ohm_interface.stop_metrics()
+        return jsonify({"message": "Metrics Stopped"})
+
+    # Otherwise start the collector the user picked.
+    if collector == 'python':
+        interval = data.get('interval')
+        interval = int(interval) if str(interval).isdigit() else psutil_collector.DEFAULT_INTERVAL
+        return submit_job("collect", ohm_interface.call_python_collector, years, months, weeks, days, interval)
+    return submit_job("collect", ohm_interface.call_executable, years, months, weeks, days)
+
+
+def submit_job(kind, function, *args):
+    """Starts a background job and returns its id straight away, rather than waiting for it."""
+    try:
+        job = job_manager.jobs.submit(kind, function, *args)
+    except job_manager.JobLimitError as error:
+        # Send back the job that is already running, so the page can show that one instead.
+        return jsonify({"error": str(error), "job": error.active[0].to_dict()}), 409
+
+    # 202 Accepted: the job has started but isn't finished.
+    return jsonify(job.to_dict()), 202
+
+
+@app.route("/metrics/status", methods=["GET"])
+def metrics_status():
+    """Returns whether the collector is running, and its pid. Doesn't stop it."""
+    # Imported here, psutil is slow to load and only the collector pages need it.
+    import ohm_interface
+    return jsonify(ohm_interface.collector_status())
 
-    # Otherwise call the collector
-    return ohm_interface.call_executable(years, months, weeks, days)
+
+@app.route("/jobs", methods=["GET"])
+def list_jobs():
+    """Returns the status of every recent job."""
+    return jsonify([job.to_dict() for job in job_manager.jobs.list()])
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    """Returns the state, elapsed time and output of a job."""
+    job = job_manager.jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": f"No job '{job_id}'"}), 404
+    return jsonify(job.to_dict())
 
 
 if __name__ == "__main__":
+    startup_profile.mark("imports")
+    # Only the server needs these.
+    import logging
+    import waitress
+    import webbrowser
+
+    # Optional overrides for where the project and database live. Mostly for the frozen builds.
+    parser = argparse.ArgumentParser(description="Metrics: The Gathering web server")
+    parser.add_argument("--root", help="Project root, where OpenHardwareMonitor.exe lives")
+    parser.add_argument("--database", help="Path to the metrics database")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="Port to listen on")
+    parser.add_argument("--no-browser", action="store_true", help="Don't open the app in a web browser")
+    parser.add_argument("--server-timing", action="store_true", help="Send Server-Timing headers")
+    parser.add_argument("--profile", type=float, metavar="RATE",
+                        help="Profile this fraction of requests and keep the slowest in profiles/")
+    parser.add_argument(startup_profile.PROFILE_FLAG, action="store_true",
+                        help="Print how long each import and start up step took, after the first response")
+    args = parser.parse_args()
+    db_interface.set_path_config(args.root, args.database)
+    instrumentation.configure(server_timing=args.server_timing or None, profile_rate=args.profile)
+
+    # Open the port first. Anything that connects waits until the server is running, so the browser
+    # can start up while the database is checked. Each open live chart stream holds a thread, so
+    # there are more than the default 4. waitress logs its warnings, like serve() would set up.
+    logging.basicConfig()
+    server = waitress.create_server(app, host="127.0.0.1", port=args.port, threads=WAITRESS_THREADS)
+    startup_profile.mark("listening")
     # Opening the app in a web browser.
-    webbrowser.open_new_tab("http://127.0.0.1:8080")
+    if not args.no_browser:
+        webbrowser.open_new_tab(f"http://127.0.0.1:{args.port}")
+        startup_profile.mark("browser opened")
+
+    # Create the database if needed and run any schema migrations before we take requests.
+    db_interface.check_db()
+    startup_profile.mark("database check")
     # Starting the app.
-    serve(app, host="127.0.0.1", port=8080)
+    server.print_listen("Serving on http://{}:{}")
+    server.run()
+    # Close the pooled database connections once the server has stopped.
+    db_interface.close_pools()
+    response_cache.close_watchers()
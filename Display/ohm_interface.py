@@ -7,41 +7,221 @@
 #            call_executable() and prune_now() are separated because we do the checking   #
 #            if the process is running in the web server. That could be moved here in the #
 #            future if we wanted. But we may want to keep them separate anyhow            #
+# v1.1.0 MTG_METRICS_EXE overrides the executable. The calls are run as background jobs   #
+#        by the web server (see job_manager.py).                                          #
+# v1.2.0 The collector is tracked with a pid file instead of scanning every process.      #
+#        is_metrics_running() only checks now. stop_metrics() does the stopping.          #
+# v1.3.0 prune_data() prunes in python (db_interface.prune_database) instead of running   #
+#        the executable, so it works on linux and only locks the database briefly.        #
+# v1.4.0 Added call_python_collector() for the psutil collector. The status and stop      #
+#        calls cover whichever collector is running.                                      #
+# v1.4.1 prune_data() takes a backup before it deletes anything, as the executable did.   #
+# v1.4.2 recorded_process() only trusts a pid it can't inspect if the name is the         #
+#        collector's, so a reused pid isn't taken for the collector.                      #
 ###########################################################################################
 
 import psutil
 import os
+import json
+import datetime
 import subprocess
 import db_interface
+import psutil_collector
 
+# Environment variable that overrides which metrics executable is run.
+METRICS_EXE_ENV = "MTG_METRICS_EXE"
 
-def is_metrics_running():
-    """Checks to see if the metrics collector is running. Kills the process if it is."""
-    # Get a list of all processes.
+# The file in the project root that records the running collector's pid and create time.
+PID_FILE_NAME = "OpenHardwareMonitor.pid"
+
+# The pids stop_metrics() has killed, so their runs aren't reported as failures.
+_STOPPED_PIDS = set()
+
+
+def metrics_exe_path():
+    """Returns the path to the metrics executable."""
+    # MTG_METRICS_EXE points at a different executable. The tests use it to run a stub on linux.
+    if os.environ.get(METRICS_EXE_ENV):
+        return os.environ[METRICS_EXE_ENV]
+
+    # The executable should be in the directory above the python scripts.
+    return os.path.join(db_interface.get_proj_root(), "OpenHardwareMonitor.exe")
+
+
+def get_pid_file():
+    """Returns the path to the file that records which process is the collector."""
+    return os.path.join(db_interface.get_proj_root(), PID_FILE_NAME)
+
+
+def write_pid_file(proc):
+    """Records the collector's pid and create time, so it can be found again without a scan."""
+    record = {"pid": proc.pid, "create_time": proc.create_time(), "name": proc.name()}
+
+    # Write then rename, so a status check never reads a half written file.
+    pid_file = get_pid_file()
+    with open(pid_file + ".tmp", "w") as file:
+        json.dump(record, file)
+    os.replace(pid_file + ".tmp", pid_file)
+    return record
+
+
+def read_pid_file():
+    """Returns the recorded collector, or None if there isn't a (readable) pid file."""
+    try:
+        with open(get_pid_file()) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def remove_pid_file():
+    """Forgets the recorded collector."""
+    try:
+        os.remove(get_pid_file())
+    except FileNotFoundError:
+        pass
+
+
+def recorded_process(record):
+    """Returns the process the record points at, if it's still the same process.
+
+    pids get reused, so the create time has to match as well. The name isn't checked, it can change
+    when a launcher (e.g. the elevation prompt or a script's interpreter) execs the real program.
+    If the create time can't be read (the collector was started elevated) the name has to be one of
+    the collector's instead. When that can't be read either it returns None, so the pid file is
+    dropped and the next lookup scans for the collector with find_collector().
+    """
+    try:
+        proc = psutil.Process(record["pid"])
+        if abs(proc.create_time() - record["create_time"]) < 0.01:
+            return proc
+    except (psutil.NoSuchProcess, psutil.ZombieProcess, KeyError, TypeError):
+        pass
+    except psutil.AccessDenied:
+        # Started elevated, so we can't look at it. A reused pid won't have the collector's name.
+        try:
+            proc = psutil.Process(record["pid"])
+            if proc.name() in collector_names():
+                return proc
+        except psutil.Error:
+            pass
+    return None
+
+
+def collector_names():
+    """The names the collector's process can have."""
+    return {"OpenHardwareMonitor.exe", os.path.basename(metrics_exe_path())}
+
+
+def find_collector():
+    """The slow way to find the collector: look at every process on the box for its name."""
+    names = collector_names()
     for proc in psutil.process_iter(['name']):
+        if proc.info['name'] in names:
+            return proc
+    return None
+
+
+def find_metrics_process():
+    """Returns the running collector process, or None if it isn't running.
+
+    The pid file makes this a single lookup. Every process is only scanned when there's no pid file,
+    e.g. the collector was started by hand. What the scan finds is recorded for next time.
+    """
+    record = read_pid_file()
+    if record is not None:
+        proc = recorded_process(record)
+        if proc is None:
+            # The collector has stopped since it was recorded.
+            remove_pid_file()
+        return proc
+
+    proc = find_collector()
+    if proc is not None:
         try:
-            # If we find the process try and kill it and return True saying the metrics was running.
-            if "OpenHardwareMonitor.exe" == proc.info['name']:
-                proc.kill()
-                return True
-        # If somehow the process is missing after finding it then it's still gone, so we can return False.
-        except psutil.NoSuchProcess:
-            return False
-        # If we can't kill the process we still found it, so we should return true.
-        except (psutil.AccessDenied, psutil.ZombieProcess):
-            return True
+            write_pid_file(proc)
+        except (psutil.Error, OSError):
+            pass
+    return proc
+
+
+def collector_status():
+    """Reports whether a metrics collector is running, and which. Never stops it."""
+    collector = psutil_collector.active_collector()
+    if collector is not None:
+        return {"running": True, "pid": os.getpid(), "collector": "python", "stats": collector.stats()}
+
+    proc = find_metrics_process()
+    return {"running": proc is not None, "pid": proc.pid if proc else None, "collector": "exe" if proc else None}
+
+
+def is_metrics_running():
+    """Checks to see if a metrics collector (the executable or the python one) is running."""
+    return psutil_collector.active_collector() is not None or find_metrics_process() is not None
 
-    # If the process isn't found then return false.
-    return False
+
+def stop_metrics():
+    """Stops the metrics collector. Returns True if it was running."""
+    # The python collector finishes its job by writing what it has buffered.
+    if psutil_collector.stop():
+        return True
+
+    proc = find_metrics_process()
+    if proc is None:
+        return False
+
+    # Remember it was stopped on purpose, so call_executable() doesn't report it as a failure.
+    _STOPPED_PIDS.add(proc.pid)
+    try:
+        proc.kill()
+    # If somehow the process is missing after finding it then it's still gone.
+    except psutil.NoSuchProcess:
+        pass
+    # If we can't kill the process it's still running, which the user needs to know.
+    except (psutil.AccessDenied, psutil.ZombieProcess):
+        return False
+
+    remove_pid_file()
+    return True
 
 
 def get_metrics_exe():
     """Finds the metrics executable and checks to see if we need a backup."""
-    # Creates a new backup if needed.
+    # Starts a new backup if needed. It runs on a background thread, so this doesn't wait for it.
     db_interface.create_backup()
+    return metrics_exe_path()
 
-    # The executable should be in the directory above the python scripts.
-    return os.path.join(db_interface.get_proj_root(), "OpenHardwareMonitor.exe")
+
+def run_collector(metrics_call, working_dir):
+    """Runs the collector, recording it in the pid file while it runs. Returns what it printed.
+
+    Without admin rights the collector relaunches itself elevated and exits, so once it exits the
+    elevated copy is looked for and recorded instead.
+    """
+    proc = subprocess.Popen(metrics_call, cwd=working_dir, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, text=True)
+    try:
+        write_pid_file(psutil.Process(proc.pid))
+    except (psutil.Error, OSError):
+        # It's already gone, or the file can't be written. The status check will fall back to a scan.
+        pass
+
+    stdout, stderr = proc.communicate()
+
+    # Stopped from the web page, that's not an error.
+    if proc.pid in _STOPPED_PIDS:
+        _STOPPED_PIDS.discard(proc.pid)
+        return "Metrics Stopped"
+
+    # The pid file still points at the process that just exited. Find the relaunched one (if any).
+    record = read_pid_file()
+    if record is not None and record.get("pid") == proc.pid:
+        remove_pid_file()
+        find_metrics_process()
+
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, metrics_call, stdout, stderr)
+    return stderr or stdout
 
 
 def call_executable(years="1", months="0", weeks="0", days="0"):
@@ -61,48 +241,42 @@ def call_executable(years="1", months="0", weeks="0", days="0"):
     # Check to make sure the executable exists.
     if os.path.exists(metrics_exe):
         # Run the executable from top level
-        working_dir = db_interface.get_proj_root()
-        output = subprocess.run(metrics_call, cwd=working_dir, capture_output=True, text=True, check=True)
-
-        # If we get an error return the error, otherwise return the stdout.
         # Whatever is returned here will be shown back to the user.
-        if output.stderr:
-            return output.stderr
-        else:
-            return output.stdout
+        return run_collector(metrics_call, db_interface.get_proj_root())
 
     # Tell the user we couldn't find the executable.
     else:
         return "Can't Find Metrics Executable"
 
 
-def prune_data(years="1", months="0", weeks="0", days="0"):
-    """Calls the executable to prune old metrics."""
-    # Check each user input to sanitize. If user didn't use digits then use default values.
-    years  = years  if years.isdigit()  else "1"
-    months = months if months.isdigit() else "0"
-    weeks  = weeks  if weeks.isdigit()  else "0"
-    days   = days   if days.isdigit()   else "0"
+def call_python_collector(years="1", months="0", weeks="0", days="0", interval=psutil_collector.DEFAULT_INTERVAL):
+    """Runs the psutil collector until it's stopped. For machines without the executable (linux, mac)."""
+    # Starts a new backup if needed, same as before the executable is run.
+    db_interface.create_backup()
+    return psutil_collector.collect(get_lifetime(years, months, weeks, days), interval)
 
-    # Find the metrics executable.
-    metrics_exe = get_metrics_exe()
 
-    # Set up the call to the executable including the user inputs.
-    metrics_call = [metrics_exe, "prune-now", "--lifetime", f"{str(years)}y{str(months)}m{str(weeks)}w{str(days)}d"]
+def get_lifetime(years="1", months="0", weeks="0", days="0"):
+    """Turns the user's lifetime into a timedelta, the same way the executable does (a month is 30 days)."""
+    # Check each user input to sanitize. If user didn't use digits then use default values.
+    years  = int(years)  if str(years).isdigit()  else 1
+    months = int(months) if str(months).isdigit() else 0
+    weeks  = int(weeks)  if str(weeks).isdigit()  else 0
+    days   = int(days)   if str(days).isdigit()   else 0
 
-    # Check to make sure the executable exists.
-    if os.path.exists(metrics_exe):
-        # Run the executable from top level
-        working_dir = db_interface.get_proj_root()
-        output = subprocess.run(metrics_call, cwd=working_dir, capture_output=True, text=True, check=True)
+    return datetime.timedelta(days=years * 365 + months * 30 + weeks * 7 + days)
 
-        # If we get an error return the error, otherwise return the stdout.
-        # Whatever is returned here will be shown back to the user.
-        if output.stderr:
-            return output.stderr
-        else:
-            return output.stdout
 
-    # Tell the user we couldn't find the executable.
-    else:
-        return "Can't Find Metrics Executable"
+def prune_data(years="1", months="0", weeks="0", days="0"):
+    """Prunes old metrics. Done in small batches, so the database isn't locked up while it runs."""
+    lifetime = get_lifetime(years, months, weeks, days)
+    # Back up first, like the executable's prune did. Wait for the copy to finish, so it has every row
+    # that's about to be deleted.
+    backup = db_interface.create_backup()
+    if backup is not None:
+        backup.join()
+    stats = db_interface.prune_database(lifetime)
+
+    # Whatever is returned here will be shown back to the user.
+    return (f"Pruned {stats['rows']} rows older than {lifetime.days} days in {stats['seconds']:.1f}s "
+            f"({stats['rows_per_second']} rows/s).")
@@ -0,0 +1,307 @@
+###########################################################################################
+# File: process_analytics.py                                                              #
+# Purpose: The busiest processes over a window: the top N pids by average or peak cpu or  #
+#          memory usage, with a sparkline of each. Hourly and daily per-pid summaries of  #
+#          the process table are kept up to date incrementally (like rollups.py), so a    #
+#          long window reads whole days and hours from them and only the raw rows at its  #
+#          ends. The grouping, sorting and limit are all done by SQLite.                  #
+#                                                                                         #
+# v1.1.0 Initial version.                                                                 #
+# v1.2.0 The hour and day the oldest raw row is in are recomputed by refresh(), so a      #
+#        prune that cuts into them doesn't leave them counting the deleted rows.          #
+# v1.3.0 The refresh is rollups.Summaries, shared with the component_statistic rollups,   #
+#        which also recomputes the buckets of pruned rows and notices deleted tail rows.  #
+###########################################################################################
+
+import datetime
+import time
+import rollups
+
+# The metrics the processes can be ranked by. Maps the API name to the process column.
+# Never put user input straight into SQL, only ever the values from this dictionary.
+METRICS = {
+    "cpu":    "cpu_usage",
+    "memory": "memory_usage",
+}
+
+# What they can be ranked on: the average over the window or the peak sample.
+STATS = ("avg", "max")
+
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 100
+
+# How many points each pid's sparkline has.
+SPARKLINE_POINTS = 48
+
+# The summary tables, and the strftime() format that turns a timestamp into the start of its bucket.
+HOURLY = "process_hourly"
+DAILY = "process_daily"
+BUCKET_FORMATS = {
+    HOURLY: "%Y-%m-%d %H:00:00",
+    DAILY:  "%Y-%m-%d 00:00:00",
+}
+BUCKET_SIZES = {
+    HOURLY: datetime.timedelta(hours=1),
+    DAILY:  datetime.timedelta(days=1),
+}
+RESOLUTIONS = {rollups.RAW: "process", "hourly": HOURLY, "daily": DAILY}
+
+# Don't refresh more often than this, the same as the component_statistic rollups.
+REFRESH_INTERVAL = rollups.REFRESH_INTERVAL
+
+# When each database was last refreshed, keyed on the database path.
+_LAST_REFRESH = {}
+
+
+def table_sql(table):
+    """The CREATE TABLE statement for a process summary table. Each metric gets a count, sum and max."""
+    columns = []
+    for column in METRICS.values():
+        columns += [f"{column}_count INT NOT NULL", f"{column}_sum FLOAT", f"{column}_max FLOAT"]
+
+    # host is '' outside a central database (ingest.py), where the process table has no host column.
+    return f"""CREATE TABLE IF NOT EXISTS {table} (
+                   bucket DATETIME,
+                   host TEXT NOT NULL,
+                   pid INT,
+                   samples INT NOT NULL,
+                   {", ".join(columns)},
+                   PRIMARY KEY (bucket, host, pid)
+               )"""
+
+
+# The statements for the schema migration that adds the summaries (see db_interface.MIGRATIONS).
+# Their high-water mark is kept in rollup_state, as 'process'.
+SCHEMA = [
+    table_sql(HOURLY),
+    table_sql(DAILY),
+    # The sparklines read a few pids' buckets across the window.
+    f"CREATE INDEX IF NOT EXISTS idx_{HOURLY}_pid_bucket ON {HOURLY} (pid, bucket)",
+    f"CREATE INDEX IF NOT EXISTS idx_{DAILY}_pid_bucket ON {DAILY} (pid, bucket)",
+]
+
+
+def has_rollups(conn):
+    """Checks the database has been migrated to a version with the process summary tables."""
+    return PROCESS_SUMMARIES.exists(conn)
+
+
+def host_column(conn, schema="main"):
+    """The process table's host column in a central database, otherwise '' (the host of every row)."""
+    columns = [row[1] for row in conn.execute(f"PRAGMA {schema}.table_info(process)")]
+    return "host" if "host" in columns else "''"
+
+
+def summary_select(aggregate=True, host="host"):
+    """The SELECT list of the per pid summaries: samples, and each metric's count, sum and max.
+
+    aggregate combines rows that are already summaries (summary table rows, or another summary's
+    rows). Otherwise it summarizes raw process rows, ignoring anything that isn't a number.
+    """
+    if aggregate:
+        parts = [f"{host} AS host", "pid", "SUM(samples) AS samples"]
+    else:
+        parts = [f"{host} AS host", "pid", "COUNT(*) AS samples"]
+    for column in METRICS.values():
+        if aggregate:
+            parts += [f"SUM({column}_count) AS {column}_count", f"SUM({column}_sum) AS {column}_sum",
+                      f"MAX({column}_max) AS {column}_max"]
+        else:
+            value = rollups.numeric(column)
+            parts += [f"COUNT({value}) AS {column}_count", f"SUM({value}) AS {column}_sum",
+                      f"MAX({value}) AS {column}_max"]
+    return ", ".join(parts)
+
+
+class ProcessSummaries(rollups.Summaries):
+    """The hourly and daily process summaries, a row per host, pid and bucket.
+
+    Each hour is recomputed for every pid in it, so the buckets are the only key.
+    """
+
+    # The collector's timestamps start with the hour, so a substr() is enough, which is much quicker
+    # than strftime() on every row. Anything that isn't really an hour is dropped by touch().
+    hour_expression = "substr(timestamp, 1, 13) || ':00:00'"
+
+    def insert_hours(self, conn):
+        # Each hour is a range of the timestamp index.
+        conn.execute(f"""INSERT INTO {self.hourly}
+                         SELECT t.bucket, {summary_select(aggregate=False, host=host_column(conn))}
+                         FROM touched_hours t
+                         JOIN {self.table}
+                         ON timestamp >= t.bucket
+                         AND timestamp < strftime('{BUCKET_FORMATS[HOURLY]}', t.bucket, '+1 hour')
+                         GROUP BY t.bucket, 2, pid""")
+
+    def insert_days(self, conn):
+        conn.execute(f"""INSERT INTO {self.daily}
+                         SELECT d.bucket, {summary_select()}
+                         FROM touched_days d
+                         JOIN {self.hourly} h
+                         ON h.bucket >= d.bucket
+                         AND h.bucket < strftime('{BUCKET_FORMATS[DAILY]}', d.bucket, '+1 day')
+                         GROUP BY d.bucket, host, pid""")
+
+
+PROCESS_SUMMARIES = ProcessSummaries("process", "process", HOURLY, DAILY)
+
+
+def refresh(conn, chunk_rows=None):
+    """Brings the hourly and daily process summaries up to date with the process table.
+
+    See rollups.Summaries.refresh(). Returns the number of new raw rows.
+    """
+    return PROCESS_SUMMARIES.refresh(conn, chunk_rows)
+
+
+def maybe_refresh(conn, db):
+    """Refreshes the summaries if they haven't been refreshed in the last REFRESH_INTERVAL seconds."""
+    if not has_rollups(conn):
+        return False
+
+    now = time.monotonic()
+    if now - _LAST_REFRESH.get(db, -REFRESH_INTERVAL) < REFRESH_INTERVAL:
+        return False
+
+    refresh(conn)
+    _LAST_REFRESH[db] = now
+    return True
+
+
+def next_bucket(moment, table):
+    """The start of the first bucket at or after moment."""
+    bucket = datetime.datetime.strptime(moment.strftime(BUCKET_FORMATS[table]), "%Y-%m-%d %H:%M:%S")
+    return bucket if bucket == moment else bucket + BUCKET_SIZES[table]
+
+
+def plan(first, last):
+    """Splits the window from first to last (datetimes) into the pieces top_query() reads.
+
+    Returns [(resolution, start bucket, stop bucket)] for the whole days and hours inside the window,
+    with the hours either side of the days. The raw rows before the first piece and from the last
+    piece's stop on are read as well, so the newest rows are always counted.
+    """
+    hourly = BUCKET_FORMATS[HOURLY]
+    first_hour, stop_hour = next_bucket(first, HOURLY), last.strftime(hourly)
+    first_day, stop_day = next_bucket(first, DAILY), last.strftime(BUCKET_FORMATS[DAILY])
+
+    pieces = []
+    if first_day.strftime(hourly) < stop_day:
+        if first_hour < first_day:
+            pieces.append(("hourly", first_hour.strftime(hourly), first_day.strftime(hourly)))
+        pieces.append(("daily", first_day.strftime(hourly), stop_day))
+        if stop_day < stop_hour:
+            pieces.append(("hourly", stop_day, stop_hour))
+    elif first_hour.strftime(hourly) < stop_hour:
+        pieces.append(("hourly", first_hour.strftime(hourly), stop_hour))
+    return pieces
+
+
+def window_query(start=None, end=None, pieces=(), host=None, host_expression="''", schema="main"):
+    """The SELECT that summarizes each pid between start and end (inclusive), and its parameters.
+
+    Gives one row per host and pid, see summary_select(). pieces are the whole buckets from plan(),
+    which are read from the summary tables, with the raw rows before and after them. Without any
+    pieces every row is read raw. start and end are compared with the timestamp column as they are,
+    so they can be text (v1) or milliseconds (v2). host limits it to one machine of a central database.
+    """
+    raw = f"SELECT {summary_select(aggregate=False, host=host_expression)} FROM {schema}.process"
+    parts, params = [], []
+
+    def add(query, column, conditions, values):
+        if host:
+            conditions = conditions + ["host = ?"]
+            values = values + [host]
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        parts.append(f"{query}{where} GROUP BY 1, pid" if column == "timestamp" else f"{query}{where}")
+        params.extend(values)
+
+    def bounds(column, lower, upper, inclusive):
+        conditions, values = [], []
+        if lower is not None:
+            conditions.append(f"{column} >= ?")
+            values.append(lower)
+        if upper is not None:
+            conditions.append(f"{column} <= ?" if inclusive else f"{column} < ?")
+            values.append(upper)
+        return conditions, values
+
+    if not pieces:
+        add(raw, "timestamp", *bounds("timestamp", start, end, True))
+    else:
+        add(raw, "timestamp", *bounds("timestamp", start, pieces[0][1], False))
+        for resolution, first, stop in pieces:
+            table = f"{schema}.{RESOLUTIONS[resolution]}"
+            columns = ", ".join(["host", "pid", "samples"] + [f"{column}_{part}" for column in METRICS.values()
+                                                              for part in ("count", "sum", "max")])
+            add(f"SELECT {columns} FROM {table}", "bucket", *bounds("bucket", first, stop, False))
+        add(raw, "timestamp", *bounds("timestamp", pieces[-1][2], end, True))
+
+    union = " UNION ALL ".join(parts)
+    return f"SELECT {summary_select()} FROM ({union}) GROUP BY host, pid", params
+
+
+def rank_expression(metric, stat):
+    """SQL for what the pids are ranked on. NULLIF stops a pid with no numbers dividing by zero."""
+    column = METRICS[metric]
+    if stat == "max":
+        return f"{column}_max"
+    return f"{column}_sum / NULLIF({column}_count, 0)"
+
+
+def top_query(summary, metric="cpu", stat="avg"):
+    """Ranks the rows of a summary (window_query() or its merge) and keeps the first LIMIT ? of them.
+
+    The busiest first. Ties go to the lowest pid so the order is the same every time.
+    """
+    return f"""SELECT *
+               FROM ({summary})
+               ORDER BY {rank_expression(metric, stat)} DESC, pid, host
+               LIMIT ?"""
+
+
+def sparkline_query(resolution, metric, stat, pids, first, last, slot, points, host=None,
+                    host_expression="''", schema="main", ms=False):
+    """The SELECT that buckets the given pids' values between first and last into sparkline slots.
+
+    Gives (host, pid, slot, sum, count, max) rows. first and last are text timestamps, or milliseconds
+    in the v2 layout (ms). slot is each slot's width: days as julianday() counts them, or milliseconds.
+    """
+    column = METRICS[metric]
+    if resolution == rollups.RAW:
+        time_column = "timestamp"
+        value = rollups.numeric(column)
+        aggregates = f"SUM({value}) AS total, COUNT({value}) AS n, MAX({value}) AS peak"
+    else:
+        time_column = "bucket"
+        host_expression = "host"
+        aggregates = f"SUM({column}_sum) AS total, SUM({column}_count) AS n, MAX({column}_max) AS peak"
+
+    if ms:
+        position = f"({time_column} - ?) / ?"
+    else:
+        position = f"(julianday({time_column}) - julianday(?)) / ?"
+    # The last point also gets anything at the very end of the window.
+    slot_expression = f"MIN(MAX(CAST({position} AS INTEGER), 0), {points - 1})"
+
+    # A bucket that starts before first but runs into the window goes in the first point.
+    lower = "?" if resolution == rollups.RAW else f"strftime('{BUCKET_FORMATS[RESOLUTIONS[resolution]]}', ?)"
+    marks = ", ".join("?" * len(pids))
+    # pid comes first in the primary key (or the summary table's index), so each pid is a range read.
+    query = f"""SELECT {host_expression} AS host, pid, {slot_expression} AS slot, {aggregates}
+                FROM {schema}.{RESOLUTIONS[resolution]}
+                WHERE pid IN ({marks}) AND {time_column} >= {lower} AND {time_column} <= ?"""
+    params = [first, slot] + list(pids) + [first, last]
+    if host:
+        query += " AND host = ?"
+        params.append(host)
+    return query + " GROUP BY 1, pid, slot", params
+
+
+def sparkline_resolution(slot):
+    """Picks raw, hourly or daily rows for sparkline slots slot (a timedelta) wide, so each slot has a few."""
+    if slot >= BUCKET_SIZES[DAILY]:
+        return "daily"
+    elif slot >= BUCKET_SIZES[HOURLY]:
+        return "hourly"
+    return rollups.RAW
@@ -0,0 +1,381 @@
+###########################################################################################
+# File: psutil_collector.py                                                               #
+# Purpose: A metrics collector written in python with psutil, for machines that can't run #
+#          OpenHardwareMonitor.exe (linux, mac). Writes the same component,               #
+#          component_statistic and process rows. Samples are buffered in memory and       #
+#          written with executemany(), one transaction per flush.                         #
+#                                                                                         #
+# v1.1.0 Initial version.                                                                 #
+# v1.2.0 Writes the compact v2 layout (schema_v2.py) when the database uses it.           #
+# v1.3.0 Writes the rows into their shards (shards.py) when the database is sharded.      #
+###########################################################################################
+
+import datetime
+import os
+import platform
+import sqlite3
+import sys
+import threading
+import time
+import psutil
+import db_interface
+import schema_v2
+import shards
+
+# Seconds between samples. The executable samples every 30 seconds.
+DEFAULT_INTERVAL = 30
+
+# The shortest interval allowed from the web page.
+MIN_INTERVAL = 1
+
+# If the database can't be written to (locked, disk full) samples are kept for the next flush.
+# Past this many samples the oldest are dropped, so a long outage can't use up all the memory.
+MAX_BUFFERED_SAMPLES = 3600
+
+# Where linux keeps the per process stats. Reading it directly is several times cheaper than psutil.
+PROC_DIR = "/proc"
+
+# The collector that is running, if any. Only one runs at a time (see job_manager.DEFAULT_LIMITS).
+_ACTIVE = None
+_ACTIVE_LOCK = threading.Lock()
+
+
+def format_timestamp(moment):
+    """Formats a datetime the way the rest of the database stores them, so they compare as strings."""
+    return moment.strftime("%Y-%m-%d %H:%M:%S.%f")
+
+
+def host_serial(device, name=""):
+    """A serial number for a component. psutil can't read hardware serials, so it's made from the hostname."""
+    serial = f"{platform.node() or 'localhost'}-{device}"
+    return f"{serial}-{name}" if name else serial
+
+
+class ProcStatReader:
+    """Reads the cpu and memory use of every process straight out of /proc/<pid>/stat. Linux only.
+
+    One small read per process, instead of the several psutil makes, which is what keeps the
+    collector's overhead down with hundreds of processes at a 1 second interval.
+    """
+
+    def __init__(self):
+        self.ticks_per_second = os.sysconf("SC_CLK_TCK")
+        self.page_mb = os.sysconf("SC_PAGE_SIZE") / 2**20
+        # The cpu ticks each process had used at the last read, and when that was.
+        self.last_ticks = {}
+        self.last_clock = None
+
+    @staticmethod
+    def available():
+        """Checks this is a system with a linux style /proc."""
+        return os.path.exists(os.path.join(PROC_DIR, "self", "stat"))
+
+    def read(self):
+        """Returns (pid, cpu percent, memory MB) for every process. Percent is since the last read."""
+        clock = time.monotonic()
+        elapsed = clock - self.last_clock if self.last_clock is not None else 0
+        ticks = {}
+        rows = []
+
+        for name in os.listdir(PROC_DIR):
+            if not name.isdigit():
+                continue
+            try:
+                fd = os.open(os.path.join(PROC_DIR, name, "stat"), os.O_RDONLY)
+                try:
+                    data = os.read(fd, 1024)
+                finally:
+                    os.close(fd)
+            except OSError:
+                # It exited between the listdir() and the open().
+                continue
+
+            # The process name is in brackets and can hold spaces, so split after the last bracket.
+            # Then utime and stime are fields 14 and 15 and rss (in pages) is field 24 of the file.
+            fields = data[data.rfind(b")") + 2:].split()
+            pid = int(name)
+            used = int(fields[11]) + int(fields[12])
+            ticks[pid] = used
+
+            # A process seen for the first time has no previous reading, so it gets 0 like psutil gives.
+            previous = self.last_ticks.get(pid)
+            cpu = 0.0
+            if previous is not None and elapsed:
+                cpu = (used - previous) / self.ticks_per_second / elapsed * 100
+            rows.append((pid, cpu, int(fields[21]) * self.page_mb))
+
+        # Only the processes that are still running are remembered.
+        self.last_ticks = ticks
+        self.last_clock = clock
+        return rows
+
+
+class PsutilProcessReader:
+    """Reads the cpu and memory use of every process with psutil. Works everywhere psutil does."""
+
+    @staticmethod
+    def available():
+        """psutil is always there, it's a requirement."""
+        return True
+
+    def read(self):
+        """Returns (pid, cpu percent, memory MB) for every process we're allowed to look at."""
+        rows = []
+        # process_iter() keeps the Process objects between calls, so cpu_percent is since the last read.
+        for proc in psutil.process_iter(["cpu_percent", "memory_info"]):
+            # pid 0 is the idle process on windows, the executable skips it too.
+            memory = proc.info["memory_info"]
+            if proc.pid == 0 or memory is None:
+                continue
+            rows.append((proc.pid, proc.info["cpu_percent"] or 0.0, memory.rss / 2**20))
+        return rows
+
+
+def process_reader():
+    """The cheapest process reader that works on this system."""
+    return ProcStatReader() if ProcStatReader.available() else PsutilProcessReader()
+
+
+def cpu_temperature():
+    """The CPU package temperature, or 0 where psutil can't read it (windows, mac, most VMs)."""
+    read = getattr(psutil, "sensors_temperatures", None)
+    if read is None:
+        return 0.0
+    try:
+        sensors = read()
+    except (OSError, RuntimeError):
+        return 0.0
+    # coretemp is intel, k10temp is amd. Otherwise take whatever there is.
+    for name in ("coretemp", "k10temp", "cpu_thermal", *sensors):
+        if sensors.get(name):
+            return sensors[name][0].current
+    return 0.0
+
+
+def disk_partitions():
+    """The mounted physical disks, as (device name, mountpoint)."""
+    partitions = []
+    for partition in psutil.disk_partitions(all=False):
+        # Read only mounts (cd drives, squashfs snaps) are never going to fill up.
+        if "ro" in partition.opts.split(","):
+            continue
+        partitions.append((os.path.basename(partition.device.rstrip("\\/")) or partition.mountpoint,
+                           partition.mountpoint))
+    return partitions
+
+
+class Collector:
+    """Samples the components and processes every interval seconds and writes them to the database."""
+
+    def __init__(self, lifetime, interval=DEFAULT_INTERVAL, flush_interval=None, debug=0, reader=None):
+        self.lifetime = lifetime
+        self.interval = interval
+        # How often the buffered samples are written. Every sample by default.
+        self.flush_interval = flush_interval or interval
+        self.debug = debug
+        self.reader = reader or process_reader()
+        self.stop_event = threading.Event()
+
+        self.partitions = disk_partitions()
+        frequency = psutil.cpu_freq()
+        # The executable stores the stock speed in GHz and the current speed in MHz.
+        stock_speed = (frequency.max or frequency.current) / 1000 if frequency else 0.0
+        self.total_ram = psutil.virtual_memory().total / 2**30
+        # (serial_number, device_type, v_ram, stock_core_speed, stock_memory_speed), like the executable.
+        self.components = [(host_serial("cpu"), "CPU", 0, stock_speed, 0.0),
+                           (host_serial("ram"), "RAM", 0, 0.0, 0.0)]
+        self.components += [(host_serial("disk", name), "HDD", 0, 0.0, 0.0) for name, _ in self.partitions]
+
+        # The buffers. Each entry is one sample's rows.
+        self.statistics = []
+        self.processes = []
+
+        # Counters for the status page and the benchmark.
+        self.samples = 0
+        self.rows = 0
+        self.flushes = 0
+        self.dropped = 0
+        self.sample_seconds = 0.0
+        self.flush_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.started = None
+
+        # The first cpu_percent() call only sets the starting point, so make it now.
+        psutil.cpu_percent(interval=None)
+
+    def sample(self, now=None):
+        """Reads everything once and adds it to the buffers."""
+        started = time.perf_counter()
+        now = now or datetime.datetime.now()
+        timestamp = format_timestamp(now)
+        end_of_life = format_timestamp(now + self.lifetime)
+
+        frequency = psutil.cpu_freq()
+        memory = psutil.virtual_memory()
+        cpu_serial, ram_serial = self.components[0][0], self.components[1][0]
+        # (serial_number, timestamp, machine_state, temperature, usage, power_consumption,
+        #  core_speed, memory_speed, total_ram, end_of_life)
+        statistics = [
+            (cpu_serial, timestamp, "Active", cpu_temperature(), psutil.cpu_percent(interval=None), 0.0,
+             frequency.current if frequency else 0.0, 0.0, self.total_ram, end_of_life),
+            (ram_serial, timestamp, "Active", 0.0, memory.percent, 0.0, 0.0, 0.0, self.total_ram, end_of_life),
+        ]
+        for (name, mountpoint), component in zip(self.partitions, self.components[2:]):
+            try:
+                usage = psutil.disk_usage(mountpoint).percent
+            except OSError:
+                # Unmounted since we started.
+                continue
+            statistics.append((component[0], timestamp, "Active", 0.0, usage, 0.0, 0.0, 0.0, self.total_ram,
+                               end_of_life))
+
+        processes = [(pid, timestamp, cpu, memory_mb, end_of_life) for pid, cpu, memory_mb in self.reader.read()]
+
+        self.statistics.append(statistics)
+        self.processes.append(processes)
+        if len(self.statistics) > MAX_BUFFERED_SAMPLES:
+            del self.statistics[0], self.processes[0]
+            self.dropped += 1
+
+        self.samples += 1
+        self.sample_seconds += time.perf_counter() - started
+
+    def flush(self):
+        """Writes the buffered samples in one transaction. Returns the number of rows written.
+
+        If the write fails the samples stay buffered and are tried again at the next flush.
+        """
+        if not self.statistics:
+            return 0
+
+        started = time.perf_counter()
+        statistics = [row for sample in self.statistics for row in sample]
+        processes = [row for sample in self.processes for row in sample]
+        try:
+            if db_interface.get_pool(self.debug).sharded:
+                self.write_sharded(statistics, processes)
+                return self.flushed(statistics, processes)
+
+            layout = db_interface.get_layout(self.debug)
+            with db_interface.connect(self.debug) as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    conn.executemany("INSERT OR IGNORE INTO component VALUES (?, ?, ?, ?, ?)", self.components)
+                    # OR REPLACE like the executable, a sample is never written twice.
+                    if layout == schema_v2.LAYOUT_V2:
+                        # The end_of_life goes, every row points at the batch for this lifetime instead.
+                        batch = schema_v2.retention_batch(conn, self.lifetime.total_seconds() * 1000)
+                        conn.executemany(schema_v2.STATISTIC_INSERT, schema_v2.with_batch(statistics, batch))
+                        conn.executemany(schema_v2.PROCESS_INSERT, schema_v2.with_batch(processes, batch))
+                    else:
+                        conn.executemany("INSERT OR REPLACE INTO component_statistic VALUES "
+                                         "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", statistics)
+                        conn.executemany("INSERT OR REPLACE INTO process VALUES (?, ?, ?, ?, ?)", processes)
+                    conn.commit()
+                except sqlite3.Error:
+                    conn.rollback()
+                    raise
+        except sqlite3.Error as error:
+            print(f"Collector flush failed, keeping {len(self.statistics)} samples: {error}", file=sys.stderr)
+            return 0
+        finally:
+            self.flush_seconds += time.perf_counter() - started
+
+        return self.flushed(statistics, processes)
+
+    def flushed(self, statistics, processes):
+        """Drops the samples that have been written. Returns the number of rows."""
+        self.statistics.clear()
+        self.processes.clear()
+        self.flushes += 1
+        self.rows += len(statistics) + len(processes)
+        return len(statistics) + len(processes)
+
+    def write_sharded(self, statistics, processes):
+        """flush() for a sharded database. The components go in metrics.db and the rows in their shards.
+
+        Each file is its own transaction. If one fails the whole flush is tried again later, which
+        is safe since every row is INSERT OR REPLACE.
+        """
+        with db_interface.connect(self.debug) as conn:
+            with conn:
+                conn.executemany("INSERT OR IGNORE INTO component VALUES (?, ?, ?, ?, ?)", self.components)
+        shards.write_rows(db_interface.get_database(self.debug), statistics, processes)
+
+    def run(self):
+        """Samples every interval seconds until stop() is called, then writes what's left."""
+        self.started = time.monotonic()
+        # Only this thread's cpu time, the web server's isn't the collector's overhead.
+        cpu_started = time.thread_time()
+        next_sample = next_flush = self.started
+
+        while not self.stop_event.is_set():
+            self.sample()
+            if time.monotonic() >= next_flush:
+                self.flush()
+                next_flush += self.flush_interval
+            self.cpu_seconds = time.thread_time() - cpu_started
+
+            # Sample on a fixed schedule, so a slow sample doesn't push every later one back.
+            next_sample += self.interval
+            self.stop_event.wait(max(next_sample - time.monotonic(), 0))
+
+        self.flush()
+        self.cpu_seconds = time.thread_time() - cpu_started
+        return self.stats()
+
+    def stop(self):
+        """Asks run() to write what it has and return."""
+        self.stop_event.set()
+
+    def stats(self):
+        """What the collector has done so far and what it has cost."""
+        wall = time.monotonic() - self.started if self.started is not None else 0.0
+        return {
+            "interval":        self.interval,
+            "samples":         self.samples,
+            "rows":            self.rows,
+            "flushes":         self.flushes,
+            "buffered":        len(self.statistics),
+            "dropped":         self.dropped,
+            "seconds":         round(wall, 3),
+            "cpu_seconds":     round(self.cpu_seconds, 3),
+            # The share of one cpu the collector has used.
+            "cpu_percent":     round(self.cpu_seconds / wall * 100, 3) if wall else 0.0,
+            "sample_ms":       round(self.sample_seconds / self.samples * 1000, 3) if self.samples else 0.0,
+            "flush_ms":        round(self.flush_seconds / self.flushes * 1000, 3) if self.flushes else 0.0,
+        }
+
+
+def active_collector():
+    """The collector that is running, or None."""
+    with _ACTIVE_LOCK:
+        return _ACTIVE
+
+
+def collect(lifetime, interval=DEFAULT_INTERVAL, debug=0):
+    """Runs a collector until stop() is called. Meant to be run as a background job."""
+    global _ACTIVE
+    collector = Collector(lifetime, max(interval, MIN_INTERVAL), debug=debug)
+    with _ACTIVE_LOCK:
+        if _ACTIVE is not None:
+            raise RuntimeError("The python collector is already running")
+        _ACTIVE = collector
+    try:
+        stats = collector.run()
+    finally:
+        with _ACTIVE_LOCK:
+            _ACTIVE = None
+
+    # Whatever is returned here will be shown back to the user.
+    return (f"Metrics Stopped. Collected {stats['samples']} samples ({stats['rows']} rows) "
+            f"in {stats['seconds']:.0f}s using {stats['cpu_percent']:.2f}% of a CPU.")
+
+
+def stop():
+    """Stops the running collector. Returns True if there was one."""
+    collector = active_collector()
+    if collector is None:
+        return False
+    collector.stop()
+    return True
@@ -0,0 +1,252 @@
+###########################################################################################
+# File: response_cache.py                                                                 #
+# Purpose: Caches rendered pages and json responses until the database changes.           #
+#          The cache key is the request plus the database's version: the file mtimes and  #
+#          sizes (including the WAL) and PRAGMA data_version. Responses get a strong ETag, #
+#          so a browser asking again with If-None-Match gets a 304 and no table is read.   #
+#                                                                                         #
+# v1.1.0 Initial version.                                                                 #
+# v1.2.0 The version includes the shard files of a sharded database.                      #
+# v1.3.0 Responses are gzip or deflate compressed for browsers that accept it. Each       #
+#        encoding is cached alongside the response and gets a weak ETag.                  #
+###########################################################################################
+
+import collections
+import functools
+import gzip
+import hashlib
+import os
+import sqlite3
+import threading
+import zlib
+from flask import request, make_response
+import db_interface
+import shards
+
+# The most memory the cached response bodies can take up, in bytes. The oldest are dropped first.
+MAX_CACHE_BYTES = 32 * 1024 * 1024
+
+# A single response bigger than this isn't worth pushing everything else out for.
+MAX_ENTRY_BYTES = MAX_CACHE_BYTES // 4
+
+# The Content-Encodings we can send, best first. Responses smaller than MIN_COMPRESS_BYTES aren't
+# worth it. Level 6 is zlib's default, nearly all of level 9's saving in a fraction of the time.
+ENCODINGS = ["gzip", "deflate"]
+MIN_COMPRESS_BYTES = 1024
+COMPRESS_LEVEL = 6
+
+
+def make_etag(body):
+    """A strong ETag for the body: it only matches if the body is byte for byte the same."""
+    return hashlib.sha256(body).hexdigest()[:32]
+
+
+def compress(body, encoding):
+    """The body compressed for a Content-Encoding of gzip or deflate (which is zlib's format)."""
+    if encoding == "gzip":
+        # mtime=0 so the same body always compresses to the same bytes.
+        return gzip.compress(body, COMPRESS_LEVEL, mtime=0)
+    return zlib.compress(body, COMPRESS_LEVEL)
+
+
+def choose_encoding(size):
+    """The Content-Encoding to send a body of this size with, from the request's Accept-Encoding. None for none."""
+    if size < MIN_COMPRESS_BYTES:
+        return None
+    return request.accept_encodings.best_match(ENCODINGS)
+
+
+class ResponseCache:
+    """A thread safe LRU cache of response bodies, capped by the total size of the bodies."""
+
+    def __init__(self, max_bytes=MAX_CACHE_BYTES, max_entry_bytes=MAX_ENTRY_BYTES):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        # Least recently used first.
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Returns the cached (etag, body, mimetype) for the key, or None. Counts the hit or miss."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, body, mimetype):
+        """Caches a response body and returns its ETag."""
+        etag = make_etag(body)
+        if len(body) > self.max_entry_bytes:
+            return etag
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old[1])
+            self.entries[key] = (etag, body, mimetype)
+            self.bytes += len(body)
+
+            # Drop the least recently used responses until we're back under the cap.
+            while self.bytes > self.max_bytes:
+                _, (_, old_body, _) = self.entries.popitem(last=False)
+                self.bytes -= len(old_body)
+                self.evictions += 1
+        return etag
+
+    def compressed(self, key, body, encoding):
+        """The body compressed with the encoding. A cached response's is kept with it, so it's only done once."""
+        variant = key + (encoding,)
+        with self.lock:
+            entry = self.entries.get(variant)
+            if entry is not None:
+                self.entries.move_to_end(variant)
+                return entry[1]
+            cached = key in self.entries
+
+        data = compress(body, encoding)
+        if cached:
+            self.put(variant, data, None)
+        return data
+
+    def clear(self):
+        """Empties the cache. The counters are kept."""
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """The counters, for monitoring."""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries":      len(self.entries),
+                "bytes":        self.bytes,
+                "max_bytes":    self.max_bytes,
+                "hits":         self.hits,
+                "misses":       self.misses,
+                "hit_rate":     round(self.hits / lookups, 3) if lookups else None,
+                "not_modified": self.not_modified,
+                "evictions":    self.evictions,
+            }
+
+
+# Read only connections used to ask for PRAGMA data_version, one per database. data_version only
+# changes for a connection when a *different* connection commits, so they are never used for anything else.
+_WATCHERS = {}
+_WATCHERS_LOCK = threading.Lock()
+
+
+def data_version(db):
+    """PRAGMA data_version from the database's watcher connection. Doesn't read any table."""
+    with _WATCHERS_LOCK:
+        conn = _WATCHERS.get(db)
+        if conn is None:
+            # mode=ro so a missing database isn't created just by looking at it.
+            conn = sqlite3.connect(f"file:{db}?mode=ro", uri=True, check_same_thread=False)
+            _WATCHERS[db] = conn
+        return conn.execute("PRAGMA data_version").fetchone()[0]
+
+
+def close_watchers():
+    """Closes the watcher connections."""
+    with _WATCHERS_LOCK:
+        for conn in _WATCHERS.values():
+            conn.close()
+        _WATCHERS.clear()
+
+
+def database_version(db):
+    """Something that changes whenever the database does, or None if there's no database to cache for.
+
+    The collector writes to the -wal file, so its mtime and size are part of it too. So are the
+    shards of a sharded database, which is where the collector writes instead.
+    """
+    try:
+        stats = [os.stat(db)]
+    except OSError:
+        return None
+
+    paths = [db + "-wal"]
+    for shard in shards.list_shards(db):
+        paths += [shard.path, shard.path + "-wal"]
+    for path in paths:
+        try:
+            stats.append(os.stat(path))
+        except OSError:
+            pass
+
+    try:
+        version = data_version(db)
+    except sqlite3.Error:
+        # A broken database. Don't cache anything for it, let the page report the error.
+        return None
+
+    return tuple((stat.st_mtime_ns, stat.st_size) for stat in stats) + (version,)
+
+
+# The cache the web server uses.
+cache = ResponseCache()
+
+
+def cached(view):
+    """Decorator that caches a route's response until the database (or the request) changes.
+
+    Only successful responses are cached. The debug parameter picks the database, like every route.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        debug = request.values.get("debug", type=int, default=0)
+        db = db_interface.get_database(debug)
+        version = database_version(db)
+        if version is None:
+            return view(*args, **kwargs)
+
+        # Every request parameter is part of the key, in a fixed order.
+        key = (request.path, db, tuple(sorted(request.values.items(multi=True))), version)
+        entry = cache.get(key)
+        if entry is None:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200 or response.is_streamed:
+                return response
+
+            # Only cache it if the database didn't change while we were working it out (the collector
+            # wrote, or the view itself refreshed the rollups). Otherwise it might not match the version.
+            body = response.get_data()
+            if database_version(db) == version:
+                etag = cache.put(key, body, response.mimetype)
+            else:
+                etag = make_etag(body)
+        else:
+            etag, body, mimetype = entry
+            response = make_response(body)
+            response.mimetype = mimetype
+
+        # A compressed body isn't byte for byte the same as the one the ETag was made from, so its ETag
+        # is weak. If-None-Match is a weak comparison, so either matches.
+        encoding = choose_encoding(len(body))
+        response.set_etag(etag, weak=encoding is not None)
+        response.vary.add("Accept-Encoding")
+
+        # The browser has to check back each time, but a 304 is all it gets if nothing has changed.
+        response.headers["Cache-Control"] = "no-cache"
+        if request.if_none_match.contains_weak(etag):
+            with cache.lock:
+                cache.not_modified += 1
+            return make_response("", 304, {"ETag": response.headers["ETag"], "Cache-Control": "no-cache",
+                                           "Vary": "Accept-Encoding"})
+
+        if encoding is not None:
+            response.set_data(cache.compressed(key, body, encoding))
+            response.headers["Content-Encoding"] = encoding
+        return response
+
+    return wrapper
@@ -0,0 +1,418 @@
+###########################################################################################
+# File: rollups.py                                                                        #
+# Purpose: Hourly and daily summaries (min/max/avg/count) of component_statistic.         #
+#          The summaries are kept up to date incrementally. Only the buckets touched by   #
+#          rows added since the last refresh are recomputed.                              #
+#                                                                                         #
+# v1.1.0 Initial version.                                                                 #
+# v1.2.0 Added rollup_query(), so a sharded read can run it against each shard.           #
+# v1.3.0 Added summary_query(), the count/min/max/sum of a window per component.          #
+# v1.4.0 The hour and day the oldest raw row is in are recomputed on every refresh, so a  #
+#        prune that cuts into them doesn't leave them counting the deleted rows.          #
+# v1.5.0 The refresh is shared with process_analytics.py (Summaries) and done a chunk of  #
+#        rows at a time. delete_rows() recomputes the buckets of the rows it deletes, and #
+#        the rollups are rebuilt if the newest rows were deleted behind their back.       #
+###########################################################################################
+
+import datetime
+import time
+
+# The component_statistic columns that are summarized.
+ROLLUP_COLUMNS = ("temperature", "usage", "power_consumption", "core_speed", "memory_speed", "total_ram")
+
+# The summary tables and the strftime() format that turns a timestamp into the start of its bucket.
+HOURLY = "component_statistic_hourly"
+DAILY = "component_statistic_daily"
+BUCKET_FORMATS = {
+    HOURLY: "%Y-%m-%d %H:00:00",
+    DAILY:  "%Y-%m-%d 00:00:00",
+}
+# How long each bucket is.
+BUCKET_SIZES = {
+    HOURLY: datetime.timedelta(hours=1),
+    DAILY:  datetime.timedelta(days=1),
+}
+
+# The names for each resolution, as reported back to the charts.
+RAW = "raw"
+RESOLUTIONS = {RAW: "component_statistic", "hourly": HOURLY, "daily": DAILY}
+
+# Windows up to RAW_MAX_SPAN read the raw rows, up to HOURLY_MAX_SPAN the hourly rollup, after that daily.
+RAW_MAX_SPAN = datetime.timedelta(days=2)
+HOURLY_MAX_SPAN = datetime.timedelta(days=60)
+
+# Don't refresh more often than this. The collector only writes every 30 seconds anyway.
+REFRESH_INTERVAL = 30
+
+# How many new raw rows each refresh transaction summarizes. About a second's work, so the first
+# refresh of a big table lets the collector write in between (and stays inside its busy_timeout).
+REFRESH_CHUNK_ROWS = 500000
+
+# When each database was last refreshed, keyed on the database path.
+_LAST_REFRESH = {}
+
+
+def rollup_table_sql(table):
+    """The CREATE TABLE statement for a rollup table. Each column gets a min, max, sum and count."""
+    columns = []
+    for column in ROLLUP_COLUMNS:
+        columns += [f"{column}_min FLOAT", f"{column}_max FLOAT", f"{column}_sum FLOAT", f"{column}_count INT"]
+
+    return f"""CREATE TABLE IF NOT EXISTS {table} (
+                   serial_number TEXT,
+                   bucket DATETIME,
+                   sample_count INT NOT NULL,
+                   {", ".join(columns)},
+                   PRIMARY KEY (serial_number, bucket)
+               )"""
+
+
+# The statements for the schema migration that adds the rollups (see db_interface.MIGRATIONS).
+SCHEMA = [
+    rollup_table_sql(HOURLY),
+    rollup_table_sql(DAILY),
+    # How far through component_statistic (by rowid) the rollups have got.
+    """CREATE TABLE IF NOT EXISTS rollup_state (
+           name TEXT PRIMARY KEY,
+           last_rowid INTEGER NOT NULL
+       )""",
+]
+
+
+def numeric(column):
+    """SQL that gives the column if it holds a number, otherwise NULL (emojis, text, etc)."""
+    return f"CASE WHEN typeof({column}) IN ('integer', 'real') THEN {column} END"
+
+
+def raw_aggregates():
+    """The SELECT list that summarizes raw component_statistic rows."""
+    parts = ["COUNT(*)"]
+    for column in ROLLUP_COLUMNS:
+        value = numeric(f"cs.{column}")
+        parts += [f"MIN({value})", f"MAX({value})", f"SUM({value})", f"COUNT({value})"]
+    return ", ".join(parts)
+
+
+def merged_aggregates():
+    """The SELECT list that combines hourly rows into a daily row."""
+    parts = ["SUM(h.sample_count)"]
+    for column in ROLLUP_COLUMNS:
+        parts += [f"MIN(h.{column}_min)", f"MAX(h.{column}_max)",
+                  f"SUM(h.{column}_sum)", f"SUM(h.{column}_count)"]
+    return ", ".join(parts)
+
+
+def has_rollups(conn):
+    """Checks the database has been migrated to a version with the rollup tables."""
+    return COMPONENT_ROLLUPS.exists(conn)
+
+
+class Summaries:
+    """A raw table summarized into an hourly and a daily table, which are kept up to date incrementally.
+
+    How far through the raw table (by rowid) the summaries have got is kept in rollup_state, as name.
+    keys are the columns each hour is recomputed by, on top of its bucket. A subclass gives the SQL
+    that summarizes the hours in temp.touched_hours from the raw rows (insert_hours) and the days in
+    temp.touched_days from the hourly rows (insert_days).
+    """
+
+    # SQL that gives the start of the hour a raw row's timestamp is in. Anything that doesn't turn out
+    # to be an hour is dropped.
+    hour_expression = f"strftime('{BUCKET_FORMATS[HOURLY]}', timestamp)"
+
+    def __init__(self, name, table, hourly, daily, keys=()):
+        self.name = name
+        self.table = table
+        self.hourly = hourly
+        self.daily = daily
+        self.keys = tuple(keys)
+
+    def insert_hours(self, conn):
+        """Summarizes the hours in temp.touched_hours from the raw rows into the hourly table."""
+        raise NotImplementedError
+
+    def insert_days(self, conn):
+        """Summarizes the days in temp.touched_days from the hourly rows into the daily table."""
+        raise NotImplementedError
+
+    def exists(self, conn):
+        """Checks the database has been migrated to a version with the summary tables."""
+        return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                            (self.daily,)).fetchone() is not None
+
+    def start(self, conn):
+        """Starts an empty list of the hours and days to recompute."""
+        for touched in ["touched_hours", "touched_days"]:
+            columns = ", ".join(self.keys + ("bucket",))
+            conn.execute(f"DROP TABLE IF EXISTS temp.{touched}")
+            conn.execute(f"CREATE TEMP TABLE {touched} ({columns}, PRIMARY KEY ({columns}))")
+
+    def touch(self, conn, where, params=()):
+        """Adds the hours of the raw rows that match where to the hours to recompute."""
+        keys = "".join(f"{key}, " for key in self.keys)
+        conn.execute(f"""INSERT OR IGNORE INTO touched_hours
+                         SELECT *
+                         FROM (SELECT DISTINCT {keys}{self.hour_expression} AS bucket
+                               FROM {self.table}
+                               WHERE {where})
+                         WHERE strftime('{BUCKET_FORMATS[HOURLY]}', bucket) = bucket""", params)
+
+    def touch_oldest(self, conn):
+        """Drops the buckets that finished before the oldest raw row, and adds the hour and day it's in.
+
+        Old raw rows get pruned, so the oldest hour and day may only have part of their rows left.
+        Returns the oldest raw row's timestamp, or None when there are no rows and so no buckets.
+        """
+        oldest = conn.execute(f"SELECT MIN(timestamp) FROM {self.table}").fetchone()[0]
+        if not oldest:
+            conn.execute(f"DELETE FROM {self.hourly}")
+            conn.execute(f"DELETE FROM {self.daily}")
+            return None
+
+        columns = ", ".join(self.keys + ("bucket",))
+        for table, touched in [(self.hourly, "touched_hours"), (self.daily, "touched_days")]:
+            bucket_format = BUCKET_FORMATS[HOURLY] if table == self.hourly else BUCKET_FORMATS[DAILY]
+            conn.execute(f"DELETE FROM {table} WHERE bucket < strftime('{bucket_format}', ?)", (oldest,))
+            conn.execute(f"""INSERT OR IGNORE INTO {touched}
+                             SELECT {columns} FROM {table}
+                             WHERE bucket = strftime('{bucket_format}', ?)""", (oldest,))
+        return oldest
+
+    def recompute(self, conn):
+        """Recomputes the touched hours from every raw row in them, then the days they're in.
+
+        Recomputing rather than adding means a row that was replaced (INSERT OR REPLACE in the
+        collector) is never counted twice. They're deleted first, so a bucket with no rows left goes.
+        """
+        columns = ", ".join(self.keys + ("bucket",))
+        keys = "".join(f"{key}, " for key in self.keys)
+        conn.execute(f"""INSERT OR IGNORE INTO touched_days
+                         SELECT {keys}strftime('{BUCKET_FORMATS[DAILY]}', bucket) FROM touched_hours""")
+
+        conn.execute(f"DELETE FROM {self.hourly} WHERE ({columns}) IN (SELECT {columns} FROM touched_hours)")
+        self.insert_hours(conn)
+        conn.execute(f"DELETE FROM {self.daily} WHERE ({columns}) IN (SELECT {columns} FROM touched_days)")
+        self.insert_days(conn)
+
+        conn.execute("DROP TABLE temp.touched_hours")
+        conn.execute("DROP TABLE temp.touched_days")
+
+    def last_rowid(self, conn):
+        """The high-water mark. Everything up to this rowid has already been summarized."""
+        row = conn.execute("SELECT last_rowid FROM rollup_state WHERE name = ?", (self.name,)).fetchone()
+        return row[0] if row else 0
+
+    def set_last_rowid(self, conn, last_rowid):
+        """Moves the high-water mark."""
+        conn.execute("INSERT OR REPLACE INTO rollup_state (name, last_rowid) VALUES (?, ?)",
+                     (self.name, last_rowid))
+
+    def delete_rows(self, conn, where, params=()):
+        """Deletes the raw rows that match where, and recomputes the buckets they were in.
+
+        Runs in the caller's transaction, so the summaries never count rows that have gone. Returns
+        the number of rows deleted.
+        """
+        self.start(conn)
+        self.touch(conn, where, params)
+        deleted = conn.execute(f"DELETE FROM {self.table} WHERE {where}", params).rowcount
+        self.recompute(conn)
+
+        # New rows can be given the rowids of the newest rows that were deleted. Move the mark back
+        # so they aren't taken for rows that have already been summarized.
+        max_rowid = conn.execute(f"SELECT MAX(rowid) FROM {self.table}").fetchone()[0] or 0
+        if max_rowid < self.last_rowid(conn):
+            self.set_last_rowid(conn, max_rowid)
+        return deleted
+
+    def refresh(self, conn, chunk_rows=None):
+        """Brings the hourly and daily summaries up to date with the raw table.
+
+        Only the hours with rows added since the last refresh are summarized again, from every raw
+        row in them, then the days those hours are in from the hourly rows. So are the hour and day
+        the oldest raw row is in, a prune may have cut into them. The new rows are taken chunk_rows at
+        a time, each chunk its own transaction, so the first refresh of a big table doesn't keep the
+        collector waiting for the whole of it. Returns the number of new raw rows.
+        """
+        chunk_rows = chunk_rows or REFRESH_CHUNK_ROWS
+
+        new_rows = 0
+        while True:
+            try:
+                # One write transaction, so readers never see the hourly and daily tables out of step.
+                conn.execute("BEGIN IMMEDIATE")
+
+                last_rowid = mark = self.last_rowid(conn)
+                max_rowid = conn.execute(f"SELECT MAX(rowid) FROM {self.table}").fetchone()[0] or 0
+                if max_rowid < last_rowid:
+                    # The newest rows were deleted by something that didn't recompute their buckets
+                    # (e.g. the executable's prune), and their rowids can be used again. Start over.
+                    conn.execute(f"DELETE FROM {self.hourly}")
+                    conn.execute(f"DELETE FROM {self.daily}")
+                    last_rowid = 0
+                upto = min(max_rowid, last_rowid + chunk_rows)
+                last_chunk = upto >= max_rowid
+
+                # The hours with new rows. The rowid range is a straight read of the end of the table.
+                self.start(conn)
+                self.touch(conn, "rowid > ? AND rowid <= ?", (last_rowid, upto))
+                if last_chunk:
+                    self.touch_oldest(conn)
+                self.recompute(conn)
+
+                if upto != mark:
+                    self.set_last_rowid(conn, upto)
+                new_rows += upto - last_rowid
+
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+            if last_chunk:
+                return new_rows
+
+
+class ComponentRollups(Summaries):
+    """The hourly and daily rollups of component_statistic, a row per component and bucket."""
+
+    def insert_hours(self, conn):
+        conn.execute(f"""INSERT INTO {self.hourly}
+                         SELECT t.serial_number, t.bucket, {raw_aggregates()}
+                         FROM touched_hours t
+                         JOIN {self.table} cs
+                         ON cs.serial_number = t.serial_number
+                         AND cs.timestamp >= t.bucket
+                         AND cs.timestamp < strftime('{BUCKET_FORMATS[HOURLY]}', t.bucket, '+1 hour')
+                         GROUP BY t.serial_number, t.bucket""")
+
+    def insert_days(self, conn):
+        conn.execute(f"""INSERT INTO {self.daily}
+                         SELECT d.serial_number, d.bucket, {merged_aggregates()}
+                         FROM touched_days d
+                         JOIN {self.hourly} h
+                         ON h.serial_number = d.serial_number
+                         AND h.bucket >= d.bucket
+                         AND h.bucket < strftime('{BUCKET_FORMATS[DAILY]}', d.bucket, '+1 day')
+                         GROUP BY d.serial_number, d.bucket""")
+
+
+COMPONENT_ROLLUPS = ComponentRollups("component_statistic", "component_statistic", HOURLY, DAILY,
+                                     keys=["serial_number"])
+
+
+def refresh_rollups(conn, chunk_rows=None):
+    """Brings the hourly and daily rollups up to date with component_statistic.
+
+    Returns the number of new raw rows that were rolled up.
+    """
+    return COMPONENT_ROLLUPS.refresh(conn, chunk_rows)
+
+
+def maybe_refresh_rollups(conn, db):
+    """Refreshes the rollups if they haven't been refreshed in the last REFRESH_INTERVAL seconds."""
+    if not has_rollups(conn):
+        return False
+
+    now = time.monotonic()
+    if now - _LAST_REFRESH.get(db, -REFRESH_INTERVAL) < REFRESH_INTERVAL:
+        return False
+
+    refresh_rollups(conn)
+    _LAST_REFRESH[db] = now
+    return True
+
+
+def choose_resolution(first, last):
+    """Picks raw, hourly or daily data for a window, so a chart never has too many rows to read."""
+    span = last - first
+    if span <= RAW_MAX_SPAN:
+        return RAW
+    elif span <= HOURLY_MAX_SPAN:
+        return "hourly"
+    return "daily"
+
+
+def rollup_query(resolution, serial_number, columns, start=None, end=None, schema="main"):
+    """The SELECT read_rollup() runs and its parameters. schema is the database the table is in."""
+    table = RESOLUTIONS[resolution]
+
+    # The average is sum / count. NULLIF stops a column with no numbers dividing by zero.
+    averages = ", ".join(f"{column}_sum / NULLIF({column}_count, 0)" for column in columns)
+    query = f"SELECT bucket, {averages} FROM {schema}.{table} WHERE serial_number = ?"
+    params = [serial_number]
+
+    # Include the bucket the start falls in, so a window never starts with a gap.
+    if start:
+        query += f" AND bucket >= strftime('{BUCKET_FORMATS[table]}', ?)"
+        params.append(start)
+    if end:
+        query += " AND bucket <= ?"
+        params.append(end)
+    query += " ORDER BY bucket"
+
+    return query, params
+
+
+def read_rollup(conn, resolution, serial_number, columns, start=None, end=None):
+    """Reads [bucket, average of each column...] rows from a rollup table, ordered by time."""
+    query, params = rollup_query(resolution, serial_number, columns, start, end)
+    return [list(row) for row in conn.execute(query, params)]
+
+
+def summary_select(columns, aggregate=True):
+    """The SELECT list of summary_query(). Each column gets a count, min, max and sum.
+
+    aggregate combines rows that are already summaries (rollup rows, or another summary's rows).
+    Otherwise it summarizes raw component_statistic rows, ignoring anything that isn't a number.
+    """
+    parts = ["serial_number"]
+    for column in columns:
+        if aggregate:
+            parts += [f"SUM({column}_count) AS {column}_count", f"MIN({column}_min) AS {column}_min",
+                      f"MAX({column}_max) AS {column}_max", f"SUM({column}_sum) AS {column}_sum"]
+        else:
+            value = numeric(column)
+            parts += [f"COUNT({value}) AS {column}_count", f"MIN({value}) AS {column}_min",
+                      f"MAX({value}) AS {column}_max", f"SUM({value}) AS {column}_sum"]
+    return ", ".join(parts)
+
+
+def summary_query(columns, start=None, end=None, resolution=RAW, whole=None, schema="main"):
+    """The SELECT that summarizes each component's columns between start and end, and its parameters.
+
+    Gives one row per serial_number with the count, min, max and sum of each column. whole is the
+    (first, stop) buckets of the resolution's rollup that lie wholly inside the window, first being
+    None for no start. Those buckets are read from the rollup, and only the raw rows either side of
+    them (before first and from stop on) are read, so the answer is the same as reading every row.
+    """
+    raw = f"SELECT {summary_select(columns, aggregate=False)} FROM {schema}.component_statistic"
+    pieces, params = [], []
+
+    def add(query, conditions, values):
+        pieces.append(f"{query} WHERE {' AND '.join(conditions)} GROUP BY serial_number" if conditions
+                      else f"{query} GROUP BY serial_number")
+        params.extend(values)
+
+    if resolution == RAW or whole is None:
+        conditions, values = [], []
+        if start:
+            conditions.append("timestamp >= ?")
+            values.append(start)
+        if end:
+            conditions.append("timestamp <= ?")
+            values.append(end)
+        add(raw, conditions, values)
+    else:
+        first, stop = whole
+        if first:
+            add(raw, ["timestamp >= ?", "timestamp < ?"], [start, first])
+            add(f"SELECT {summary_select(columns)} FROM {schema}.{RESOLUTIONS[resolution]}",
+                ["bucket >= ?", "bucket < ?"], [first, stop])
+        else:
+            add(f"SELECT {summary_select(columns)} FROM {schema}.{RESOLUTIONS[resolution]}",
+                ["bucket < ?"], [stop])
+        add(raw, ["timestamp >= ?"] + (["timestamp <= ?"] if end else []), [stop] + ([end] if end else []))
+
+    union = " UNION ALL ".join(pieces)
+    return f"SELECT {summary_select(columns)} FROM ({union}) GROUP BY serial_number", params
@@ -0,0 +1,460 @@
+###########################################################################################
+# File: schema_v2.py                                                                      #
+# Purpose: The compact (v2) storage layout and the tool that converts a database to it.   #
+#          v2 stores timestamps as integer epoch milliseconds in WITHOUT ROWID tables     #
+#          clustered on (serial_number, timestamp) and (pid, timestamp). Instead of an    #
+#          end_of_life on every row, each row points at a retention batch that holds the  #
+#          lifetime it was collected with.                                                #
+#                                                                                         #
+#          Naive timestamps are treated as UTC, like columnar.py, so a timestamp turns    #
+#          into milliseconds and back without moving.                                     #
+#                                                                                         #
+# Usage: python Display/schema_v2.py convert metrics.db [metrics-v2.db] [--replace]       #
+#        python Display/schema_v2.py report metrics.db                                    #
+#                                                                                         #
+# v1.1.0 Initial version.                                                                 #
+# v1.2.0 New databases get the anomaly tables (anomalies.py) as well.                     #
+###########################################################################################
+
+import argparse
+import datetime
+import os
+import sqlite3
+import sys
+import time
+import anomalies
+
+# The two layouts. v1 is what OpenHardwareMonitor.exe writes, v2 is this module's.
+LAYOUT_V1 = "v1"
+LAYOUT_V2 = "v2"
+
+# Set to 2 to create new databases with the v2 layout. Existing databases keep the layout they have.
+# OpenHardwareMonitor.exe can only write v1, so only use it with the python collector.
+LAYOUT_ENV = "MTG_SCHEMA"
+
+# The v2 tables. The component table is the same as v1.
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS component (
+           serial_number TEXT,
+           device_type TEXT NOT NULL,
+           v_ram FLOAT,
+           stock_core_speed FLOAT,
+           stock_memory_speed FLOAT,
+           PRIMARY KEY (serial_number)
+       )""",
+    # One row per lifetime the collector has been run with. Rows expire at timestamp + lifetime_ms.
+    """CREATE TABLE IF NOT EXISTS retention (
+           batch INTEGER PRIMARY KEY,
+           lifetime_ms INTEGER NOT NULL UNIQUE
+       )""",
+    """CREATE TABLE IF NOT EXISTS component_statistic (
+           serial_number TEXT,
+           timestamp INTEGER,
+           machine_state TEXT NOT NULL,
+           temperature FLOAT NOT NULL,
+           usage FLOAT NOT NULL,
+           power_consumption FLOAT NOT NULL,
+           core_speed FLOAT,
+           memory_speed FLOAT,
+           total_ram FLOAT,
+           batch INTEGER NOT NULL,
+           PRIMARY KEY (serial_number, timestamp)
+       ) WITHOUT ROWID""",
+    """CREATE TABLE IF NOT EXISTS process (
+           pid INT,
+           timestamp INTEGER,
+           cpu_usage FLOAT NOT NULL,
+           memory_usage FLOAT NOT NULL,
+           batch INTEGER NOT NULL,
+           PRIMARY KEY (pid, timestamp)
+       ) WITHOUT ROWID""",
+    # Time window lookups and the prune. Also covers the process table sorted by cpu.
+    """CREATE INDEX IF NOT EXISTS idx_process_timestamp_cpu_usage
+       ON process (timestamp, cpu_usage)""",
+]
+
+# The unix epoch as a julian day, and how many milliseconds there are in a day.
+JULIAN_EPOCH = 2440587.5
+DAY_MS = 86400000
+
+# Lifetimes are rounded to the hour when they are turned into batches, so a run of the
+# collector (or a converted database) ends up with a handful of batches, not one per row.
+LIFETIME_ROUNDING_MS = 3600000
+
+# The bucket sizes for the hourly and daily charts. v2 has no rollup tables, the clustered
+# primary key makes grouping one component's rows fast enough.
+BUCKET_MS = {"hourly": 3600000, "daily": DAY_MS}
+
+# How many rows the conversion copies per transaction.
+CHUNK_ROWS = 50000
+
+# The patterns a timestamp bound is parsed with, and where the time each one covers ends.
+# '2025-04-17 18' is the whole hour, the same as the string compare on a v1 database.
+BOUND_PATTERNS = [
+    ("%Y-%m-%d %H:%M:%S.%f", lambda moment: moment + datetime.timedelta(milliseconds=1)),
+    ("%Y-%m-%d %H:%M:%S",    lambda moment: moment + datetime.timedelta(seconds=1)),
+    ("%Y-%m-%d %H:%M",       lambda moment: moment + datetime.timedelta(minutes=1)),
+    ("%Y-%m-%d %H",          lambda moment: moment + datetime.timedelta(hours=1)),
+    ("%Y-%m-%d",             lambda moment: moment + datetime.timedelta(days=1)),
+    ("%Y-%m",                lambda moment: moment.replace(year=moment.year + moment.month // 12,
+                                                           month=moment.month % 12 + 1)),
+    ("%Y",                   lambda moment: moment.replace(year=moment.year + 1)),
+]
+
+
+def to_ms_sql(expression):
+    """SQL that turns a text timestamp into epoch milliseconds. NULL if it isn't a timestamp."""
+    return f"CAST(ROUND((julianday({expression}) - {JULIAN_EPOCH}) * {DAY_MS}) AS INTEGER)"
+
+
+def to_text_sql(expression):
+    """SQL that turns epoch milliseconds back into a 'YYYY-MM-DD HH:MM:SS.SSS' timestamp."""
+    return f"strftime('%Y-%m-%d %H:%M:%f', ({expression}) / 1000.0, 'unixepoch')"
+
+
+# The insert statements for the collector. The timestamp is passed as text and converted in SQL.
+STATISTIC_INSERT = (f"INSERT OR REPLACE INTO component_statistic VALUES "
+                    f"(?, {to_ms_sql('?')}, ?, ?, ?, ?, ?, ?, ?, ?)")
+PROCESS_INSERT = f"INSERT OR REPLACE INTO process VALUES (?, {to_ms_sql('?')}, ?, ?, ?)"
+
+
+def to_ms(moment):
+    """Epoch milliseconds for a naive datetime."""
+    return round((moment - datetime.datetime(1970, 1, 1)).total_seconds() * 1000)
+
+
+def from_ms(ms):
+    """The naive datetime for epoch milliseconds."""
+    return datetime.datetime(1970, 1, 1) + datetime.timedelta(milliseconds=ms)
+
+
+def bound_ms(timestamp, upper=False):
+    """Turns a user supplied timestamp into a millisecond bound, like db_interface.normalize_timestamp().
+
+    An upper bound covers the whole of what was given, so '2025-04-17 18:17' runs to 18:17:59.999.
+    Returns None for no timestamp and raises ValueError for one that can't be read.
+    """
+    if not timestamp:
+        return None
+
+    # strptime only takes 6 fractional digits, the collector writes 7. Milliseconds is all v2 keeps.
+    text = timestamp.strip().rstrip("~").replace("T", " ")
+    if "." in text:
+        whole, fraction = text.split(".", 1)
+        text = f"{whole}.{fraction[:3]}"
+
+    for pattern, end in BOUND_PATTERNS:
+        try:
+            moment = datetime.datetime.strptime(text, pattern)
+        except ValueError:
+            continue
+        return to_ms(end(moment)) - 1 if upper else to_ms(moment)
+
+    raise ValueError(f"Not a timestamp: {timestamp}")
+
+
+def get_layout(conn):
+    """Which layout the database uses. Only v2 has the retention table."""
+    found = conn.execute("""SELECT 1 FROM sqlite_master
+                            WHERE type = 'table' AND name = 'retention'""").fetchone()
+    return LAYOUT_V2 if found else LAYOUT_V1
+
+
+def serial_numbers(conn):
+    """Every serial number in component_statistic, a primary key seek each rather than a scan for DISTINCT."""
+    serials = []
+    serial = conn.execute("SELECT MIN(serial_number) FROM component_statistic").fetchone()[0]
+    while serial is not None:
+        serials.append(serial)
+        serial = conn.execute("""SELECT MIN(serial_number) FROM component_statistic
+                                 WHERE serial_number > ?""", (serial,)).fetchone()[0]
+    return serials
+
+
+def wants_v2(conn):
+    """True if this is a brand new database and LAYOUT_ENV asks for v2."""
+    if os.environ.get(LAYOUT_ENV, "").lower().lstrip("v") != "2":
+        return False
+    return conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()[0] == 0
+
+
+def create_database(conn):
+    """Creates the v2 tables.
+
+    The v2 tables already have everything the v1 migrations add (or don't need it), so the
+    schema version starts at the latest one and those migrations are never run.
+    """
+    # Imported here, db_interface imports this module.
+    import db_interface
+
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        # The anomaly tables work the same on both layouts.
+        for statement in SCHEMA + anomalies.SCHEMA:
+            conn.execute(statement)
+        conn.execute(f"PRAGMA user_version = {int(db_interface.MIGRATIONS[-1][0])}")
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+
+
+def retention_batch(conn, lifetime_ms):
+    """The batch for a lifetime, added to the retention table if it's new. Call inside a transaction."""
+    lifetime_ms = round(lifetime_ms / LIFETIME_ROUNDING_MS) * LIFETIME_ROUNDING_MS
+    conn.execute("INSERT OR IGNORE INTO retention (lifetime_ms) VALUES (?)", (lifetime_ms,))
+    return conn.execute("SELECT batch FROM retention WHERE lifetime_ms = ?", (lifetime_ms,)).fetchone()[0]
+
+
+def with_batch(rows, batch):
+    """Swaps the end_of_life at the end of each v1 row for the batch."""
+    return [row[:-1] + (batch,) for row in rows]
+
+
+def open_read_only(path):
+    """Opens a database without any chance of changing it."""
+    return sqlite3.connect(f"file:{os.path.abspath(path)}?mode=ro", uri=True)
+
+
+def copy_rows(source, target, table, columns, after, upto, chunk_rows, batches, counts):
+    """Copies the v1 rows with after < rowid <= upto into the v2 table, a chunk per transaction.
+
+    Rows whose timestamp or end_of_life can't be read are skipped and counted.
+    Returns the last rowid copied.
+    """
+    # The key, the timestamp, the rest of the columns and the batch.
+    values = ", ".join(["?"] * (len(columns) + 2))
+    insert = f"INSERT OR REPLACE INTO {table} VALUES ({values})"
+    select = f"""SELECT rowid, {to_ms_sql('timestamp')}, {to_ms_sql('end_of_life')}, {", ".join(columns)}
+                 FROM {table}
+                 WHERE rowid > ? AND rowid <= ?
+                 ORDER BY rowid
+                 LIMIT ?"""
+
+    while True:
+        chunk = source.execute(select, (after, upto, chunk_rows)).fetchall()
+        if not chunk:
+            return after
+
+        rows = []
+        with target:
+            for rowid, timestamp, end_of_life, key, *rest in chunk:
+                if timestamp is None or end_of_life is None:
+                    counts["skipped"] += 1
+                    continue
+                lifetime = end_of_life - timestamp
+                if lifetime not in batches:
+                    batches[lifetime] = retention_batch(target, lifetime)
+                rows.append((key, timestamp, *rest, batches[lifetime]))
+            target.executemany(insert, rows)
+
+        counts[table] += len(rows)
+        after = chunk[-1][0]
+
+
+# The v1 columns copied for each table, the first is the key that goes before the timestamp.
+CONVERT_COLUMNS = {
+    "component_statistic": ["serial_number", "machine_state", "temperature", "usage", "power_consumption",
+                            "core_speed", "memory_speed", "total_ram"],
+    "process": ["pid", "cpu_usage", "memory_usage"],
+}
+
+
+def convert(source_path, target_path, chunk_rows=CHUNK_ROWS, replace=False):
+    """Converts a v1 database to a new v2 database, a chunk at a time.
+
+    The source is only read, so the collector can keep writing to it. Rows are copied in rowid
+    order, and anything added while the copy runs (the collector's INSERT OR REPLACE always
+    gets a new rowid) is picked up by catch up passes at the end.
+
+    With replace the source is renamed to '<name>-v1.db' and the new database takes its place.
+    Stop the collector and the web server first, they keep the old file open.
+    Returns the number of rows copied and skipped.
+    """
+    source_path = os.path.abspath(source_path)
+    target_path = os.path.abspath(target_path)
+    if os.path.exists(target_path):
+        raise FileExistsError(f"{target_path} already exists")
+
+    source = open_read_only(source_path)
+    if get_layout(source) == LAYOUT_V2:
+        source.close()
+        raise ValueError(f"{source_path} is already v2")
+
+    target = sqlite3.connect(target_path, isolation_level=None)
+    counts = {"component": 0, "component_statistic": 0, "process": 0, "skipped": 0}
+    batches = {}
+    try:
+        # Nothing else can see the new file yet, and it's thrown away if this fails, so no journal.
+        target.execute("PRAGMA journal_mode = OFF")
+        target.execute("PRAGMA synchronous = OFF")
+        target.execute("PRAGMA cache_size = -262144")
+        create_database(target)
+        target.isolation_level = ""
+
+        marks = {table: 0 for table in CONVERT_COLUMNS}
+        # Keep going until a pass finds nothing new. The first pass is the big one.
+        while True:
+            copied = sum(counts[table] for table in CONVERT_COLUMNS) + counts["skipped"]
+            with target:
+                components = source.execute("SELECT * FROM component").fetchall()
+                target.executemany("INSERT OR REPLACE INTO component VALUES (?, ?, ?, ?, ?)", components)
+            counts["component"] = len(components)
+
+            for table, columns in CONVERT_COLUMNS.items():
+                upto = source.execute(f"SELECT MAX(rowid) FROM {table}").fetchone()[0] or 0
+                marks[table] = copy_rows(source, target, table, columns, marks[table], upto, chunk_rows,
+                                         batches, counts)
+
+            if sum(counts[table] for table in CONVERT_COLUMNS) + counts["skipped"] == copied:
+                break
+
+        target.isolation_level = None
+        target.execute("PRAGMA journal_mode = DELETE")
+        target.execute("PRAGMA optimize")
+    except BaseException:
+        target.close()
+        source.close()
+        os.remove(target_path)
+        raise
+
+    target.close()
+    source.close()
+
+    if replace:
+        replace_database(source_path, target_path)
+    return counts
+
+
+def replace_database(source_path, target_path):
+    """Moves the converted database into the source's place, keeping the source as '<name>-v1.db'.
+
+    Not '<name>.v1', that would look like one of create_backup()'s backups.
+    """
+    # Fold the WAL back into the file, so the rename takes everything with it.
+    conn = sqlite3.connect(source_path)
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.execute("PRAGMA journal_mode = DELETE")
+    conn.close()
+
+    stem, extension = os.path.splitext(source_path)
+    os.replace(source_path, f"{stem}-v1{extension}")
+    os.replace(target_path, source_path)
+
+
+def best_time(function, repeats=3):
+    """The fastest of repeats runs of function, in seconds, and what it returned."""
+    best, result = None, None
+    for _ in range(repeats):
+        started = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def report(path, window=datetime.timedelta(days=1)):
+    """The size of a database and how fast it can be read, for comparing the layouts.
+
+    The scan reads every component_statistic row. The window reads the last `window` of one component.
+    """
+    conn = open_read_only(path)
+    try:
+        layout = get_layout(conn)
+        size = sum(os.path.getsize(name) for name in (path, path + "-wal") if os.path.exists(name))
+        statistic_rows = conn.execute("SELECT COUNT(*) FROM component_statistic").fetchone()[0]
+        process_rows = conn.execute("SELECT COUNT(*) FROM process").fetchone()[0]
+
+        # The usage total makes the scan read each row, not just count them.
+        scan_seconds, _ = best_time(lambda: conn.execute("""SELECT COUNT(*), SUM(usage), MAX(timestamp)
+                                                            FROM component_statistic""").fetchone())
+
+        window_seconds, window_rows = None, 0
+        component = conn.execute("SELECT serial_number FROM component ORDER BY rowid").fetchone()
+        last = component and conn.execute("""SELECT MAX(timestamp) FROM component_statistic
+                                             WHERE serial_number = ?""", component).fetchone()[0]
+        first = None
+        if isinstance(last, int):
+            first = last - int(window.total_seconds() * 1000)
+        elif last is not None:
+            try:
+                first = (from_ms(bound_ms(last)) - window).strftime("%Y-%m-%d %H:%M:%S.%f")
+            except ValueError:
+                # The newest timestamp isn't a timestamp, there's no window to read.
+                pass
+        if first is not None:
+            window_seconds, rows = best_time(lambda: conn.execute("""
+                SELECT * FROM component_statistic
+                WHERE serial_number = ? AND timestamp >= ? AND timestamp <= ?
+                ORDER BY timestamp""", (component[0], first, last)).fetchall())
+            window_rows = len(rows)
+    finally:
+        conn.close()
+
+    rows = statistic_rows + process_rows
+    return {
+        "layout":              layout,
+        "bytes":               size,
+        "statistic_rows":      statistic_rows,
+        "process_rows":        process_rows,
+        "bytes_per_row":       round(size / rows, 1) if rows else None,
+        "scan_seconds":        round(scan_seconds, 4),
+        "scan_rows_per_second": round(statistic_rows / scan_seconds) if scan_seconds else None,
+        "window_seconds":      None if window_seconds is None else round(window_seconds, 5),
+        "window_rows":         window_rows,
+    }
+
+
+def print_reports(*reports, out=sys.stdout):
+    """Prints reports side by side, one column per database."""
+    rows = [
+        ("layout",            lambda r: r["layout"]),
+        ("size (MB)",         lambda r: f"{r['bytes'] / 2**20:,.1f}"),
+        ("statistic rows",    lambda r: f"{r['statistic_rows']:,}"),
+        ("process rows",      lambda r: f"{r['process_rows']:,}"),
+        ("bytes per row",     lambda r: r["bytes_per_row"]),
+        ("full scan (ms)",    lambda r: f"{r['scan_seconds'] * 1000:,.1f}"),
+        ("scan rows/s",       lambda r: f"{r['scan_rows_per_second'] or 0:,}"),
+        ("1 day window (ms)", lambda r: "-" if r["window_seconds"] is None else f"{r['window_seconds'] * 1000:,.2f}"),
+        ("window rows",       lambda r: f"{r['window_rows']:,}"),
+    ]
+    for name, value in rows:
+        print(f"{name:<20}" + "".join(f"{str(value(r)):>16}" for r in reports), file=out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a metrics database to the compact v2 layout")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    convert_parser = commands.add_parser("convert", help="copy a v1 database into a new v2 database")
+    convert_parser.add_argument("source", help="the v1 database")
+    convert_parser.add_argument("target", nargs="?", help="the new database (default: <source>-v2.db)")
+    convert_parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS, help="rows per transaction")
+    convert_parser.add_argument("--replace", action="store_true",
+                                help="put the new database in the source's place, keeping the source as "
+                                     "<source>-v1.db (stop the collector and web server first)")
+
+    report_parser = commands.add_parser("report", help="print a database's size and read speed")
+    report_parser.add_argument("database")
+    args = parser.parse_args()
+
+    if args.command == "report":
+        print_reports(report(args.database))
+        return
+
+    stem, extension = os.path.splitext(args.source)
+    target = args.target or f"{stem}-v2{extension}"
+    before = report(args.source)
+
+    started = time.perf_counter()
+    counts = convert(args.source, target, args.chunk_rows, args.replace)
+    elapsed = time.perf_counter() - started
+    copied = counts["component_statistic"] + counts["process"]
+    print(f"Copied {copied:,} rows in {elapsed:.1f}s ({copied / elapsed:,.0f} rows/s), "
+          f"skipped {counts['skipped']:,} with unreadable timestamps")
+
+    print_reports(before, report(args.source if args.replace else target))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,379 @@
+###########################################################################################
+# File: shards.py                                                                         #
+# Purpose: Partitioned storage. The component_statistic and process rows go in one SQLite #
+#          file per month (or week, or day) in a '<name>-shards' directory next to        #
+#          metrics.db, which keeps the component table. Reads ATTACH the shards that      #
+#          overlap the window and combine the results, retention deletes whole files and  #
+#          backups only copy the shards that have changed.                                #
+#                                                                                         #
+#          Each shard is an ordinary v1 database, so any one of them can be opened on its #
+#          own. Rows OpenHardwareMonitor.exe writes to metrics.db are read as well, and   #
+#          'split' moves them into their shards.                                          #
+#                                                                                         #
+# Usage: python Display/shards.py split metrics.db [--period month]                       #
+#        python Display/shards.py list metrics.db                                         #
+#                                                                                         #
+# v1.1.0 Initial version.                                                                 #
+# v1.1.1 Dropping an expired shard keeps its backups.                                     #
+###########################################################################################
+
+import argparse
+import contextlib
+import datetime
+import glob
+import os
+import sqlite3
+import time
+
+# Set to month, week or day to keep new rows in shards of that length. A database that already
+# has a shard directory stays sharded (in months) without it.
+SHARD_ENV = "MTG_SHARDS"
+PERIODS = ["month", "week", "day"]
+DEFAULT_PERIOD = "month"
+
+# SQLite's default for SQLITE_MAX_ATTACHED. More shards than this are read a group at a time.
+DEFAULT_ATTACH_LIMIT = 10
+
+# How many rows split moves from metrics.db per transaction.
+SPLIT_CHUNK_ROWS = 50000
+
+# The live feed's event ids are the shard's first day (since the epoch) in the high bits and the
+# rowid in the low bits, so they keep going up from one shard to the next.
+ID_SHIFT = 32
+MAX_ROWID = (1 << ID_SHIFT) - 1
+
+
+class Shard:
+    """One shard file and the period of time it holds."""
+
+    def __init__(self, path, start, end):
+        self.path = path
+        self.start = start
+        self.end = end
+
+    @property
+    def ordinal(self):
+        """Days from the epoch to the start of the period. Orders the shards, and the live feed's ids."""
+        return (self.start - datetime.datetime(1970, 1, 1)).days
+
+    def __repr__(self):
+        return f"Shard({os.path.basename(self.path)!r})"
+
+
+def shard_dir(db):
+    """Where a database's shards are kept: metrics.db -> metrics-shards/."""
+    stem, _ = os.path.splitext(db)
+    return f"{stem}-shards"
+
+
+def configured_period():
+    """The period asked for with SHARD_ENV, or None if it isn't set."""
+    period = os.environ.get(SHARD_ENV, "").strip().lower()
+    return period if period in PERIODS else None
+
+
+def is_sharded(db):
+    """True if new rows for this database go into shards."""
+    return configured_period() is not None or os.path.isdir(shard_dir(db))
+
+
+def period_key(moment, period=None):
+    """The name of the shard a moment belongs in: 2025-06, 2025-W23 or 2025-06-01."""
+    period = period or configured_period() or DEFAULT_PERIOD
+    if period == "day":
+        return moment.strftime("%Y-%m-%d")
+    if period == "week":
+        year, week, _ = moment.isocalendar()
+        return f"{year}-W{week:02d}"
+    return moment.strftime("%Y-%m")
+
+
+def period_bounds(key):
+    """The (start, end) a shard's name covers. None if the name isn't a shard's."""
+    try:
+        if "-W" in key:
+            start = datetime.datetime.strptime(key + "-1", "%G-W%V-%u")
+            return start, start + datetime.timedelta(days=7)
+        if key.count("-") == 2:
+            start = datetime.datetime.strptime(key, "%Y-%m-%d")
+            return start, start + datetime.timedelta(days=1)
+        start = datetime.datetime.strptime(key, "%Y-%m")
+        return start, start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+    except ValueError:
+        return None
+
+
+def shard_path(db, key):
+    """The file for the shard with the given name."""
+    return os.path.join(shard_dir(db), f"{key}.db")
+
+
+def list_shards(db):
+    """Every shard of the database, oldest first."""
+    shards = []
+    for path in glob.glob(os.path.join(shard_dir(db), "*.db")):
+        bounds = period_bounds(os.path.splitext(os.path.basename(path))[0])
+        if bounds:
+            shards.append(Shard(path, *bounds))
+    return sorted(shards, key=lambda shard: shard.start)
+
+
+def overlapping(db, start=None, end=None):
+    """The shards that can have rows between start and end (datetimes, None is open ended)."""
+    return [shard for shard in list_shards(db)
+            if (end is None or shard.start <= end) and (start is None or shard.end > start)]
+
+
+def get_pool(path):
+    """The connection pool for a shard, creating the file and its tables the first time."""
+    # Imported here, db_interface imports this module.
+    import db_interface
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return db_interface.open_pool(path)
+
+
+def attach_limit(conn):
+    """How many databases the connection can have attached at once."""
+    try:
+        return conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+    except AttributeError:
+        # getlimit() is new in python 3.11.
+        return DEFAULT_ATTACH_LIMIT
+
+
+@contextlib.contextmanager
+def attached(conn, shards):
+    """Attaches the shards as shard_0, shard_1, ... for the length of a with block. Yields their names.
+
+    A shard deleted since it was listed is skipped, ATTACH would create an empty file in its place.
+    """
+    names = []
+    try:
+        for shard in shards:
+            if not os.path.exists(shard.path):
+                continue
+            name = f"shard_{len(names)}"
+            conn.execute(f"ATTACH DATABASE ? AS {name}", (shard.path,))
+            names.append(name)
+        yield names
+    finally:
+        for name in names:
+            conn.execute(f"DETACH DATABASE {name}")
+
+
+@contextlib.contextmanager
+def federated(conn, shards, arm, params=(), merge="SELECT * FROM ({arms})", merge_params=(),
+              partial_params=None):
+    """Runs a query against metrics.db and the shards, and combines the results. Yields the cursor.
+
+    arm is a SELECT with {db} where the schema name goes, e.g.
+        SELECT MIN(timestamp) AS first FROM {db}.component_statistic WHERE serial_number = ?
+    and is bound with params for each database. merge is a SELECT over {arms}, the UNION ALL of
+    every arm, e.g. 'SELECT MIN(first) FROM ({arms})'. The default just puts the rows together,
+    metrics.db's first and then the shards oldest first.
+
+    If there are more shards than can be attached at once, they're done in groups. Each group's
+    merged rows (merged with partial_params, which default to merge_params) go in a temp table
+    and merge is run again over that. So merge has to work on its own output: MIN of MINs, SUM
+    of counts, ORDER BY with a LIMIT. Name the columns it makes (MIN(first) AS first).
+
+    With no shards the arm is simply run against metrics.db, so merge has to give the same
+    answer for a single arm as the arm does by itself.
+    """
+    if not shards:
+        yield conn.execute(arm.replace("{db}", "main"), list(params))
+        return
+
+    limit = attach_limit(conn)
+    groups = [shards[i:i + limit] for i in range(0, len(shards), limit)]
+    partial_params = merge_params if partial_params is None else partial_params
+
+    def statement(schemas):
+        arms = " UNION ALL ".join(f"SELECT * FROM ({arm.replace('{db}', schema)})" for schema in schemas)
+        return merge.replace("{arms}", arms), list(params) * len(schemas)
+
+    if len(groups) == 1:
+        with attached(conn, groups[0]) as names:
+            sql, arm_params = statement(["main"] + names)
+            yield conn.execute(sql, arm_params + list(merge_params))
+        return
+
+    conn.execute("DROP TABLE IF EXISTS temp.federated")
+    try:
+        for i, group in enumerate(groups):
+            with attached(conn, group) as names:
+                sql, arm_params = statement((["main"] if i == 0 else []) + names)
+                if i == 0:
+                    conn.execute(f"CREATE TEMP TABLE federated AS {sql}", arm_params + list(partial_params))
+                elif names:
+                    conn.execute(f"INSERT INTO temp.federated {sql}", arm_params + list(partial_params))
+                # A database can't be detached in the middle of a transaction.
+                conn.commit()
+        yield conn.execute(merge.replace("{arms}", "SELECT * FROM temp.federated ORDER BY rowid"),
+                           list(merge_params))
+    finally:
+        conn.execute("DROP TABLE IF EXISTS temp.federated")
+
+
+def fetch(conn, shards, arm, params=(), merge="SELECT * FROM ({arms})", merge_params=(), partial_params=None):
+    """federated(), returning every row."""
+    with federated(conn, shards, arm, params, merge, merge_params, partial_params) as cursor:
+        return cursor.fetchall()
+
+
+def shard_keys(timestamps, period=None):
+    """Maps each text timestamp to the name of the shard it belongs in, or None if it can't be read."""
+    # Imported here, db_interface imports this module.
+    import db_interface
+
+    # The collector writes every row of a sample with the same timestamp, so each is only parsed once.
+    keys = {}
+    for timestamp in set(timestamps):
+        moment = db_interface.parse_timestamp(timestamp) if isinstance(timestamp, str) else None
+        keys[timestamp] = period_key(moment, period) if moment else None
+    return keys
+
+
+def write_rows(db, statistics, processes, period=None):
+    """Writes v1 component_statistic and process rows into their shards, oldest shard first.
+
+    Each shard is its own transaction. A write that fails part way can simply be done again,
+    the rows are INSERT OR REPLACE. Rows without a readable timestamp go in metrics.db.
+    Returns the shards that were written to.
+    """
+    # Imported here, db_interface imports this module.
+    import db_interface
+
+    by_shard = {}
+    for table, rows in [("component_statistic", statistics), ("process", processes)]:
+        keys = shard_keys([row[1] for row in rows], period)
+        for row in rows:
+            by_shard.setdefault(keys[row[1]], {}).setdefault(table, []).append(row)
+
+    written = []
+    for key in sorted(by_shard, key=lambda key: (key is not None, key or "")):
+        if key is None:
+            pool = db_interface.open_pool(db, sharded=True)
+        else:
+            pool = get_pool(shard_path(db, key))
+        with pool.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for table, rows in by_shard[key].items():
+                    values = ", ".join(["?"] * len(rows[0]))
+                    conn.executemany(f"INSERT OR REPLACE INTO {table} VALUES ({values})", rows)
+                conn.commit()
+            except sqlite3.Error:
+                conn.rollback()
+                raise
+        written.append(key)
+    return written
+
+
+def split(db, period=None, chunk_rows=SPLIT_CHUNK_ROWS):
+    """Moves the component_statistic and process rows in metrics.db into their shards.
+
+    Turns an existing database into a sharded one, and picks up the rows OpenHardwareMonitor.exe
+    writes to metrics.db. Each chunk is written to the shards before it's deleted from metrics.db,
+    so stopping part way leaves every row somewhere. Returns the number of rows moved.
+    """
+    # Imported here, db_interface imports this module.
+    import db_interface
+
+    os.makedirs(shard_dir(db), exist_ok=True)
+    pool = db_interface.open_pool(db, sharded=True)
+    moved = {"component_statistic": 0, "process": 0}
+    for table in moved:
+        after = 0
+        while True:
+            with pool.connection() as conn:
+                chunk = conn.execute(f"SELECT rowid, * FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                                     (after, chunk_rows)).fetchall()
+            if not chunk:
+                break
+            after = chunk[-1][0]
+
+            # Rows without a readable timestamp stay where they are.
+            keys = shard_keys([row[2] for row in chunk], period)
+            movable = [row for row in chunk if keys[row[2]] is not None]
+            rows = [row[1:] for row in movable]
+            if table == "component_statistic":
+                write_rows(db, rows, [], period)
+            else:
+                write_rows(db, [], rows, period)
+
+            with pool.connection() as conn:
+                with conn:
+                    conn.executemany(f"DELETE FROM {table} WHERE rowid = ?", [(row[0],) for row in movable])
+            moved[table] += len(movable)
+    return moved
+
+
+def drop_expired(db, cutoff):
+    """Deletes the shards that end before cutoff. Returns the shards deleted.
+
+    Their backups are kept, they're the only copy of the rows once the shard has gone.
+    """
+    # Imported here, db_interface imports this module.
+    import db_interface
+
+    dropped = []
+    for shard in list_shards(db):
+        if shard.end > cutoff:
+            continue
+        db_interface.close_pool(shard.path)
+        for path in [shard.path, shard.path + "-wal", shard.path + "-shm"]:
+            if os.path.exists(path):
+                os.remove(path)
+        dropped.append(shard)
+    return dropped
+
+
+def changed_since_backup(shard):
+    """True if the shard has been written to since its newest backup was made (or it has none)."""
+    backups = glob.glob(shard.path + ".*")
+    if not backups:
+        return True
+    backed_up = max(os.path.getmtime(backup) for backup in backups)
+    modified = max(os.path.getmtime(path) for path in (shard.path, shard.path + "-wal") if os.path.exists(path))
+    return modified > backed_up
+
+
+def parse_event_id(event_id):
+    """The shard ordinal and rowid in a live feed event id."""
+    return event_id >> ID_SHIFT, event_id & MAX_ROWID
+
+
+def event_id(shard, rowid):
+    """The live feed event id for a row of a shard."""
+    return (shard.ordinal << ID_SHIFT) | rowid
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the monthly (weekly, daily) shards of a metrics database")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    split_parser = commands.add_parser("split", help="move the rows in metrics.db into their shards")
+    split_parser.add_argument("database")
+    split_parser.add_argument("--period", choices=PERIODS, help=f"shard length (default: {DEFAULT_PERIOD})")
+    split_parser.add_argument("--chunk-rows", type=int, default=SPLIT_CHUNK_ROWS, help="rows per transaction")
+
+    list_parser = commands.add_parser("list", help="list the shards and their sizes")
+    list_parser.add_argument("database")
+    args = parser.parse_args()
+
+    database = os.path.abspath(args.database)
+    if args.command == "split":
+        started = time.perf_counter()
+        moved = split(database, args.period, args.chunk_rows)
+        print(f"Moved {moved['component_statistic']:,} statistic and {moved['process']:,} process rows "
+              f"in {time.perf_counter() - started:.1f}s")
+
+    for shard in list_shards(database):
+        size = sum(os.path.getsize(path) for path in (shard.path, shard.path + "-wal") if os.path.exists(path))
+        print(f"{os.path.basename(shard.path):<16}{shard.start:%Y-%m-%d} to {shard.end:%Y-%m-%d}"
+              f"{size / 2**20:>12,.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+###########################################################################################
+# File: startup_profile.py                                                                #
+# Purpose: Where the time goes between launching the web server and its first response.   #
+#          Times each module imported (like python -X importtime, which the frozen build  #
+#          can't be given) and the start up phases, and prints them when the first        #
+#          response has been sent. Only the standard library, so it can start before      #
+#          everything else is imported.                                                   #
+#                                                                                         #
+# Usage: metrics_web_server.py --profile-startup, or MTG_STARTUP_PROFILE=1                #
+#                                                                                         #
+# v1.1.0 Initial version.                                                                 #
+###########################################################################################
+
+import builtins
+import importlib.util
+import os
+import sys
+import threading
+import time
+
+# Set to 1 (or pass PROFILE_FLAG) to print the start up profile.
+PROFILE_ENV = "MTG_STARTUP_PROFILE"
+PROFILE_FLAG = "--profile-startup"
+
+# How many of the slowest modules are listed.
+TOP_IMPORTS = 20
+
+# Roughly when the interpreter started, everything is timed from here.
+_STARTED = time.perf_counter()
+
+# (phase, seconds since _STARTED) in the order they happened.
+_PHASES = []
+
+# The running ImportProfiler, or None when the profile is off.
+_profiler = None
+_reported = threading.Lock()
+
+
+class ImportProfiler:
+    """Times every module imported on the thread that started it, with how they were nested."""
+
+    def __init__(self):
+        # (depth, name, self seconds, total seconds) in the order the imports finished.
+        self.imports = []
+        # The time spent in the nested imports of each import still running.
+        self.stack = []
+        self.thread = None
+        self.original = None
+
+    def start(self):
+        self.thread = threading.get_ident()
+        self.original = builtins.__import__
+        builtins.__import__ = self.timed_import
+
+    def stop(self):
+        if self.original is not None:
+            builtins.__import__ = self.original
+            self.original = None
+
+    def timed_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        """builtins.__import__, timing the modules that aren't loaded yet."""
+        key = name
+        if level:
+            try:
+                key = importlib.util.resolve_name("." * level + name, (globals or {}).get("__package__"))
+            except (ImportError, ValueError):
+                pass
+        # Already loaded (most imports), or from a request thread: nothing worth timing.
+        if key in sys.modules or threading.get_ident() != self.thread:
+            return self.original(name, globals, locals, fromlist, level)
+
+        depth = len(self.stack)
+        self.stack.append(0.0)
+        started = time.perf_counter()
+        try:
+            return self.original(name, globals, locals, fromlist, level)
+        finally:
+            total = time.perf_counter() - started
+            nested = self.stack.pop()
+            if self.stack:
+                self.stack[-1] += total
+            self.imports.append((depth, key, total - nested, total))
+
+
+def requested(argv=None):
+    """True if the profile was asked for on the command line or in the environment."""
+    argv = sys.argv if argv is None else argv
+    return PROFILE_FLAG in argv or os.environ.get(PROFILE_ENV, "") not in ("", "0")
+
+
+def enabled():
+    return _profiler is not None
+
+
+def begin(enabled=True):
+    """Starts timing the imports if the profile was asked for. Call it before the imports to be timed."""
+    global _profiler
+    if enabled and _profiler is None and requested():
+        _profiler = ImportProfiler()
+        _profiler.start()
+    return _profiler is not None
+
+
+def mark(phase):
+    """Records that a phase of start up has finished. Does nothing if the profile is off."""
+    if _profiler is not None:
+        _PHASES.append((phase, time.perf_counter() - _STARTED))
+
+
+def report():
+    """The profile as text: the phases, the server's own imports, then the slowest modules."""
+    lines = ["Start up profile (ms since the interpreter started)"]
+    previous = 0.0
+    for phase, seconds in _PHASES:
+        lines.append(f"  {phase:<28}{seconds * 1000:>10.1f}  (+{(seconds - previous) * 1000:.1f})")
+        previous = seconds
+
+    imports = _profiler.imports if _profiler else []
+    lines.append("Imported by metrics_web_server (ms, including what they import)")
+    for depth, name, _, total in imports:
+        if depth == 0:
+            lines.append(f"  {name:<40}{total * 1000:>10.1f}")
+
+    lines.append(f"Slowest {TOP_IMPORTS} modules on their own (ms)")
+    for depth, name, own, total in sorted(imports, key=lambda item: item[2], reverse=True)[:TOP_IMPORTS]:
+        lines.append(f"  {name:<40}{own * 1000:>10.1f}{total * 1000:>10.1f} total")
+    return "\n".join(lines)
+
+
+def watch(app):
+    """Prints the profile after the app's first response, then stops timing imports."""
+    if _profiler is None:
+        return
+
+    def first_response(response):
+        if _reported.acquire(blocking=False):
+            mark("first response")
+            _profiler.stop()
+            print(report(), file=sys.stderr, flush=True)
+        return response
+
+    app.after_request(first_response)
@@ -0,0 +1,56 @@
+// Reads the binary chart series from /api/metrics?format=binary (see binary_series.py).
+// decodeSeries() reads the columns where they are in the response, as typed arrays, without copying.
+// seriesPoints() then copies the points with a number into the plain arrays the chart is given, which
+// it can add the live rows to (see benchmarks/transport_benchmark.py, the copy is most of the time).
+// Typed arrays are in the machine's byte order, which is little-endian on anything a browser runs on.
+
+// Unpacks the response into its header and a typed array for each column.
+function decodeSeries(buffer) {
+    const view = new DataView(buffer);
+    const magic = String.fromCharCode(view.getUint8(0), view.getUint8(1), view.getUint8(2), view.getUint8(3));
+    if (magic !== "MTGS") {
+        throw new Error("Not a binary series");
+    }
+
+    const headerLength = view.getUint32(4, true);
+    const header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 8, headerLength)));
+    const columns = {};
+    header.columns.forEach(column => {
+        columns[column.name] = column.type === "int64"
+            ? new BigInt64Array(buffer, column.offset, header.length)
+            : new Float32Array(buffer, column.offset, header.length);
+    });
+    return { header: header, columns: columns };
+}
+
+// Turns epoch milliseconds back into the '2025-04-17 18:17:30' the json points have.
+function formatTimestamp(ms) {
+    return new Date(ms).toISOString().substring(0, 19).replace("T", " ");
+}
+
+// Epoch milliseconds for a database timestamp (a live row's, or an anomaly's), read as UTC like the server does.
+function parseTimestamp(text) {
+    return Date.parse(text.substring(0, 23).replace(" ", "T") + "Z");
+}
+
+// Copies a decoded series into chart labels and values, leaving out the points without a number.
+// The labels are the epoch milliseconds. Turning every one of them into text takes longer than
+// parsing the same series as json, so the chart only formats the ticks and tooltips it shows.
+function seriesPoints(series, column = "value") {
+    const timestamps = series.columns.timestamp;
+    const values = series.columns[column];
+    const labels = [];
+    const data = [];
+    for (let i = 0; i < values.length; i++) {
+        if (isFinite(values[i])) {
+            labels.push(Number(timestamps[i]));
+            data.push(values[i]);
+        }
+    }
+    return { labels: labels, values: data };
+}
+
+// So the benchmark can run the same code in node.
+if (typeof module !== "undefined") {
+    module.exports = { decodeSeries, formatTimestamp, parseTimestamp, seriesPoints };
+}
@@ -0,0 +1,182 @@
+import unittest
+from unittest import mock
+import datetime
+import math
+import sqlite3
+import shutil
+import tempfile
+import sys
+import os
+
+# Get the path of the directory above the test file and insert it into our path.
+# This is where db_interface and anomalies live, which we need to import to test.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from metrics_web_server import app
+import anomalies
+import db_interface
+import schema_v2
+import shards
+
+START = datetime.datetime(2025, 1, 1)
+
+# Sample numbers with a thermal runaway on the cpu and a usage spike on the gpu.
+TEMPERATURE_SPIKES = {400, 1500}
+USAGE_SPIKES = {900}
+
+
+def stamp(i):
+    """The timestamp of the i-th sample, one a minute."""
+    return (START + datetime.timedelta(minutes=i)).strftime("%Y-%m-%d %H:%M:%S.0000000")
+
+
+def samples(first, count):
+    """component_statistic rows for two components. The values wander slowly, apart from the spikes."""
+    rows = []
+    for i in range(first, first + count):
+        temperature = 50 + 2 * math.sin(i / 5)
+        usage = 30 + 5 * math.sin(i / 7)
+        rows.append(("cpu", stamp(i), "Active", 95.0 if i in TEMPERATURE_SPIKES else temperature, usage,
+                     10.0, 0, 0, 0, "2030-01-01 00:00:00.000000"))
+        rows.append(("gpu", stamp(i), "Active", temperature, 100.0 if i in USAGE_SPIKES else usage,
+                     10.0, 0, 0, 0, "2030-01-01 00:00:00.000000"))
+    return rows
+
+
+class EwmaTestCase(unittest.TestCase):
+    """Testcase for the moving average itself"""
+
+    def test_warmup_and_spike(self):
+        """Nothing is flagged while it warms up, then a spike is, judged against the samples before it"""
+        ewma = anomalies.Ewma()
+        flags = [ewma.update(100.0 if i in (5, 200) else 50.0, 0.05, 3.0) for i in range(300)]
+        self.assertEqual([i for i, flag in enumerate(flags) if flag], [200])
+        mean, std, z = flags[200]
+        self.assertAlmostEqual(mean, 50.0, places=3)
+        # The variance has died away since the warm up spike, so the smallest std is used.
+        self.assertEqual((std, z), (anomalies.MIN_STD, 100.0 - mean))
+        self.assertEqual(ewma.samples, 300)
+
+    def test_thresholds(self):
+        """Thresholds are one number for everything, or per column"""
+        self.assertEqual(anomalies.parse_thresholds("2.5"), {"temperature": 2.5, "usage": 2.5})
+        self.assertEqual(anomalies.parse_thresholds("usage=6"), {"temperature": 3.0, "usage": 6.0})
+        self.assertEqual(anomalies.parse_thresholds(""), anomalies.DEFAULT_THRESHOLDS)
+        with self.assertRaises(ValueError):
+            anomalies.parse_thresholds("power=2")
+        with mock.patch.dict(os.environ, {anomalies.THRESHOLD_ENV: "temperature=9"}):
+            self.assertEqual(anomalies.configured_thresholds()["temperature"], 9.0)
+
+
+class DetectorTestCase(unittest.TestCase):
+    """Testcase for running the detector over a database"""
+
+    def setUp(self):
+        """A migrated database with 2000 samples from each of two components"""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_name = os.path.join(self.tmp_dir, "metrics.db")
+        conn = sqlite3.connect(self.db_name)
+        db_interface.create_mtg_database(conn)
+        db_interface.migrate_database(conn)
+        conn.executemany("INSERT INTO component VALUES (?, ?, 0, 0, 0)", [("cpu", "CPU"), ("gpu", "GPU")])
+        conn.commit()
+        conn.close()
+        self.insert(samples(0, 2000))
+
+        self.environ = mock.patch.dict(os.environ)
+        self.environ.start()
+        db_interface.set_path_config(database=self.db_name)
+
+    def tearDown(self):
+        """Close everything and clean up"""
+        db_interface.close_pools()
+        self.environ.stop()
+        db_interface.set_path_config()
+        anomalies._LAST_DETECT.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def insert(self, rows, db=None):
+        conn = sqlite3.connect(db or self.db_name)
+        conn.executemany("INSERT INTO component_statistic VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        conn.commit()
+        conn.close()
+
+    def flagged(self):
+        """Every (serial number, column, timestamp) in the anomaly table."""
+        with db_interface.connect() as conn:
+            return conn.execute("SELECT serial_number, metric, timestamp FROM anomaly ORDER BY 1, 2, 3").fetchall()
+
+    def expected(self):
+        return sorted([("cpu", "temperature", stamp(i)) for i in TEMPERATURE_SPIKES] +
+                      [("gpu", "usage", stamp(i)) for i in USAGE_SPIKES])
+
+    def test_finds_the_spikes(self):
+        """The spikes are flagged and nothing else is"""
+        self.assertEqual(db_interface.detect_anomalies(), (4000, 3))
+        self.assertEqual(self.flagged(), self.expected())
+
+        # Nothing new, nothing read.
+        self.assertEqual(db_interface.detect_anomalies(), (0, 0))
+
+    def test_incremental(self):
+        """Running it as the rows arrive, a batch at a time, ends up the same as running it once"""
+        reference = os.path.join(self.tmp_dir, "reference.db")
+        shutil.copyfile(self.db_name, reference)
+        conn = sqlite3.connect(self.db_name)
+        conn.execute("DELETE FROM component_statistic WHERE timestamp >= ?", (stamp(1000),))
+        conn.commit()
+        conn.close()
+
+        self.assertEqual(db_interface.detect_anomalies(batch_rows=77), (2000, 2))
+        self.insert(samples(1000, 1000))
+        self.assertEqual(db_interface.detect_anomalies(batch_rows=77), (2000, 1))
+        self.assertEqual(self.flagged(), self.expected())
+        with db_interface.connect() as conn:
+            state = conn.execute("SELECT * FROM anomaly_state ORDER BY 1, 2").fetchall()
+
+        db_interface.set_path_config(database=reference)
+        self.assertEqual(db_interface.detect_anomalies(), (4000, 3))
+        with db_interface.connect() as conn:
+            self.assertEqual(conn.execute("SELECT * FROM anomaly_state ORDER BY 1, 2").fetchall(), state)
+
+    def test_sharded(self):
+        """A sharded database gives the same anomalies"""
+        shards.split(self.db_name, "day")
+        db_interface.close_pools()
+        self.assertEqual(len(shards.list_shards(self.db_name)), 2)
+        self.assertEqual(db_interface.detect_anomalies(batch_rows=500), (4000, 3))
+        self.assertEqual(self.flagged(), self.expected())
+
+        shards.write_rows(self.db_name, samples(2000, 10), [])
+        self.assertEqual(db_interface.detect_anomalies(), (20, 0))
+
+    def test_v2(self):
+        """A v2 database gives the same anomalies, with text timestamps on the way out"""
+        target = os.path.join(self.tmp_dir, "metrics-v2.db")
+        schema_v2.convert(self.db_name, target)
+        db_interface.set_path_config(database=target)
+        self.assertEqual(db_interface.detect_anomalies(), (4000, 3))
+        self.assertEqual([row[0] for row in db_interface.read_anomalies("cpu", "temperature")],
+                         [stamp(i)[:23] for i in sorted(TEMPERATURE_SPIKES)])
+
+    def test_api(self):
+        """/api/anomalies runs the detector and sends back the markers for one chart"""
+        client = app.test_client()
+        response = client.get("/api/anomalies", query_string={"serial_number": "cpu", "column": "temperature",
+                                                               "start": "2025-01-01T01:00"})
+        self.assertEqual([row[:2] for row in response.get_json()["anomalies"]],
+                         [[stamp(i), 95.0] for i in sorted(TEMPERATURE_SPIKES)])
+        self.assertGreater(response.get_json()["anomalies"][0][2], anomalies.DEFAULT_THRESHOLDS["temperature"])
+
+        response = client.get("/api/anomalies", query_string={"serial_number": "gpu", "column": "power"})
+        self.assertEqual(response.get_json()["anomalies"], [])
+        self.assertEqual(client.get("/api/anomalies", query_string={"column": "emoji"}).status_code, 400)
+
+    def test_test_databases_untouched(self):
+        """The checked in test databases don't have the tables, so the detector leaves them alone"""
+        self.assertEqual(db_interface.detect_anomalies(1), (0, 0))
+        self.assertEqual(db_interface.read_anomalies("test_cpu", "temperature", debug=2), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+import unittest
+from unittest import mock
+import shutil
+import tempfile
+import threading
+import time
+import sys
+import os
+
+# Get the path of the directory above the test file and insert it into our path.
+# This is where the web app lives, which we need to import to test.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from metrics_web_server import app
+import db_interface
+import job_manager
+
+# Stands in for OpenHardwareMonitor.exe.
+STUB_EXE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stub_metrics.py")
+
+
+def wait_for(job, timeout=10):
+    """Waits for a job to finish."""
+    deadline = time.monotonic() + timeout
+    while job.active and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return job
+
+
+class JobManagerTestCase(unittest.TestCase):
+    """Testcase for the job manager on its own"""
+
+    def setUp(self):
+        self.jobs = job_manager.JobManager(limits={"prune": 1}, max_finished=2)
+
+    def test_job_output(self):
+        """A job runs in the background and keeps what it returned"""
+        job = wait_for(self.jobs.submit("collect", lambda a, b: a + b, "Hello ", "World"))
+        self.assertEqual(job.state, job_manager.SUCCEEDED)
+        self.assertEqual(job.output, "Hello World")
+        self.assertIs(self.jobs.get(job.job_id), job)
+
+    def test_job_failure(self):
+        """A job that raises is marked failed, with the error kept"""
+        def fail():
+            raise ValueError("No good")
+
+        job = wait_for(self.jobs.submit("collect", fail))
+        self.assertEqual(job.state, job_manager.FAILED)
+        self.assertEqual(job.to_dict()["error"], "No good")
+
+    def test_limit(self):
+        """Only one prune at a time. The second is refused and told about the first"""
+        release = threading.Event()
+        first = self.jobs.submit("prune", release.wait)
+        with self.assertRaises(job_manager.JobLimitError) as context:
+            self.jobs.submit("prune", release.wait)
+        self.assertEqual(context.exception.active, [first])
+
+        # Other kinds of job aren't held up.
+        wait_for(self.jobs.submit("collect", str))
+
+        # Once the first prune is done another can start.
+        release.set()
+        wait_for(first)
+        wait_for(self.jobs.submit("prune", str))
+
+    def test_old_jobs_forgotten(self):
+        """Only the newest finished jobs are kept"""
+        submitted = [wait_for(self.jobs.submit("collect", str)) for _ in range(4)]
+        self.jobs.submit("collect", str)
+        self.assertNotIn(submitted[0], self.jobs.list())
+        self.assertIn(submitted[-1], self.jobs.list())
+
+
+class MetricsJobsTestCase(unittest.TestCase):
+    """Testcase for the /metrics and /jobs routes, running the stub executable"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.environ = mock.patch.dict(os.environ, {"MTG_METRICS_EXE": STUB_EXE})
+        self.environ.start()
+        # Any backup made before the executable runs goes in the temp directory.
+        db_interface.set_path_config(database=os.path.join(self.tmp_dir, "metrics.db"))
+
+        # A fresh job manager, so jobs from other tests don't count towards the limits.
+        self.jobs = mock.patch.object(job_manager, "jobs", job_manager.JobManager())
+        self.jobs.start()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        for job in job_manager.jobs.list():
+            wait_for(job)
+        self.jobs.stop()
+        thread = db_interface._BACKUP_THREAD
+        if thread is not None:
+            thread.join(10)
+        db_interface.close_pools()
+        self.environ.stop()
+        db_interface.set_path_config()
+        shutil.rmtree(self.tmp_dir)
+
+    def post(self, job, years="1"):
+        return self.client.post("/metrics", json={"years": years, "months": "0", "weeks": "0",
+                                                  "days": "0", "job": job})
+
+    def test_prune_job(self):
+        """A prune returns a job id straight away, and a second prune is refused while it runs"""
+        # Hold the prune up until both requests have been made.
+        release = threading.Event()
+        real_prune = db_interface.prune_database
+
+        def slow_prune(*args, **kwargs):
+            release.wait(10)
+            return real_prune(*args, **kwargs)
+
+        with mock.patch.object(db_interface, "prune_database", slow_prune):
+            response = self.post("prune")
+            self.assertEqual(response.status_code, 202)
+            job_id = response.get_json()["job_id"]
+
+            second = self.post("prune")
+            self.assertEqual(second.status_code, 409)
+            self.assertEqual(second.get_json()["job"]["job_id"], job_id)
+
+            release.set()
+            wait_for(job_manager.jobs.get(job_id))
+
+        status = self.client.get(f"/jobs/{job_id}").get_json()
+        self.assertEqual(status["state"], "succeeded")
+        self.assertIn("Pruned 0 rows older than 365 days", status["output"])
+
+        self.assertEqual(len(self.client.get("/jobs").get_json()), 1)
+
+    def test_failed_job(self):
+        """An executable that fails shows up as a failed job with its error"""
+        os.environ["MTG_STUB_EXIT"] = "1"
+        job_id = self.post("collect").get_json()["job_id"]
+        wait_for(job_manager.jobs.get(job_id))
+
+        status = self.client.get(f"/jobs/{job_id}").get_json()
+        self.assertEqual(status["state"], "failed")
+        self.assertIn("Stub failure", status["error"])
+
+    def test_unknown_job(self):
+        """Asking about a job that doesn't exist is a 404"""
+        self.assertEqual(self.client.get("/jobs/nope").status_code, 404)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+import unittest
+import datetime
+import math
+import sys
+import os
+
+# Get the path of the directory above the test file and insert it into our path.
+# This is where the web app and binary_series live, which we need to import to test.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from metrics_web_server import app
+import binary_series
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def epoch_ms(timestamp):
+    """What the timestamp should come back as, whole milliseconds since the epoch."""
+    return (datetime.datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S.%f") - EPOCH) // datetime.timedelta(milliseconds=1)
+
+
+class BinarySeriesTestCase(unittest.TestCase):
+    """Testcase for the binary format on its own"""
+
+    def test_round_trip(self):
+        """Columns come back as they went in, with the buffers lined up for typed arrays"""
+        body = binary_series.encode([("timestamp", "int64", [0, -1000, 2 ** 53]),
+                                     ("value", "float32", [1.5, None, "🔥"])], resolution="raw")
+        self.assertEqual(body[:4], binary_series.MAGIC)
+        header, columns = binary_series.decode(body)
+        self.assertEqual((header["length"], header["resolution"]), (3, "raw"))
+        self.assertTrue(all(column["offset"] % 8 == 0 for column in header["columns"]))
+        self.assertEqual(columns["timestamp"], [0, -1000, 2 ** 53])
+        self.assertEqual(columns["value"][0], 1.5)
+        self.assertTrue(math.isnan(columns["value"][1]) and math.isnan(columns["value"][2]))
+
+        # An empty series is still a valid one.
+        header, columns = binary_series.decode(binary_series.encode_points([]))
+        self.assertEqual((header["length"], columns), (0, {"timestamp": [], "value": []}))
+
+        with self.assertRaises(ValueError):
+            binary_series.encode([("timestamp", "int64", [1, 2]), ("value", "float32", [1.0])])
+        with self.assertRaises(ValueError):
+            binary_series.decode(b"{}")
+
+    def test_timestamps(self):
+        """Database timestamps, with up to 7 fractional digits, and bucket timestamps are all read"""
+        self.assertEqual(binary_series.to_epoch_ms("2025-01-01 00:00:01.2345678"), epoch_ms("2025-01-01 00:00:01.234567"))
+        self.assertEqual(binary_series.to_epoch_ms("2025-01-01 05:00:00"), epoch_ms("2025-01-01 05:00:00.0"))
+        self.assertEqual(binary_series.to_epoch_ms("2025-01-01"), epoch_ms("2025-01-01 00:00:00.0"))
+        self.assertIsNone(binary_series.to_epoch_ms("yesterday"))
+        self.assertIsNone(binary_series.to_epoch_ms(None))
+
+        # A point without a usable timestamp can't be charted, so it's left out.
+        _, columns = binary_series.decode(binary_series.encode_points([["2025-01-01 00:00:00", 1.0], ["🔥", 2.0]]))
+        self.assertEqual(columns["value"], [1.0])
+
+
+class BinaryApiTestCase(unittest.TestCase):
+    """Testcase for /api/metrics?format=binary"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.client = app.test_client()
+
+    def get(self, debug, **query):
+        return self.client.get("/api/metrics", query_string=dict(query, debug=debug, serial_number="test_cpu",
+                                                                 max_points=0))
+
+    def test_same_points_as_json(self):
+        """The binary series is the json one, with the missing values as NaN"""
+        for debug in [2, 4]:
+            points = self.get(debug).get_json()["points"]
+            response = self.get(debug, format="binary")
+            self.assertEqual(response.mimetype, binary_series.MIMETYPE)
+            header, columns = binary_series.decode(response.data)
+
+            self.assertEqual((header["serial_number"], header["column"], header["resolution"]),
+                             ("test_cpu", "temperature", "raw"))
+            self.assertEqual(columns["timestamp"], [epoch_ms(point[0]) for point in points])
+            for value, point in zip(columns["value"], points):
+                if point[1] is None:
+                    self.assertTrue(math.isnan(value))
+                else:
+                    self.assertAlmostEqual(value, point[1], places=5)
+
+    def test_unknown_format(self):
+        """Asking for a format we don't have is an error"""
+        response = self.get(2, format="xml")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("xml", response.get_json()["error"])
+
+
+if __name__ == '__main__':
+    unittest.main()
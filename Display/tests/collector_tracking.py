@@ -0,0 +1,128 @@
+import unittest
+from unittest import mock
+import json
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import sys
+import os
+
+import psutil
+
+# Get the path of the directory above the test file and insert it into our path.
+# This is where ohm_interface lives, which we need to import to test.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import db_interface
+import ohm_interface
+
+# Stands in for OpenHardwareMonitor.exe.
+STUB_EXE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stub_metrics.py")
+
+
+def no_scan(*args, **kwargs):
+    """Stands in for psutil.process_iter() when the test expects it not to be called."""
+    raise AssertionError("Scanned every process")
+
+
+class CollectorTrackingTestCase(unittest.TestCase):
+    """Testcase for tracking the collector with the pid file"""
+
+    def setUp(self):
+        """The project root (where the pid file goes) is a temp directory, the collector is the stub"""
+        self.tmp_dir = tempfile.mkdtemp()
+        # A collector that keeps running until it's stopped.
+        self.environ = mock.patch.dict(os.environ, {"MTG_METRICS_EXE": STUB_EXE, "MTG_STUB_SLEEP": "30"})
+        self.environ.start()
+        db_interface.set_path_config(root=self.tmp_dir, database=os.path.join(self.tmp_dir, "metrics.db"))
+        self.pid_file = os.path.join(self.tmp_dir, ohm_interface.PID_FILE_NAME)
+
+    def tearDown(self):
+        """Stop anything still running and clean up"""
+        ohm_interface.stop_metrics()
+        if db_interface._BACKUP_THREAD is not None:
+            db_interface._BACKUP_THREAD.join(10)
+        db_interface.close_pools()
+        self.environ.stop()
+        db_interface.set_path_config()
+        shutil.rmtree(self.tmp_dir)
+
+    def start_collector(self):
+        """Runs call_executable() in the background (like a job), returning where its output goes"""
+        output = []
+        thread = threading.Thread(target=lambda: output.append(ohm_interface.call_executable()))
+        thread.start()
+
+        deadline = time.monotonic() + 10
+        while not os.path.exists(self.pid_file) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return thread, output
+
+    def test_status_doesnt_stop(self):
+        """The status check uses the pid file, and checking doesn't stop the collector"""
+        thread, output = self.start_collector()
+
+        with mock.patch.object(psutil, "process_iter", no_scan):
+            for _ in range(3):
+                status = ohm_interface.collector_status()
+                self.assertTrue(status["running"])
+            self.assertEqual(status["pid"], json.load(open(self.pid_file))["pid"])
+
+            # Stopping is separate. The run is reported as stopped, not as failing.
+            self.assertTrue(ohm_interface.stop_metrics())
+            thread.join(10)
+            self.assertEqual(output, ["Metrics Stopped"])
+            self.assertFalse(os.path.exists(self.pid_file))
+
+        # With no pid file it falls back to the scan, which doesn't find it either.
+        self.assertFalse(ohm_interface.stop_metrics())
+
+    def test_stale_pid_file(self):
+        """A pid file for a process that has gone (or a reused pid) isn't running, and is removed"""
+        me = psutil.Process()
+        with open(self.pid_file, "w") as file:
+            json.dump({"pid": me.pid, "create_time": me.create_time() - 100, "name": me.name()}, file)
+
+        with mock.patch.object(psutil, "process_iter", no_scan):
+            self.assertFalse(ohm_interface.is_metrics_running())
+        self.assertFalse(os.path.exists(self.pid_file))
+
+    def test_access_denied(self):
+        """A pid that can't be inspected is only the collector if it has the collector's name"""
+        me = psutil.Process()
+        with open(self.pid_file, "w") as file:
+            json.dump({"pid": me.pid, "create_time": me.create_time(), "name": "OpenHardwareMonitor.exe"}, file)
+
+        with mock.patch.object(psutil.Process, "create_time", side_effect=psutil.AccessDenied(me.pid)), \
+                mock.patch.object(psutil, "process_iter", no_scan):
+            with mock.patch.object(psutil.Process, "name", return_value="OpenHardwareMonitor.exe"):
+                self.assertEqual(ohm_interface.find_metrics_process().pid, me.pid)
+            self.assertTrue(os.path.exists(self.pid_file))
+
+            # The pid has been reused by something else, e.g. this test.
+            self.assertIsNone(ohm_interface.find_metrics_process())
+            self.assertFalse(os.path.exists(self.pid_file))
+
+    def test_scan_without_pid_file(self):
+        """A collector started by hand is found by the scan, and recorded so the next check is quick"""
+        proc = subprocess.Popen([STUB_EXE, "--lifetime", "1y0m0w0d"], stdout=subprocess.DEVNULL)
+        try:
+            # Give it the real executable's name, as it would have on windows.
+            found = psutil.Process(proc.pid)
+            found.info = {"name": "OpenHardwareMonitor.exe"}
+            with mock.patch.object(psutil, "process_iter", return_value=[found]):
+                self.assertTrue(ohm_interface.is_metrics_running())
+            self.assertEqual(json.load(open(self.pid_file))["pid"], proc.pid)
+
+            with mock.patch.object(psutil, "process_iter", no_scan):
+                self.assertEqual(ohm_interface.collector_status(),
+                                 {"running": True, "pid": proc.pid, "collector": "exe"})
+        finally:
+            proc.kill()
+            proc.wait()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+import math
+import sys
+import os
+
+# Get the path of the directory above the test file and insert it into our path.
+# This is where db_interface and columnar live, which we need to import to test.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import db_interface
+import columnar
+
+
+@unittest.skipIf(columnar.numpy is None, "numpy is not installed")
+class ColumnarTestCase(unittest.TestCase):
+    """Testcase for the columnar (numpy) version of read_metrics"""
+
+    def test_matches_read_metrics(self):
+        """Every component and every value should match read_metrics() (debug:2 is normal.db)"""
+        rows = db_interface.read_metrics(2)
+        columns = db_interface.read_metrics_columnar(2)
+        self.assertEqual(set(rows), set(columns))
+
+        for key, series in columns.items():
+            self.assertEqual(series["timestamp"].dtype, columnar.numpy.int64)
+            self.assertEqual(series["usage"].dtype, columnar.numpy.float32)
+            for row, adapted in zip(rows[key], columnar.to_rows(series)):
+                # Timestamps come back at millisecond precision.
+                self.assertEqual(row[0][:23], adapted[0])
+                for expected, actual in zip(row[1:], adapted[1:]):
+                    self.assertAlmostEqual(expected, actual, places=4)
+
+    def test_unexpected_values(self):
+        """Emojis become NaN in the arrays and None in the adapter (debug:5 is unexpected.db)"""
+        columns = db_interface.read_metrics_columnar(5)
+        series = columns["test_cpu (😄)"]
+        self.assertTrue(math.isnan(series["usage"][3]))
+        self.assertIsNone(columnar.to_rows(series)[3][2])
+
+        # The NaNs are left out of the aggregates.
+        self.assertEqual(columnar.aggregate(series, "usage")["count"], len(series["usage"]) - 6)
+
+    def test_empty_database(self):
+        """An empty database gives no series, and the adapter still returns SOMETHING (debug:3)"""
+        columns = db_interface.read_metrics_columnar(3)
+        self.assertEqual(columns, {})
+        self.assertEqual(columnar.to_datasets(columns), db_interface.read_metrics(3))
+
+    def test_window(self):
+        """Windows are inclusive on both ends"""
+        series = db_interface.read_metrics_columnar(2)["test_cpu (CPU)"]
+        start = columnar.to_epoch_ms("2025-01-01 02:00")
+        end = columnar.to_epoch_ms("2025-01-01 04:00:00")
+        part = columnar.window(series, start, end)
+        self.assertEqual(part["temperature"].tolist(), [3.0, 4.0, 5.0])
+        self.assertEqual(columnar.aggregate(part, "temperature")["mean"], 4.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
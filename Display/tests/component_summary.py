@@ -0,0 +1,168 @@
+import unittest
+from unittest import mock
+import datetime
+import math
+import random
+import sqlite3
+import shutil
+import tempfile
+import sys
+import os
+
+# Get the path of the directory above the test file and insert it into our path.
+# This is where db_interface lives, which we need to import to test.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from metrics_web_server import app
+import db_interface
+import rollups
+import schema_v2
+import shards
+
+START = datetime.datetime(2025, 1, 1)
+
+# Windows that are read raw, from the hourly rollup with raw rows either side, and open ended.
+WINDOWS = [
+    (None, None),
+    ("2025-01-02T05:30", "2025-01-08T17:45"),
+    ("2025-01-01T01:00", "2025-01-01T03:00"),
+    (None, "2025-01-05"),
+    ("2025-01-04T12:34:56", None),
+    ("2025-02-01", None),
+]
+
+
+def percentile(values, percent):
+    """The percentile the way numpy.percentile() works it out, interpolating between the two nearest."""
+    values = sorted(values)
+    position = percent / 100 * (len(values) - 1)
+    lower = math.floor(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+class SummaryTestCase(unittest.TestCase):
+    """Testcase for the per component summaries (read_summary and /api/summary)"""
+
+    def setUp(self):
+        """A migrated database with 10 days of random samples from two components, every 7 minutes"""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_name = os.path.join(self.tmp_dir, "metrics.db")
+        conn = sqlite3.connect(self.db_name)
+        db_interface.create_mtg_database(conn)
+        db_interface.migrate_database(conn)
+        conn.executemany("INSERT INTO component VALUES (?, ?, 0, 0, 0)", [("cpu", "CPU"), ("gpu", "GPU")])
+
+        generator = random.Random(710)
+        self.rows = []
+        for i in range(10 * 24 * 60 // 7):
+            timestamp = (START + datetime.timedelta(minutes=7 * i)).strftime("%Y-%m-%d %H:%M:%S.0000000")
+            for serial_number in ["cpu", "gpu"]:
+                # Every so often the usage isn't a number, which the summary leaves out.
+                usage = "😄" if i % 97 == 0 else round(generator.uniform(0, 100), 2)
+                self.rows.append((serial_number, timestamp, "Active", round(generator.gauss(55, 8), 2), usage,
+                                  10.0, 0, 0, 0, "2030-01-01 00:00:00.000000"))
+        conn.executemany("INSERT INTO component_statistic VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", self.rows)
+        conn.commit()
+        conn.close()
+
+        self.environ = mock.patch.dict(os.environ)
+        self.environ.start()
+        db_interface.set_path_config(database=self.db_name)
+
+    def tearDown(self):
+        """Close everything and clean up"""
+        db_interface.close_pools()
+        self.environ.stop()
+        db_interface.set_path_config()
+        rollups._LAST_REFRESH.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def expected(self, start, end):
+        """Works the summary out in python from every row in the window."""
+        start = db_interface.normalize_timestamp(start)
+        end = db_interface.normalize_timestamp(end, upper=True)
+        summary = {}
+        for serial_number in ["cpu", "gpu"]:
+            rows = [row for row in self.rows if row[0] == serial_number
+                    and (not start or row[1] >= start) and (not end or row[1] <= end)]
+            if not rows:
+                continue
+            summary[serial_number] = {}
+            for column, index in [("temperature", 3), ("usage", 4)]:
+                values = [row[index] for row in rows if isinstance(row[index], float)]
+                summary[serial_number][column] = (len(values), min(values), max(values),
+                                                  sum(values) / len(values), percentile(values, 95))
+        return summary
+
+    def check(self, start, end):
+        summary = db_interface.read_summary(0, start, end)
+        expected = self.expected(start, end)
+        self.assertEqual([component["serial_number"] for component in summary["components"]], list(expected))
+        for component in summary["components"]:
+            for column, (count, low, high, mean, p95) in expected[component["serial_number"]].items():
+                stats = component["columns"][column]
+                self.assertEqual((stats["count"], stats["min"], stats["max"]), (count, low, high))
+                self.assertAlmostEqual(stats["mean"], mean, places=6)
+                self.assertAlmostEqual(stats["p95"], p95, places=6)
+        return summary
+
+    def test_matches_python(self):
+        """Every window gives the same numbers as working them out from every row"""
+        for start, end in WINDOWS:
+            with self.subTest(start=start, end=end):
+                self.check(start, end)
+
+    def test_long_window_uses_rollups(self):
+        """A long window reads the whole hours from the rollup, and only the raw rows at either end"""
+        self.assertEqual(self.check(*WINDOWS[1])["resolution"], "hourly")
+        self.assertEqual(self.check(*WINDOWS[2])["resolution"], "raw")
+
+        # Rows added since the rollup was refreshed are still counted, they're in the last bucket.
+        conn = sqlite3.connect(self.db_name)
+        row = ("cpu", "2025-01-11 00:00:01.0000000", "Active", 99.5, 1.0, 10.0, 0, 0, 0, "2030-01-01 00:00:00.000000")
+        conn.execute("INSERT INTO component_statistic VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+        conn.commit()
+        conn.close()
+        self.rows.append(row)
+        self.check(None, None)
+
+    def test_sharded(self):
+        """The summary is the same from daily shards, however many can be attached at once"""
+        shards.split(self.db_name, "day")
+        db_interface.close_pools()
+        self.assertEqual(len(shards.list_shards(self.db_name)), 10)
+        for start, end in WINDOWS:
+            with self.subTest(start=start, end=end):
+                self.check(start, end)
+        with mock.patch.object(shards, "attach_limit", return_value=3):
+            self.check(*WINDOWS[1])
+
+    def test_v2(self):
+        """The compact layout gives the same summary, from the raw rows"""
+        target = os.path.join(self.tmp_dir, "metrics-v2.db")
+        schema_v2.convert(self.db_name, target)
+        db_interface.set_path_config(database=target)
+        summary = self.check(*WINDOWS[1])
+        self.assertEqual(summary["resolution"], "raw")
+        self.assertEqual(db_interface.read_summary(0, "not a time")["components"], [])
+
+    def test_api(self):
+        """/api/summary sends the summary back as json, and the reports page has the panel"""
+        client = app.test_client()
+        response = client.get("/api/summary", query_string={"start": "2025-01-02", "column": "temperature"})
+        self.assertEqual(response.status_code, 200)
+        components = response.get_json()["components"]
+        self.assertEqual([component["key"] for component in components], ["cpu (CPU)", "gpu (GPU)"])
+        self.assertEqual(list(components[0]["columns"]), ["temperature"])
+
+        self.assertEqual(client.get("/api/summary", query_string={"column": "emoji"}).status_code, 400)
+        with self.assertRaises(ValueError):
+            db_interface.read_summary(0, columns=["emoji"])
+
+        page = client.post("/user_report").get_data(as_text=True)
+        self.assertIn('id="summaryTable"', page)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import unittest
+import sqlite3
+import shutil
+import tempfile
+import threading
+import sys
+import os
+import database_setup
+
+# Get the path of the directory above the test file and insert it into our path.
+# This is where db_interface lives, which we need to import to test.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import db_interface
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+    """Testcase for the pooled database connections"""
+
+    def setUp(self):
+        """Each test gets a fresh normal database and a pool for it"""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_name = os.path.join(self.tmp_dir, "normal.db")
+        database_setup.create_normal_database(self.db_name)
+        self.pool = db_interface.ConnectionPool(self.db_name, size=2)
+
+    def tearDown(self):
+        """Close the pool and clean up"""
+        self.pool.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_connection_reused(self):
+        """Releasing then acquiring again should hand back the same connection"""
+        with self.pool.connection() as first:
+            pass
+        with self.pool.connection() as second:
+            self.assertIs(first, second)
+
+    def test_profile_applied(self):
+        """Pooled connections are in WAL mode with the profile's PRAGMAs set"""
+        with self.pool.connection() as conn:
+            self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+            self.assertEqual(conn.execute("PRAGMA busy_timeout").fetchone()[0],
+                             db_interface.DB_PROFILE["busy_timeout"])
+            self.assertEqual(conn.execute("PRAGMA cache_size").fetchone()[0],
+                             db_interface.DB_PROFILE["cache_size"])
+
+    def test_threads_get_their_own_connection(self):
+        """Two threads using the pool at the same time never share a connection"""
+        barrier = threading.Barrier(2)
+        used = []
+
+        def reader():
+            with self.pool.connection() as conn:
+                used.append(conn)
+                conn.execute("SELECT COUNT(*) FROM component_statistic").fetchone()
+                barrier.wait(timeout=5)
+
+        threads = [threading.Thread(target=reader) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertIsNot(used[0], used[1])
+
+    def test_extra_connections_closed(self):
+        """Connections over the pool size are closed instead of kept"""
+        conns = [self.pool.acquire() for _ in range(3)]
+        for conn in conns:
+            self.pool.release(conn)
+        self.assertEqual(self.pool.idle.qsize(), 2)
+
+        # The one that didn't fit back in the pool should be closed.
+        with self.assertRaises(sqlite3.ProgrammingError):
+            conns[-1].execute("SELECT 1")
+
+    def test_close(self):
+        """Closing the pool closes the idle connections and refuses new ones"""
+        with self.pool.connection() as conn:
+            pass
+        self.pool.close()
+        with self.assertRaises(sqlite3.ProgrammingError):
+            conn.execute("SELECT 1")
+        with self.assertRaises(sqlite3.ProgrammingError):
+            self.pool.acquire()
+
+
+if __name__ == "__main__":
+    unittest.main()
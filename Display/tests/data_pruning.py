@@ -0,0 +1,133 @@
+import unittest
+from unittest import mock
+import datetime
+import sqlite3
+import glob
+import time
+import shutil
+import tempfile
+import sys
+import os
+
+# Get the path of the directory above the test file and insert it into our path.
+# This is where db_interface lives, which we need to import to test.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import db_interface
+import job_manager
+import ohm_interface
+import process_analytics
+import rollups
+
+NOW = datetime.datetime(2025, 6, 1, 12, 0, 0)
+
+
+def stamp(days_ago):
+    """A timestamp the given number of days before NOW, stored the way the collector stores it."""
+    return (NOW - datetime.timedelta(days=days_ago)).strftime("%Y-%m-%d %H:%M:%S.%f")
+
+
+class PruneTestCase(unittest.TestCase):
+    """Testcase for the batched python pruner"""
+
+    def setUp(self):
+        """Rows that are too old, rows past their end of life, and rows to keep"""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_name = os.path.join(self.tmp_dir, "metrics.db")
+        self.conn = sqlite3.connect(self.db_name)
+        db_interface.create_mtg_database(self.conn)
+        db_interface.migrate_database(self.conn)
+
+        self.conn.executemany("INSERT INTO component VALUES (?, 'CPU', 0, 0, 0)", [("keep_cpu",), ("old_cpu",)])
+        statistics = []
+        for i in range(50):
+            # Older than the 30 day lifetime.
+            statistics.append(("old_cpu", stamp(40 + i / 100), "Active", 1, 1, 1, 1, 1, 1, stamp(-300)))
+            # Recent, but past its end of life.
+            statistics.append(("keep_cpu", stamp(5 + i / 100), "Active", 1, 1, 1, 1, 1, 1, stamp(1)))
+            # Recent and still alive.
+            statistics.append(("keep_cpu", stamp(1 + i / 100), "Active", 1, 1, 1, 1, 1, 1, stamp(-300)))
+        self.conn.executemany("INSERT INTO component_statistic VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", statistics)
+        self.conn.executemany("INSERT INTO process VALUES (?, ?, 1, 1, ?)",
+                              [(pid, stamp(days), stamp(-300)) for pid in range(20) for days in (60, 2)])
+        self.conn.commit()
+
+        self.environ = mock.patch.dict(os.environ)
+        self.environ.start()
+        db_interface.set_path_config(database=self.db_name)
+
+    def tearDown(self):
+        """Close everything and clean up"""
+        db_interface.close_pools()
+        self.environ.stop()
+        db_interface.set_path_config()
+        self.conn.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_prune(self):
+        """Old and expired rows go in several small batches, everything else stays"""
+        stats = db_interface.prune_database(datetime.timedelta(days=30), batch_size=7, yield_interval=0, now=NOW)
+
+        self.assertEqual(stats["deleted"], {"component_statistic": 100, "process": 20, "component": 1})
+        self.assertEqual(stats["rows"], 121)
+        # 50 + 50 rows in batches of 7, 20 in batches of 7, plus the empty passes.
+        self.assertGreaterEqual(stats["batches"], 8 + 8 + 3)
+        self.assertGreaterEqual(stats["rows_per_second"], 0)
+
+        self.assertEqual(self.conn.execute("SELECT COUNT(*) FROM component_statistic").fetchone()[0], 50)
+        self.assertEqual(self.conn.execute("SELECT COUNT(*) FROM process").fetchone()[0], 20)
+        self.assertEqual(self.conn.execute("SELECT serial_number FROM component").fetchall(), [("keep_cpu",)])
+
+        # Nothing left to do the second time around.
+        self.assertEqual(db_interface.prune_database(datetime.timedelta(days=30), now=NOW)["rows"], 0)
+
+    def test_prune_recomputes_summaries(self):
+        """The rollups and process summaries lose the pruned rows in the same batch, without a refresh"""
+        rollups.refresh_rollups(self.conn)
+        process_analytics.refresh(self.conn)
+        db_interface.prune_database(datetime.timedelta(days=30), batch_size=7, yield_interval=0, now=NOW)
+
+        for module, table in [(rollups, "component_statistic"), (process_analytics, "process")]:
+            for summary, bucket_format in module.BUCKET_FORMATS.items():
+                count = "sample_count" if module is rollups else "samples"
+                summarized = self.conn.execute(f"SELECT bucket, SUM({count}) FROM {summary} GROUP BY 1 ORDER BY 1")
+                raw = self.conn.execute(f"""SELECT strftime('{bucket_format}', timestamp), COUNT(*)
+                                            FROM {table} GROUP BY 1 ORDER BY 1""")
+                self.assertEqual(summarized.fetchall(), raw.fetchall())
+
+    def test_batches_use_indexes(self):
+        """Each batch finds its rows with an index rather than scanning the table"""
+        for table, column, index in [("component_statistic", "timestamp", "idx_component_statistic_timestamp"),
+                                     ("component_statistic", "end_of_life", "idx_component_statistic_end_of_life"),
+                                     ("process", "timestamp", "idx_process_timestamp_cpu_usage"),
+                                     ("process", "end_of_life", "idx_process_end_of_life")]:
+            plan = " ".join(row[-1] for row in self.conn.execute(
+                f"EXPLAIN QUERY PLAN SELECT rowid FROM {table} WHERE {column} < ? LIMIT ?", ("x", 1)))
+            self.assertIn(index, plan)
+
+    def test_backup_before_prune(self):
+        """A prune job backs the database up first, and the backup still has the pruned rows"""
+        job = job_manager.JobManager().submit("prune", ohm_interface.prune_data, "0", "1", "0", "0")
+        deadline = time.monotonic() + 30
+        while job.active and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(job.state, job_manager.SUCCEEDED, job.error)
+
+        # Everything is older than a month by now.
+        self.assertEqual(self.conn.execute("SELECT COUNT(*) FROM component_statistic").fetchone()[0], 0)
+        backups = glob.glob(self.db_name + ".*")
+        self.assertEqual(len(backups), 1)
+        backup = sqlite3.connect(backups[0])
+        try:
+            self.assertEqual(backup.execute("SELECT COUNT(*) FROM component_statistic").fetchone()[0], 150)
+        finally:
+            backup.close()
+
+    def test_lifetime(self):
+        """The lifetime is worked out the same way as the executable"""
+        self.assertEqual(ohm_interface.get_lifetime("1", "2", "1", "3"), datetime.timedelta(days=365 + 60 + 7 + 3))
+        self.assertEqual(ohm_interface.get_lifetime("x", "", "0", "0"), datetime.timedelta(days=365))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+import unittest
+from unittest import mock
+import datetime
+import sqlite3
+import shutil
+import tempfile
+import threading
+import sys
+import os
+
+# Get the path of the directory above the test file and insert it into our path.
+# This is where db_interface lives, which we need to import to test.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import db_interface
+
+
+class BackupTestCase(unittest.TestCase):
+    """Testcase for the online database backups"""
+
+    def setUp(self):
+        """Each test gets a database big enough to need a few backup steps"""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_name = os.path.join(self.tmp_dir, "metrics.db")
+        conn = sqlite3.connect(self.db_name)
+        db_interface.create_mtg_database(conn)
+        conn.executemany("INSERT INTO process VALUES (?, ?, 1.5, 2.5, '2030-01-01')",
+                         [(pid, f"2025-01-01 00:00:{pid:010d}") for pid in range(20000)])
+        conn.commit()
+        conn.close()
+
+        self.environ = mock.patch.dict(os.environ)
+        self.environ.start()
+        db_interface.set_path_config(database=self.db_name)
+
+        # Small steps so the backup is copied in several pieces.
+        self.pages = mock.patch.object(db_interface, "BACKUP_PAGES", 16)
+        self.pages.start()
+
+    def tearDown(self):
+        """Close everything and clean up"""
+        self.pages.stop()
+        db_interface.close_pools()
+        self.environ.stop()
+        db_interface.set_path_config()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_backup_is_complete(self):
+        """The backup has every row, replaces the old backups and leaves no temp file behind"""
+        old_backup = self.db_name + ".2000_01_01_00"
+        open(old_backup, "w").close()
+
+        new_backup = self.db_name + ".2025_01_01_00"
+        self.assertTrue(db_interface.run_backup(self.db_name, new_backup, [old_backup]))
+
+        conn = sqlite3.connect(new_backup)
+        self.assertEqual(conn.execute("PRAGMA integrity_check").fetchone()[0], "ok")
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM process").fetchone()[0], 20000)
+        conn.close()
+
+        self.assertFalse(os.path.exists(old_backup))
+        self.assertFalse(os.path.exists(self.db_name + "-backup.tmp"))
+
+        # The stats say how big it was and how long it took.
+        stats = db_interface.backup_stats()
+        self.assertFalse(stats["running"])
+        self.assertEqual(stats["backup"], new_backup)
+        self.assertGreater(stats["steps"], 1)
+        self.assertGreater(stats["pages"], 16)
+        self.assertIsNotNone(stats["duration"])
+
+    def test_backup_in_background(self):
+        """create_backup() returns straight away, and the database can be written while it runs"""
+        # Slow the backup right down, so the write happens part way through.
+        started = threading.Event()
+        real_sleep = db_interface.time.sleep
+
+        def slow_sleep(seconds):
+            started.set()
+            real_sleep(0.01)
+
+        with mock.patch.object(db_interface.time, "sleep", slow_sleep):
+            thread = db_interface.create_backup()
+            self.assertIsInstance(thread, threading.Thread)
+
+            # A second request while it's running gets the same backup, not a new one.
+            self.assertIs(db_interface.create_backup(), thread)
+
+            started.wait(5)
+            conn = sqlite3.connect(self.db_name, timeout=5)
+            conn.execute("INSERT INTO process VALUES (-1, '2025-01-02', 1, 1, '2030-01-01')")
+            conn.commit()
+            conn.close()
+            thread.join(30)
+
+        # The backup is named for the hour it was made in, and no new one is needed straight away.
+        backups = db_interface.glob.glob(self.db_name + ".*")
+        self.assertEqual(len(backups), 1)
+        self.assertTrue(backups[0].endswith(datetime.datetime.now().strftime("%Y_%m_%d_%H")))
+        self.assertIsNone(db_interface.create_backup())
+
+    def test_failed_backup(self):
+        """A backup that can't be written is recorded rather than raised"""
+        failures = db_interface.backup_stats()["failures"]
+        missing = os.path.join(self.tmp_dir, "no_such_dir", "metrics.db.2025_01_01_00")
+        self.assertFalse(db_interface.run_backup(self.db_name, missing))
+
+        stats = db_interface.backup_stats()
+        self.assertEqual(stats["failures"], failures + 1)
+        self.assertIsNotNone(stats["error"])
+        self.assertFalse(os.path.exists(self.db_name + "-backup.tmp"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+import unittest
+import sqlite3
+import shutil
+import tempfile
+import sys
+import os
+import database_setup
+
+# Get the path of the directory above the test file and insert it into our path.
+# This is where db_interface lives, which we need to import to test.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import db_interface
+
+# The sample database that looks like one from a real collector run.
+SAMPLE_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sample_dbs", "metrics.db")
+
+
+def query_plan(conn, query, params=()):
+    """Returns the EXPLAIN QUERY PLAN output as one string."""
+    rows = conn.execute(f"EXPLAIN QUERY PLAN {query}", params).fetchall()
+    return " | ".join(row[-1] for row in rows)
+
+
+class MigrationTestCase(unittest.TestCase):
+    """Testcase for the schema migrations"""
+
+    def setUp(self):
+        """Each test gets a fresh copy of the normal database"""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_name = os.path.join(self.tmp_dir, "normal.db")
+        database_setup.create_normal_database(self.db_name)
+        self.conn = sqlite3.connect(self.db_name)
+
+    def tearDown(self):
+        """Close the database and clean up"""
+        self.conn.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_migrates_to_latest(self):
+        """A new database starts at 0 and ends at the latest version"""
+        self.assertEqual(db_interface.get_schema_version(self.conn), 0)
+        version = db_interface.migrate_database(self.conn)
+        self.assertEqual(version, db_interface.MIGRATIONS[-1][0])
+
+        # Running it again should be harmless.
+        self.assertEqual(db_interface.migrate_database(self.conn), version)
+
+    def test_upgrade_in_place(self):
+        """Upgrading a copy of a real database keeps all of its data"""
+        db = os.path.join(self.tmp_dir, "metrics.db")
+        shutil.copy(SAMPLE_DB, db)
+        conn = sqlite3.connect(db)
+        before = conn.execute("SELECT COUNT(*) FROM component_statistic").fetchone()[0]
+
+        db_interface.migrate_database(conn)
+        after = conn.execute("SELECT COUNT(*) FROM component_statistic").fetchone()[0]
+        self.assertEqual(before, after)
+        self.assertEqual(db_interface.get_schema_version(conn), db_interface.MIGRATIONS[-1][0])
+        conn.close()
+
+    def test_v1_prune_uses_indexes(self):
+        """The collector's prune filter should use the timestamp and end_of_life indexes"""
+        db_interface.migrate_database(self.conn)
+        for table, indexes in [("component_statistic", ["idx_component_statistic_timestamp",
+                                                        "idx_component_statistic_end_of_life"]),
+                               ("process", ["idx_process_timestamp_cpu_usage",
+                                            "idx_process_end_of_life"])]:
+            plan = query_plan(self.conn, f"SELECT * FROM {table} WHERE timestamp < ? OR end_of_life < ?",
+                              ("2025-01-01", "2025-01-01"))
+            for index in indexes:
+                self.assertIn(index, plan)
+
+    def test_v1_time_window_uses_indexes(self):
+        """Time window queries across every component should use the timestamp indexes"""
+        db_interface.migrate_database(self.conn)
+        plan = query_plan(self.conn, "SELECT * FROM component_statistic WHERE timestamp BETWEEN ? AND ?",
+                          ("2025-01-01", "2025-01-02"))
+        self.assertIn("idx_component_statistic_timestamp", plan)
+
+        # The busiest processes in a window should be answered from the index alone.
+        plan = query_plan(self.conn, "SELECT timestamp, cpu_usage FROM process WHERE timestamp >= ? "
+                                     "ORDER BY timestamp", ("2025-01-01",))
+        self.assertIn("COVERING INDEX idx_process_timestamp_cpu_usage", plan)
+
+
+if __name__ == "__main__":
+    unittest.main()
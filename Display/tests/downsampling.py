@@ -0,0 +1,63 @@
+import unittest
+import sys
+import os
+
+# Get the path of the directory above the test file and insert it into our path.
+# This is where downsample.py lives, which we need to import to test.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import downsample
+
+
+def make_rows(count):
+    """Creates read_metrics() style rows with a spike in the middle."""
+    rows = []
+    for i in range(count):
+        # The temperature spikes at the halfway point so we can check the peak is kept.
+        temperature = 100.0 if i == count // 2 else 40.0 + (i % 10)
+        rows.append([f"ts{i}", temperature, i * 0.01, 1.5, 2.0, 2.5, 3.0])
+    return rows
+
+
+class DownsampleTestCase(unittest.TestCase):
+    """Testcase for the LTTB downsampling"""
+
+    def test_reduces_to_threshold(self):
+        """The output should be exactly the threshold long"""
+        rows = make_rows(10000)
+        self.assertEqual(len(downsample.lttb(rows, 500)), 500)
+
+    def test_keeps_endpoints_and_peak(self):
+        """The first point, the last point and the spike should all survive"""
+        rows = make_rows(10000)
+        sampled = downsample.lttb(rows, 100)
+        self.assertIs(sampled[0], rows[0])
+        self.assertIs(sampled[-1], rows[-1])
+        self.assertIn(100.0, [row[1] for row in sampled])
+
+    def test_short_series_untouched(self):
+        """Series shorter than the threshold are returned as is"""
+        rows = make_rows(10)
+        self.assertEqual(downsample.lttb(rows, 100), rows)
+
+    def test_unexpected_values(self):
+        """Emojis and missing values should be skipped, not crash"""
+        rows = make_rows(1000)
+        for i in range(0, 1000, 4):
+            rows[i][2] = "😄"
+            rows[i][3] = None
+        self.assertEqual(len(downsample.lttb(rows, 50)), 50)
+
+    def test_downsample_datasets(self):
+        """Every series is downsampled and the empty placeholder is left alone"""
+        datasets = {"cpu (CPU)": make_rows(5000), "No Components Found": [0]}
+        result = downsample.downsample_datasets(datasets, 200)
+        self.assertEqual(len(result["cpu (CPU)"]), 200)
+        self.assertEqual(result["No Components Found"], [0])
+
+        # 0 means no downsampling.
+        self.assertEqual(len(downsample.downsample_datasets(datasets, 0)["cpu (CPU)"]), 5000)
+
+
+if __name__ == "__main__":
+    unittest.main()
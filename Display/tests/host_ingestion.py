@@ -0,0 +1,153 @@
+import unittest
+from unittest import mock
+import sqlite3
+import shutil
+import tempfile
+import sys
+import os
+
+# Get the path of the directory above the test file and insert it into our path.
+# This is where db_interface lives, which we need to import to test.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from metrics_web_server import app
+import db_interface
+import ingest
+
+# Real databases from lab machines, checked in at the top of the project.
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+SOURCES = {
+    "lab26": os.path.join(PROJECT_ROOT, "samples", "metrics_labSystem_03_26.db"),
+    "lab27": os.path.join(PROJECT_ROOT, "lab_metrics3-27.db"),
+    # The same machine as sample01, so the two have the same serial numbers.
+    "home": os.path.join(PROJECT_ROOT, "samples", "sample_0401_metrics.db"),
+    "sample01": os.path.join(PROJECT_ROOT, "samples", "sample01_metrics.db"),
+}
+
+
+class IngestTestCase(unittest.TestCase):
+    """Testcase for merging many machines' databases into a central one"""
+
+    def setUp(self):
+        """Copies of the sample databases, so rows can be added to them, and no central database yet"""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.central = os.path.join(self.tmp_dir, "central.db")
+        self.sources = []
+        for host, path in SOURCES.items():
+            copy = os.path.join(self.tmp_dir, os.path.basename(path))
+            shutil.copyfile(path, copy)
+            self.sources.append((host, copy))
+        self.environ = mock.patch.dict(os.environ)
+        self.environ.start()
+
+    def tearDown(self):
+        """Close everything and clean up"""
+        db_interface.close_pools()
+        self.environ.stop()
+        db_interface.set_path_config()
+        shutil.rmtree(self.tmp_dir)
+
+    def query(self, db, sql, params=()):
+        conn = sqlite3.connect(db)
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+
+    def test_ingest(self):
+        """Every row of every source ends up in the central database, tagged with its host"""
+        result = ingest.ingest(self.central, self.sources, workers=2, batch_rows=10)
+        self.assertEqual({source["host"]: source["rows"] for source in result["sources"].values()},
+                         {"lab26": 24, "lab27": 48 + 3270, "home": 68, "sample01": 24})
+
+        self.assertEqual(self.query(self.central, "SELECT COUNT(*) FROM component_statistic"), [(164,)])
+        self.assertEqual(self.query(self.central, "SELECT host, COUNT(*) FROM process GROUP BY host"),
+                         [("lab27", 3270)])
+        # The same serial numbers on two hosts are two components.
+        self.assertEqual(self.query(self.central, "SELECT COUNT(*) FROM component"), [(16,)])
+        self.assertEqual(self.query(self.central, "SELECT device_type FROM component WHERE serial_number = ?",
+                                    ("home/178BFBFF00B40F40",)), [("CPU",)])
+
+    def test_incremental(self):
+        """Running it again only reads the rows added since, and reading a row twice changes nothing"""
+        ingest.ingest(self.central, self.sources, workers=2)
+        self.assertEqual(ingest.ingest(self.central, self.sources, workers=2)["rows"], 0)
+
+        host, path = self.sources[0]
+        conn = sqlite3.connect(path)
+        conn.execute("""INSERT INTO component_statistic
+                        SELECT serial_number, '2025-03-27 00:00:00.0000000', machine_state, temperature, usage,
+                               power_consumption, core_speed, memory_speed, total_ram, end_of_life
+                        FROM component_statistic LIMIT 1""")
+        conn.commit()
+        conn.close()
+
+        result = ingest.ingest(self.central, self.sources, workers=2)
+        self.assertEqual(result["rows"], 1)
+        self.assertEqual(result["sources"][path]["rows"], 1)
+        self.assertEqual(self.query(self.central, "SELECT COUNT(*) FROM component_statistic"), [(165,)])
+        self.assertEqual(self.query(self.central, "SELECT rows FROM ingest_source WHERE path = ?", (path,)),
+                         [(25,)])
+
+    def test_replaced_source(self):
+        """A source that's been replaced is read again from the start, without duplicating anything"""
+        ingest.ingest(self.central, self.sources, workers=1)
+        host, path = self.sources[3]
+        shutil.copyfile(SOURCES["lab26"], path)
+
+        result = ingest.ingest(self.central, self.sources, workers=1)
+        self.assertEqual(result["sources"][path]["rows"], 24)
+        self.assertEqual(self.query(self.central, "SELECT COUNT(*) FROM component_statistic "
+                                                  "WHERE serial_number LIKE 'sample01/%'"), [(48,)])
+
+    def test_bad_sources(self):
+        """Hosts can't have the separator in them, and a source keeps its host"""
+        self.assertEqual(ingest.parse_source("lab03=metrics.db"), ("lab03", os.path.abspath("metrics.db")))
+        self.assertEqual(ingest.parse_source("x/metrics lab.db")[0], "metrics_lab")
+        with self.assertRaises(ValueError):
+            ingest.parse_source("a/b=metrics.db")
+
+        ingest.ingest(self.central, self.sources[:1], workers=1)
+        with self.assertRaises(ValueError):
+            ingest.ingest(self.central, [("renamed", self.sources[0][1])], workers=1)
+        # An ordinary metrics database isn't a central one.
+        with self.assertRaises(ValueError):
+            ingest.ingest(self.sources[1][1], self.sources[:1], workers=1)
+
+    def test_filter_by_host(self):
+        """The pages and the apis can be limited to one host"""
+        ingest.ingest(self.central, self.sources, workers=2)
+        db_interface.set_path_config(database=self.central)
+
+        devices = db_interface.read_devices(0, "lab27")
+        self.assertEqual(len(devices), 4)
+        self.assertTrue(all(device["serial_number"].startswith("lab27/") for device in devices))
+        self.assertEqual(len(db_interface.read_devices()), 16)
+
+        total, filtered, rows = db_interface.read_process_page(0, 0, 10, host="lab27")
+        self.assertEqual((total, filtered, len(rows)), (3270, 3270, 10))
+        self.assertEqual(db_interface.read_process_page(0, 0, 10, host="home")[1:], (0, []))
+
+        hosts = {host["host"]: host for host in ingest.read_hosts()}
+        self.assertEqual(sorted(hosts), ["home", "lab26", "lab27", "sample01"])
+        self.assertEqual(hosts["lab27"]["components"], 4)
+        self.assertEqual(hosts["lab27"]["rows"], 48 + 3270)
+        self.assertEqual(hosts["home"]["last"], "2025-04-01 22:45:23.3981146")
+
+        client = app.test_client()
+        self.assertEqual(len(client.get("/api/hosts").get_json()), 4)
+        page = client.post("/user_report", data={"host": "lab26"}).get_data(as_text=True)
+        self.assertIn('<option value="lab26" selected>', page)
+        self.assertNotIn("lab27/", page)
+        response = client.get("/api/processes", query_string={"host": "lab27", "length": 5})
+        self.assertEqual(response.get_json()["recordsFiltered"], 3270)
+
+    def test_not_central(self):
+        """An ordinary database has no hosts, and its pages have no host filter"""
+        self.assertEqual(ingest.read_hosts(1), [])
+        page = app.test_client().post("/user_report", data={"debug": 1}).get_data(as_text=True)
+        self.assertNotIn("hostSelect", page)
+
+
+if __name__ == '__main__':
+    unittest.main()
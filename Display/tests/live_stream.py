@@ -0,0 +1,155 @@
+import unittest
+from unittest import mock
+import json
+import sqlite3
+import shutil
+import tempfile
+import sys
+import os
+
+# Get the path of the directory above the test file and insert it into our path.
+# This is where the web app lives, which we need to import to test.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from metrics_web_server import app
+import db_interface
+import live_feed
+
+
+def parse_events(body):
+    """Splits a Server-Sent Events body into (id, rows) for each rows event."""
+    events = []
+    for block in body.strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.split("\n") if not line.startswith(":"))
+        if fields.get("event") == "rows":
+            events.append((int(fields["id"]), json.loads(fields["data"])))
+    return events
+
+
+class LiveFeedTestCase(unittest.TestCase):
+    """Testcase for the live stream of new rows"""
+
+    def setUp(self):
+        """Each test gets an empty database. The poller is only ever run by hand"""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_name = os.path.join(self.tmp_dir, "metrics.db")
+        self.conn = sqlite3.connect(self.db_name)
+        db_interface.create_mtg_database(self.conn)
+        db_interface.migrate_database(self.conn)
+        self.insert("old_cpu", 0)
+
+        self.environ = mock.patch.dict(os.environ)
+        self.environ.start()
+        db_interface.set_path_config(database=self.db_name)
+        self.feed = live_feed.LiveFeed(0, interval=3600)
+
+    def tearDown(self):
+        """Close everything and clean up"""
+        live_feed._FEEDS.clear()
+        db_interface.close_pools()
+        self.environ.stop()
+        db_interface.set_path_config()
+        self.conn.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def insert(self, serial_number, second):
+        """Adds a row, like the collector does"""
+        self.conn.execute("INSERT INTO component_statistic VALUES (?, ?, 'Active', 40, ?, 10, 0, 0, 0, '2030')",
+                          (serial_number, f"2025-01-01 00:00:{second:02d}.000000", second))
+        self.conn.commit()
+
+    def test_one_query_for_every_subscriber(self):
+        """However many pages are open, each poll is one query, and everyone gets the rows they asked for"""
+        everything = [self.feed.subscribe() for _ in range(50)]
+        gpu_only = self.feed.subscribe(["test_gpu"])
+        queries = self.feed.queries
+
+        # Rows that were there before subscribing aren't sent again.
+        self.insert("test_cpu", 1)
+        self.insert("test_gpu", 2)
+        self.assertEqual(self.feed.poll(), 2)
+        self.assertEqual(self.feed.poll(), 0)
+        self.assertEqual(self.feed.queries, queries + 2)
+
+        for subscriber in everything:
+            rows = subscriber.batches.get_nowait()
+            self.assertEqual([(row["serial_number"], row["usage"]) for row in rows],
+                             [("test_cpu", 1), ("test_gpu", 2)])
+        self.assertEqual([row["serial_number"] for row in gpu_only.batches.get_nowait()], ["test_gpu"])
+
+    def test_events(self):
+        """The rows come out as Server-Sent Events, with the rowid as the event id"""
+        subscriber = self.feed.subscribe()
+        self.insert("test_cpu", 1)
+        self.feed.poll()
+
+        body = "".join(live_feed.stream(self.feed, subscriber, duration=0.1))
+        self.assertTrue(body.startswith("retry:"))
+        events = parse_events(body)
+        self.assertEqual(events[0][0], 2)
+        self.assertEqual(events[0][1][0]["timestamp"], "2025-01-01 00:00:01.000000")
+
+        # The stream has ended, so it no longer counts as a subscriber.
+        self.assertNotIn(subscriber, self.feed.subscribers)
+
+    def test_reconnect_catches_up(self):
+        """A browser reconnecting with the last id it saw gets the rows it missed"""
+        self.feed.subscribe()
+        self.insert("test_cpu", 1)
+        self.insert("test_cpu", 2)
+        self.feed.poll()
+
+        subscriber = self.feed.subscribe(last_id=2)
+        self.assertEqual([row["usage"] for row in subscriber.batches.get_nowait()], [2])
+
+    def test_slow_subscriber(self):
+        """A subscriber that falls behind loses its oldest rows instead of holding up the poller"""
+        with mock.patch.object(live_feed, "MAX_QUEUED_BATCHES", 2):
+            subscriber = self.feed.subscribe()
+        for second in range(1, 4):
+            self.insert("test_cpu", second)
+            self.feed.poll()
+
+        self.assertEqual(subscriber.dropped, 1)
+        self.assertEqual(subscriber.batches.get_nowait()[0]["usage"], 2)
+
+    def test_newest_rows_pruned(self):
+        """New rows that are given the rowids of pruned rows are still sent"""
+        subscriber = self.feed.subscribe()
+        self.insert("test_cpu", 1)
+        self.insert("test_cpu", 2)
+        self.feed.poll()
+        subscriber.batches.get_nowait()
+
+        self.conn.execute("DELETE FROM component_statistic WHERE usage > 0")
+        self.conn.commit()
+        self.assertEqual(self.feed.poll(), 0)
+        self.insert("test_cpu", 3)
+        self.assertEqual(self.feed.poll(), 1)
+        self.assertEqual([row["usage"] for row in subscriber.batches.get_nowait()], [3])
+
+    def test_poll_failure(self):
+        """A poll that fails is sent to the pages as an error event, and the poller keeps going"""
+        self.feed.interval = 0.01
+        subscriber = self.feed.subscribe()
+        with mock.patch.object(self.feed, "read_rows", side_effect=sqlite3.OperationalError("database is locked")):
+            body = "".join(subscriber.events(duration=0.5))
+        self.feed.unsubscribe(subscriber)
+
+        self.assertIn('event: error\ndata: {"error": "Live feed poll failed: database is locked"}', body)
+
+    def test_live_route(self):
+        """The route streams the rows inserted while it's open"""
+        feed = live_feed.get_feed(0)
+        feed.interval = 0.05
+        response = app.test_client().get("/api/live", query_string={"serial_number": "test_cpu", "duration": 1})
+        self.assertEqual(response.mimetype, "text/event-stream")
+        self.insert("test_cpu", 1)
+        self.insert("test_gpu", 2)
+
+        events = parse_events(response.get_data(as_text=True))
+        self.assertEqual([row["serial_number"] for _, rows in events for row in rows], ["test_cpu"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,6 +2,30 @@ import unittest
 import database_injection
 import database_extraction
 import web_interface
+import downsampling
+import database_migration
+import connection_pool
+import path_resolution
+import columnar_metrics
+import rollup_tables
+import process_paging
+import database_backup
+import background_jobs
+import collector_tracking
+import data_pruning
+import live_stream
+import response_caching
+import synthetic_database
+import request_timing
+import python_collector
+import storage_layout
+import sharded_storage
+import host_ingestion
+import component_summary
+import anomaly_detection
+import binary_transport
+import startup_profiling
+import top_processes
 import sys
 
 # Initialize the test loader and test suite.
@@ -9,7 +33,14 @@ loader = unittest.TestLoader()
 suite = unittest.TestSuite()
 
 # Load all the tests from all the different test files into the test suite.
-for module in [database_extraction, database_injection, web_interface]:
+for module in [database_extraction, database_injection, web_interface, downsampling, database_migration,
+               connection_pool, path_resolution, columnar_metrics, rollup_tables,
+               process_paging, database_backup, background_jobs,
+               collector_tracking, data_pruning, live_stream,
+               response_caching, synthetic_database, request_timing,
+               python_collector, storage_layout, sharded_storage,
+               host_ingestion, component_summary, anomaly_detection, binary_transport,
+               startup_profiling, top_processes]:
     suite.addTests(loader.loadTestsFromModule(module))
 
 # Run the test suite at verbosity=2, so we can see each individual test run.
@@ -0,0 +1,64 @@
+import unittest
+from unittest import mock
+import tempfile
+import sys
+import os
+
+# Get the path of the directory above the test file and insert it into our path.
+# This is where db_interface lives, which we need to import to test.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import db_interface
+
+
+class PathResolutionTestCase(unittest.TestCase):
+    """Testcase for finding the project root and database"""
+
+    def setUp(self):
+        """Start every test with no overrides and nothing cached"""
+        self.environ = mock.patch.dict(os.environ)
+        self.environ.start()
+        os.environ.pop(db_interface.ROOT_ENV, None)
+        os.environ.pop(db_interface.DATABASE_ENV, None)
+        db_interface.set_path_config()
+
+    def tearDown(self):
+        """Put the environment back and forget anything cached"""
+        self.environ.stop()
+        db_interface.set_path_config()
+
+    def test_root_is_cached(self):
+        """git should only be asked once no matter how many requests come in"""
+        with mock.patch.object(db_interface, "get_git_root", return_value="/fake/root") as git_root:
+            for debug in range(7):
+                db_interface.get_database(debug)
+            self.assertEqual(db_interface.get_proj_root(), "/fake/root")
+            self.assertEqual(git_root.call_count, 1)
+
+    def test_root_override(self):
+        """MTG_ROOT wins over git and doesn't call it at all"""
+        root = tempfile.gettempdir()
+        db_interface.set_path_config(root=root)
+        with mock.patch.object(db_interface, "get_git_root") as git_root:
+            self.assertEqual(db_interface.get_proj_root(), os.path.abspath(root))
+            self.assertEqual(db_interface.get_database(0), os.path.join(os.path.abspath(root), "metrics.db"))
+            git_root.assert_not_called()
+
+    def test_database_override(self):
+        """MTG_DATABASE only changes the production database, not the test ones"""
+        db = os.path.join(tempfile.gettempdir(), "elsewhere.db")
+        debug_db = db_interface.get_database(2)
+        db_interface.set_path_config(database=db)
+        self.assertEqual(db_interface.get_database(0), os.path.abspath(db))
+        self.assertEqual(db_interface.get_database(2), debug_db)
+
+    def test_config_change_clears_cache(self):
+        """Changing the configuration means the root is worked out again"""
+        with mock.patch.object(db_interface, "get_git_root", side_effect=["/first", "/second"]):
+            self.assertEqual(db_interface.get_proj_root(), "/first")
+            db_interface.set_path_config()
+            self.assertEqual(db_interface.get_proj_root(), "/second")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+import unittest
+from unittest import mock
+import sqlite3
+import shutil
+import tempfile
+import sys
+import os
+
+# Get the path of the directory above the test file and insert it into our path.
+# This is where db_interface lives, which we need to import to test.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from metrics_web_server import app
+import db_interface
+
+
+class ProcessPagingTestCase(unittest.TestCase):
+    """Testcase for the server side paging of the process table"""
+
+    def setUp(self):
+        """Each test gets a database with 10 pids sampled every minute for 2 hours"""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_name = os.path.join(self.tmp_dir, "metrics.db")
+        self.conn = sqlite3.connect(self.db_name)
+        db_interface.create_mtg_database(self.conn)
+        db_interface.migrate_database(self.conn)
+        rows = [(pid, f"2025-01-01 {hour:02d}:{minute:02d}:00.000000", pid * 1.5 + minute, 100.0, "2030-01-01")
+                for pid in range(1, 11) for hour in range(2) for minute in range(60)]
+        self.conn.executemany("INSERT INTO process VALUES (?, ?, ?, ?, ?)", rows)
+        self.conn.commit()
+
+        self.environ = mock.patch.dict(os.environ)
+        self.environ.start()
+        db_interface.set_path_config(database=self.db_name)
+
+    def tearDown(self):
+        """Close everything and clean up"""
+        db_interface.close_pools()
+        db_interface._PROCESS_COUNTS.clear()
+        self.environ.stop()
+        db_interface.set_path_config()
+        self.conn.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_pages(self):
+        """The pages are in order and don't overlap"""
+        total, filtered, first = db_interface.read_process_page(0, start=0, length=25)
+        self.assertEqual((total, filtered), (1200, 1200))
+        _, _, second = db_interface.read_process_page(0, start=25, length=25)
+        self.assertEqual(len(first), 25)
+        self.assertEqual(first + second, sorted(first + second))
+        self.assertLess(first[-1], second[0])
+
+        # 'All' is capped, so a huge table can't be pulled in one request.
+        _, _, everything = db_interface.read_process_page(0, length=-1)
+        self.assertEqual(len(everything), db_interface.MAX_PAGE_LENGTH)
+
+    def test_sorting(self):
+        """Sorting by a column, and a bad column falls back to pid"""
+        _, _, rows = db_interface.read_process_page(0, length=3, order_column=2, order_dir="desc")
+        self.assertEqual([row[2] for row in rows], [74.0, 74.0, 73.0])
+
+        _, _, rows = db_interface.read_process_page(0, length=1, order_column=99, order_dir="desc; DROP")
+        self.assertEqual(rows[0][0], 1)
+
+    def test_search(self):
+        """Searching by pid or the start of a timestamp"""
+        _, filtered, rows = db_interface.read_process_page(0, search="7")
+        self.assertEqual(filtered, 120)
+        self.assertTrue(all(row[0] == 7 for row in rows))
+
+        _, filtered, _ = db_interface.read_process_page(0, search="2025-01-01 01:05")
+        self.assertEqual(filtered, 10)
+
+        _, filtered, _ = db_interface.read_process_page(0, search="no such thing")
+        self.assertEqual(filtered, 0)
+
+    def test_host_outside_central_database(self):
+        """A host is ignored by a database that isn't a central one, it has no host column"""
+        self.assertEqual(db_interface.read_process_page(0, length=5, host="lab27"),
+                         db_interface.read_process_page(0, length=5))
+
+        response = app.test_client().get("/api/processes", query_string={"host": "lab27", "length": 5})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()["recordsFiltered"], 1200)
+
+    def test_count_cache(self):
+        """The total count is cached until rows are added or removed"""
+        self.assertEqual(db_interface.count_processes(0), 1200)
+
+        # The cached count is used while the table hasn't changed.
+        with mock.patch.dict(db_interface._PROCESS_COUNTS):
+            rowids, counted, _ = db_interface._PROCESS_COUNTS[self.db_name]
+            db_interface._PROCESS_COUNTS[self.db_name] = (rowids, counted, 5)
+            self.assertEqual(db_interface.count_processes(0), 5)
+
+        # New rows change the rowid range, so it gets counted again.
+        self.conn.execute("INSERT INTO process VALUES (99, '2025-01-02', 1, 1, '2030-01-01')")
+        self.conn.commit()
+        self.assertEqual(db_interface.count_processes(0), 1201)
+
+
+if __name__ == "__main__":
+    unittest.main()
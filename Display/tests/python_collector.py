@@ -0,0 +1,218 @@
+import unittest
+from unittest import mock
+import datetime
+import sqlite3
+import shutil
+import tempfile
+import threading
+import time
+import sys
+import os
+
+# Get the path of the directory above the test file and insert it into our path.
+# This is where the collector lives, which we need to import to test.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from metrics_web_server import app
+import db_interface
+import job_manager
+import ohm_interface
+import psutil_collector
+
+LIFETIME = datetime.timedelta(days=30)
+
+
+def wait_until(condition, timeout=5):
+    """Waits for condition() to be true."""
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+class FixedReader:
+    """Stands in for the process reader, so the tests know exactly what processes there are."""
+
+    def read(self):
+        return [(100, 1.5, 20.0), (200, 0.0, 5.25)]
+
+
+class ProcessReaderTestCase(unittest.TestCase):
+    """Testcase for the two ways of reading the processes"""
+
+    def check_reader(self, reader):
+        """Both readers find this process, with some memory in use"""
+        reader.read()
+        rows = {pid: (cpu, memory) for pid, cpu, memory in reader.read()}
+        self.assertIn(os.getpid(), rows)
+        cpu, memory = rows[os.getpid()]
+        self.assertGreaterEqual(cpu, 0)
+        self.assertGreater(memory, 1)
+
+    def test_psutil_reader(self):
+        self.check_reader(psutil_collector.PsutilProcessReader())
+
+    @unittest.skipUnless(psutil_collector.ProcStatReader.available(), "needs a linux /proc")
+    def test_proc_stat_reader(self):
+        self.check_reader(psutil_collector.ProcStatReader())
+
+    @unittest.skipUnless(psutil_collector.ProcStatReader.available(), "needs a linux /proc")
+    def test_proc_stat_cpu(self):
+        """A busy process shows up as using the cpu"""
+        reader = psutil_collector.ProcStatReader()
+        reader.read()
+        deadline = time.process_time() + 0.2
+        while time.process_time() < deadline:
+            pass
+        cpu = dict((pid, cpu) for pid, cpu, _ in reader.read())[os.getpid()]
+        self.assertGreater(cpu, 10)
+
+
+class CollectorTestCase(unittest.TestCase):
+    """Testcase for sampling and writing"""
+
+    def setUp(self):
+        """An empty database in a temporary directory"""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_name = os.path.join(self.tmp_dir, "metrics.db")
+        self.environ = mock.patch.dict(os.environ)
+        self.environ.start()
+        db_interface.set_path_config(database=self.db_name)
+        self.collector = psutil_collector.Collector(LIFETIME, interval=0.05, reader=FixedReader())
+
+    def tearDown(self):
+        """Close everything and clean up"""
+        db_interface.close_pools()
+        self.environ.stop()
+        db_interface.set_path_config()
+        shutil.rmtree(self.tmp_dir)
+
+    def query(self, sql):
+        conn = sqlite3.connect(self.db_name)
+        try:
+            return conn.execute(sql).fetchall()
+        finally:
+            conn.close()
+
+    def test_buffered_until_flush(self):
+        """Samples are kept in memory, then written together in one go"""
+        now = datetime.datetime(2025, 6, 1, 12, 0, 0)
+        self.collector.sample(now)
+        self.collector.sample(now + datetime.timedelta(seconds=1))
+        self.assertFalse(os.path.exists(self.db_name))
+
+        components = len(self.collector.components)
+        self.assertEqual(self.collector.flush(), 2 * components + 4)
+        self.assertEqual(self.collector.flushes, 1)
+        self.assertEqual(self.collector.statistics, [])
+
+        self.assertEqual(self.query("SELECT COUNT(*) FROM component")[0][0], components)
+        self.assertEqual(self.query("SELECT COUNT(*) FROM component_statistic")[0][0], 2 * components)
+        self.assertEqual(self.query("SELECT pid, timestamp, cpu_usage, memory_usage, end_of_life FROM process "
+                                    "ORDER BY timestamp, pid")[:2],
+                         [(100, "2025-06-01 12:00:00.000000", 1.5, 20.0, "2025-07-01 12:00:00.000000"),
+                          (200, "2025-06-01 12:00:00.000000", 0.0, 5.25, "2025-07-01 12:00:00.000000")])
+
+        # Nothing left to write.
+        self.assertEqual(self.collector.flush(), 0)
+
+    def test_same_schema(self):
+        """The rows read back like the executable's do"""
+        self.collector.sample()
+        self.collector.flush()
+        device_types = {device["device_type"] for device in db_interface.read_devices()}
+        self.assertTrue({"CPU", "RAM"} <= device_types)
+        usage = self.query("SELECT usage FROM component_statistic")
+        self.assertTrue(all(0 <= value <= 100 for value, in usage))
+
+    def test_failed_flush_kept(self):
+        """A failed write keeps the samples for the next flush"""
+        self.collector.sample()
+        with mock.patch.object(db_interface, "connect", side_effect=sqlite3.OperationalError("locked")):
+            self.assertEqual(self.collector.flush(), 0)
+        self.assertEqual(len(self.collector.statistics), 1)
+        self.assertGreater(self.collector.flush(), 0)
+
+    def test_buffer_cap(self):
+        """A long outage drops the oldest samples instead of growing forever"""
+        with mock.patch.object(psutil_collector, "MAX_BUFFERED_SAMPLES", 3):
+            for _ in range(5):
+                self.collector.sample()
+        self.assertEqual((len(self.collector.statistics), self.collector.dropped), (3, 2))
+
+    def test_run_until_stopped(self):
+        """run() samples on its interval until stopped, and writes everything before returning"""
+        thread = threading.Thread(target=self.collector.run)
+        thread.start()
+        time.sleep(0.3)
+        self.collector.stop()
+        thread.join(5)
+
+        stats = self.collector.stats()
+        self.assertGreaterEqual(stats["samples"], 3)
+        self.assertEqual(stats["buffered"], 0)
+        self.assertEqual(self.query("SELECT COUNT(DISTINCT timestamp) FROM process")[0][0], stats["samples"])
+        self.assertGreaterEqual(stats["cpu_percent"], 0)
+
+
+class PythonCollectorRouteTestCase(unittest.TestCase):
+    """Testcase for starting and stopping the python collector from /metrics"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.environ = mock.patch.dict(os.environ)
+        self.environ.start()
+        db_interface.set_path_config(database=os.path.join(self.tmp_dir, "metrics.db"))
+        self.jobs = mock.patch.object(job_manager, "jobs", job_manager.JobManager())
+        self.jobs.start()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        psutil_collector.stop()
+        for job in job_manager.jobs.list():
+            wait_until(lambda: not job.active, 10)
+        self.jobs.stop()
+        thread = db_interface._BACKUP_THREAD
+        if thread is not None:
+            thread.join(10)
+        db_interface.close_pools()
+        self.environ.stop()
+        db_interface.set_path_config()
+        shutil.rmtree(self.tmp_dir)
+
+    def post(self):
+        return self.client.post("/metrics", json={"years": "0", "months": "1", "weeks": "0", "days": "0",
+                                                  "job": "collect", "collector": "python", "interval": "1"})
+
+    def test_start_and_stop(self):
+        """The toggle starts the python collector as a job, then stops it"""
+        response = self.post()
+        self.assertEqual(response.status_code, 202)
+        job = job_manager.jobs.get(response.get_json()["job_id"])
+
+        wait_until(lambda: psutil_collector.active_collector() is not None)
+        status = self.client.get("/metrics/status").get_json()
+        self.assertEqual((status["running"], status["collector"]), (True, "python"))
+        self.assertEqual(status["stats"]["interval"], 1)
+
+        self.assertEqual(self.post().get_json(), {"message": "Metrics Stopped"})
+        wait_until(lambda: not job.active)
+        self.assertEqual(job.state, job_manager.SUCCEEDED)
+        self.assertIn("Metrics Stopped. Collected", job.output)
+        self.assertFalse(ohm_interface.is_metrics_running())
+
+        # The lifetime the user asked for was used.
+        conn = sqlite3.connect(db_interface.get_database(0))
+        timestamp, end_of_life = conn.execute("SELECT timestamp, end_of_life FROM component_statistic").fetchone()
+        conn.close()
+        self.assertEqual(db_interface.parse_timestamp(end_of_life) - db_interface.parse_timestamp(timestamp),
+                         datetime.timedelta(days=30))
+
+    def test_gather_page(self):
+        """The gather page lets the user pick the collector"""
+        page = self.client.post("/gather").get_data(as_text=True)
+        self.assertIn('id="collector"', page)
+        self.assertIn("Python (psutil)", page)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+import unittest
+import pstats
+import sqlite3
+import shutil
+import tempfile
+import sys
+import os
+
+# Get the path of the directory above the test file and insert it into our path.
+# This is where the web app lives, which we need to import to test.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from metrics_web_server import app
+import db_interface
+import instrumentation
+import response_cache
+
+
+class HistogramTestCase(unittest.TestCase):
+    """Testcase for the rolling histograms"""
+
+    def test_percentiles(self):
+        """Nearest rank percentiles of the values in the window"""
+        histogram = instrumentation.Histogram()
+        for value in range(100, 0, -1):
+            histogram.add(value)
+        summary = histogram.summary()
+        self.assertEqual((summary["p50"], summary["p95"], summary["p99"], summary["max"]), (50, 95, 99, 100))
+        self.assertEqual((summary["count"], summary["mean"]), (100, 50.5))
+
+    def test_window(self):
+        """Only the most recent values count towards the percentiles, the count is all time"""
+        histogram = instrumentation.Histogram(window=10)
+        for value in range(1000):
+            histogram.add(value)
+        summary = histogram.summary()
+        self.assertEqual((summary["p50"], summary["max"], summary["count"]), (994, 999, 1000))
+
+    def test_empty(self):
+        """Nothing recorded yet"""
+        self.assertEqual(instrumentation.Histogram().summary(), {"count": 0})
+
+
+class RequestTimingTestCase(unittest.TestCase):
+    """Testcase for the route, query and template timings"""
+
+    def setUp(self):
+        """Start from nothing recorded and an empty response cache, so every view really runs"""
+        self.client = app.test_client()
+        app.config["TESTING"] = True
+        self.tmp_dir = tempfile.mkdtemp()
+        instrumentation.reset()
+        response_cache.cache.clear()
+
+    def tearDown(self):
+        """Put the settings back and clean up"""
+        instrumentation.configure(server_timing=False, profile_rate=0.0, profile_keep=instrumentation.PROFILE_KEEP)
+        instrumentation.SETTINGS["profile_dir"] = None
+        instrumentation.reset()
+        response_cache.cache.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_route_timings(self):
+        """A json route records its wall time, SQL time, rows and size"""
+        response = self.client.get("/api/metrics", query_string={"debug": 1, "serial_number": "BFEBFBFF000806F8"})
+        self.assertEqual(response.status_code, 200)
+
+        route = instrumentation.stats()["routes"]["GET /api/metrics"]
+        self.assertEqual(route["wall_ms"]["count"], 1)
+        self.assertGreater(route["sql_ms"]["max"], 0)
+        self.assertEqual(route["sql_rows"]["max"], len(response.get_json()["points"]))
+        self.assertEqual(route["bytes"]["max"], len(response.get_data()))
+        self.assertEqual(route["template_ms"]["max"], 0)
+
+        query = instrumentation.stats()["queries"]["read_metric_range"]
+        self.assertEqual(query["ms"]["count"], 1)
+
+    def test_template_timings(self):
+        """A page records how long its template took"""
+        self.client.post("/user_report", data={"debug": 1})
+        route = instrumentation.stats()["routes"]["POST /user_report"]
+        self.assertGreater(route["template_ms"]["max"], 0)
+        self.assertGreater(route["bytes"]["max"], 0)
+        self.assertIn("read_devices", instrumentation.stats()["queries"])
+
+    def test_nested_queries(self):
+        """A query that calls another query is only counted once towards the request"""
+        with app.test_request_context("/"):
+            app.preprocess_request()
+            db_interface.read_metrics(1, "2025-01-01", "2026-01-01")
+            timings = instrumentation._CURRENT.get()
+            self.assertEqual(timings.queries, 1)
+            app.do_teardown_request()
+
+        # Both are still in the per query stats.
+        queries = instrumentation.stats()["queries"]
+        self.assertEqual(queries["read_metrics"]["rows"], queries["read_metrics_window"]["rows"])
+
+    def test_queries_outside_requests(self):
+        """Background jobs still record their queries"""
+        db_interface.read_processes(1)
+        self.assertEqual(instrumentation.stats()["queries"]["read_processes"]["ms"]["count"], 1)
+        self.assertIsNone(instrumentation._CURRENT.get())
+
+    def test_server_timing(self):
+        """Server-Timing is only sent when it's turned on"""
+        self.assertNotIn("Server-Timing", self.client.post("/proc_table", data={"debug": 1}).headers)
+
+        instrumentation.configure(server_timing=True)
+        header = self.client.post("/proc_table", data={"debug": 2}).headers["Server-Timing"]
+        self.assertIn("sql;dur=", header)
+        self.assertIn('desc="1 queries, 1 rows"', header)
+        self.assertIn("tpl;dur=", header)
+        self.assertIn("app;dur=", header)
+
+    def test_stats_endpoint(self):
+        """/debug/stats has the percentiles for each route"""
+        self.client.get("/")
+        self.client.get("/")
+        stats = self.client.get("/debug/stats").get_json()
+        self.assertEqual(stats["routes"]["GET /"]["wall_ms"]["count"], 2)
+        self.assertEqual(set(stats["routes"]["GET /"]["wall_ms"]), {"count", "mean", "p50", "p95", "p99", "max"})
+        self.assertEqual(stats["window"], instrumentation.WINDOW)
+
+    def test_failed_request(self):
+        """A view that raises still cleans up after itself"""
+        with self.assertRaises(sqlite3.DatabaseError):
+            self.client.post("/user_report", data={"debug": 6})
+        self.assertIsNone(instrumentation._CURRENT.get())
+
+    def test_profiles(self):
+        """Profiling keeps the slowest profile_keep profiles and deletes the rest"""
+        instrumentation.configure(profile_rate=1.0, profile_dir=self.tmp_dir, profile_keep=2)
+        for _ in range(4):
+            self.client.post("/user_report", data={"debug": 1})
+
+        profiles = instrumentation.stats()["profiles"]
+        self.assertEqual(len(profiles), 2)
+        self.assertGreaterEqual(profiles[0]["ms"], profiles[1]["ms"])
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), sorted(os.path.basename(p["file"]) for p in profiles))
+
+        # They're ordinary cProfile dumps.
+        stats = pstats.Stats(profiles[0]["file"])
+        self.assertTrue(any(function[2] == "user_report" for function in stats.stats))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+import unittest
+from unittest import mock
+import gzip
+import sqlite3
+import shutil
+import tempfile
+import sys
+import os
+import zlib
+
+# Get the path of the directory above the test file and insert it into our path.
+# This is where the web app lives, which we need to import to test.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from metrics_web_server import app
+import db_interface
+import response_cache
+import rollups
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    """Testcase for the LRU cache on its own"""
+
+    def test_lru_eviction(self):
+        """The least recently used responses are dropped to stay under the memory cap"""
+        cache = response_cache.ResponseCache(max_bytes=30, max_entry_bytes=20)
+        cache.put("a", b"a" * 10, "text/html")
+        cache.put("b", b"b" * 10, "text/html")
+        cache.get("a")
+        cache.put("c", b"c" * 15, "text/html")
+
+        # b was used least recently, so it went.
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("a"))
+        self.assertIsNotNone(cache.get("c"))
+
+        # Too big to be worth caching.
+        cache.put("d", b"d" * 25, "text/html")
+        self.assertIsNone(cache.get("d"))
+
+        stats = cache.stats()
+        self.assertEqual((stats["entries"], stats["bytes"], stats["evictions"]), (2, 25, 1))
+        self.assertEqual((stats["hits"], stats["misses"]), (3, 2))
+
+    def test_strong_etag(self):
+        """The same body always gets the same ETag, a different body a different one"""
+        cache = response_cache.ResponseCache()
+        self.assertEqual(cache.put("a", b"body", "text/html"), cache.put("b", b"body", "text/html"))
+        self.assertNotEqual(cache.put("a", b"body", "text/html"), cache.put("a", b"other", "text/html"))
+
+
+class CachedRoutesTestCase(unittest.TestCase):
+    """Testcase for the cached routes"""
+
+    def setUp(self):
+        """Each test gets a small database, a fresh cache and a test client"""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_name = os.path.join(self.tmp_dir, "metrics.db")
+        self.conn = sqlite3.connect(self.db_name)
+        db_interface.create_mtg_database(self.conn)
+        db_interface.migrate_database(self.conn)
+        self.conn.execute("INSERT INTO component VALUES ('test_cpu', 'CPU', 0, 0, 0)")
+        self.insert(1)
+
+        self.environ = mock.patch.dict(os.environ)
+        self.environ.start()
+        db_interface.set_path_config(database=self.db_name)
+        self.cache = mock.patch.object(response_cache, "cache", response_cache.ResponseCache())
+        self.cache.start()
+        self.client = app.test_client()
+        self.query = {"serial_number": "test_cpu", "column": "usage"}
+
+        # Open the pool and bring the rollups up to date, so the first request doesn't write anything.
+        db_interface.read_metric_range("test_cpu", "usage")
+
+    def tearDown(self):
+        """Close everything and clean up"""
+        self.cache.stop()
+        rollups._LAST_REFRESH.clear()
+        response_cache.close_watchers()
+        db_interface.close_pools()
+        self.environ.stop()
+        db_interface.set_path_config()
+        self.conn.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def insert(self, second):
+        """Adds a row from another connection, like the collector does"""
+        self.conn.execute("INSERT INTO component_statistic VALUES "
+                          "('test_cpu', ?, 'Active', 40, ?, 10, 0, 0, 0, '2030')",
+                          (f"2025-01-01 00:00:{second:02d}.000000", second))
+        self.conn.commit()
+
+    def test_repeat_request_is_cached(self):
+        """The second identical request is answered from the cache"""
+        first = self.client.get("/api/metrics", query_string=self.query)
+        with mock.patch.object(db_interface, "read_metric_range", side_effect=AssertionError("Not cached")):
+            second = self.client.get("/api/metrics", query_string=self.query)
+
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(first.headers["ETag"], second.headers["ETag"])
+        self.assertEqual(response_cache.cache.stats()["hits"], 1)
+
+        # Different parameters are a different response.
+        self.client.get("/api/metrics", query_string=dict(self.query, column="temperature"))
+        self.assertEqual(response_cache.cache.stats()["misses"], 2)
+
+    def test_not_modified(self):
+        """A browser that already has the response gets a 304, without the database being read"""
+        etag = self.client.get("/api/metrics", query_string=self.query).headers["ETag"]
+        with mock.patch.object(db_interface, "read_metric_range", side_effect=AssertionError("Not cached")):
+            response = self.client.get("/api/metrics", query_string=self.query, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b"")
+        self.assertEqual(response_cache.cache.stats()["not_modified"], 1)
+
+    def test_new_data_invalidates(self):
+        """A write to the database means the response is worked out again"""
+        first = self.client.get("/api/metrics", query_string=self.query)
+        self.insert(2)
+        second = self.client.get("/api/metrics", query_string=self.query, headers={"If-None-Match": first.headers["ETag"]})
+
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(len(second.get_json()["points"]), 2)
+        self.assertNotEqual(first.headers["ETag"], second.headers["ETag"])
+
+    def test_compressed(self):
+        """Browsers that accept gzip or deflate get it, with a weak ETag that still gets a 304"""
+        for second in range(2, 60):
+            self.insert(second)
+        identity = self.client.get("/api/metrics", query_string=self.query)
+        self.assertNotIn("Content-Encoding", identity.headers)
+        self.assertGreater(len(identity.data), response_cache.MIN_COMPRESS_BYTES)
+
+        for encoding, decompress in [("gzip", gzip.decompress), ("deflate", zlib.decompress)]:
+            response = self.client.get("/api/metrics", query_string=self.query, headers={"Accept-Encoding": encoding})
+            self.assertEqual(response.headers["Content-Encoding"], encoding)
+            self.assertIn("Accept-Encoding", response.headers["Vary"])
+            self.assertLess(len(response.data), len(identity.data))
+            self.assertEqual(decompress(response.data), identity.data)
+            self.assertEqual(response.headers["ETag"], "W/" + identity.headers["ETag"])
+
+        # The compressed body is cached with the response, so it isn't compressed again.
+        with mock.patch.object(response_cache, "compress", side_effect=AssertionError("Not cached")):
+            again = self.client.get("/api/metrics", query_string=self.query, headers={"Accept-Encoding": "gzip"})
+            self.assertEqual(again.headers["Content-Encoding"], "gzip")
+
+            # Either ETag matches either encoding.
+            for etag in [identity.headers["ETag"], again.headers["ETag"]]:
+                response = self.client.get("/api/metrics", query_string=self.query,
+                                           headers={"Accept-Encoding": "gzip, deflate", "If-None-Match": etag})
+                self.assertEqual(response.status_code, 304)
+
+    def test_small_not_compressed(self):
+        """A small response isn't worth compressing"""
+        response = self.client.get("/api/metrics", query_string=self.query, headers={"Accept-Encoding": "gzip"})
+        self.assertLess(len(response.data), response_cache.MIN_COMPRESS_BYTES)
+        self.assertNotIn("Content-Encoding", response.headers)
+        self.assertFalse(response.headers["ETag"].startswith("W/"))
+
+    def test_pages_cached(self):
+        """The report and process pages are cached too"""
+        for route in ["/user_report", "/proc_table"]:
+            first = self.client.post(route)
+            second = self.client.post(route)
+            self.assertEqual(first.data, second.data)
+        self.assertEqual(response_cache.cache.stats()["hits"], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
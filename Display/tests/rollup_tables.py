@@ -0,0 +1,186 @@
+import unittest
+from unittest import mock
+import datetime
+import sqlite3
+import shutil
+import tempfile
+import sys
+import os
+
+# Get the path of the directory above the test file and insert it into our path.
+# This is where db_interface and rollups live, which we need to import to test.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import db_interface
+import rollups
+
+START = datetime.datetime(2025, 1, 1)
+
+
+def insert_samples(conn, first, count, serial="roll_cpu"):
+    """Inserts a sample every 10 minutes. The usage goes 0, 1, 2, ... so the sums are easy to check."""
+    rows = []
+    for i in range(first, first + count):
+        timestamp = (START + datetime.timedelta(minutes=10 * i)).strftime("%Y-%m-%d %H:%M:%S.%f")
+        rows.append((serial, timestamp, "Active", 50.0, float(i), 10.0, 0, 0, 0, "2030-01-01 00:00:00.000000"))
+    conn.executemany("INSERT INTO component_statistic VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    conn.commit()
+
+
+def from_raw(conn, bucket_format):
+    """The count and usage sum of each bucket, worked out straight from the raw rows."""
+    return conn.execute(f"""SELECT strftime('{bucket_format}', timestamp), COUNT(*), SUM(usage)
+                            FROM component_statistic GROUP BY 1 ORDER BY 1""").fetchall()
+
+
+class RollupTestCase(unittest.TestCase):
+    """Testcase for the hourly and daily rollups"""
+
+    def setUp(self):
+        """Each test gets a migrated database with 3 days of samples, and db_interface pointed at it"""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_name = os.path.join(self.tmp_dir, "metrics.db")
+        self.conn = sqlite3.connect(self.db_name)
+        db_interface.create_mtg_database(self.conn)
+        db_interface.migrate_database(self.conn)
+        self.conn.execute("INSERT INTO component VALUES ('roll_cpu', 'CPU', 0, 0, 0)")
+        insert_samples(self.conn, 0, 6 * 24 * 3)
+
+        self.environ = mock.patch.dict(os.environ)
+        self.environ.start()
+        db_interface.set_path_config(database=self.db_name)
+
+    def tearDown(self):
+        """Close everything and clean up"""
+        db_interface.close_pools()
+        self.environ.stop()
+        db_interface.set_path_config()
+        rollups._LAST_REFRESH.clear()
+        self.conn.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_hourly_matches_raw(self):
+        """Each hour should hold the count, min, max and sum of its 6 raw samples"""
+        rollups.refresh_rollups(self.conn)
+        rows = self.conn.execute(f"""SELECT sample_count, usage_min, usage_max, usage_sum
+                                     FROM {rollups.HOURLY} ORDER BY bucket""").fetchall()
+        self.assertEqual(len(rows), 24 * 3)
+        self.assertEqual(rows[1], (6, 6.0, 11.0, 51.0))
+
+        # The daily rollup is built from the hourly one.
+        day = self.conn.execute(f"SELECT sample_count, usage_sum FROM {rollups.DAILY} ORDER BY bucket").fetchone()
+        self.assertEqual(day, (144, sum(range(144))))
+
+    def test_incremental_refresh(self):
+        """Only the new rows are rolled up, and a half full hour is finished off correctly"""
+        self.assertEqual(rollups.refresh_rollups(self.conn), 6 * 24 * 3)
+        self.assertEqual(rollups.refresh_rollups(self.conn), 0)
+
+        # Add 9 more samples. The first 6 fill a new hour, the last 3 start the one after.
+        insert_samples(self.conn, 6 * 24 * 3, 9)
+        self.assertEqual(rollups.refresh_rollups(self.conn), 9)
+        last = self.conn.execute(f"SELECT sample_count FROM {rollups.HOURLY} ORDER BY bucket DESC").fetchone()
+        self.assertEqual(last[0], 3)
+
+        # Add the rest of that hour and it should be recomputed, not double counted.
+        insert_samples(self.conn, 6 * 24 * 3 + 9, 3)
+        rollups.refresh_rollups(self.conn)
+        last = self.conn.execute(f"SELECT sample_count FROM {rollups.HOURLY} ORDER BY bucket DESC").fetchone()
+        self.assertEqual(last[0], 6)
+
+    def test_pruned_rows_drop_buckets(self):
+        """Once the raw rows of a day are pruned, its rollups go too"""
+        rollups.refresh_rollups(self.conn)
+        self.conn.execute("DELETE FROM component_statistic WHERE timestamp < '2025-01-02'")
+        self.conn.commit()
+        rollups.refresh_rollups(self.conn)
+        first_day = self.conn.execute(f"SELECT MIN(bucket) FROM {rollups.DAILY}").fetchone()[0]
+        self.assertEqual(first_day, "2025-01-02 00:00:00")
+
+    def test_prune_into_a_bucket(self):
+        """A prune that cuts into an hour and a day has them recomputed from the rows that are left"""
+        rollups.refresh_rollups(self.conn)
+        # Leaves the last 2 samples of the 01:00 hour on the 2nd (usage 154 and 155).
+        self.conn.execute("DELETE FROM component_statistic WHERE timestamp < '2025-01-02 01:40'")
+        self.conn.commit()
+        self.assertEqual(rollups.refresh_rollups(self.conn), 0)
+
+        hour = self.conn.execute(f"""SELECT bucket, sample_count, usage_sum FROM {rollups.HOURLY}
+                                     ORDER BY bucket""").fetchone()
+        self.assertEqual(hour, ("2025-01-02 01:00:00", 2, 154.0 + 155.0))
+        day = self.conn.execute(f"""SELECT bucket, sample_count, usage_sum FROM {rollups.DAILY}
+                                    ORDER BY bucket""").fetchone()
+        self.assertEqual(day, ("2025-01-02 00:00:00", 2 + 6 * 22, sum(range(154, 288))))
+
+        # Once every raw row has gone, so have the rollups.
+        self.conn.execute("DELETE FROM component_statistic")
+        self.conn.commit()
+        rollups.refresh_rollups(self.conn)
+        for table in [rollups.HOURLY, rollups.DAILY]:
+            self.assertEqual(self.conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0], 0)
+
+    def assertMatchesRaw(self):
+        for table, bucket_format in rollups.BUCKET_FORMATS.items():
+            rolled_up = self.conn.execute(f"SELECT bucket, sample_count, usage_sum FROM {table} ORDER BY bucket")
+            self.assertEqual(rolled_up.fetchall(), from_raw(self.conn, bucket_format))
+
+    def test_prune_middle_and_end(self):
+        """Deleting rows from the middle and end of the table recomputes their buckets, and new rows
+        that get the deleted rows' rowids are still rolled up"""
+        rollups.refresh_rollups(self.conn)
+        with self.conn:
+            # All of one hour, part of another, and the last 2 hours (like an end_of_life prune).
+            for where in ["timestamp >= '2025-01-02 03:00' AND timestamp < '2025-01-02 04:00'",
+                          "timestamp >= '2025-01-02 05:20' AND timestamp < '2025-01-02 05:40'",
+                          "timestamp >= '2025-01-03 22:00'"]:
+                self.assertGreater(rollups.COMPONENT_ROLLUPS.delete_rows(self.conn, where), 0)
+        self.assertMatchesRaw()
+
+        insert_samples(self.conn, 6 * 24 * 3, 9)
+        self.assertEqual(rollups.refresh_rollups(self.conn), 9)
+        self.assertMatchesRaw()
+
+    def test_newest_rows_deleted_elsewhere(self):
+        """If something else deletes the newest rows, the rollups are rebuilt"""
+        rollups.refresh_rollups(self.conn)
+        self.conn.execute("DELETE FROM component_statistic WHERE timestamp >= '2025-01-03 20:00'")
+        self.conn.commit()
+        rollups.refresh_rollups(self.conn)
+        self.assertMatchesRaw()
+
+        # The rowids are used again, and the new rows still get rolled up.
+        insert_samples(self.conn, 6 * 24 * 3, 6)
+        rollups.refresh_rollups(self.conn)
+        self.assertMatchesRaw()
+
+    def test_chunked_refresh(self):
+        """The first refresh can be done a chunk at a time, each in its own transaction"""
+        statements = []
+        self.conn.set_trace_callback(statements.append)
+        self.assertEqual(rollups.refresh_rollups(self.conn, chunk_rows=100), 6 * 24 * 3)
+        self.conn.set_trace_callback(None)
+        self.assertEqual(statements.count("BEGIN IMMEDIATE"), 5)
+        self.assertMatchesRaw()
+
+    def test_resolution_picked_by_span(self):
+        """Short windows read the raw rows, longer ones the rollups"""
+        one_day = db_interface.read_metric_range("roll_cpu", "usage", "2025-01-01T00:00", "2025-01-01T23:59", 0)
+        self.assertEqual(one_day["resolution"], "raw")
+        self.assertEqual(len(one_day["points"]), 144)
+
+        # The whole 3 days is more than the raw limit, so it comes from the hourly rollup.
+        everything = db_interface.read_metric_range("roll_cpu", "usage", max_points=0)
+        self.assertEqual(everything["resolution"], "hourly")
+        self.assertEqual(len(everything["points"]), 24 * 3)
+        self.assertEqual(everything["points"][1], ["2025-01-01 01:00:00", 8.5])
+
+        # read_metrics() with a window takes the same path.
+        datasets = db_interface.read_metrics(0, "2025-01-01", "2025-01-03 23:59")
+        self.assertEqual(len(datasets["roll_cpu (CPU)"]), 24 * 3)
+
+        with mock.patch.object(rollups, "HOURLY_MAX_SPAN", datetime.timedelta(days=1)):
+            self.assertEqual(db_interface.read_metric_range("roll_cpu", "usage")["resolution"], "daily")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,260 @@
+import unittest
+from unittest import mock
+import datetime
+import glob
+import sqlite3
+import shutil
+import tempfile
+import sys
+import os
+
+# Get the path of the directory above the test file and insert it into our path.
+# This is where db_interface lives, which we need to import to test.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import db_interface
+import live_feed
+import psutil_collector
+import response_cache
+import shards
+from storage_layout import read_everything
+
+LIFETIME = datetime.timedelta(days=30)
+
+
+class FixedReader:
+    """Stands in for the process reader, so the tests know exactly what processes there are."""
+
+    def read(self):
+        return [(100, 1.5, 20.0), (200, 0.0, 5.25)]
+
+
+def statistic(serial_number, timestamp):
+    """A component_statistic row, like the collector writes."""
+    return (serial_number, timestamp, "Active", 40.0, 5.0, 10.0, 0.0, 0.0, 0.0, "2030-01-01 00:00:00.000000")
+
+
+class SplitTestCase(unittest.TestCase):
+    """Testcase for moving a database into daily shards and reading it back"""
+
+    def setUp(self):
+        """A copy of a sample database, so the real one is never touched. It runs from one midnight to the next"""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_name = os.path.join(self.tmp_dir, "metrics.db")
+        shutil.copyfile(os.path.join(os.path.dirname(__file__), "sample_dbs", "normal.db"), self.db_name)
+        self.environ = mock.patch.dict(os.environ)
+        self.environ.start()
+
+    def tearDown(self):
+        """Close everything and clean up"""
+        live_feed._FEEDS.clear()
+        db_interface.close_pools()
+        self.environ.stop()
+        db_interface.set_path_config()
+        shutil.rmtree(self.tmp_dir)
+
+    def query(self, db, sql):
+        conn = sqlite3.connect(db)
+        try:
+            return conn.execute(sql).fetchall()
+        finally:
+            conn.close()
+
+    def split(self):
+        db_interface.set_path_config(database=self.db_name)
+        moved = shards.split(self.db_name, "day", chunk_rows=40)
+        db_interface.close_pools()
+        return moved
+
+    def test_split(self):
+        """Every row moves into the shard for its day, and metrics.db keeps the components"""
+        self.assertEqual(self.split(), {"component_statistic": 100, "process": 225})
+        names = [os.path.basename(shard.path) for shard in shards.list_shards(self.db_name)]
+        self.assertEqual(names, ["2025-01-01.db", "2025-01-02.db"])
+        self.assertEqual(self.query(self.db_name, "SELECT COUNT(*) FROM component_statistic"), [(0,)])
+        self.assertEqual(self.query(self.db_name, "SELECT COUNT(*) FROM component"), [(4,)])
+        self.assertEqual(sum(self.query(shard.path, "SELECT COUNT(*) FROM process")[0][0]
+                             for shard in shards.list_shards(self.db_name)), 225)
+
+        # Running it again has nothing left to move.
+        self.assertEqual(self.split(), {"component_statistic": 0, "process": 0})
+
+    def test_reads_match(self):
+        """The pages show the same thing from the shards as from the one file"""
+        before = read_everything(self.db_name)
+        self.split()
+        after = read_everything(self.db_name)
+        for old, new in zip(before, after):
+            self.assertEqual(old, new)
+
+    def test_reads_match_in_groups(self):
+        """More shards than can be attached at once are read a group at a time"""
+        before = read_everything(self.db_name)
+        self.split()
+        with mock.patch.object(shards, "attach_limit", return_value=1):
+            after = read_everything(self.db_name)
+        for old, new in zip(before, after):
+            self.assertEqual(old, new)
+
+    def test_window_only_attaches_its_shards(self):
+        """A window only looks at the shards it overlaps"""
+        self.split()
+        db_interface.set_path_config(database=self.db_name)
+        for start, end, expected in [("2025-01-01T10:00", "2025-01-01T12:00", ["2025-01-01.db"]),
+                                     ("2025-01-01T10:00", None, ["2025-01-01.db", "2025-01-02.db"]),
+                                     ("2025-01-03", None, [])]:
+            names = [os.path.basename(shard.path) for shard in db_interface.get_shards(0, start, end)]
+            self.assertEqual(names, expected)
+
+    def test_rows_left_in_metrics_db(self):
+        """Rows the executable writes to metrics.db are read along with the shards"""
+        self.split()
+        conn = sqlite3.connect(self.db_name)
+        conn.execute("INSERT INTO component_statistic VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                     statistic("test_cpu", "2025-01-06 00:00:00.0000000"))
+        conn.commit()
+        conn.close()
+
+        db_interface.set_path_config(database=self.db_name)
+        devices = {device["serial_number"]: device for device in db_interface.read_devices()}
+        self.assertEqual(devices["test_cpu"]["last"], "2025-01-06 00:00:00.0000000")
+        self.assertEqual(len(db_interface.read_metrics()["test_cpu (CPU)"]), 26)
+
+    def test_prune_drops_shards(self):
+        """Shards older than the cutoff are deleted whole, but their backups are kept"""
+        self.split()
+        db_interface.set_path_config(database=self.db_name)
+        first, last = [shard.path for shard in shards.list_shards(self.db_name)]
+        open(first + ".2025_01_01_00", "w").close()
+
+        result = db_interface.prune_database(datetime.timedelta(hours=12), now=datetime.datetime(2025, 1, 2, 12))
+        self.assertEqual(result["shards_dropped"], ["2025-01-01.db"])
+        self.assertEqual(glob.glob(first + "*"), [first + ".2025_01_01_00"])
+        self.assertEqual(self.query(last, "SELECT COUNT(*) FROM component_statistic"), [(4,)])
+
+        # The rows of the shard the cutoff falls in are deleted a batch at a time.
+        result = db_interface.prune_database(datetime.timedelta(hours=1), now=datetime.datetime(2025, 1, 2, 12))
+        self.assertEqual(result["shards_dropped"], [])
+        self.assertEqual(result["deleted"]["component_statistic"], 4)
+        self.assertEqual(result["deleted"]["component"], 4)
+        self.assertEqual(self.query(last, "SELECT COUNT(*) FROM component_statistic"), [(0,)])
+
+    def test_backup_skips_unchanged_shards(self):
+        """A backup copies metrics.db and the shards written to since their last backup"""
+        self.split()
+        db_interface.set_path_config(database=self.db_name)
+
+        def backup(suffix):
+            changed = [shard for shard in db_interface.get_shards() if shards.changed_since_backup(shard)]
+            self.assertTrue(db_interface.run_backup(self.db_name, self.db_name + suffix,
+                                                    glob.glob(self.db_name + ".*"), changed))
+            return db_interface.backup_stats()["shards"]
+
+        self.assertEqual(backup(".2025_01_05_00"), 2)
+        self.assertEqual(backup(".2025_01_05_06"), 0)
+
+        # The collector writes to the last shard, which is the only one copied.
+        last = shards.list_shards(self.db_name)[-1]
+        shards.write_rows(self.db_name, [statistic("test_cpu", "2025-01-02 23:00:00.0000000")], [], "day")
+        os.utime(last.path, (os.path.getmtime(last.path) + 1,) * 2)
+        self.assertEqual(backup(".2025_01_05_12"), 1)
+        self.assertEqual(glob.glob(last.path + ".*"), [last.path + ".2025_01_05_12"])
+        self.assertEqual(len(glob.glob(shards.list_shards(self.db_name)[0].path + ".*")), 1)
+
+
+class ShardedCollectorTestCase(unittest.TestCase):
+    """Testcase for writing to a new sharded database"""
+
+    def setUp(self):
+        """An empty database in a temporary directory, sharded by month"""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_name = os.path.join(self.tmp_dir, "metrics.db")
+        self.environ = mock.patch.dict(os.environ, {shards.SHARD_ENV: "month"})
+        self.environ.start()
+        db_interface.set_path_config(database=self.db_name)
+
+    def tearDown(self):
+        """Close everything and clean up"""
+        live_feed._FEEDS.clear()
+        db_interface.close_pools()
+        self.environ.stop()
+        db_interface.set_path_config()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_collector(self):
+        """The collector writes the components to metrics.db and the rows to this month's shard"""
+        collector = psutil_collector.Collector(LIFETIME, interval=0.05, reader=FixedReader())
+        collector.sample()
+        self.assertGreater(collector.flush(), 0)
+
+        key = shards.period_key(datetime.datetime.now())
+        self.assertEqual([shard.path for shard in shards.list_shards(self.db_name)],
+                         [shards.shard_path(self.db_name, key)])
+        conn = sqlite3.connect(self.db_name)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM component_statistic").fetchone()[0], 0)
+        self.assertGreater(conn.execute("SELECT COUNT(*) FROM component").fetchone()[0], 0)
+        conn.close()
+        self.assertEqual(db_interface.count_processes(), 2)
+
+        # Stays sharded without the environment variable, the directory is there now.
+        db_interface.close_pools()
+        del os.environ[shards.SHARD_ENV]
+        self.assertTrue(db_interface.get_pool().sharded)
+
+    def test_rows_go_to_their_shards(self):
+        """A flush that runs over the end of a month writes to both months' shards"""
+        db_interface.check_db()
+        written = shards.write_rows(self.db_name, [statistic("cpu", "2025-06-30 23:59:59.0000000"),
+                                                   statistic("cpu", "2025-07-01 00:00:29.0000000")],
+                                    [(1, "2025-07-01 00:00:29.0000000", 1.0, 1.0, "2030")])
+        self.assertEqual(written, ["2025-06", "2025-07"])
+        self.assertEqual(shards.period_bounds("2025-12"), (datetime.datetime(2025, 12, 1),
+                                                           datetime.datetime(2026, 1, 1)))
+        self.assertEqual(shards.period_bounds("2025-W01"), (datetime.datetime(2024, 12, 30),
+                                                            datetime.datetime(2025, 1, 6)))
+
+    def test_long_window(self):
+        """A window too long for the raw rows reads each shard's rollups"""
+        db_interface.check_db()
+        hours = [datetime.datetime(2025, 6, 28) + datetime.timedelta(hours=hour) for hour in range(96)]
+        conn = sqlite3.connect(self.db_name)
+        conn.execute("INSERT INTO component VALUES ('cpu', 'CPU', 0, 0, 0)")
+        conn.commit()
+        conn.close()
+        shards.write_rows(self.db_name, [statistic("cpu", f"{hour:%Y-%m-%d %H}:00:00.0000000")[:4] + (index,) +
+                                         statistic("cpu", "")[5:] for index, hour in enumerate(hours)], [], "day")
+        self.assertEqual(len(shards.list_shards(self.db_name)), 4)
+
+        series = db_interface.read_metric_range("cpu", "usage")
+        self.assertEqual(series["resolution"], "hourly")
+        self.assertEqual(series["points"], [[f"{hour:%Y-%m-%d %H}:00:00", float(index)]
+                                            for index, hour in enumerate(hours)])
+
+    def test_live_feed(self):
+        """The live feed's ids keep going up from one shard to the next"""
+        feed = live_feed.LiveFeed(0, interval=3600)
+        db_interface.check_db()
+        shards.write_rows(self.db_name, [statistic("cpu", "2025-06-30 23:59:59.0000000")], [])
+        feed.subscribe()
+        last_id = feed.last_rowid
+
+        shards.write_rows(self.db_name, [statistic("cpu", "2025-06-30 23:59:59.5000000"),
+                                         statistic("cpu", "2025-07-01 00:00:29.0000000")], [])
+        rows = feed.read_rows(last_id)
+        self.assertEqual([row["timestamp"] for row in rows], ["2025-06-30 23:59:59.5000000",
+                                                              "2025-07-01 00:00:29.0000000"])
+        self.assertLess(last_id, rows[0]["rowid"])
+        self.assertLess(rows[0]["rowid"], rows[1]["rowid"])
+        self.assertEqual(feed.read_rows(rows[-1]["rowid"]), [])
+
+    def test_cache_sees_shard_writes(self):
+        """A write to a shard changes the database version, so cached pages aren't served"""
+        db_interface.check_db()
+        shards.write_rows(self.db_name, [statistic("cpu", "2025-06-30 23:59:59.0000000")], [])
+        before = response_cache.database_version(self.db_name)
+        shards.write_rows(self.db_name, [statistic("cpu", "2025-06-30 23:59:59.5000000")], [])
+        self.assertNotEqual(response_cache.database_version(self.db_name), before)
+
+
+if __name__ == '__main__':
+    unittest.main()
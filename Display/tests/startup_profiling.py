@@ -0,0 +1,101 @@
+import unittest
+from unittest import mock
+import contextlib
+import io
+import shutil
+import subprocess
+import tempfile
+import sys
+import os
+
+# Get the path of the directory above the test file and insert it into our path.
+# This is where startup_profile lives, which we need to import to test.
+DISPLAY_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, DISPLAY_DIR)
+
+from flask import Flask
+import startup_profile
+
+
+class ImportProfilerTestCase(unittest.TestCase):
+    """Testcase for timing the imports"""
+
+    def setUp(self):
+        """Two new modules, one importing the other, so they haven't been imported yet"""
+        self.tmp_dir = tempfile.mkdtemp()
+        with open(os.path.join(self.tmp_dir, "mtg_outer.py"), "w") as file:
+            file.write("import time\nimport mtg_inner\ntime.sleep(0.02)\n")
+        with open(os.path.join(self.tmp_dir, "mtg_inner.py"), "w") as file:
+            file.write("import time\ntime.sleep(0.03)\n")
+        sys.path.insert(0, self.tmp_dir)
+
+    def tearDown(self):
+        sys.path.remove(self.tmp_dir)
+        for name in ["mtg_outer", "mtg_inner"]:
+            sys.modules.pop(name, None)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_nested_times(self):
+        """Each module gets its own time and its total, with what it imported inside the total"""
+        profiler = startup_profile.ImportProfiler()
+        profiler.start()
+        try:
+            import mtg_outer
+            # Already loaded, so not timed again.
+            import mtg_outer
+        finally:
+            profiler.stop()
+
+        imports = {name: (depth, own, total) for depth, name, own, total in profiler.imports}
+        self.assertEqual(sorted(imports), ["mtg_inner", "mtg_outer"])
+        self.assertEqual((imports["mtg_outer"][0], imports["mtg_inner"][0]), (0, 1))
+        self.assertGreaterEqual(imports["mtg_inner"][1], 0.03)
+        self.assertGreaterEqual(imports["mtg_outer"][1], 0.02)
+        self.assertLess(imports["mtg_outer"][1], imports["mtg_outer"][2] - 0.025)
+        self.assertGreaterEqual(imports["mtg_outer"][2], 0.05)
+
+    def test_requested(self):
+        """The profile is asked for with the flag or the environment variable"""
+        with mock.patch.dict(os.environ, {startup_profile.PROFILE_ENV: ""}):
+            self.assertFalse(startup_profile.requested(["metrics_web_server.py"]))
+            self.assertTrue(startup_profile.requested(["metrics_web_server.py", startup_profile.PROFILE_FLAG]))
+        with mock.patch.dict(os.environ, {startup_profile.PROFILE_ENV: "1"}):
+            self.assertTrue(startup_profile.requested(["metrics_web_server.py"]))
+        with mock.patch.dict(os.environ, {startup_profile.PROFILE_ENV: "0"}):
+            self.assertFalse(startup_profile.requested(["metrics_web_server.py"]))
+
+    def test_report_after_first_response(self):
+        """The report is printed once, after the first response"""
+        app = Flask(__name__)
+        app.route("/")(lambda: "hello")
+        with mock.patch.object(startup_profile, "_profiler", startup_profile.ImportProfiler()), \
+                mock.patch.object(startup_profile, "_PHASES", []), \
+                mock.patch.object(startup_profile, "_reported", startup_profile.threading.Lock()):
+            startup_profile.mark("imports")
+            startup_profile.watch(app)
+            output = io.StringIO()
+            with contextlib.redirect_stderr(output):
+                client = app.test_client()
+                client.get("/")
+                client.get("/")
+            self.assertEqual([phase for phase, _ in startup_profile._PHASES], ["imports", "first response"])
+
+        self.assertEqual(output.getvalue().count("Start up profile"), 1)
+        self.assertIn("first response", output.getvalue())
+
+
+class ColdStartTestCase(unittest.TestCase):
+    """Testcase for what the web server imports before it can answer"""
+
+    def test_slow_modules_deferred(self):
+        """psutil, numpy and the process pool aren't imported until a page needs them"""
+        code = ("import sys, metrics_web_server; "
+                "print(' '.join(sorted(m for m in ('psutil', 'numpy', 'multiprocessing', 'waitress', "
+                "'webbrowser', 'ohm_interface', 'psutil_collector') if m in sys.modules)))")
+        output = subprocess.run([sys.executable, "-c", code], cwd=DISPLAY_DIR, capture_output=True, text=True,
+                                check=True).stdout
+        self.assertEqual(output.strip(), "")
+
+
+if __name__ == '__main__':
+    unittest.main()
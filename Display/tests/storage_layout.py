@@ -0,0 +1,315 @@
+import unittest
+from unittest import mock
+import datetime
+import glob
+import sqlite3
+import shutil
+import tempfile
+import sys
+import os
+
+# Get the path of the directory above the test file and insert it into our path.
+# This is where db_interface lives, which we need to import to test.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import db_interface
+import live_feed
+import psutil_collector
+import schema_v2
+
+NOW = datetime.datetime(2025, 6, 1, 12, 0, 0)
+
+
+def stamp(days_ago):
+    """A timestamp the given number of days before NOW, stored the way the collector stores it."""
+    return (NOW - datetime.timedelta(days=days_ago)).strftime("%Y-%m-%d %H:%M:%S.%f")
+
+
+def read_everything(db):
+    """What the pages would show from a database, with the timestamps cut to the millisecond."""
+    db_interface.close_pools()
+    db_interface.set_path_config(database=db)
+
+    def cut(rows):
+        return [[value[:23] if isinstance(value, str) and value[:2] == "20" else value for value in row]
+                for row in rows]
+
+    metrics = {key: cut(rows) for key, rows in db_interface.read_metrics().items()}
+    window = {key: cut(rows) for key, rows in db_interface.read_metrics(0, "2025-01-01 10", "2025-01-02").items()}
+    devices = [(device["key"], device["first"][:23], device["last"][:23]) for device in db_interface.read_devices()]
+    processes = cut(db_interface.read_processes())
+    pages = [cut(db_interface.read_process_page(0, 3, 5, column, direction)[2])
+             for column in range(5) for direction in ("asc", "desc")]
+    search = db_interface.read_process_page(0, 0, 100, 0, "asc", "2025-01-01 02")
+    ranges = [db_interface.read_metric_range("test_cpu", "usage", start, end)
+              for start, end in [(None, None), ("2025-01-01 03:00", "2025-01-01 05:00:00")]]
+    ranges = [(series["resolution"], cut(series["points"])) for series in ranges]
+    db_interface.close_pools()
+    return metrics, window, devices, processes, pages, (search[0], search[1], cut(search[2])), ranges
+
+
+class ConvertTestCase(unittest.TestCase):
+    """Testcase for converting a v1 database to the compact v2 layout"""
+
+    def setUp(self):
+        """A copy of a sample database, so the real one is never touched"""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmp_dir, "metrics.db")
+        self.target = os.path.join(self.tmp_dir, "metrics-v2.db")
+        shutil.copyfile(os.path.join(os.path.dirname(__file__), "sample_dbs", "normal.db"), self.source)
+        self.environ = mock.patch.dict(os.environ)
+        self.environ.start()
+
+    def tearDown(self):
+        """Close everything and clean up"""
+        db_interface.close_pools()
+        self.environ.stop()
+        db_interface.set_path_config()
+        shutil.rmtree(self.tmp_dir)
+
+    def query(self, db, sql):
+        conn = sqlite3.connect(db)
+        try:
+            return conn.execute(sql).fetchall()
+        finally:
+            conn.close()
+
+    def test_convert(self):
+        """Every row is copied into integer timestamps, WITHOUT ROWID tables and one retention batch"""
+        counts = schema_v2.convert(self.source, self.target, chunk_rows=7)
+        self.assertEqual(counts, {"component": 4, "component_statistic": 100, "process": 225, "skipped": 0})
+
+        conn = sqlite3.connect(self.target)
+        self.assertEqual(schema_v2.get_layout(conn), schema_v2.LAYOUT_V2)
+        self.assertEqual(db_interface.get_schema_version(conn), db_interface.MIGRATIONS[-1][0])
+        self.assertEqual(conn.execute("SELECT lifetime_ms FROM retention").fetchall(), [(365 * schema_v2.DAY_MS,)])
+        self.assertEqual(conn.execute("SELECT typeof(timestamp), COUNT(*) FROM component_statistic "
+                                      "GROUP BY 1").fetchall(), [("integer", 100)])
+        sql = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'component_statistic'").fetchone()[0]
+        self.assertIn("WITHOUT ROWID", sql)
+        conn.close()
+
+        # The source is left as it was.
+        self.assertEqual(self.query(self.source, "SELECT COUNT(*) FROM sqlite_master WHERE name = 'retention'"),
+                         [(0,)])
+
+    def test_reads_match(self):
+        """The pages show the same thing from either layout"""
+        schema_v2.convert(self.source, self.target)
+        before = read_everything(self.source)
+        after = read_everything(self.target)
+        for old, new in zip(before, after):
+            self.assertEqual(old, new)
+
+    def test_bad_timestamps_skipped(self):
+        """Rows whose timestamps can't be read are counted, not copied"""
+        conn = sqlite3.connect(self.source)
+        conn.execute("INSERT INTO process VALUES (1, 'yesterday', 1, 1, '2030-01-01')")
+        conn.commit()
+        conn.close()
+
+        counts = schema_v2.convert(self.source, self.target)
+        self.assertEqual(counts["skipped"], 1)
+        self.assertEqual(counts["process"], 225)
+
+    def test_rows_added_while_converting(self):
+        """Rows the collector writes during the copy are picked up by the catch up pass"""
+        copy_rows = schema_v2.copy_rows
+        written = []
+
+        def collector_writes(*args, **kwargs):
+            if not written:
+                conn = sqlite3.connect(self.source)
+                conn.execute("INSERT INTO component_statistic VALUES "
+                             "('test_cpu', '2025-02-01 00:00:00.000000', 'Active', 1, 2, 3, 4, 5, 6, "
+                             "'2026-02-01 00:00:00.000000')")
+                conn.commit()
+                conn.close()
+                written.append(True)
+            return copy_rows(*args, **kwargs)
+
+        with mock.patch.object(schema_v2, "copy_rows", side_effect=collector_writes):
+            counts = schema_v2.convert(self.source, self.target)
+
+        self.assertEqual(counts["component_statistic"], 101)
+        self.assertEqual(self.query(self.target, "SELECT MAX(timestamp) FROM component_statistic"),
+                         [(schema_v2.to_ms(datetime.datetime(2025, 2, 1)),)])
+
+    def test_replace(self):
+        """--replace puts the new database in place and keeps the old one, without looking like a backup"""
+        schema_v2.convert(self.source, self.target, replace=True)
+        self.assertFalse(os.path.exists(self.target))
+        self.assertTrue(os.path.exists(os.path.join(self.tmp_dir, "metrics-v1.db")))
+        self.assertEqual(self.query(self.source, "SELECT name FROM sqlite_master WHERE name = 'retention'"),
+                         [("retention",)])
+        self.assertEqual(glob.glob(self.source + ".*"), [])
+
+    def test_refuses_to_overwrite(self):
+        """An existing target, or a source that's already v2, is an error and leaves no files behind"""
+        schema_v2.convert(self.source, self.target)
+        with self.assertRaises(FileExistsError):
+            schema_v2.convert(self.source, self.target)
+        with self.assertRaises(ValueError):
+            schema_v2.convert(self.target, os.path.join(self.tmp_dir, "again.db"))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, "again.db")))
+
+    def test_report(self):
+        """The report has the size and the read speeds of either layout"""
+        schema_v2.convert(self.source, self.target)
+        for db, layout in [(self.source, schema_v2.LAYOUT_V1), (self.target, schema_v2.LAYOUT_V2)]:
+            report = schema_v2.report(db)
+            self.assertEqual(report["layout"], layout)
+            self.assertEqual(report["statistic_rows"], 100)
+            self.assertEqual(report["process_rows"], 225)
+            self.assertGreater(report["bytes"], 0)
+            # normal.db has a row an hour, so the last day of test_cpu is 25 rows.
+            self.assertEqual(report["window_rows"], 25)
+
+
+class LayoutTestCase(unittest.TestCase):
+    """Testcase for using a v2 database directly"""
+
+    def setUp(self):
+        """An empty database that will be created as v2"""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_name = os.path.join(self.tmp_dir, "metrics.db")
+        self.environ = mock.patch.dict(os.environ, {schema_v2.LAYOUT_ENV: "2"})
+        self.environ.start()
+        db_interface.set_path_config(database=self.db_name)
+
+    def tearDown(self):
+        """Close everything and clean up"""
+        live_feed._FEEDS.clear()
+        db_interface.close_pools()
+        self.environ.stop()
+        db_interface.set_path_config()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_new_database(self):
+        """MTG_SCHEMA=2 makes new databases v2, existing ones keep their layout"""
+        db_interface.check_db()
+        self.assertEqual(db_interface.get_layout(), schema_v2.LAYOUT_V2)
+        self.assertEqual(db_interface.read_metrics(), {"No Components Found": [0]})
+
+        db_interface.close_pools()
+        os.environ[schema_v2.LAYOUT_ENV] = "1"
+        self.assertEqual(db_interface.get_layout(), schema_v2.LAYOUT_V2)
+        self.assertEqual(db_interface.get_layout(1), schema_v2.LAYOUT_V1)
+
+    def test_collector(self):
+        """The python collector writes v2 rows, which read back like v1 ones"""
+        collector = psutil_collector.Collector(datetime.timedelta(days=30), interval=1,
+                                               reader=mock.Mock(read=lambda: [(100, 1.5, 20.0)]))
+        collector.sample(NOW)
+        collector.flush()
+
+        conn = sqlite3.connect(self.db_name)
+        self.assertEqual(conn.execute("SELECT pid, timestamp, batch FROM process").fetchall(),
+                         [(100, schema_v2.to_ms(NOW), 1)])
+        self.assertEqual(conn.execute("SELECT lifetime_ms FROM retention").fetchall(), [(30 * schema_v2.DAY_MS,)])
+        conn.close()
+
+        self.assertEqual(db_interface.read_processes(),
+                         [(100, "2025-06-01 12:00:00.000", 1.5, 20.0, "2025-07-01 12:00:00.000")])
+        self.assertEqual(db_interface.count_processes(), 1)
+
+    def test_prune(self):
+        """Rows go when they're older than max_age or their batch's lifetime has run out"""
+        db_interface.check_db()
+        conn = sqlite3.connect(self.db_name)
+        with conn:
+            keep = schema_v2.retention_batch(conn, 300 * schema_v2.DAY_MS)
+            expired = schema_v2.retention_batch(conn, 4 * schema_v2.DAY_MS)
+            conn.executemany("INSERT INTO component VALUES (?, 'CPU', 0, 0, 0)", [("keep_cpu",), ("old_cpu",)])
+            rows = []
+            for i in range(50):
+                rows.append(("old_cpu", stamp(40 + i / 100), "Active", 1, 1, 1, 1, 1, 1, keep))
+                rows.append(("keep_cpu", stamp(5 + i / 100), "Active", 1, 1, 1, 1, 1, 1, expired))
+                rows.append(("keep_cpu", stamp(1 + i / 100), "Active", 1, 1, 1, 1, 1, 1, keep))
+            conn.executemany(schema_v2.STATISTIC_INSERT, rows)
+            conn.executemany(schema_v2.PROCESS_INSERT, [(pid, stamp(days), 1, 1, keep)
+                                                        for pid in range(20) for days in (60, 2)])
+
+        stats = db_interface.prune_database(datetime.timedelta(days=30), batch_size=7, yield_interval=0, now=NOW)
+        self.assertEqual(stats["deleted"], {"component_statistic": 100, "process": 20, "component": 1})
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM component_statistic").fetchone()[0], 50)
+        self.assertEqual(db_interface.prune_database(datetime.timedelta(days=30), now=NOW)["rows"], 0)
+        conn.close()
+
+    def test_live_feed(self):
+        """The live feed uses the timestamp as the id, since there's no rowid"""
+        db_interface.check_db()
+        conn = sqlite3.connect(self.db_name)
+
+        def insert(serial_number, second):
+            with conn:
+                conn.execute(schema_v2.STATISTIC_INSERT, (serial_number, f"2025-01-01 00:00:{second:02d}.000000",
+                                                          "Active", 40, second, 10, 0, 0, 0, 1))
+
+        insert("old_cpu", 0)
+        feed = live_feed.LiveFeed(0, interval=3600)
+        subscriber = feed.subscribe()
+        insert("test_cpu", 1)
+        insert("test_gpu", 1)
+        insert("test_cpu", 2)
+        self.assertEqual(feed.poll(), 3)
+        self.assertEqual(feed.poll(), 0)
+
+        rows = subscriber.batches.get_nowait()
+        self.assertEqual([(row["serial_number"], row["timestamp"]) for row in rows],
+                         [("test_cpu", "2025-01-01 00:00:01.000"), ("test_gpu", "2025-01-01 00:00:01.000"),
+                          ("test_cpu", "2025-01-01 00:00:02.000")])
+
+        # A reconnect with the id of the first second gets the rest.
+        reconnected = feed.subscribe(last_id=rows[0]["rowid"])
+        self.assertEqual([row["usage"] for row in reconnected.batches.get_nowait()], [2])
+        conn.close()
+
+    def test_live_feed_limit(self):
+        """A component with more than a poll's worth of new rows never makes the others skip any"""
+        db_interface.check_db()
+        conn = sqlite3.connect(self.db_name)
+        feed = live_feed.LiveFeed(0, interval=3600)
+        subscriber = feed.subscribe()
+        with conn:
+            conn.executemany(schema_v2.STATISTIC_INSERT,
+                             [(serial, f"2025-01-01 00:00:{second:02d}", "Active", 1, second, 1, 1, 1, 1, 1)
+                              for second in range(5) for serial in ("busy", "quiet")])
+
+        with mock.patch.object(live_feed, "MAX_ROWS_PER_POLL", 3):
+            self.assertEqual(feed.poll(), 6)
+            self.assertEqual(feed.poll(), 4)
+        seconds = [(row["serial_number"], row["usage"]) for batch in (subscriber.batches.get_nowait(),
+                                                                      subscriber.batches.get_nowait())
+                   for row in batch]
+        self.assertEqual(sorted(seconds), sorted((serial, second) for second in range(5)
+                                                 for serial in ("busy", "quiet")))
+        conn.close()
+
+
+class BoundTestCase(unittest.TestCase):
+    """Testcase for turning the browser's timestamps into milliseconds"""
+
+    def test_bounds(self):
+        """An upper bound covers everything the timestamp could mean, like the v1 string compare"""
+        hour = schema_v2.to_ms(datetime.datetime(2025, 4, 17, 18))
+        self.assertEqual(schema_v2.bound_ms("2025-04-17T18"), hour)
+        self.assertEqual(schema_v2.bound_ms("2025-04-17 18", upper=True), hour + 3600000 - 1)
+        self.assertEqual(schema_v2.bound_ms("2025-04-17 18:17:30.9250629"), hour + (17 * 60 + 30) * 1000 + 925)
+        self.assertEqual(schema_v2.bound_ms("2025-12", upper=True),
+                         schema_v2.to_ms(datetime.datetime(2026, 1, 1)) - 1)
+        self.assertIsNone(schema_v2.bound_ms(""))
+        with self.assertRaises(ValueError):
+            schema_v2.bound_ms("\U0001F527")
+
+    def test_process_search(self):
+        """The process table's search turns into a millisecond range on v2"""
+        day = schema_v2.to_ms(datetime.datetime(2025, 4, 17))
+        self.assertEqual(db_interface.process_search("2025-04-17", schema_v2.LAYOUT_V2),
+                         ("WHERE timestamp >= ? AND timestamp <= ?", [day, day + schema_v2.DAY_MS - 1]))
+        self.assertEqual(db_interface.process_search("12", schema_v2.LAYOUT_V2), ("WHERE pid = ?", [12]))
+        self.assertEqual(db_interface.process_search("soon", schema_v2.LAYOUT_V2), ("WHERE 0", []))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+###########################################################################################
+# File: stub_metrics.py                                                                   #
+# Purpose: Stands in for OpenHardwareMonitor.exe in the tests, so the collect and prune   #
+#          jobs can be run on linux. Point MTG_METRICS_EXE at this file.                  #
+#                                                                                         #
+#          MTG_STUB_SLEEP   seconds to take, to act like a long prune.                    #
+#          MTG_STUB_EXIT    exit code to finish with, to act like a failed run.           #
+#                                                                                         #
+# v1.1.0 Initial version.                                                                 #
+###########################################################################################
+
+import os
+import sys
+import time
+
+if __name__ == "__main__":
+    time.sleep(float(os.environ.get("MTG_STUB_SLEEP", "0")))
+
+    # Print the same as the real executable does.
+    if "prune-now" in sys.argv:
+        print(f"Pruned data older than {' '.join(sys.argv[sys.argv.index('--lifetime') + 1:])}.")
+    else:
+        print(f"Data lifetime set to: {sys.argv[-1]}")
+
+    exit_code = int(os.environ.get("MTG_STUB_EXIT", "0"))
+    if exit_code:
+        print("Stub failure", file=sys.stderr)
+    sys.exit(exit_code)
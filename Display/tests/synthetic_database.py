@@ -0,0 +1,84 @@
+import unittest
+from unittest import mock
+import datetime
+import sqlite3
+import shutil
+import tempfile
+import sys
+import os
+
+# Get the path of the directory above the test file and insert it into our path.
+# This is where db_interface lives, which we need to import to test.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+# The generator lives with the benchmarks.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'benchmarks')))
+
+import db_interface
+import synthetic_data
+
+
+class SyntheticDataTestCase(unittest.TestCase):
+    """Testcase for the benchmark database generator"""
+
+    def setUp(self):
+        """A small database in a temporary directory"""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_name = os.path.join(self.tmp_dir, "metrics.db")
+        self.start = datetime.datetime(2025, 1, 1)
+        self.counts = synthetic_data.generate_database(self.db_name, 400, processes=5, start=self.start, seed=3)
+        self.conn = sqlite3.connect(self.db_name)
+
+        self.environ = mock.patch.dict(os.environ)
+        self.environ.start()
+        db_interface.set_path_config(database=self.db_name)
+
+    def tearDown(self):
+        """Close everything and clean up"""
+        db_interface.close_pools()
+        self.environ.stop()
+        db_interface.set_path_config()
+        self.conn.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_row_counts(self):
+        """One row per device per sample, and the asked for number of processes per sample"""
+        self.assertEqual(self.counts, (400, 500))
+        self.assertEqual(self.conn.execute("SELECT COUNT(*) FROM component").fetchone()[0], 4)
+        self.assertEqual(self.conn.execute("SELECT COUNT(*) FROM component_statistic").fetchone()[0], 400)
+        self.assertEqual(self.conn.execute("SELECT COUNT(*) FROM process").fetchone()[0], 500)
+        self.assertEqual(self.conn.execute("SELECT COUNT(DISTINCT timestamp) FROM process").fetchone()[0], 100)
+
+    def test_timestamps(self):
+        """Timestamps are 30 seconds apart, written like the collector writes them"""
+        first, last = self.conn.execute("SELECT MIN(timestamp), MAX(timestamp) FROM component_statistic").fetchone()
+        self.assertEqual(first, "2025-01-01 00:00:00.0000000")
+        self.assertEqual(last, "2025-01-01 00:49:30.0000000")
+        end_of_life = self.conn.execute("SELECT MIN(end_of_life) FROM component_statistic").fetchone()[0]
+        self.assertEqual(end_of_life, "2026-01-01 00:00:00.0000000")
+
+    def test_values(self):
+        """Usage stays a percentage and the database is at the latest schema"""
+        low, high = self.conn.execute("SELECT MIN(usage), MAX(usage) FROM component_statistic").fetchone()
+        self.assertGreaterEqual(low, 0)
+        self.assertLessEqual(high, 100)
+        self.assertEqual(db_interface.get_schema_version(self.conn), len(db_interface.MIGRATIONS))
+
+    def test_same_seed(self):
+        """The same seed gives the same rows"""
+        other = os.path.join(self.tmp_dir, "other.db")
+        synthetic_data.generate_database(other, 400, processes=5, start=self.start, seed=3)
+        conn = sqlite3.connect(other)
+        query = "SELECT * FROM component_statistic ORDER BY rowid"
+        self.assertEqual(conn.execute(query).fetchall(), self.conn.execute(query).fetchall())
+        conn.close()
+
+    def test_readable(self):
+        """The app can read what was generated"""
+        metrics = db_interface.read_metrics()
+        self.assertEqual(sorted(metrics), sorted(f"{serial} ({device_type})" for serial, device_type, *_ in
+                                                 synthetic_data.DEVICE_MIXES["nvidia"]))
+        self.assertEqual(db_interface.count_processes(), 500)
+
+
+if __name__ == '__main__':
+    unittest.main()
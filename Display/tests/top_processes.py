@@ -0,0 +1,335 @@
+import unittest
+from unittest import mock
+import datetime
+import random
+import sqlite3
+import shutil
+import tempfile
+import sys
+import os
+
+# Get the path of the directory above the test file and insert it into our path.
+# This is where db_interface and process_analytics live, which we need to import to test.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from metrics_web_server import app
+import db_interface
+import ingest
+import process_analytics
+import schema_v2
+import shards
+
+START = datetime.datetime(2025, 1, 1)
+PIDS = [4, 8, 12, 16, 20, 24]
+
+# Windows that are read raw, from the hourly/daily summaries with raw rows either side, and open ended.
+WINDOWS = [
+    (None, None),
+    ("2025-01-02T05:30", "2025-01-08T17:45"),
+    ("2025-01-01T01:00", "2025-01-01T03:00"),
+    ("2025-01-03T10:20", "2025-01-04T09:10"),
+    (None, "2025-01-05"),
+    ("2025-01-04T12:34:56", None),
+    ("2025-02-01", None),
+]
+
+
+class TopProcessesTestCase(unittest.TestCase):
+    """Testcase for the top processes over a window (read_top_processes and /api/processes/top)"""
+
+    def setUp(self):
+        """A migrated database with 10 days of random process samples, every 7 minutes"""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_name = os.path.join(self.tmp_dir, "metrics.db")
+        conn = sqlite3.connect(self.db_name)
+        db_interface.create_mtg_database(conn)
+        db_interface.migrate_database(conn)
+
+        generator = random.Random(711)
+        self.rows = []
+        for i in range(10 * 24 * 60 // 7):
+            timestamp = (START + datetime.timedelta(minutes=7 * i)).strftime("%Y-%m-%d %H:%M:%S.0000000")
+            # Not every pid is running at every sample.
+            for pid in generator.sample(PIDS, 4):
+                # Every so often the cpu usage isn't a number, which is left out of its average.
+                cpu = "😄" if i % 89 == 0 else round(generator.uniform(0, pid * 2), 2)
+                self.rows.append((pid, timestamp, cpu, round(generator.lognormvariate(3, 1), 2),
+                                  "2030-01-01 00:00:00.000000"))
+        conn.executemany("INSERT INTO process VALUES (?, ?, ?, ?, ?)", self.rows)
+        conn.commit()
+        conn.close()
+
+        self.environ = mock.patch.dict(os.environ)
+        self.environ.start()
+        db_interface.set_path_config(database=self.db_name)
+
+    def tearDown(self):
+        """Close everything and clean up"""
+        db_interface.close_pools()
+        self.environ.stop()
+        db_interface.set_path_config()
+        process_analytics._LAST_REFRESH.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def expected(self, start, end, metric, stat, limit):
+        """Works the top pids out in python from every row in the window."""
+        start = db_interface.normalize_timestamp(start)
+        end = db_interface.normalize_timestamp(end, upper=True)
+        index = {"cpu": 2, "memory": 3}[metric]
+        by_pid = {}
+        for row in self.rows:
+            if (not start or row[1] >= start) and (not end or row[1] <= end):
+                by_pid.setdefault(row[0], []).append(row)
+
+        top = []
+        for pid, rows in by_pid.items():
+            values = [row[index] for row in rows if isinstance(row[index], float)]
+            rank = max(values) if stat == "max" else sum(values) / len(values)
+            top.append((-rank, pid, len(rows), rank))
+        return [(pid, samples, rank) for _, pid, samples, rank in sorted(top)[:limit]]
+
+    def check(self, start, end, metric="cpu", stat="avg", limit=4):
+        top = db_interface.read_top_processes(0, start, end, metric, stat, limit)
+        expected = self.expected(start, end, metric, stat, limit)
+        self.assertEqual([(process["pid"], process["samples"]) for process in top["processes"]],
+                         [(pid, samples) for pid, samples, _ in expected])
+        for process, (_, _, rank) in zip(top["processes"], expected):
+            self.assertAlmostEqual(process[metric][stat], rank, places=6)
+        return top
+
+    def test_matches_python(self):
+        """Every window and ranking gives the same pids and numbers as working them out from every row"""
+        for start, end in WINDOWS:
+            for metric in process_analytics.METRICS:
+                for stat in process_analytics.STATS:
+                    with self.subTest(start=start, end=end, metric=metric, stat=stat):
+                        self.check(start, end, metric, stat)
+
+    def test_long_window_uses_summaries(self):
+        """A long window reads whole days and hours from the summaries, and only the raw rows at either end"""
+        self.assertEqual(self.check(*WINDOWS[1])["resolution"], "daily")
+        self.assertEqual(self.check(*WINDOWS[3])["resolution"], "hourly")
+        self.assertEqual(self.check("2025-01-01T01:10", "2025-01-01T01:50")["resolution"], "raw")
+
+        # Rows added since the summaries were refreshed are still counted, they're after the last bucket.
+        conn = sqlite3.connect(self.db_name)
+        row = (4, "2025-01-11 00:00:01.0000000", 99.5, 1.0, "2030-01-01 00:00:00.000000")
+        conn.execute("INSERT INTO process VALUES (?, ?, ?, ?, ?)", row)
+        conn.commit()
+        conn.close()
+        self.rows.append(row)
+        self.check(None, None, "cpu", "max")
+
+    def test_incremental_refresh(self):
+        """Only new rows are summarized, a chunk at a time, and give the same summaries as one go"""
+        with db_interface.connect() as conn:
+            self.assertEqual(process_analytics.refresh(conn), len(self.rows))
+            self.assertEqual(process_analytics.refresh(conn), 0)
+            whole = conn.execute(f"SELECT * FROM {process_analytics.HOURLY} ORDER BY 1, 2, 3").fetchall()
+            days = conn.execute(f"SELECT * FROM {process_analytics.DAILY} ORDER BY 1, 2, 3").fetchall()
+            self.assertEqual(len(days), 10 * len(PIDS))
+            self.assertEqual(sum(day[3] for day in days), len(self.rows))
+
+            conn.execute(f"DELETE FROM {process_analytics.HOURLY}")
+            conn.execute(f"DELETE FROM {process_analytics.DAILY}")
+            conn.execute("DELETE FROM rollup_state WHERE name = 'process'")
+            conn.commit()
+            self.assertEqual(process_analytics.refresh(conn, chunk_rows=1000), len(self.rows))
+            self.assertEqual(conn.execute(f"SELECT * FROM {process_analytics.HOURLY} ORDER BY 1, 2, 3").fetchall(),
+                             whole)
+            self.assertEqual(conn.execute(f"SELECT * FROM {process_analytics.DAILY} ORDER BY 1, 2, 3").fetchall(),
+                             days)
+
+            # Pruned rows take their buckets with them.
+            conn.execute("DELETE FROM process WHERE timestamp < '2025-01-03'")
+            conn.commit()
+            process_analytics.refresh(conn)
+            oldest = conn.execute(f"SELECT MIN(bucket) FROM {process_analytics.DAILY}").fetchone()[0]
+            self.assertEqual(oldest, "2025-01-03 00:00:00")
+
+    def test_prune_into_a_bucket(self):
+        """A prune that cuts into an hour and a day has them recomputed from the rows that are left"""
+        with db_interface.connect() as conn:
+            process_analytics.refresh(conn)
+            conn.execute("DELETE FROM process WHERE timestamp < '2025-01-03 05:30'")
+            conn.commit()
+            self.assertEqual(process_analytics.refresh(conn), 0)
+
+            for table, bucket, end in [(process_analytics.HOURLY, "2025-01-03 05:00:00", "2025-01-03 06:00"),
+                                       (process_analytics.DAILY, "2025-01-03 00:00:00", "2025-01-04")]:
+                first = conn.execute(f"SELECT bucket, SUM(samples) FROM {table} GROUP BY 1 ORDER BY 1").fetchone()
+                samples = len([row for row in self.rows if "2025-01-03 05:30" <= row[1] < end])
+                self.assertEqual(first, (bucket, samples))
+
+            # Once every raw row has gone, so have the summaries.
+            conn.execute("DELETE FROM process")
+            conn.commit()
+            process_analytics.refresh(conn)
+            for table in [process_analytics.HOURLY, process_analytics.DAILY]:
+                self.assertEqual(conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0], 0)
+
+    def assertMatchesRaw(self, conn):
+        for table, bucket_format in process_analytics.BUCKET_FORMATS.items():
+            summarized = conn.execute(f"SELECT bucket, pid, samples FROM {table} ORDER BY 1, 2").fetchall()
+            raw = conn.execute(f"""SELECT strftime('{bucket_format}', timestamp), pid, COUNT(*)
+                                   FROM process GROUP BY 1, 2 ORDER BY 1, 2""").fetchall()
+            self.assertEqual(summarized, raw)
+
+    def test_prune_middle_and_end(self):
+        """Deleting rows from the middle and end of the table recomputes their buckets, and new rows
+        that get the deleted rows' rowids, or that follow a delete done elsewhere, are still summarized"""
+        with db_interface.connect() as conn:
+            process_analytics.refresh(conn)
+            with conn:
+                for where in ["timestamp >= '2025-01-04 03:00' AND timestamp < '2025-01-04 05:30'",
+                              "timestamp >= '2025-01-10 20:00'"]:
+                    self.assertGreater(process_analytics.PROCESS_SUMMARIES.delete_rows(conn, where), 0)
+            self.assertMatchesRaw(conn)
+
+            row = (4, "2025-01-10 21:00:01.0000000", 99.5, 1.0, "2030-01-01 00:00:00.000000")
+            conn.execute("INSERT INTO process VALUES (?, ?, ?, ?, ?)", row)
+            conn.commit()
+            self.assertEqual(process_analytics.refresh(conn), 1)
+            self.assertMatchesRaw(conn)
+
+            # The executable's prune doesn't recompute anything, so the summaries are rebuilt.
+            conn.execute("DELETE FROM process WHERE timestamp >= '2025-01-10'")
+            conn.commit()
+            conn.execute("INSERT INTO process VALUES (?, ?, ?, ?, ?)", row)
+            conn.commit()
+            process_analytics.refresh(conn)
+            self.assertMatchesRaw(conn)
+
+    def test_sparklines(self):
+        """Each pid's sparkline is the average in equal slices of the window, with gaps where it wasn't running"""
+        # pid 24 stopped running part way through.
+        conn = sqlite3.connect(self.db_name)
+        conn.execute("DELETE FROM process WHERE pid = 24 AND timestamp >= '2025-01-06'")
+        conn.commit()
+        conn.close()
+        self.rows = [row for row in self.rows if row[0] != 24 or row[1] < "2025-01-06"]
+
+        start, end = "2025-01-03T00:00", "2025-01-03T07:59:59"
+        top = db_interface.read_top_processes(0, start, end, "memory", "avg", 2, points=8)
+        self.assertEqual(top["sparkline"]["resolution"], "raw")
+        self.assertEqual(top["sparkline"]["points"], 8)
+        for process in top["processes"]:
+            expected = []
+            for hour in range(8):
+                prefix = f"2025-01-03 0{hour}"
+                values = [row[3] for row in self.rows if row[0] == process["pid"] and row[1].startswith(prefix)]
+                expected.append(sum(values) / len(values) if values else None)
+            for value, want in zip(process["sparkline"], expected):
+                self.assertAlmostEqual(value, want, places=6)
+
+        # A long window reads the hourly summaries. The pid that stopped running has gaps after that.
+        top = db_interface.read_top_processes(0, None, None, "cpu", "max", 1)
+        self.assertEqual(top["sparkline"]["resolution"], "hourly")
+        line = top["processes"][0]["sparkline"]
+        self.assertEqual((top["processes"][0]["pid"], len(line)), (24, process_analytics.SPARKLINE_POINTS))
+        self.assertTrue(all(value is not None for value in line[:20]))
+        self.assertTrue(all(value is None for value in line[-20:]))
+        self.assertEqual(max(value for value in line if value is not None), top["processes"][0]["cpu"]["max"])
+
+    def test_sharded(self):
+        """The top pids are the same from daily shards, however many can be attached at once"""
+        shards.split(self.db_name, "day")
+        db_interface.close_pools()
+        for start, end in WINDOWS[:4]:
+            with self.subTest(start=start, end=end):
+                self.check(start, end)
+                self.check(start, end, "memory", "max")
+        with mock.patch.object(shards, "attach_limit", return_value=3):
+            self.check(*WINDOWS[1])
+
+    def test_v2(self):
+        """The compact layout gives the same top pids, from the raw rows"""
+        target = os.path.join(self.tmp_dir, "metrics-v2.db")
+        schema_v2.convert(self.db_name, target)
+        db_interface.set_path_config(database=target)
+        for start, end in WINDOWS[:4]:
+            with self.subTest(start=start, end=end):
+                self.assertEqual(self.check(start, end)["resolution"], "raw")
+        self.assertEqual(db_interface.read_top_processes(0, "not a time")["processes"], [])
+
+    def test_api(self):
+        """/api/processes/top sends the top pids back as json, and the process page has the panel"""
+        client = app.test_client()
+        response = client.get("/api/processes/top", query_string={"start": "2025-01-02", "metric": "memory",
+                                                                   "by": "max", "limit": 3})
+        self.assertEqual(response.status_code, 200)
+        top = response.get_json()
+        self.assertEqual((top["metric"], top["by"], len(top["processes"])), ("memory", "max", 3))
+        self.assertEqual(len(top["processes"][0]["sparkline"]), process_analytics.SPARKLINE_POINTS)
+
+        for query in [{"metric": "emoji"}, {"by": "median"}, {"limit": 0}, {"limit": "lots"},
+                      {"limit": process_analytics.MAX_LIMIT + 1}]:
+            with self.subTest(query=query):
+                self.assertEqual(client.get("/api/processes/top", query_string=query).status_code, 400)
+        with self.assertRaises(ValueError):
+            db_interface.read_top_processes(0, metric="emoji")
+
+        page = client.post("/proc_table").get_data(as_text=True)
+        self.assertIn('id="top-table"', page)
+
+    def test_sample_databases(self):
+        """The test databases don't have the summaries, so they're read raw"""
+        top = db_interface.read_top_processes(2, limit=3)
+        self.assertEqual(top["resolution"], "raw")
+        self.assertEqual([process["pid"] for process in top["processes"]], [1, 2, 3])
+        self.assertEqual(db_interface.read_top_processes(3)["processes"], [])
+
+
+class CentralTopProcessesTestCase(unittest.TestCase):
+    """Testcase for the top processes of one host in a central database"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.central = os.path.join(self.tmp_dir, "central.db")
+        # Only the lab27 sample has processes. A copy of it is a second machine running the same pids.
+        source = os.path.join(os.path.dirname(__file__), "..", "..", "lab_metrics3-27.db")
+        copy = os.path.join(self.tmp_dir, "lab28.db")
+        shutil.copyfile(source, copy)
+        self.sources = [("lab27", source), ("lab28", copy)]
+        self.environ = mock.patch.dict(os.environ)
+        self.environ.start()
+
+    def tearDown(self):
+        """Close everything and clean up"""
+        db_interface.close_pools()
+        self.environ.stop()
+        db_interface.set_path_config()
+        process_analytics._LAST_REFRESH.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_filter_by_host(self):
+        """Each host's pids are ranked on their own, the summaries keep the hosts apart"""
+        ingest.ingest(self.central, self.sources, workers=1)
+        db_interface.set_path_config(database=self.central)
+
+        conn = sqlite3.connect(self.central)
+        expected = conn.execute("""SELECT pid, COUNT(*), AVG(cpu_usage) AS rank
+                                   FROM process
+                                   WHERE host = 'lab27'
+                                   GROUP BY pid
+                                   ORDER BY rank DESC, pid
+                                   LIMIT 5""").fetchall()
+        conn.close()
+        top = db_interface.read_top_processes(0, limit=5, host="lab27")
+        self.assertEqual([(process["host"], process["pid"], process["samples"]) for process in top["processes"]],
+                         [("lab27", pid, samples) for pid, samples, _ in expected])
+        for process, (_, _, rank) in zip(top["processes"], expected):
+            self.assertAlmostEqual(process["cpu"]["avg"], rank, places=6)
+
+        # Without a host, each machine's pids are ranked separately.
+        top = db_interface.read_top_processes(0, limit=4)
+        self.assertEqual([(process["host"], process["pid"]) for process in top["processes"]],
+                         [(host, pid) for pid, _, _ in expected[:2] for host in ["lab27", "lab28"]])
+        with db_interface.connect() as conn:
+            process_analytics.refresh(conn)
+            hosts = [row[0] for row in conn.execute(f"SELECT DISTINCT host FROM {process_analytics.HOURLY}")]
+        self.assertEqual(sorted(hosts), ["lab27", "lab28"])
+
+
+if __name__ == '__main__':
+    unittest.main()
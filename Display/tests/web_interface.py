@@ -9,6 +9,7 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')
 
 # Import the app from the web app file.
 from metrics_web_server import app
+import db_interface
 
 
 # Set up the test suite for the web interface.
@@ -54,6 +55,68 @@ class FlaskAppTestCase(unittest.TestCase):
             self.assertEqual(response.status_code, 200)
             self.assertIn(b"<html", response.data.lower())
 
+    def test_api_metrics_route(self):
+        """Test the json metrics api"""
+        # debug:6 means testing the corrupted database. Should return an error.
+        if self.debug == 6:
+            with self.assertRaises(sqlite3.DatabaseError):
+                self.client.get("/api/metrics", query_string={"debug": self.debug, "serial_number": "test_cpu"})
+            return
+
+        # Ask for the first device in the database, if there is one.
+        devices = db_interface.read_devices(self.debug)
+        serial_number = devices[0]["serial_number"] if devices else "test_cpu"
+        response = self.client.get("/api/metrics", query_string={"debug": self.debug,
+                                                                 "serial_number": serial_number,
+                                                                 "column": "usage",
+                                                                 "max_points": 10})
+        self.assertEqual(response.status_code, 200)
+
+        # We should never get back more points than we asked for.
+        points = response.get_json()["points"]
+        self.assertLessEqual(len(points), 10)
+        if devices:
+            self.assertGreater(len(points), 0)
+
+        # An unknown column should be rejected rather than put into the SQL.
+        response = self.client.get("/api/metrics", query_string={"debug": self.debug, "column": "pid; DROP"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_api_processes_route(self):
+        """Test the DataTables process api"""
+        # debug:6 means testing the corrupted database. Should return an error.
+        if self.debug == 6:
+            with self.assertRaises(sqlite3.DatabaseError):
+                self.client.get("/api/processes", query_string={"debug": self.debug})
+            return
+
+        response = self.client.get("/api/processes", query_string={"debug": self.debug, "draw": 3,
+                                                                   "start": 0, "length": 5,
+                                                                   "order[0][column]": 2,
+                                                                   "order[0][dir]": "desc"})
+        self.assertEqual(response.status_code, 200)
+
+        # draw is echoed back and we never get more than a page of rows.
+        body = response.get_json()
+        self.assertEqual(body["draw"], 3)
+        self.assertLessEqual(len(body["data"]), 5)
+        self.assertEqual(body["recordsTotal"], body["recordsFiltered"])
+        self.assertEqual(len(body["data"]), min(5, body["recordsTotal"]))
+
+    def test_api_live_route(self):
+        """Test the live stream of new rows"""
+        # debug:6 means testing the corrupted database. Should return an error.
+        if self.debug == 6:
+            with self.assertRaises(sqlite3.DatabaseError):
+                self.client.get("/api/live", query_string={"debug": self.debug, "duration": 0.1})
+            return
+
+        # Nothing is being written to the test databases, so we should only get the reconnect time.
+        response = self.client.get("/api/live", query_string={"debug": self.debug, "duration": 0.1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "text/event-stream")
+        self.assertTrue(response.get_data(as_text=True).startswith("retry:"))
+
 
 def load_tests(loader, tests, pattern):
     """Loads the tests into the test suite"""